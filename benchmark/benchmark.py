@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 import sys
 import gc
+import os
 import random
+import bisect
+import threading
+import multiprocessing as mp
+from array import array
 from os import path as op, system
 from functools import wraps
 from typing import Optional
@@ -10,6 +15,10 @@ from typing import Optional
 import click
 
 import proxystore as ps
+import proxystore.proxy
+from proxystore.store.stats import TimeStats
+
+from harness import HEADER, compare, read_samples, write_json
 
 from time import perf_counter_ns
 
@@ -23,22 +32,29 @@ class Benchmark:
         name: str,
         logfile: Optional[None],
         overwrite: bool = True,
+        max_exp: int = 29,
+        warmup: int = 2,
+        samples: int = 5,
         **kwargs,
     ):
         self.cmd = name
         self.logfile = logfile
-        self.proxies = {}
+        self.max_exp = max_exp
+        self.warmup = warmup
+        self.samples = samples
+        # keys written for every object size
+        self.keys = {}
+        # (store function, size) -> mean milliseconds of each phase
+        self.phases = {}
+        # (store, function, size, start, end, duration) of every timed sample
+        self.records = []
 
         if logfile is not None and (overwrite or not op.exists(logfile)):
             # overwrite logfile and write header
             with open(logfile, "w+") as f:
-                f.write("store,function,size,start,end,duration\n")
-        
-        if cmd == "rdma":
-            self.store = self.bench(0)(connect)(name, **kwargs)
+                f.write(HEADER)
 
-        else:
-            self.store = self.bench(0)(connect)(cmd, name, **kwargs)
+        self.store = connect_store(self.bench(0)(connect), cmd, name, kwargs)
 
     def run(self):
         OKGREEN = "\033[92m"
@@ -57,49 +73,78 @@ class Benchmark:
 
             print(f"{OKGREEN}done{OKENDC}")
 
-        print_status(self.write, f"Running {BOLD}write{OKENDC} benchmarks...")
+        try:
+            print_status(self.write, f"Running {BOLD}write{OKENDC} benchmarks...")
 
-        if self.cmd != "local":
-            print_status(self.read, f"Running {BOLD}cached read{OKENDC} benchmarks...", True)
+            if self.cmd != "local":
+                print_status(self.read, f"Running {BOLD}cached read{OKENDC} benchmarks...", True)
 
-            # attempting to remove from caches
-            self.cache_evict()
+                # attempting to remove from caches
+                self.cache_evict()
 
-        print_status(self.read, f"Running {BOLD}read{OKENDC} benchmarks...")
+            print_status(self.read, f"Running {BOLD}read{OKENDC} benchmarks...")
+            self.phases = self.phase_breakdown()
+            print_phases(self.phases)
+        finally:
+            self.flush()
+            # every sample wrote its own object
+            for keys in self.keys.values():
+                for k in keys:
+                    self.store.evict(k)
 
     def write(self):
         min_exp = 10  # approx 1 KB
-        max_exp = 29  # 512MB is the redis string limit, but python strings are never exactly a certain number of bytes
+        # 512MB is the redis string limit, the default for stores bound by it.
+        # The mochi stores move larger objects in chunks, up to tens of GB.
+        max_exp = self.max_exp
 
         for i in (2**i for i in range(min_exp, max_exp)):
             data = "a" * i
 
             b = sys.getsizeof(data)
 
+            for _ in range(self.warmup):
+                self.store.evict(ps.proxy.get_key(self.store.proxy(data)))
+
             @self.bench(size=b)
             def store_data():
                 y = self.store.proxy(data)
                 return y
 
-            y = store_data()
-            self.proxies[y] = b
+            self.keys[b] = [ps.proxy.get_key(store_data()) for _ in range(self.samples)]
 
     def read(self, cached=False):
         suffix = ""
         if cached:
             suffix = "_cached"
-        for k, v in self.proxies.items():
+        cache = getattr(self.store, "_cache", None)
+
+        for v, keys in self.keys.items():
+
+            def resolve(k):
+                # a new proxy for every sample, a proxy resolves only once
+                p = self.store.proxy(key=k)
+                if not cached and cache is not None:
+                    cache.evict(k)
+                return p
 
-            @self.bench(size=v, task_suffix=suffix)
-            def load_proxy():
-                z = len(k)
-                return z
+            for k in keys[: self.warmup]:
+                len(resolve(k))
 
-            z = load_proxy()
+            for k in keys:
+                p = resolve(k)
+
+                @self.bench(size=v, task_suffix=suffix)
+                def load_proxy():
+                    z = len(p)
+                    return z
+
+                load_proxy()
 
     def cache_evict(self):
-        for k, v in self.proxies.items():
-            self.store._cache.evict(k)
+        for keys in self.keys.values():
+            for k in keys:
+                self.store._cache.evict(k)
 
         gc.collect()
 
@@ -109,6 +154,52 @@ class Benchmark:
         except Exception as e:
             print(f"ERROR: unable to drop caches due to -- {str(e)}")
 
+    def flush(self):
+        # one write of the log per run, not one per sample
+        if self.logfile is not None:
+            with open(self.logfile, "a+") as f:
+                for record in self.records:
+                    f.write(",".join(str(v) for v in record) + "\n")
+
+    def phase_breakdown(self):
+        # the stores with stats=True that time the phases of their
+        # operations report them per key, as "<function>.<phase>" events
+        if not getattr(self.store, "has_stats", False) or not hasattr(self.store, "phase_stats"):
+            return {}
+        stores = [self.store]
+        # proxies resolve through the store registered under the same name,
+        # which their factory creates if the benchmark's own store is not
+        registered = ps.store.get_store(self.store.name)
+        if registered is not None and registered is not self.store:
+            stores.append(registered)
+
+        totals = {}
+        for size, keys in self.keys.items():
+            for store, k in ((store, k) for store in stores for k in keys):
+                for event, t in store.stats(k).items():
+                    function, _, phase = event.partition(".")
+                    if phase:
+                        phases = totals.setdefault((function, size), {})
+                        phases[phase] = phases.get(phase, TimeStats()) + t
+        return {
+            group: {phase: t.avg_time_ms for phase, t in phases.items()}
+            for group, phases in totals.items()
+        }
+
+    def results(self):
+        grouped = {}
+        for store, function, size, _, _, duration in self.records:
+            grouped.setdefault((store, function, size), []).append(duration)
+        results = [
+            {"store": store, "function": function, "size": size, "samples": samples}
+            for (store, function, size), samples in grouped.items()
+        ]
+        results += [
+            {"store": self.cmd, "function": f"{function}_phases", "size": size, "phases": phases}
+            for (function, size), phases in self.phases.items()
+        ]
+        return results
+
     def bench(self, size, task_suffix=""):
         cmd = self.cmd
 
@@ -118,40 +209,366 @@ class Benchmark:
                 func_name = f"{func.__name__}{task_suffix}"
 
                 start = perf_counter_ns()
-                func(*args, **kwargs)
+                result = func(*args, **kwargs)
                 end = perf_counter_ns()
                 duration = (end - start) * 10**-9
 
-                # Open the logfile and append
-                if self.logfile is not None:
-                    with open(self.logfile, "a+") as f:
-                        f.write(f"{cmd},{func_name},{size},{start},{end},{duration}\n")
-                else:
+                self.records.append((cmd, func_name, size, start, end, duration))
+                if self.logfile is None:
                     print(
                         f"{self.cmd=}, {func_name=}, {size=}, {start=}, {end=}, {duration=}"
                     )
-                return func(*args, **kwargs)
+                return result
 
             return wrapped_function
 
         return bench_decorator
 
 
+READ, WRITE = 0, 1
+OPS = {"read": (READ,), "write": (WRITE,), "all": (READ, WRITE)}
+PERCENTILES = (0.5, 0.95, 0.99, 0.999)
+LOAD_FIELDS = ("store", "interval", "op", "ops", "ops_per_sec", "gb_per_sec", "p50", "p95", "p99", "p999")
+
+
+def connect_store(connect, cmd, name, kwargs):
+    if cmd == "rdma":
+        return connect(name, **kwargs)
+    return connect(cmd, name, **kwargs)
+
+
+def object_sizes(spec, rng):
+    # one size per key, drawn from the size distribution of the load
+    count, size, dist = spec["keys"], spec["size"], spec["size_dist"]
+    max_size = 2 ** (spec["max_exp"] - 1)
+    if dist == "fixed":
+        sizes = [size] * count
+    elif dist == "uniform":
+        sizes = [rng.randint(spec["min_size"], size) for _ in range(count)]
+    else:
+        # lognormal with a median of size, a few objects are much larger
+        sizes = [int(rng.lognormvariate(0, 1) * size) for _ in range(count)]
+    return [min(max(s, spec["min_size"]), max_size) for s in sizes]
+
+
+def key_picker(spec, rng):
+    count = spec["keys"]
+    if spec["popularity"] == "uniform":
+        return lambda: rng.randrange(count)
+
+    # zipf: key i is drawn with a probability proportional to 1 / (i + 1)^s
+    weights = [1 / (i + 1) ** spec["zipf_s"] for i in range(count)]
+    total = 0.0
+    cumulative = []
+    for w in weights:
+        total += w
+        cumulative.append(total)
+    return lambda: min(bisect.bisect(cumulative, rng.random() * total), count - 1)
+
+
+def load_worker(store, spec, index, keys, sizes, start):
+    """Run reads and writes for spec["duration"] seconds.
+
+    Returns the (op, end, latency, bytes) columns of every operation, end
+    in nanoseconds since the start of the worker, and the number of failed
+    operations with the last error.
+    """
+    rng = random.Random(spec["seed"] + index)
+    pick = key_picker(spec, rng)
+    payload = os.urandom(max(sizes))
+    ops, ends, latencies, nbytes = bytearray(), array("q"), array("q"), array("q")
+    errors, error = 0, None
+
+    start.wait()
+    begin = perf_counter_ns()
+    deadline = begin + int(spec["duration"] * 10**9)
+    now = begin
+    while now < deadline:
+        i = pick()
+        try:
+            if rng.random() < spec["read_ratio"]:
+                op = READ
+                t = perf_counter_ns()
+                store.get(keys[i])
+            else:
+                op = WRITE
+                value = payload[:sizes[i]]
+                t = perf_counter_ns()
+                store.set(value, key=keys[i])
+        except Exception as e:
+            # e.g. a read racing a write in a store without atomic writes
+            errors, error = errors + 1, repr(e)
+            now = perf_counter_ns()
+            continue
+        now = perf_counter_ns()
+        ops.append(op)
+        ends.append(now - begin)
+        latencies.append(now - t)
+        nbytes.append(sizes[i])
+    return ops, ends, latencies, nbytes, errors, error
+
+
+def load_process(connect, cmd, name, kwargs, spec, index, keys, sizes, start, results):
+    store = connect_store(connect, cmd, name, kwargs)
+    results.put(load_worker(store, spec, index, keys, sizes, start))
+
+
+def print_phases(phases):
+    # mean milliseconds of each phase of the store operations
+    for (function, size), times in sorted(phases.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+        label = function if size is None else f"{function} {size}"
+        total = sum(times.values())
+        print(f"{label:>20} {total:>9.3f} ms: " + ", ".join(
+            f"{phase} {ms:.3f} ({ms / (total or 1):.0%})" for phase, ms in sorted(times.items(), key=lambda p: -p[1])
+        ))
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LoadBenchmark:
+    """Concurrent mixed reads and writes of a key population.
+
+    spec["workers"] threads, or processes with their own store connection
+    if spec["processes"], each draw keys by popularity and read them with
+    probability spec["read_ratio"], or write them otherwise, for
+    spec["duration"] seconds. Throughput and latency percentiles are
+    reported for every spec["interval"] seconds and for the whole run.
+    """
+
+    def __init__(
+        self,
+        connect,
+        *,
+        cmd: str,
+        name: str,
+        logfile: Optional[str],
+        load: dict,
+        overwrite: bool = True,
+        max_exp: int = 29,
+        **kwargs,
+    ):
+        self.connect = connect
+        self.cmd = cmd
+        self.name = name
+        self.logfile = logfile
+        self.spec = dict(load, max_exp=max_exp)
+        self.kwargs = dict(kwargs)
+        if cmd != "local":
+            # reads measure the store, not its client cache
+            self.kwargs["cache_size"] = self.spec["cache_size"]
+
+        if logfile is not None and (overwrite or not op.exists(logfile)):
+            with open(logfile, "w+") as f:
+                f.write(",".join(LOAD_FIELDS) + "\n")
+
+        self.store = connect_store(connect, cmd, name, self.kwargs)
+        rng = random.Random(self.spec["seed"])
+        self.keys = [f"load-{i}" for i in range(self.spec["keys"])]
+        self.rows = []
+        self.phases = {}
+        self.sizes = object_sizes(self.spec, rng)
+
+    def run(self):
+        spec = self.spec
+        print(
+            f"Populating {len(self.keys)} keys of {sum(self.sizes) / len(self.sizes):.0f} bytes "
+            f"on average...",
+            flush=True,
+        )
+        payload = os.urandom(max(self.sizes))
+        for key, size in zip(self.keys, self.sizes):
+            self.store.set(payload[:size], key=key)
+
+        kind = "processes" if spec["processes"] else "threads"
+        print(
+            f"Running {spec['workers']} {kind}, {spec['read_ratio']:.0%} reads, "
+            f"{spec['popularity']} popularity, for {spec['duration']}s...",
+            flush=True,
+        )
+        try:
+            samples = self.spawn() if spec["processes"] else self.threads()
+        finally:
+            for key in self.keys:
+                self.store.evict(key)
+        self.report(samples)
+        if getattr(self.store, "has_stats", False) and hasattr(self.store, "phase_stats"):
+            # operations of the worker processes are timed in their own stores
+            self.phases = {
+                (function, None): {p: t["avg_ms"] for p, t in stats["phases"].items()}
+                for function, stats in self.store.phase_stats().items()
+            }
+            print_phases(self.phases)
+
+    def threads(self):
+        start = threading.Barrier(self.spec["workers"])
+        samples = [None] * self.spec["workers"]
+
+        def work(index):
+            samples[index] = load_worker(self.store, self.spec, index, self.keys, self.sizes, start)
+
+        workers = [threading.Thread(target=work, args=(i,)) for i in range(self.spec["workers"])]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return samples
+
+    def spawn(self):
+        ctx = mp.get_context("spawn")
+        start = ctx.Barrier(self.spec["workers"])
+        results = ctx.Queue()
+        procs = [
+            ctx.Process(
+                target=load_process,
+                args=(self.connect, self.cmd, self.name, self.kwargs, self.spec, i, self.keys,
+                      self.sizes, start, results),
+            )
+            for i in range(self.spec["workers"])
+        ]
+        for p in procs:
+            p.start()
+        samples = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        return samples
+
+    def results(self):
+        results = [dict(zip(LOAD_FIELDS, (self.name, *row))) for row in self.rows]
+        results += [
+            {"store": self.name, "function": f"{function}_phases", "phases": phases}
+            for (function, _), phases in self.phases.items()
+        ]
+        return results
+
+    def report(self, samples):
+        step = self.spec["interval"]
+        interval = int(step * 10**9)
+        # (interval, op) -> (latencies, bytes), interval None for the whole run
+        buckets = {}
+        for ops, ends, latencies, nbytes, _, _ in samples:
+            for op, end, latency, size in zip(ops, ends, latencies, nbytes):
+                for b in (end // interval, None):
+                    bucket = buckets.setdefault((b, op), [[], 0])
+                    bucket[0].append(latency)
+                    bucket[1] += size
+
+        duration = max((s[1][-1] for s in samples if s[1]), default=0) * 10**-9
+        rows = self.rows = []
+        for b in sorted({b for b, _ in buckets if b is not None}) + [None]:
+            # the last interval ends with the run
+            seconds = duration if b is None else min(step, duration - b * step)
+            for name, codes in OPS.items():
+                latencies = []
+                size = 0
+                for code in codes:
+                    found, found_size = buckets.get((b, code), ([], 0))
+                    latencies += found
+                    size += found_size
+                if not latencies:
+                    continue
+                latencies.sort()
+                rows.append((
+                    "total" if b is None else b,
+                    name,
+                    len(latencies),
+                    len(latencies) / seconds,
+                    size / 10**9 / seconds,
+                    *(percentile(latencies, q) * 10**-6 for q in PERCENTILES),
+                ))
+
+        print(f"{'interval':>8} {'op':>5} {'ops':>8} {'ops/s':>10} {'GB/s':>8} "
+              f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'p999 ms':>9}")
+        for interval, name, ops, rate, gbps, *pcts in rows:
+            print(f"{interval:>8} {name:>5} {ops:>8} {rate:>10.1f} {gbps:>8.3f} "
+                  + " ".join(f"{p:>9.3f}" for p in pcts))
+
+        errors = sum(s[4] for s in samples)
+        if errors:
+            error = next(s[5] for s in samples if s[4])
+            print(f"{errors} operations failed, e.g. {error}")
+
+        if self.logfile is not None:
+            with open(self.logfile, "a+") as f:
+                for row in rows:
+                    f.write(",".join(str(v) for v in (self.name, *row)) + "\n")
+
+
 def run_reps(func, **kwargs):
     reps = kwargs.pop("reps")
+    load = kwargs.pop("load")
+    json_file = kwargs.pop("json")
+    if kwargs.pop("phases"):
+        kwargs["stats"] = True
+    sweep = {"warmup": kwargs.pop("warmup"), "samples": kwargs.pop("samples")}
+    results = []
     for i in range(reps):
         print(f"***Repetition {i}***")
-        b = Benchmark(func, **kwargs)
+        if load is not None:
+            b = LoadBenchmark(func, load=load, **kwargs)
+        else:
+            b = Benchmark(func, **sweep, **kwargs)
         b.run()
+        results += b.results()
+
+    if json_file is not None:
+        options = dict(reps=reps, load=load, **sweep)
+        options.update((k, v) for k, v in kwargs.items() if k in ("cmd", "name", "max_exp"))
+        write_json(json_file, results, options)
 
 
 @click.group()
 @click.option("--logfile", type=str, default=None)
 @click.option("--reps", type=int, default=1)
 @click.option("--overwrite", is_flag=True)
+@click.option("--max-exp", type=int, default=29, help="write objects of up to 2**(max_exp - 1) bytes")
+@click.option("--warmup", type=int, default=1, help="untimed operations per object size")
+@click.option("--samples", type=int, default=5, help="timed operations per object size")
+@click.option("--json", "json_file", type=str, default=None, help="also write the results, with the environment, as JSON")
+@click.option("--phases", is_flag=True, help="break operations down by phase, for the stores that time them")
+@click.option("--load", is_flag=True, help="run a concurrent load instead of the size sweep")
+@click.option("--workers", type=int, default=8, help="load: concurrent workers")
+@click.option("--processes", is_flag=True, help="load: workers are processes instead of threads")
+@click.option("--read-ratio", type=float, default=0.9, help="load: fraction of operations that are reads")
+@click.option("--keys", type=int, default=1000, help="load: number of keys")
+@click.option("--size", type=int, default=1024**2, help="load: object size, the median for lognormal")
+@click.option("--min-size", type=int, default=1024, help="load: smallest object size")
+@click.option("--size-dist", type=click.Choice(["fixed", "uniform", "lognormal"]), default="fixed")
+@click.option("--popularity", type=click.Choice(["uniform", "zipf"]), default="uniform")
+@click.option("--zipf-s", type=float, default=0.99, help="load: zipf exponent")
+@click.option("--duration", type=float, default=30.0, help="load: seconds of load")
+@click.option("--interval", type=float, default=1.0, help="load: seconds per reported interval")
+@click.option("--cache-size", type=int, default=0, help="load: client cache entries of the store")
+@click.option("--seed", type=int, default=0)
 @click.pass_context
-def cli(ctx, logfile, reps, overwrite):
+def cli(
+    ctx, logfile, reps, overwrite, max_exp, warmup, samples, json_file, phases, load, workers, processes, read_ratio, keys, size,
+    min_size, size_dist, popularity, zipf_s, duration, interval, cache_size, seed,
+):
     ctx.ensure_object(dict)
+    ctx.obj["max_exp"] = max_exp
+    ctx.obj["warmup"] = warmup
+    ctx.obj["samples"] = samples
+    ctx.obj["json"] = json_file
+    ctx.obj["phases"] = phases
+    ctx.obj["load"] = None
+    if load:
+        ctx.obj["load"] = dict(
+            workers=workers,
+            processes=processes,
+            read_ratio=read_ratio,
+            keys=keys,
+            size=size,
+            min_size=min_size,
+            size_dist=size_dist,
+            popularity=popularity,
+            zipf_s=zipf_s,
+            duration=duration,
+            interval=interval,
+            cache_size=cache_size,
+            seed=seed,
+        )
     ctx.obj["logfile"] = logfile
     ctx.obj["reps"] = reps
     ctx.obj["overwrite"] = overwrite
@@ -248,5 +665,44 @@ def globus(ctx, endpoint_json):
     )
 
 
+@cli.command("compare")
+@click.argument("baseline")
+@click.argument("candidate")
+@click.option("--confidence", type=float, default=0.95)
+@click.option("--threshold", type=float, default=0.05, help="smallest relative slowdown that counts")
+def compare_runs(baseline, candidate, confidence, threshold):
+    """Compare two runs, CSV logs or JSON results, of the size sweep.
+
+    Exits with status 1 if the mean duration of a (store, function, size)
+    grew by more than threshold with the given confidence.
+    """
+    base, cand = read_samples(baseline), read_samples(candidate)
+    regressions = 0
+    print(f"{'store':>8} {'function':>18} {'size':>11} {'base ms':>10} {'new ms':>10} "
+          f"{'change':>8} {f'{confidence:.0%} interval':>20}")
+    for group in sorted(base.keys() & cand.keys()):
+        result = compare(base[group], cand[group], confidence)
+        if result is None:
+            continue
+        change, low, high = result
+        regressed = low > threshold
+        regressions += regressed
+        store, function, size = group
+        print(
+            f"{store:>8} {function:>18} {size:>11} "
+            f"{sum(base[group]) / len(base[group]) * 1e3:>10.3f} "
+            f"{sum(cand[group]) / len(cand[group]) * 1e3:>10.3f} "
+            f"{change:>+8.1%} {f'[{low:+.1%}, {high:+.1%}]':>20}"
+            + ("  REGRESSION" if regressed else "")
+        )
+
+    missing = base.keys() ^ cand.keys()
+    if missing:
+        print(f"{len(missing)} groups are in only one of the runs")
+    if regressions:
+        print(f"{regressions} significant regressions")
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     cli(obj={})
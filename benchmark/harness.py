@@ -0,0 +1,192 @@
+"""Result schema, latency histograms and run comparison of the benchmarks.
+
+A run is written as CSV, one row per timed sample in the columns of
+``HEADER`` (the format of ``results/*.log``), and optionally as JSON::
+
+    {
+        "schema": 1,
+        "environment": {...},
+        "results": [
+            {"store", "function", "size", "samples", "summary", "histogram"},
+            ...
+        ],
+    }
+
+with samples in seconds and the histogram of :class:`Histogram` in
+nanoseconds. :func:`compare` reads either format.
+"""
+import csv
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+from collections import defaultdict
+from datetime import datetime, timezone
+from statistics import NormalDist, mean, stdev
+
+SCHEMA = 1
+
+HEADER = "store,function,size,start,end,duration\n"
+
+
+class Histogram:
+    """Log-linear latency histogram in the manner of HdrHistogram.
+
+    Values are counted in buckets of 2**precision_bits sub-buckets per
+    power of two, so that a recorded value is off by less than
+    2**-(precision_bits - 1) of itself (under 1% by default) whatever its
+    magnitude, in a few hundred buckets at most.
+    """
+
+    def __init__(self, precision_bits=8):
+        self.precision_bits = precision_bits
+        self.counts = defaultdict(int)
+        self.count = 0
+
+    def record(self, value):
+        value = int(value)
+        shift = max(value.bit_length() - self.precision_bits, 0)
+        self.counts[value >> shift << shift] += 1
+        self.count += 1
+
+    def merge(self, other):
+        for lower, count in other.counts.items():
+            self.counts[lower] += count
+        self.count += other.count
+
+    def percentile(self, q):
+        """Return the lower bound of the bucket holding quantile q."""
+        rank = max(math.ceil(q * self.count), 1)
+        seen = 0
+        for lower in sorted(self.counts):
+            seen += self.counts[lower]
+            if seen >= rank:
+                return lower
+        return 0
+
+    def to_dict(self):
+        return {
+            "unit": "ns",
+            "precision_bits": self.precision_bits,
+            "counts": sorted(self.counts.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(d["precision_bits"])
+        for lower, count in d["counts"]:
+            h.counts[lower] += count
+            h.count += count
+        return h
+
+
+def summary(samples):
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean": mean(ordered),
+        "stdev": stdev(ordered) if len(ordered) > 1 else 0.0,
+        "min": ordered[0],
+        "p50": ordered[len(ordered) // 2],
+        "p90": ordered[min(int(0.9 * len(ordered)), len(ordered) - 1)],
+        "p99": ordered[min(int(0.99 * len(ordered)), len(ordered) - 1)],
+        "max": ordered[-1],
+    }
+
+
+def environment(options=None):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    import proxystore
+
+    return {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "proxystore": proxystore.__version__,
+        "commit": commit,
+        "argv": sys.argv,
+        "options": options or {},
+    }
+
+
+def write_json(path, results, options=None):
+    """Write results, a list of dicts with their samples, to path."""
+    doc = {"schema": SCHEMA, "environment": environment(options), "results": []}
+    for r in results:
+        entry = dict(r)
+        if r.get("samples"):
+            entry["summary"] = summary(r["samples"])
+            h = Histogram()
+            for s in r["samples"]:
+                h.record(s * 10**9)
+            entry["histogram"] = h.to_dict()
+        doc["results"].append(entry)
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=1)
+
+
+def read_samples(path):
+    """Return {(store, function, size): [seconds]} of a CSV log or JSON run."""
+    samples = defaultdict(list)
+    with open(path) as f:
+        if path.endswith(".json"):
+            for r in json.load(f)["results"]:
+                if r.get("samples"):
+                    samples[(r["store"], r["function"], r["size"])] += r["samples"]
+        else:
+            for row in csv.DictReader(f):
+                samples[(row["store"], row["function"], int(row["size"]))].append(
+                    float(row["duration"])
+                )
+    return samples
+
+
+def t_quantile(p, dof):
+    """Quantile p of Student's t distribution with dof degrees of freedom.
+
+    Cornish-Fisher expansion around the normal quantile, within 1% of the
+    exact value from 3 degrees of freedom on.
+    """
+    z = NormalDist().inv_cdf(p)
+    return (
+        z
+        + (z**3 + z) / (4 * dof)
+        + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * dof**2)
+        + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * dof**3)
+    )
+
+
+def compare(baseline, candidate, confidence=0.95):
+    """Compare the mean of two sample lists with Welch's t interval.
+
+    Returns:
+        (change, low, high): the relative change of the mean from baseline
+        to candidate and its confidence interval, or None if either has
+        fewer than two samples.
+    """
+    if len(baseline) < 2 or len(candidate) < 2:
+        return None
+    mb, mc = mean(baseline), mean(candidate)
+    vb, vc = stdev(baseline) ** 2 / len(baseline), stdev(candidate) ** 2 / len(candidate)
+    se = math.sqrt(vb + vc)
+    if se == 0:
+        change = (mc - mb) / mb
+        return change, change, change
+    dof = (vb + vc) ** 2 / (vb**2 / (len(baseline) - 1) + vc**2 / (len(candidate) - 1))
+    margin = t_quantile(1 - (1 - confidence) / 2, max(dof, 1)) * se
+    return (mc - mb) / mb, (mc - mb - margin) / mb, (mc - mb + margin) / mb
@@ -94,5 +94,25 @@ remote_bench() {
 
 }
 
+scaling_bench() {
+	logfile="scaling.log"
+	rm ${logfile}
+
+	echo -e "**Running margo_server handler thread scaling Benchmark**\n"
+	${connect_remote} "${load_spack} && redis-server --port ${redis_port} --daemonize yes"
+	for threads in 0 1 2 4 8 16; do
+		${connect_remote} "${mochi} ${redis_port} ${remoteip} ${mochi_port} 42 ${threads} &> outputs.log &"
+		sleep 15
+		python scaling.py --logfile ${logfile} external "ofi+tcp;ofi_rxm://${remoteip}:${mochi_port}" --threads ${threads}
+		${connect_remote} "pkill -f margo_server"
+	done
+	${connect_remote} "${load_spack} && redis-cli -p ${redis_port} FLUSHALL" # clean the store
+	${connect_remote} "${load_spack} && redis-cli -p ${redis_port} SHUTDOWN" # stop server
+
+	echo -e "\n\n**Running Python provider handler thread scaling Benchmark**\n"
+	python scaling.py --logfile ${logfile} python
+}
+
 local_bench
 remote_bench
+scaling_bench
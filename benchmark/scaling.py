@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Throughput of the RDMA servers as a function of their handler threads.
+
+Client processes each repeat gets (or sets) of a value of a fixed size
+against one server for a fixed duration, and the aggregate operations and
+bytes per second are reported for every handler thread count.
+
+``python`` starts the Python provider itself once per thread count,
+``external`` measures an already running server (e.g. ``margo_server``
+started with a given number of handler threads by runbench.sh).
+"""
+import importlib.util
+import multiprocessing as mp
+import os
+import sys
+import time
+from os import path as op
+
+import click
+
+HERE = op.dirname(op.abspath(__file__))
+CLIENT_DIR = op.join(HERE, "..", "proxy-client")
+SERVER_DIR = op.join(HERE, "..", "proxy-server")
+
+HEADER = "server,handler_threads,clients,op,size,ops,duration,ops_per_sec,bytes_per_sec\n"
+
+
+def serve(addr, provider_id, rpc_threads, ready):
+    from pymargo.core import Engine
+
+    spec = importlib.util.spec_from_file_location("proxy_server", op.join(SERVER_DIR, "proxy-server.py"))
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+
+    engine = Engine(addr, use_progress_thread=True, rpc_thread_count=rpc_threads)
+    server.RDMAProvider(engine, provider_id)
+    ready.set()
+    engine.wait_for_finalize()
+
+
+def client(addr, provider_id, operation, size, duration, start, results):
+    sys.path.insert(0, CLIENT_DIR)
+    from rdma_interface import RDMA
+
+    rdma = RDMA(addr, provider_id)
+    key = f"scaling-{os.getpid()}"
+    value = os.urandom(size)
+    rdma.set(key, value)
+
+    # all clients start together once they are connected
+    start.wait()
+    ops = 0
+    begin = time.perf_counter()
+    end = begin + duration
+    while time.perf_counter() < end:
+        if operation == "get":
+            rdma.get(key, size)
+        else:
+            rdma.set(key, value)
+        ops += 1
+    results.put((ops, time.perf_counter() - begin))
+    rdma.evict(key)
+
+
+def measure(addr, provider_id, operation, size, clients, duration):
+    ctx = mp.get_context("spawn")
+    start = ctx.Barrier(clients)
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=client, args=(addr, provider_id, operation, size, duration, start, results))
+        for _ in range(clients)
+    ]
+    for p in procs:
+        p.start()
+    samples = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    return sum(ops for ops, _ in samples), max(elapsed for _, elapsed in samples)
+
+
+def report(ctx, server, threads, ops, elapsed):
+    o = ctx.obj
+    line = (
+        f"{server},{threads},{o['clients']},{o['op']},{o['size']},{ops},{elapsed},"
+        f"{ops / elapsed},{ops * o['size'] / elapsed}\n"
+    )
+    print(
+        f"{server} {threads} handler threads: {ops / elapsed:.1f} ops/s, "
+        f"{ops * o['size'] / elapsed / 1024**2:.1f} MB/s"
+    )
+    if o["logfile"] is not None:
+        new = not op.exists(o["logfile"])
+        with open(o["logfile"], "a+") as f:
+            if new:
+                f.write(HEADER)
+            f.write(line)
+
+
+@click.group()
+@click.option("--clients", type=int, default=8, help="number of client processes")
+@click.option("--size", type=int, default=16 * 1024**2, help="value size in bytes")
+@click.option("--duration", type=float, default=10.0, help="seconds per measurement")
+@click.option("--op", type=click.Choice(["get", "set"]), default="get")
+@click.option("--logfile", type=str, default=None)
+@click.pass_context
+def cli(ctx, clients, size, duration, op, logfile):
+    ctx.ensure_object(dict)
+    ctx.obj.update(clients=clients, size=size, duration=duration, op=op, logfile=logfile)
+
+
+@cli.command()
+@click.option("--addr", type=str, default="tcp://127.0.0.1:45840")
+@click.option("--threads", type=str, default="0,1,2,4,8", help="comma separated handler thread counts")
+@click.pass_context
+def python(ctx, addr, threads):
+    o = ctx.obj
+    spawn = mp.get_context("spawn")
+    for count in (int(t) for t in threads.split(",")):
+        ready = spawn.Event()
+        server = spawn.Process(target=serve, args=(addr, 42, count, ready), daemon=True)
+        server.start()
+        ready.wait()
+        try:
+            ops, elapsed = measure(addr, 42, o["op"], o["size"], o["clients"], o["duration"])
+        finally:
+            server.terminate()
+            server.join()
+        report(ctx, "python", count, ops, elapsed)
+
+
+@cli.command()
+@click.argument("addr")
+@click.option("--threads", type=int, required=True, help="handler threads the server runs with")
+@click.option("--provider", type=int, default=42)
+@click.option("--name", type=str, default="margo_server")
+@click.pass_context
+def external(ctx, addr, threads, provider, name):
+    o = ctx.obj
+    ops, elapsed = measure(addr, provider, o["op"], o["size"], o["clients"], o["duration"])
+    report(ctx, name, threads, ops, elapsed)
+
+
+if __name__ == "__main__":
+    cli()
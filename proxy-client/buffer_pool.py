@@ -0,0 +1,226 @@
+"""Pool of pre-registered bulk regions for the RDMA client."""
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Any
+
+import numpy as np
+import pymargo.bulk as bulk
+
+from protocol import bulk_descriptor
+
+logger = logging.getLogger(__name__)
+
+
+class Region:
+    """Registered memory region owned by a :class:`BufferPool`."""
+
+    __slots__ = ("array", "bulk", "capacity", "pooled", "_descriptor")
+
+    def __init__(self, array: np.ndarray, blk: Any, pooled: bool) -> None:
+        self.array = array
+        self.bulk = blk
+        self.capacity = array.size
+        self.pooled = pooled
+        self._descriptor: bytes | None = None
+
+    @property
+    def descriptor(self) -> bytes:
+        """Serialized bulk handle, computed once per registration."""
+        if self._descriptor is None:
+            self._descriptor = bulk_descriptor(self.bulk)
+        return self._descriptor
+
+
+class Lease:
+    """Temporary ownership of a region handed out by :class:`BufferPool`.
+
+    The region goes back to the pool once :func:`release()` is called or the
+    ``with`` block using the lease exits. The lease must not be used after it
+    has been released.
+    """
+
+    __slots__ = ("pool", "region", "size")
+
+    def __init__(self, pool: BufferPool, region: Region, size: int) -> None:
+        self.pool = pool
+        self.region = region
+        self.size = size
+
+    @property
+    def array(self) -> np.ndarray:
+        """``uint8`` view of the first `size` bytes of the region."""
+        return self.region.array[: self.size]
+
+    @property
+    def capacity(self) -> int:
+        """Size of the whole region, at least `size` bytes."""
+        return self.region.capacity
+
+    @property
+    def bulk(self) -> Any:
+        """Bulk handle registered for the whole region."""
+        return self.region.bulk
+
+    @property
+    def descriptor(self) -> bytes:
+        """Serialized bulk handle of the region to send to the server."""
+        return self.region.descriptor
+
+    def release(self) -> None:
+        """Return the region to the pool."""
+        if self.region is not None:
+            self.pool._release(self.region)
+            self.region = None
+
+    def __enter__(self) -> Lease:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.release()
+
+
+class BufferPool:
+    """Size-classed free lists of registered bulk regions.
+
+    Regions are allocated in power-of-two size classes between `min_class`
+    and `max_class` and registered once with the engine. Released regions
+    are kept for reuse until the total registered memory would go over
+    `limit`, in which case free regions are dropped (largest first) to make
+    room. Requests larger than `max_class`, or that cannot fit under the
+    limit, get a one-off region that is never pooled.
+    """
+
+    def __init__(
+        self,
+        engine: Any,
+        *,
+        min_class: int = 4 * 1024,
+        max_class: int = 64 * 1024**2,
+        limit: int = 256 * 1024**2,
+        copy_limit: int = 1024**2,
+    ) -> None:
+        """Init BufferPool.
+
+        Args:
+            engine (Engine): margo engine used to register the regions.
+            min_class (int): smallest region size in bytes (default: 4 KB).
+            max_class (int): largest pooled region size in bytes
+                (default: 64 MB).
+            limit (int): cap on the bytes registered by pooled regions,
+                leased or free (default: 256 MB).
+            copy_limit (int): values up to this size are copied into a
+                leased region on set, larger ones are registered in place
+                (default: 1 MB).
+        """
+        self.engine = engine
+        self.min_class = min_class
+        self.max_class = max_class
+        self.limit = limit
+        self.copy_limit = copy_limit
+
+        self.hits = 0
+        self.misses = 0
+        self._registered = 0
+        self._free: dict[int, list[Region]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        """Bytes currently registered by pooled regions."""
+        return self._registered
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of leases served from a free region."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def size_class(self, size: int) -> int | None:
+        """Return the region size used for `size` bytes or None if unpooled."""
+        cls = max(self.min_class, 1 << max(size - 1, 0).bit_length())
+        return cls if cls <= self.max_class else None
+
+    def lease(self, size: int, *, pooled: bool = True) -> Lease:
+        """Lease a registered region of at least `size` bytes.
+
+        Args:
+            size (int): number of bytes needed.
+            pooled (bool): if False, always allocate a new region that never
+                goes back to the pool, so that the caller may keep its array
+                after the transfer, e.g. to hand it out without a copy
+                (default: True).
+
+        Returns:
+            :class:`Lease` to release once the transfer is complete.
+        """
+        cls = self.size_class(size)
+        if cls is None or not pooled:
+            return Lease(self, self._allocate(size, pooled=False), size)
+
+        with self._lock:
+            free = self._free.get(cls)
+            if free:
+                self.hits += 1
+                return Lease(self, free.pop(), size)
+
+            self.misses += 1
+            pooled = self._reserve(cls)
+
+        return Lease(self, self._allocate(cls, pooled=pooled), size)
+
+    def register(self, buffer: Any, mode: Any = bulk.read_only) -> Any:
+        """Register a caller-owned buffer once, bypassing the pool.
+
+        Used for values too large to be worth copying into a leased region.
+
+        Args:
+            buffer: object supporting the buffer protocol, or a list of them
+                registered as the segments of a single bulk handle.
+            mode: bulk access mode (default: read only).
+
+        Returns:
+            bulk handle for `buffer`.
+        """
+        if isinstance(buffer, (list, tuple)):
+            segments = [np.frombuffer(segment, dtype=np.uint8) for segment in buffer]
+            return self.engine.create_bulk(segments, mode)
+        array = np.frombuffer(buffer, dtype=np.uint8)
+        return self.engine.create_bulk(array, mode)
+
+    def clear(self) -> None:
+        """Drop all free regions."""
+        with self._lock:
+            for cls, free in self._free.items():
+                self._registered -= cls * len(free)
+            self._free.clear()
+
+    def _allocate(self, capacity: int, pooled: bool) -> Region:
+        array = np.empty(capacity, dtype=np.uint8)
+        blk = self.engine.create_bulk(array, bulk.read_write)
+        return Region(array, blk, pooled)
+
+    def _reserve(self, cls: int) -> bool:
+        # Must be called with the lock held. Makes room for a new region of
+        # size cls, returns False if it has to be allocated outside the pool.
+        for other in sorted(self._free, reverse=True):
+            if self._registered + cls <= self.limit:
+                break
+            free = self._free[other]
+            while free and self._registered + cls > self.limit:
+                free.pop()
+                self._registered -= other
+
+        if self._registered + cls > self.limit:
+            logger.debug(f"BufferPool limit reached, {cls} byte region unpooled")
+            return False
+
+        self._registered += cls
+        return True
+
+    def _release(self, region: Region) -> None:
+        if not region.pooled:
+            return
+        with self._lock:
+            self._free.setdefault(region.capacity, []).append(region)
@@ -0,0 +1,231 @@
+"""Completion of non-blocking margo operations."""
+from __future__ import annotations
+
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Generator
+from typing import Sequence
+
+logger = logging.getLogger(__name__)
+
+# threads running the calls of background(), shared by every session
+BACKGROUND_WORKERS = 8
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+
+class RDMAFuture(Future):
+    """Future of an asynchronous RDMA operation.
+
+    A regular :class:`concurrent.futures.Future` that can also be awaited
+    from a coroutine running in an asyncio event loop.
+    """
+
+    def __await__(self) -> Generator[Any, None, Any]:
+        return asyncio.wrap_future(self).__await__()
+
+
+def _settle(future: RDMAFuture, result: Any) -> None:
+    # a result that is itself a future, e.g. a retry started from the
+    # completion thread, settles `future` once it is done
+    if not isinstance(result, Future):
+        future.set_result(result)
+        return
+
+    def done(source: Future) -> None:
+        if source.exception() is not None:
+            future.set_exception(source.exception())
+        else:
+            future.set_result(source.result())
+
+    result.add_done_callback(done)
+
+
+def completed(result: Any) -> RDMAFuture:
+    """Return a future that is already done with `result`."""
+    future = RDMAFuture()
+    future.set_running_or_notify_cancel()
+    future.set_result(result)
+    return future
+
+
+def gather(
+    futures: Sequence[Future],
+    combine: Callable[[list[Any]], Any] = list,
+) -> RDMAFuture:
+    """Return a future done once every future of `futures` is done.
+
+    Args:
+        futures (sequence): futures to wait for.
+        combine (callable): called with the list of results to produce the
+            result of the returned future (default: list). It may return
+            another future, whose result is then the result.
+
+    Returns:
+        :class:`RDMAFuture` failing with the first exception raised by one of
+        `futures`, if any.
+    """
+    if not futures:
+        return completed(combine([]))
+
+    gathered = RDMAFuture()
+    gathered.set_running_or_notify_cancel()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future: Future) -> None:
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+            if gathered.done():
+                return
+            if future.exception() is not None:
+                gathered.set_exception(future.exception())
+                return
+        if last:
+            try:
+                _settle(gathered, combine([f.result() for f in futures]))
+            except BaseException as e:
+                gathered.set_exception(e)
+
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+
+def background(func: Callable[..., Any], *args: Any) -> RDMAFuture:
+    """Run a blocking call on a background thread and return its future.
+
+    Meant for long operations, such as chunked transfers of large values,
+    that would otherwise hold up the completion thread. The calls share
+    :data:`BACKGROUND_WORKERS` threads, and wait for one to be free. A call
+    made from one of these threads runs right away on that thread, so that
+    the calls waiting on each other cannot take up every thread.
+    """
+    global _executor
+
+    future = RDMAFuture()
+    future.set_running_or_notify_cancel()
+
+    def run() -> None:
+        _local.background = True
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    if getattr(_local, "background", False):
+        run()
+        return future
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(BACKGROUND_WORKERS, thread_name_prefix="rdma-background")
+    _executor.submit(run)
+    return future
+
+
+class CompletionQueue:
+    """Bounded window of in-flight margo requests.
+
+    Operations are started with ``handle.iforward`` on the caller thread and
+    completed by a background thread that waits on the returned requests in
+    submission order. At most `window` operations are in flight at a time,
+    :func:`submit()` blocks until a slot frees up. Operations submitted by
+    the completion thread itself, such as retries, never wait for a slot.
+    """
+
+    def __init__(self, window: int = 64) -> None:
+        """Init CompletionQueue.
+
+        Args:
+            window (int): maximum number of operations in flight
+                (default: 64).
+        """
+        self.window = window
+        self._slots = threading.BoundedSemaphore(window)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        start: Callable[[], Any],
+        finish: Callable[[Any], Any],
+        cleanup: Callable[[], None] | None = None,
+    ) -> RDMAFuture:
+        """Start an operation and return its future.
+
+        Args:
+            start (callable): issues the operation and returns the pymargo
+                request to wait on.
+            finish (callable): called on the completion thread with the
+                output of the request, its return value is the result of
+                the future. It must not block: a follow-up operation is
+                submitted and its future returned instead, the result is
+                then that of the follow-up.
+            cleanup (callable): optionally called once the operation is
+                done, successful or not, e.g. to release buffers.
+
+        Returns:
+            :class:`RDMAFuture` of the result of `finish`.
+        """
+        future = RDMAFuture()
+        future.set_running_or_notify_cancel()
+        # the completion thread would wait for a slot only it can free
+        slot = threading.current_thread() is not self._thread
+        if slot:
+            self._slots.acquire()
+        try:
+            request = start()
+        except BaseException as e:
+            if slot:
+                self._slots.release()
+            if cleanup is not None:
+                cleanup()
+            future.set_exception(e)
+            return future
+
+        self._start_thread()
+        self._queue.put((request, finish, cleanup, slot, future))
+        return future
+
+    def _start_thread(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run,
+                        name="rdma-completion",
+                        daemon=True,
+                    )
+                    self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            request, finish, cleanup, slot, future = self._queue.get()
+            error = None
+            try:
+                result = finish(request.wait())
+            except BaseException as e:
+                logger.debug(f"Asynchronous RDMA operation failed: {e}")
+                error = e
+            finally:
+                # free the slot and buffers before waking up the waiters
+                if cleanup is not None:
+                    cleanup()
+                if slot:
+                    self._slots.release()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                _settle(future, result)
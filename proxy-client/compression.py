@@ -0,0 +1,265 @@
+"""Adaptive compression of the objects moved by the RDMA stores.
+
+A compressed value is a frame of independently compressed blocks::
+
+    header | block sizes | block 0 | block 1 ...
+
+where header is ``<QI`` (raw length, number of blocks) and block sizes
+holds one ``<II`` (raw, compressed) per block. Blocks are compressed and
+decompressed in parallel by a thread pool when a value spans several of
+them, the codecs release the GIL while they work.
+
+The codec of a compressed value is recorded in bits 1 to 3 of its object
+flags (:data:`CODEC_MASK`), next to :data:`oob.OUT_OF_BAND
+<oob.OUT_OF_BAND>` in bit 0, and its raw length in the frame header.
+
+:class:`Compressor` decides per object whether compressing pays off: the
+object must be large enough, a few samples of it must compress well, and
+moving the compressed bytes plus compressing and decompressing them must
+take less time than moving the raw bytes over the link, whose bandwidth
+is measured from the transfers of the store.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import NamedTuple
+
+try:
+    import lz4.block
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# codec id of a value in its object flags, 0 when not compressed. Requests
+# carry the flags of an object in a single byte.
+CODEC_SHIFT = 1
+CODEC_MASK = 0x7 << CODEC_SHIFT
+
+FRAME = struct.Struct("<QI")
+BLOCK = struct.Struct("<II")
+
+BLOCK_SIZE = 4 * 1024**2
+
+_pool: ThreadPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+class Codec(NamedTuple):
+    """Compression codec usable for the values of a store."""
+
+    id: int
+    name: str
+    compress: Callable[[Any], bytes]
+    # called with the compressed data and its raw length
+    decompress: Callable[[Any, int], bytes]
+
+
+def _zstd_compress(data: Any) -> bytes:
+    # compressor objects are not thread-safe, they are cheap to create
+    return zstandard.ZstdCompressor(level=1).compress(data)
+
+
+def _zstd_decompress(data: Any, size: int) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+
+CODECS: dict[int, Codec] = {
+    1: Codec(1, "zlib", lambda d: zlib.compress(d, 1), lambda d, n: zlib.decompress(d, bufsize=max(n, 1))),
+}
+if lz4 is not None:
+    CODECS[2] = Codec(
+        2,
+        "lz4",
+        lambda d: lz4.block.compress(d, store_size=False),
+        lambda d, n: lz4.block.decompress(d, uncompressed_size=n),
+    )
+if zstandard is not None:
+    CODECS[3] = Codec(3, "zstd", _zstd_compress, _zstd_decompress)
+
+
+def codec_of(flags: int) -> Codec | None:
+    """Return the codec recorded in object `flags`, None if uncompressed.
+
+    Raises:
+        ValueError:
+            if the codec is not available in this process.
+    """
+    codec_id = (flags & CODEC_MASK) >> CODEC_SHIFT
+    if codec_id == 0:
+        return None
+    if codec_id not in CODECS:
+        raise ValueError(f"object compressed with unavailable codec {codec_id}")
+    return CODECS[codec_id]
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(os.cpu_count() or 1, thread_name_prefix="compression")
+    return _pool
+
+
+def _blocks(value: Any) -> list[memoryview]:
+    # blocks of a bytes-like value, or of the segments of a list of them
+    segments = value if isinstance(value, (list, tuple)) else [value]
+    blocks = []
+    for segment in segments:
+        view = memoryview(segment).cast("B")
+        blocks += [view[i:i + BLOCK_SIZE] for i in range(0, view.nbytes, BLOCK_SIZE)]
+    return blocks
+
+
+def _map(func: Callable[..., Any], *args: list[Any]) -> list[Any]:
+    if len(args[0]) > 1:
+        return list(_executor().map(func, *args))
+    return list(map(func, *args))
+
+
+def compress(value: Any, codec: Codec) -> bytes:
+    """Compress `value`, bytes-like or a list of segments, into a frame."""
+    blocks = _blocks(value)
+    compressed = _map(codec.compress, blocks)
+    head = bytearray(FRAME.pack(sum(b.nbytes for b in blocks), len(blocks)))
+    for block, data in zip(blocks, compressed):
+        head += BLOCK.pack(block.nbytes, len(data))
+    return b"".join([head, *compressed])
+
+
+def decompress(data: Any, codec: Codec) -> bytearray:
+    """Decompress a frame produced by :func:`compress()`.
+
+    Returns:
+        the raw value as a writable bytearray.
+    """
+    view = memoryview(data).cast("B")
+    length, count = FRAME.unpack_from(view)
+    out = bytearray(length)
+    target = memoryview(out)
+
+    jobs = []
+    offset = FRAME.size + count * BLOCK.size
+    position = 0
+    for i in range(count):
+        raw, size = BLOCK.unpack_from(view, FRAME.size + i * BLOCK.size)
+        jobs.append((view[offset:offset + size], raw, position))
+        offset += size
+        position += raw
+
+    def run(job: tuple[memoryview, int, int]) -> None:
+        block, raw, position = job
+        target[position:position + raw] = codec.decompress(block, raw)
+
+    _map(run, jobs)
+    return out
+
+
+class Compressor:
+    """Per-object compression decisions of a store.
+
+    The bandwidth of the link starts at `bandwidth` and follows the
+    transfers reported with :func:`observe()`.
+    """
+
+    # bytes sampled at each of the start, middle and end of an object
+    sample_size = 16 * 1024
+    # samples must shrink to this fraction of their size
+    max_ratio = 0.9
+
+    def __init__(
+        self,
+        codecs: list[str] | None = None,
+        *,
+        min_size: int = 64 * 1024,
+        bandwidth: float = 1.25e9,
+    ) -> None:
+        """Init Compressor.
+
+        Args:
+            codecs (list): names of the codecs to choose from, all the
+                available ones if None (default: None).
+            min_size (int): smallest object worth compressing
+                (default: 64 KB).
+            bandwidth (float): initial estimate of the link bandwidth in
+                bytes per second (default: 10 Gb/s).
+
+        Raises:
+            ValueError:
+                if none of `codecs` is available.
+        """
+        self.codecs = [c for c in CODECS.values() if codecs is None or c.name in codecs]
+        if not self.codecs:
+            raise ValueError(f"none of the codecs {codecs} is available")
+        self.min_size = min_size
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+
+    def observe(self, nbytes: int, seconds: float) -> None:
+        """Account for a transfer of `nbytes` that took `seconds`."""
+        if nbytes < self.min_size or seconds <= 0:
+            return
+        with self._lock:
+            self.bandwidth = 0.8 * self.bandwidth + 0.2 * nbytes / seconds
+
+    def choose(self, value: Any) -> Codec | None:
+        """Return the codec to compress `value` with, or None to send it raw."""
+        blocks = _blocks(value)
+        size = sum(b.nbytes for b in blocks)
+        if size < self.min_size:
+            return None
+
+        sample = _sample(blocks, size, self.sample_size)
+        # the parallel blocks divide the codec time
+        workers = min(len(blocks), os.cpu_count() or 1)
+        best, best_time = None, size / self.bandwidth
+        for codec in self.codecs:
+            start = time.perf_counter()
+            compressed = codec.compress(sample)
+            middle = time.perf_counter()
+            codec.decompress(compressed, len(sample))
+            end = time.perf_counter()
+
+            ratio = len(compressed) / len(sample)
+            if ratio > self.max_ratio:
+                continue
+            scale = size / len(sample)
+            seconds = scale * (end - start) / workers + size * ratio / self.bandwidth
+            if seconds < best_time:
+                best, best_time = codec, seconds
+            logger.debug(
+                f"{codec.name}: ratio {ratio:.2f}, {scale * (middle - start) / workers:.4f}s to "
+                f"compress {size} bytes",
+            )
+        return best
+
+
+def _sample(blocks: list[memoryview], size: int, length: int) -> bytes:
+    # length bytes from each of the start, middle and end of the value
+    if size <= 3 * length:
+        return b"".join(bytes(b) for b in blocks)
+    parts = []
+    for start in (0, size // 2 - length // 2, size - length):
+        part = bytearray()
+        offset = 0
+        for block in blocks:
+            end = offset + block.nbytes
+            if end > start and offset < start + length:
+                part += block[max(start - offset, 0):min(start + length - offset, block.nbytes)]
+            offset = end
+        parts.append(bytes(part))
+    return b"".join(parts)
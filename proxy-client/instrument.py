@@ -0,0 +1,249 @@
+"""Per-phase timers and byte counters of the RDMA client operations.
+
+An operation (a store ``get``, ``set``, ...) is timed as a sequence of
+phases: every :func:`Operation.mark()` charges the time since the previous
+mark, or since the operation started, to the phase it names, so that the
+phases of an operation add up to its latency. The phases of the client
+are:
+
+    cache, shared_cache    lookups in the process and node caches
+    serialize, compress    encoding of the object
+    lease, register, copy  getting registered memory, copying in or out
+    encode, decode         building the request and parsing the response
+    acquire                taking a handle, looking up the server first
+    forward, submit        the RPC and its bulk transfer, or starting it
+    decompress, deserialize
+    other                  whatever follows the last mark
+
+The operation of the calling thread is found with :func:`current()`, so
+that the layers a store operation goes through (the store, the sharded
+client, the RDMA client) mark their phases without passing it around.
+Asynchronous operations capture it when submitted.
+
+A store created with ``stats=True`` records its operations in a
+:class:`Phases`, which adds the time of every phase to the proxystore
+stats of the key, as the ``<function>.<phase>`` event, and keeps per
+function aggregates, and a trace of the recent operations if asked for
+with ``phase_trace=True``. When stats are off, :func:`current()` returns
+a no-op operation.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextlib import nullcontext
+from time import perf_counter_ns
+from typing import Any
+from typing import Generator
+
+from proxystore.store.stats import Event
+from proxystore.store.stats import TimeStats
+
+_local = threading.local()
+
+
+class NullOperation:
+    """Operation of a store without stats, every method is a no-op."""
+
+    __slots__ = ()
+
+    def mark(self, phase: str) -> None:
+        pass
+
+    def count(self, nbytes: int) -> None:
+        pass
+
+    def identify(self, key: str | None) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+NULL = NullOperation()
+
+
+class Operation:
+    """Phases of one operation being timed."""
+
+    __slots__ = ("phases", "function", "key", "thread", "start", "last", "times", "marks", "nbytes")
+
+    def __init__(self, phases: Phases, function: str, key: str | None) -> None:
+        self.phases = phases
+        self.function = function
+        self.key = key
+        self.thread = threading.get_ident()
+        self.start = self.last = perf_counter_ns()
+        self.times: dict[str, int] = {}
+        # (phase, end) of every mark, kept for the trace
+        self.marks: list[tuple[str, int]] | None = [] if phases.trace else None
+        self.nbytes = 0
+
+    def mark(self, phase: str) -> None:
+        """Charge the time since the last mark to `phase`."""
+        now = perf_counter_ns()
+        self.times[phase] = self.times.get(phase, 0) + now - self.last
+        self.last = now
+        if self.marks is not None:
+            self.marks.append((phase, now))
+
+    def count(self, nbytes: int) -> None:
+        """Account for `nbytes` moved by the operation."""
+        self.nbytes += nbytes
+
+    def identify(self, key: str | None) -> None:
+        """Set the key of an operation started before it was known."""
+        self.key = key
+
+    def stop(self) -> None:
+        """End the operation and record it."""
+        self.mark("other")
+        self.phases.record(self)
+
+
+class Phases:
+    """Recorder of the operations of a store.
+
+    Args:
+        stats (FunctionEventStats): stats of the store the phase times
+            are added to, per key.
+        trace (bool): keep the recent operations, with all their marks, for
+            :func:`write_trace()` (default: False).
+    """
+
+    # operations kept for the trace
+    max_trace = 100_000
+
+    def __init__(self, stats: Any, trace: bool = False) -> None:
+        self.stats = stats
+        self.trace = trace
+        self._functions: dict[str, dict[str, TimeStats]] = {}
+        self._calls: dict[str, int] = {}
+        self._bytes: dict[str, int] = {}
+        self._trace: deque[Operation] = deque(maxlen=self.max_trace)
+        self._lock = threading.Lock()
+
+    def start(self, function: str, key: str | None = None) -> Operation:
+        """Start timing an operation, without making it current."""
+        return Operation(self, function, key)
+
+    @contextmanager
+    def operation(self, function: str, key: str | None = None) -> Generator[Operation, None, None]:
+        """Time an operation of the calling thread.
+
+        An operation started while another one of the same recorder is
+        current is part of it. One of another recorder, a store used by the
+        serializer of another store say, is timed on its own while the outer
+        operation waits.
+        """
+        op = getattr(_local, "op", None)
+        if op is not None and op.phases is self:
+            yield op
+            return
+        op = self.start(function, key)
+        try:
+            with using(op):
+                yield op
+        finally:
+            op.stop()
+
+    def record(self, op: Operation) -> None:
+        """Add the phases of a finished operation."""
+        with self._lock:
+            functions = self._functions.setdefault(op.function, {})
+            for phase, ns in op.times.items():
+                ms = ns / 1e6
+                self.stats[Event(function=f"{op.function}.{phase}", key=op.key)].add_time(ms)
+                functions.setdefault(phase, TimeStats()).add_time(ms)
+            self._calls[op.function] = self._calls.get(op.function, 0) + 1
+            self._bytes[op.function] = self._bytes.get(op.function, 0) + op.nbytes
+            if self.trace:
+                self._trace.append(op)
+
+    def snapshot(self) -> dict[str, Any]:
+        """Return the phases of every function over all keys.
+
+        Returns:
+            dict mapping each function to its number of calls, bytes
+            moved and phases, with the calls, total, average, minimum and
+            maximum time in milliseconds of each phase.
+        """
+        with self._lock:
+            return {
+                function: {
+                    "calls": self._calls[function],
+                    "bytes": self._bytes[function],
+                    "phases": {
+                        phase: {
+                            "calls": t.calls,
+                            "total_ms": t.avg_time_ms * t.calls,
+                            "avg_ms": t.avg_time_ms,
+                            "min_ms": t.min_time_ms,
+                            "max_ms": t.max_time_ms,
+                        }
+                        for phase, t in phases.items()
+                    },
+                }
+                for function, phases in self._functions.items()
+            }
+
+    def write_trace(self, path: str) -> None:
+        """Write the recent operations to `path` in the Chrome trace format.
+
+        Every operation is an event with its phases nested in it, the file
+        opens in ``chrome://tracing`` or Perfetto.
+        """
+        pid = os.getpid()
+        with self._lock:
+            ops = list(self._trace)
+        events = []
+        for op in ops:
+            tid = op.thread
+            end = op.marks[-1][1] if op.marks else op.last
+            events.append({
+                "name": op.function, "ph": "X", "pid": pid, "tid": tid,
+                "ts": op.start / 1e3, "dur": (end - op.start) / 1e3,
+                "args": {"key": op.key, "bytes": op.nbytes},
+            })
+            begin = op.start
+            for phase, at in op.marks or ():
+                events.append({
+                    "name": phase, "ph": "X", "pid": pid, "tid": tid,
+                    "ts": begin / 1e3, "dur": (at - begin) / 1e3,
+                })
+                begin = at
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def current() -> Operation | NullOperation:
+    """Return the operation of the calling thread, a no-op one if none."""
+    return getattr(_local, "op", None) or NULL
+
+
+@contextmanager
+def using(op: Operation | NullOperation) -> Generator[None, None, None]:
+    """Make `op` the operation of the calling thread for a while."""
+    previous = getattr(_local, "op", None)
+    _local.op = op if op is not NULL else None
+    try:
+        yield
+    finally:
+        _local.op = previous
+
+
+class _Disabled:
+    # recorder of a store without stats
+    _context = nullcontext(NULL)
+
+    def start(self, function: str, key: str | None = None) -> NullOperation:
+        return NULL
+
+    def operation(self, function: str, key: str | None = None) -> nullcontext[NullOperation]:
+        return self._context
+
+
+DISABLED = _Disabled()
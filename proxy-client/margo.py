@@ -1,12 +1,19 @@
-"""RedisStore Implementation."""
+"""RedisStore Implementation.
+
+Like :mod:`rdma`, this module and the client modules it uses are imported
+by their bare name, with the ``proxy-client`` directory on ``sys.path``.
+"""
 from __future__ import annotations
 
 import logging
-import time
 
 import redis
 
-from proxystore.store.rdma_interface import RDMA
+from rdma_interface import RDMA
+from compression import Compressor
+import instrument
+from shm_cache import SharedCache
+from store_mixin import RDMAStoreMixin
 
 from proxystore.store.base import Store
 
@@ -14,7 +21,7 @@ logger = logging.getLogger(__name__)
 
 
 is_init = False
-class MargoStore(Store):
+class MargoStore(RDMAStoreMixin, Store):
     """Redis backend class."""
 
     def __init__(
@@ -25,7 +32,12 @@ class MargoStore(Store):
         provider_id: int,
         cache_size: int = 16,
         stats: bool = False,
-        _mochi : RDMA | None = None, #temp hack to not start up client multiple times
+        pool_limit: int = 256 * 1024**2,
+        shared_cache: str | None = None,
+        shared_cache_size: int = 1024**3,
+        compression: bool = False,
+        codecs: list[str] | None = None,
+        phase_trace: bool = False,
     ) -> None:
         """Init RedisStore.
 
@@ -36,42 +48,75 @@ class MargoStore(Store):
             cache_size (int): size of LRU cache (in # of objects). If 0,
                 the cache is disabled. The cache is local to the Python
                 process (default: 16).
-            stats (bool): collect stats on store operations (default: False).
+            stats (bool): collect stats on store operations, and on the
+                phases of each of them (default: False).
+            pool_limit (int): cap in bytes on the registered memory kept by
+                the client buffer pool (default: 256 MB). The pool belongs to
+                the margo client session shared by all stores of the process.
+            shared_cache (str): name of a node-local cache in ``/dev/shm``
+                shared by all the processes of the node that use it, looked up
+                after the per-process cache, or None for none (default: None).
+            shared_cache_size (int): bytes the shared cache may take
+                (default: 1 GB).
+            compression (bool): compress the objects for which it saves
+                time on the link (default: False).
+            codecs (list): names of the codecs compression may use, all the
+                available ones (zlib, and lz4 or zstd when installed) if None
+                (default: None).
+            phase_trace (bool): with ``stats=True``, also keep the phases of
+                the recent operations for :func:`write_phase_trace()`
+                (default: False).
         """
         self.addr = addr_str
         self.provider_id = provider_id
-        if _mochi is None:
-            self._mochi = RDMA(addr=addr_str, provider_id=provider_id)
-        else:
-            self._mochi = _mochi
-        
+        self.pool_limit = pool_limit
+        self.shared_cache = shared_cache
+        self.shared_cache_size = shared_cache_size
+        if shared_cache is not None:
+            self._shm = SharedCache(shared_cache, shared_cache_size)
+        self.compression = compression
+        self.codecs = codecs
+        self.phase_trace = phase_trace
+        if compression:
+            self._compressor = Compressor(codecs)
+        # RDMA attaches to the process-wide client session, so re-creating
+        # the store (e.g. when a factory resolves) does not start a new engine
+        self._rdma = RDMA(
+            addr=addr_str,
+            provider_id=provider_id,
+            pool_limit=pool_limit,
+        )
+
         super().__init__(
             name,
             cache_size=cache_size,
             stats=stats,
-            kwargs={'addr_str': self.addr, 'provider_id': self.provider_id, '_mochi': self._mochi },
+            kwargs={
+                'addr_str': self.addr, 'provider_id': self.provider_id, 'pool_limit': self.pool_limit,
+                'shared_cache': self.shared_cache, 'shared_cache_size': self.shared_cache_size,
+                'compression': self.compression, 'codecs': self.codecs,
+                'phase_trace': self.phase_trace,
+            },
         )
+        if self._stats is not None:
+            self._phases = instrument.Phases(self._stats, trace=phase_trace)
 
-    def evict(self, key: str) -> None:
-        self._cache.evict(key)
-        logger.debug(
-            f"EVICT key='{key}' FROM {self.__class__.__name__}"
-            f"(name='{self.name}')",
-        )
+    @property
+    def pool_size(self) -> int:
+        """Bytes of registered memory held by the client buffer pool."""
+        return self._rdma.pool.size
+
+    @property
+    def pool_hit_rate(self) -> float:
+        """Fraction of transfers served by an already registered region."""
+        return self._rdma.pool.hit_rate
 
     def exists(self, key: str) -> bool:
-        return bool(self._mochi.exists(key))
+        return bool(self._rdma.exists(key))
 
     def get_bytes(self, key: str) -> bytes | None:
-        return self._mochi.get(key)
-
-    def get_timestamp(self, key: str) -> float:
-        value = self._mochi.get(key + '_timestamp')
-        if value is None:
-            raise KeyError(f"Key='{key}' does not exist in Redis store")
-        return float(value.decode())
+        return self._get_raw(key)
 
     def set_bytes(self, key: str, data: bytes) -> None:
-        # We store the creation time for the key as a separate redis key-value.
-        self._mochi.set(key + '_timestamp', str(time.time()).encode())
-        self._mochi.set(key, data)
+        # the creation time is sent along and kept in the object metadata
+        self._put(key, data)
@@ -0,0 +1,123 @@
+"""Pickle protocol 5 serialization with out-of-band buffers.
+
+Objects holding large contiguous buffers (NumPy arrays, ``bytearray``,
+``memoryview`` and anything else pickled through :class:`pickle.PickleBuffer`)
+are serialized to a list of segments instead of a single ``bytes``::
+
+    header | sizes | pickle | pad | buffer 0 | pad | buffer 1 ...
+
+where header is ``<II`` (pickle length, number of buffers) and sizes holds
+one ``<Q`` per buffer. Every buffer starts on an `ALIGNMENT` byte boundary
+of the value. The segments reference the memory of the object itself, so
+the client registers them as the segments of one bulk handle and the value
+leaves the process without being copied. On the way back the buffers are
+handed to :func:`pickle.loads` as views into the receive buffer.
+
+Values serialized this way are flagged :data:`OUT_OF_BAND` in the flags of
+their metadata. Objects without a buffer worth sending out-of-band come back
+serialized in-band instead, as by :func:`proxystore.serialize.serialize`,
+from the same pickling pass.
+"""
+from __future__ import annotations
+
+import pickle
+import struct
+from typing import Any
+
+import cloudpickle
+import proxystore as ps
+
+# object flag of values in the out-of-band format
+OUT_OF_BAND = 0x1
+
+ALIGNMENT = 64
+
+HEADER = struct.Struct("<II")
+SIZE = struct.Struct("<Q")
+
+_PADDING = bytes(ALIGNMENT)
+
+# identifiers of the pickled values of proxystore.serialize
+_PICKLE = b"03\n"
+_CLOUDPICKLE = b"04\n"
+
+
+def dumps(obj: Any, min_size: int = 64 * 1024) -> list[Any] | bytes:
+    """Serialize `obj` with its large buffers out-of-band.
+
+    Args:
+        obj: object to serialize.
+        min_size (int): smallest buffer worth sending out-of-band, the
+            smaller ones are pickled in-band (default: 64 KB).
+
+    Returns:
+        list of buffer-protocol segments of the serialized value, or, if
+        `obj` has no buffer of `min_size` bytes, the ``bytes`` of `obj`
+        serialized in-band in the format of
+        :func:`proxystore.serialize.serialize`.
+    """
+    if isinstance(obj, (bytes, str)):
+        return ps.serialize.serialize(obj)
+
+    buffers: list[pickle.PickleBuffer] = []
+
+    def out_of_band(buf: pickle.PickleBuffer) -> bool:
+        # a false value sends the buffer out-of-band
+        if memoryview(buf).nbytes < min_size:
+            return True
+        buffers.append(buf)
+        return False
+
+    try:
+        data = pickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+        identifier = _PICKLE
+    except Exception:
+        buffers.clear()
+        data = cloudpickle.dumps(obj, protocol=5, buffer_callback=out_of_band)
+        identifier = _CLOUDPICKLE
+    if not buffers:
+        return identifier + data
+
+    raws = [buf.raw() for buf in buffers]
+
+    head = bytearray(HEADER.pack(len(data), len(raws)))
+    for raw in raws:
+        head += SIZE.pack(raw.nbytes)
+
+    segments: list[Any] = [head, data]
+    offset = len(head) + len(data)
+    for raw in raws:
+        pad = -offset % ALIGNMENT
+        if pad:
+            segments.append(_PADDING[:pad])
+        segments.append(raw)
+        offset += pad + raw.nbytes
+    return segments
+
+
+def loads(data: Any) -> Any:
+    """Deserialize a value produced by :func:`dumps()`.
+
+    The buffers of the returned object are views into `data`, which must
+    stay alive as long as the object. A read-only `data` is copied once so
+    that the buffers are writable, as they were when serialized.
+    """
+    view = memoryview(data).cast("B")
+    if view.readonly:
+        view = memoryview(bytearray(view))
+
+    length, count = HEADER.unpack_from(view)
+    offset = HEADER.size
+    sizes = []
+    for _ in range(count):
+        sizes.append(SIZE.unpack_from(view, offset)[0])
+        offset += SIZE.size
+
+    payload = view[offset : offset + length]
+    offset += length
+    buffers = []
+    for size in sizes:
+        offset += -offset % ALIGNMENT
+        buffers.append(view[offset : offset + size])
+        offset += size
+    return pickle.loads(payload, buffers=buffers)
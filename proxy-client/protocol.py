@@ -0,0 +1,467 @@
+"""Binary wire protocol shared by the RDMA clients and servers.
+
+Every RPC carries one binary message instead of a JSON document. A request
+is a fixed 24 byte header followed by the key and the serialized bulk handle
+of the client buffer, if the operation moves data::
+
+    version u8 | flags u8 | key length u16 | bulk length u32 | size u64
+    | timestamp f64
+    key bytes | bulk descriptor bytes
+
+For a ``set``, `flags` and `timestamp` are stored with the value as part of
+its metadata. A response is a fixed 16 byte record, followed by the 32 byte
+metadata of the object when the ``HAS_METADATA`` flag is set::
+
+    status i32 | flags u32 | value u64
+    [timestamp f64 | size u64 | version u64 | flags u32 | reserved u32]
+
+where `value` is the number of bytes transferred for ``get``/``set``, the
+object size for ``get_size``, 0 or 1 for ``exists`` and the number of
+values saved for ``snapshot``. A ``get`` whose
+`size` (the capacity of the client buffer) is too small for the value
+transfers nothing and answers ``OVERFLOW`` with the size of the value.
+``get``, ``set`` and ``stat`` answer with the metadata, which the server
+keeps in a fixed header next to the value, so ``stat`` needs no bulk
+transfer. The version is assigned by the server and grows with each set of
+a key.
+
+Batch RPCs (``get_many``, ``set_many``, ``exists_many``, ``delete_many``)
+carry a key vector and a single scatter/gather region holding the values
+back to back in key order::
+
+    version u8 | flags u8 | reserved u16 | count u32 | bulk length u32 | size u64
+    | timestamp f64
+    key lengths u16[count] | sizes u64[count] | keys | bulk descriptor
+
+and are answered with a response record whose `value` is `count`, followed
+by a status and a value per key, and by the metadata of each key for
+``get_many`` and ``set_many``::
+
+    status i32 | flags u32 | count u64 | status u8[count] | value u64[count]
+    [metadata[count]]
+
+For ``get_many`` the server packs the values that fit in the client region
+back to back, skipping the keys it answers with ``NOT_FOUND`` or
+``OVERFLOW``.
+
+Objects larger than ``CHUNK_SIZE`` are moved with ``set_chunk`` and
+``get_chunk`` requests, several of them in flight at once. A chunk request
+is a regular request followed by a 16 byte trailer::
+
+    offset u64 | total u64
+
+where `size` is the length of the chunk, `offset` its position in the
+object and `total` the object size. The bulk handle of a chunk request
+covers the whole object on the client and the chunk sits at `offset` in it,
+so a single registration serves every chunk. Offsets are multiples of
+``CHUNK_SIZE`` so that servers with a per-value size limit (Redis strings
+are capped at 512 MB) can store one chunk per entry. The object becomes
+visible once all of its chunks are stored. A ``get_chunk`` response holds
+the number of bytes pushed and the metadata of the object, whose version
+lets the client detect an object that changed between chunks.
+
+The ``snapshot`` RPC takes a regular request, whose key is ignored, and
+saves the values of the server so that they survive a restart: the Python
+provider writes its snapshot file, the C server writes its pending values
+to Redis and has Redis save its dataset in the background. The response
+`value` is the number of values saved, the number of Redis keys for the C
+server.
+
+The ``stats`` RPC takes a regular request, whose key is ignored, and
+answers with a metrics snapshot of the server: a response record whose
+`value` is the number of counter records that follow a 56 byte header::
+
+    status i32 | flags u32 | count u64
+    | uptime f64 | memory used u64 | memory limit u64 | items u64
+    | evictions u64 | dirty u64 | active u32 | queued u32
+    rpc[count]
+
+where `dirty` counts the values not yet written to the backing store,
+`active` the handlers running and `queued` those waiting for a handler
+thread (0 where the server cannot tell). Each counter record covers one
+RPC type, or the bulk pulls and pushes of the server as the ``pull`` and
+``push`` records::
+
+    name 16 bytes | calls u64 | errors u64 | bytes in u64 | bytes out u64
+    | latency u64 | max latency u64 | buckets u64[LATENCY_BUCKETS]
+
+with the name NUL padded, bytes in and out pulled from and pushed to the
+clients, and latencies in nanoseconds: the total, the largest, and a log2
+histogram whose bucket ``i`` counts the calls that took ``[2**i,
+2**(i + 1))`` ns, the last one everything longer. The counters grow from
+the start of the server, rates come from the difference of two snapshots.
+
+All integers are little-endian. The bulk descriptor is the native
+``margo_bulk_serialize`` form so that the C server
+(``proxy-server/protocol.h``), the ``rdma_transfer`` extension and the
+Python provider all read the same bytes.
+"""
+from __future__ import annotations
+
+import base64
+import struct
+from typing import Any
+from typing import NamedTuple
+
+VERSION = 2
+
+REQUEST = struct.Struct("<BBHIQd")
+RESPONSE = struct.Struct("<iIQ")
+METADATA = struct.Struct("<dQQI4x")
+BATCH_REQUEST = struct.Struct("<BBHIIQd")
+CHUNK = struct.Struct("<QQ")
+
+# log2 buckets of the latency histograms, up to 2**39 ns (about 9 minutes)
+LATENCY_BUCKETS = 40
+
+STATS = struct.Struct("<dQQQQQII")
+RPC_STATS = struct.Struct(f"<16s6Q{LATENCY_BUCKETS}Q")
+
+# objects larger than this are split into chunks of this size
+CHUNK_SIZE = 64 * 1024**2
+
+# response flags
+HAS_METADATA = 0x1
+
+# response status
+OK = 0
+NOT_FOUND = 1
+ERROR = 2
+OVERFLOW = 3
+
+
+class RDMAError(RuntimeError):
+    """Raised when a peer reports a failure or sends a malformed message."""
+
+
+class Metadata(NamedTuple):
+    """Metadata stored by the server next to a value."""
+
+    timestamp: float
+    size: int
+    version: int = 0
+    flags: int = 0
+
+
+class Request(NamedTuple):
+    """Decoded request message."""
+
+    key: str
+    size: int
+    descriptor: bytes
+    flags: int = 0
+    timestamp: float = 0.0
+
+
+class ChunkRequest(NamedTuple):
+    """Decoded chunk request message."""
+
+    key: str
+    size: int
+    descriptor: bytes
+    offset: int
+    total: int
+    flags: int = 0
+    timestamp: float = 0.0
+
+
+class BatchRequest(NamedTuple):
+    """Decoded batch request message."""
+
+    keys: list[str]
+    sizes: list[int]
+    size: int
+    descriptor: bytes
+    flags: int = 0
+    timestamp: float = 0.0
+
+
+class Response(NamedTuple):
+    """Decoded response message."""
+
+    status: int
+    value: int = 0
+    flags: int = 0
+    metadata: Metadata | None = None
+
+
+class BatchResponse(NamedTuple):
+    """Decoded batch response message."""
+
+    status: int
+    statuses: list[int]
+    values: list[int]
+    metadata: list[Metadata] | None = None
+
+
+class RPCStats(NamedTuple):
+    """Counters of an RPC type since the start of a server."""
+
+    name: str
+    calls: int = 0
+    errors: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    # nanoseconds
+    latency: int = 0
+    max_latency: int = 0
+    histogram: tuple[int, ...] = (0,) * LATENCY_BUCKETS
+
+
+class Stats(NamedTuple):
+    """Metrics snapshot of a server."""
+
+    uptime: float
+    memory_used: int
+    memory_limit: int
+    items: int
+    evictions: int
+    dirty: int
+    active: int
+    queued: int
+    rpcs: dict[str, RPCStats]
+
+
+def latency_bucket(ns: int) -> int:
+    """Return the histogram bucket of a latency of `ns` nanoseconds."""
+    return min(max(ns, 1).bit_length() - 1, LATENCY_BUCKETS - 1)
+
+
+def bulk_descriptor(blk: Any) -> bytes:
+    """Return the native serialized form of a pymargo bulk handle."""
+    # pymargo only exposes the serialized handle as base64, callers cache the
+    # result for long-lived regions so this runs once per registration
+    return base64.b64decode(blk.to_base64())
+
+
+def bulk_from_descriptor(engine: Any, descriptor: bytes) -> Any:
+    """Rebuild a remote bulk handle from its native serialized form."""
+    # imported here so that the message encoding works without pymargo
+    from pymargo.bulk import Bulk
+
+    return Bulk.from_base64(engine, base64.b64encode(descriptor).decode())
+
+
+def encode_request(
+    key: str,
+    size: int = 0,
+    descriptor: bytes = b"",
+    flags: int = 0,
+    timestamp: float = 0.0,
+) -> bytes:
+    """Encode a request message."""
+    k = key.encode()
+    header = REQUEST.pack(VERSION, flags, len(k), len(descriptor), size, timestamp)
+    return header + k + descriptor
+
+
+def decode_request(msg: bytes) -> Request:
+    """Decode a request message.
+
+    Raises:
+        RDMAError:
+            if the message is truncated or uses another protocol version.
+    """
+    if len(msg) < REQUEST.size:
+        raise RDMAError(f"Truncated request of {len(msg)} bytes")
+    version, flags, key_len, bulk_len, size, timestamp = REQUEST.unpack_from(msg)
+    if version != VERSION:
+        raise RDMAError(f"Unsupported protocol version {version}")
+    start = REQUEST.size
+    end = start + key_len
+    if end + bulk_len > len(msg):
+        raise RDMAError(f"Truncated request of {len(msg)} bytes")
+    key = bytes(msg[start:end]).decode()
+    return Request(key, size, bytes(msg[end : end + bulk_len]), flags, timestamp)
+
+
+def encode_chunk_request(
+    key: str,
+    offset: int,
+    total: int,
+    size: int,
+    descriptor: bytes,
+    flags: int = 0,
+    timestamp: float = 0.0,
+) -> bytes:
+    """Encode a chunk request message."""
+    request = encode_request(key, size, descriptor, flags, timestamp)
+    return request + CHUNK.pack(offset, total)
+
+
+def decode_chunk_request(msg: bytes) -> ChunkRequest:
+    """Decode a chunk request message.
+
+    Raises:
+        RDMAError:
+            if the message is truncated or uses another protocol version.
+    """
+    req = decode_request(msg)
+    if len(msg) < REQUEST.size + len(req.key.encode()) + len(req.descriptor) + CHUNK.size:
+        raise RDMAError(f"Truncated chunk request of {len(msg)} bytes")
+    offset, total = CHUNK.unpack_from(msg, len(msg) - CHUNK.size)
+    return ChunkRequest(
+        req.key, req.size, req.descriptor, offset, total, req.flags, req.timestamp,
+    )
+
+
+def encode_response(
+    status: int = OK,
+    value: int = 0,
+    flags: int = 0,
+    metadata: Metadata | None = None,
+) -> bytes:
+    """Encode a response message, with the object metadata if given."""
+    if metadata is None:
+        return RESPONSE.pack(status, flags, value)
+    return RESPONSE.pack(status, flags | HAS_METADATA, value) + METADATA.pack(*metadata)
+
+
+def decode_response(msg: bytes) -> Response:
+    """Decode a response message.
+
+    Raises:
+        RDMAError:
+            if the message is truncated.
+    """
+    if len(msg) < RESPONSE.size:
+        raise RDMAError(f"Truncated response of {len(msg)} bytes")
+    status, flags, value = RESPONSE.unpack_from(msg)
+    metadata = None
+    if flags & HAS_METADATA:
+        if len(msg) < RESPONSE.size + METADATA.size:
+            raise RDMAError(f"Truncated response of {len(msg)} bytes")
+        metadata = Metadata(*METADATA.unpack_from(msg, RESPONSE.size))
+    return Response(status, value, flags, metadata)
+
+
+def encode_batch_request(
+    keys: list[str],
+    sizes: list[int] | None = None,
+    size: int = 0,
+    descriptor: bytes = b"",
+    flags: int = 0,
+    timestamp: float = 0.0,
+) -> bytes:
+    """Encode a batch request message."""
+    encoded = [k.encode() for k in keys]
+    n = len(encoded)
+    if sizes is None:
+        sizes = [0] * n
+    return b"".join(
+        (
+            BATCH_REQUEST.pack(VERSION, flags, 0, n, len(descriptor), size, timestamp),
+            struct.pack(f"<{n}H", *(len(k) for k in encoded)),
+            struct.pack(f"<{n}Q", *sizes),
+            *encoded,
+            descriptor,
+        ),
+    )
+
+
+def decode_batch_request(msg: bytes) -> BatchRequest:
+    """Decode a batch request message.
+
+    Raises:
+        RDMAError:
+            if the message is truncated or uses another protocol version.
+    """
+    if len(msg) < BATCH_REQUEST.size:
+        raise RDMAError(f"Truncated batch request of {len(msg)} bytes")
+    version, flags, _, n, bulk_len, size, timestamp = BATCH_REQUEST.unpack_from(msg)
+    if version != VERSION:
+        raise RDMAError(f"Unsupported protocol version {version}")
+    offset = BATCH_REQUEST.size
+    if offset + 10 * n > len(msg):
+        raise RDMAError(f"Truncated batch request of {len(msg)} bytes")
+    key_lens = struct.unpack_from(f"<{n}H", msg, offset)
+    offset += 2 * n
+    sizes = list(struct.unpack_from(f"<{n}Q", msg, offset))
+    offset += 8 * n
+    if offset + sum(key_lens) + bulk_len > len(msg):
+        raise RDMAError(f"Truncated batch request of {len(msg)} bytes")
+    keys = []
+    for key_len in key_lens:
+        keys.append(bytes(msg[offset : offset + key_len]).decode())
+        offset += key_len
+    descriptor = bytes(msg[offset : offset + bulk_len])
+    return BatchRequest(keys, sizes, size, descriptor, flags, timestamp)
+
+
+def encode_batch_response(
+    statuses: list[int],
+    values: list[int],
+    status: int = OK,
+    metadata: list[Metadata] | None = None,
+) -> bytes:
+    """Encode a batch response message, with per key metadata if given."""
+    n = len(statuses)
+    parts = [
+        RESPONSE.pack(status, 0 if metadata is None else HAS_METADATA, n),
+        struct.pack(f"<{n}B", *statuses),
+        struct.pack(f"<{n}Q", *values),
+    ]
+    if metadata is not None:
+        parts += [METADATA.pack(*m) for m in metadata]
+    return b"".join(parts)
+
+
+def decode_batch_response(msg: bytes) -> BatchResponse:
+    """Decode a batch response message.
+
+    Raises:
+        RDMAError:
+            if the message is truncated.
+    """
+    if len(msg) < RESPONSE.size:
+        raise RDMAError(f"Truncated batch response of {len(msg)} bytes")
+    status, flags, n = RESPONSE.unpack_from(msg)
+    if status == ERROR:
+        return BatchResponse(status, [], [])
+    with_metadata = flags & HAS_METADATA
+    if len(msg) < RESPONSE.size + (9 + (METADATA.size if with_metadata else 0)) * n:
+        raise RDMAError(f"Truncated batch response of {len(msg)} bytes")
+    statuses = list(struct.unpack_from(f"<{n}B", msg, RESPONSE.size))
+    values = list(struct.unpack_from(f"<{n}Q", msg, RESPONSE.size + n))
+    metadata = None
+    if with_metadata:
+        offset = RESPONSE.size + 9 * n
+        metadata = [
+            Metadata(*METADATA.unpack_from(msg, offset + i * METADATA.size))
+            for i in range(n)
+        ]
+    return BatchResponse(status, statuses, values, metadata)
+
+
+def encode_stats(stats: Stats) -> bytes:
+    """Encode a metrics snapshot as the response of the ``stats`` RPC."""
+    rpcs = list(stats.rpcs.values())
+    return b"".join(
+        (
+            RESPONSE.pack(OK, 0, len(rpcs)),
+            STATS.pack(*stats[:-1]),
+            *(RPC_STATS.pack(r.name.encode(), *r[1:-1], *r.histogram) for r in rpcs),
+        ),
+    )
+
+
+def decode_stats(msg: bytes) -> Stats:
+    """Decode the response of the ``stats`` RPC.
+
+    Raises:
+        RDMAError:
+            if the server failed or the message is truncated.
+    """
+    if len(msg) < RESPONSE.size:
+        raise RDMAError(f"Truncated stats response of {len(msg)} bytes")
+    status, _, n = RESPONSE.unpack_from(msg)
+    if status != OK:
+        raise RDMAError(f"Stats failed with status {status}")
+    if len(msg) < RESPONSE.size + STATS.size + n * RPC_STATS.size:
+        raise RDMAError(f"Truncated stats response of {len(msg)} bytes")
+    rpcs = {}
+    for i in range(n):
+        name, *counters = RPC_STATS.unpack_from(msg, RESPONSE.size + STATS.size + i * RPC_STATS.size)
+        name = name.rstrip(b"\0").decode()
+        rpcs[name] = RPCStats(name, *counters[:6], tuple(counters[6:]))
+    return Stats(*STATS.unpack_from(msg, RESPONSE.size), rpcs)
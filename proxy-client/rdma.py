@@ -1,21 +1,37 @@
-"""RDMAStore Implementation."""
+"""RDMAStore Implementation.
+
+The modules of ``proxy-client`` import each other by their bare name, so
+the directory itself goes on ``sys.path`` (``PYTHONPATH``), as the
+examples, the benchmark and the proxy server do, rather than being copied
+into the ``proxystore.store`` package. Loading them under both names would
+give two copies of every module and of its state.
+"""
 from __future__ import annotations
 
 import logging
-import time
-import struct  # need to handle this in rdma_transfer.c instead
 from typing import Any
 
-
 import proxystore as ps
 from proxystore.store.remote import RemoteFactory
 from proxystore.store.remote import RemoteStore
 
+import instrument
+from rdma_interface import RDMA
+from compression import Compressor
+from sharding import ShardedRDMA
+from shm_cache import SharedCache
+from store_mixin import RDMAStoreMixin
+
 logger = logging.getLogger(__name__)
 
 
 class RDMAFactory(RemoteFactory):
-    """Factory for Instances of RDMAStore."""
+    """Factory for Instances of RDMAStore.
+
+    Resolving re-creates the store from `store_kwargs` when it is not
+    registered in this process, which attaches to the existing margo client
+    session instead of starting a new engine.
+    """
 
     def __init__(
         self,
@@ -53,17 +69,25 @@ class RDMAFactory(RemoteFactory):
         )
 
 
-class RDMAStore(RemoteStore):
+class RDMAStore(RDMAStoreMixin, RemoteStore):
     """Redis backend class."""
 
     def __init__(
         self,
         name: str,
         *,
-        addr: str,
-        store: dict,
+        addr: str | None = None,
         provider: int = 42,
-        max_transfer: int = (514*1024**2) // 4,
+        peer_dir: str | None = None,
+        replicas: int = 1,
+        hot_threshold: int | None = None,
+        pool_limit: int = 256 * 1024**2,
+        shared_cache: str | None = None,
+        shared_cache_size: int = 1024**3,
+        compression: bool = False,
+        codecs: list[str] | None = None,
+        phase_trace: bool = False,
+        native: bool = False,
         **kwargs: Any,
     ) -> None:
         """Init RDMAStore.
@@ -71,14 +95,72 @@ class RDMAStore(RemoteStore):
         Args:
             name (str): name of the store instance.
             addr (str): RDMA server address in the form <protocol>://<ip>:<port>.
+            provider (int): provider id of the server (default: 42).
+            peer_dir (str): directory of the peers started by
+                ``RDMAClient``. If given, keys are sharded over those peers
+                (see :class:`ShardedRDMA <sharding.ShardedRDMA>`) instead of
+                going to `addr`.
+            replicas (int): number of peers of `peer_dir` each object is
+                written to (default: 1).
+            hot_threshold (int): reads of an object within a second that
+                copy it to more peers of `peer_dir`, or None to never do so
+                (default: None).
+            pool_limit (int): cap in bytes on the registered memory kept by
+                the client buffer pool of the shared session (default: 256 MB).
+            shared_cache (str): name of a node-local
+                :class:`SharedCache <shm_cache.SharedCache>` in ``/dev/shm``
+                shared by all the processes of the node that use it, or None
+                for none (default: None).
+            shared_cache_size (int): bytes the shared cache may take
+                (default: 1 GB).
+            compression (bool): compress the objects for which it saves
+                time on the link (default: False).
+            codecs (list): names of the codecs compression may use, all the
+                available ones (zlib, and lz4 or zstd when installed) if None
+                (default: None).
+            phase_trace (bool): with ``stats=True``, also keep the phases of
+                the recent operations for :func:`write_phase_trace()`
+                (default: False).
+            native (bool): with `addr`, make the single-key calls on values
+                of at most one chunk through the ``rdma_transfer``
+                extension if it is built, and not connected to another
+                server by another store of the process (default: False).
             kwargs (dict): additional keyword arguments to pass to
                 :class:`RemoteStore <proxystore.store.remote.RemoteStore>`.
+                With ``stats=True`` the phases of every operation are timed
+                as well (see :mod:`instrument`).
+
+        Raises:
+            ValueError:
+                if neither `addr` nor `peer_dir` is given.
         """
+        if addr is None and peer_dir is None:
+            raise ValueError("RDMAStore needs an addr or a peer_dir")
         self.addr = addr
         self.provider = provider
-        self.max_transfer = max_transfer
-        self.store = store
+        self.peer_dir = peer_dir
+        self.replicas = replicas
+        self.hot_threshold = hot_threshold
+        self.pool_limit = pool_limit
+        self.shared_cache = shared_cache
+        self.shared_cache_size = shared_cache_size
+        if shared_cache is not None:
+            self._shm = SharedCache(shared_cache, shared_cache_size)
+        self.compression = compression
+        self.codecs = codecs
+        self.phase_trace = phase_trace
+        self.native = native
+        if compression:
+            self._compressor = Compressor(codecs)
+        if peer_dir is not None:
+            self._rdma = ShardedRDMA(
+                peer_dir, replicas=replicas, hot_threshold=hot_threshold, pool_limit=pool_limit,
+            )
+        else:
+            self._rdma = RDMA(addr, provider, pool_limit=pool_limit, native=native)
         super().__init__(name, **kwargs)
+        if self._stats is not None:
+            self._phases = instrument.Phases(self._stats, trace=phase_trace)
 
     def _kwargs(
         self,
@@ -92,22 +174,15 @@ class RDMAStore(RemoteStore):
         """
         if kwargs is None:
             kwargs = {}
-        kwargs.update({"addr": self.addr, "store": self.store, "max_transfer": self.max_transfer, "provider": self.provider })
+        kwargs.update({
+            "addr": self.addr, "provider": self.provider, "peer_dir": self.peer_dir,
+            "replicas": self.replicas, "hot_threshold": self.hot_threshold, "pool_limit": self.pool_limit,
+            "shared_cache": self.shared_cache, "shared_cache_size": self.shared_cache_size,
+            "compression": self.compression, "codecs": self.codecs, "phase_trace": self.phase_trace,
+            "native": self.native,
+        })
         return super()._kwargs(kwargs)
 
-    def evict(self, key: str) -> None:
-        """Evict object associated with key from Redis.
-
-        Args:
-            key (str): key corresponding to object in store to evict.
-        """
-
-        # TODO: implement in rdma transfer
-        self._cache.evict(key)
-        logger.debug(
-            f"EVICT key='{key}' FROM {self.__class__.__name__}" f"(name='{self.name}')",
-        )
-
     def exists(self, key: str) -> bool:
         """Check if key exists in Redis.
 
@@ -117,8 +192,7 @@ class RDMAStore(RemoteStore):
         Returns:
             `bool`
         """
-        # TODO: implement in rdma transfer
-        return False
+        return self._rdma.exists(key)
 
     def get_bytes(self, key: str) -> bytes | None:
         """Get serialized object from Remote location.
@@ -129,44 +203,7 @@ class RDMAStore(RemoteStore):
         Returns:
             serialized object or `None` if it does not exist.
         """
-        with Engine('tcp', mode=pymargo.client) as engine:
-            rpc_id = engine.register("get")
-            buff = np.array([" " * self.max_transfer], dtype=bytes)  # equivalent to malloc
-            blk = engine.create_bulk(buff, bulk.read_write)
-            s = blk.to_base64()
-            call_rpc_on(engine, rpc_id, self.addr, self.provider, s, key, self.max_transfer)
-            print(buff[0].strip())
-        if key not in self.store:
-            return None
-        return self.store[key] #buff[0].strip()
-
-    def get_timestamp(self, key: str) -> float:
-        """Get timestamp of most recent object version in the store.
-
-        Args:
-            key (str): key corresponding to object.
-
-        Returns:
-            timestamp (float) of when key was added to remote server (seconds since
-            epoch).
-
-        Raises:
-            KeyError:
-                if `key` does not exist in store.
-        """
-        with Engine('tcp', mode=pymargo.client) as engine:
-            rpc_id = engine.register("get")
-            buff = np.array([" " * self.max_transfer], dtype=str)  # equivalent to malloc
-            blk = engine.create_bulk(buff, bulk.read_write)
-            s = blk.to_base64()
-            call_rpc_on(engine, rpc_id, self.addr, self.provider, s, key + "_timestamp", self.max_transfer)
-            value = buff[0:10].strip()
-
-            if value is None:
-                raise KeyError(f"Key='{key}' does not exist on the remote server")
-
-        print("val", value)
-        return self.store[key + "_timestamp"] #time.time() #value.decode("utf-8")  # struct.unpack("<d", value)
+        return self._get_raw(key)
 
     def proxy(  # type: ignore[override]
         self,
@@ -197,7 +234,6 @@ class RDMAStore(RemoteStore):
             ValueError:
                 if `key` and `obj` are both `None`.
         """
-        print("test")
         return super().proxy(obj, key=key, factory=factory, **kwargs)
 
     def set_bytes(self, key: str, data: bytes) -> None:
@@ -209,25 +245,5 @@ class RDMAStore(RemoteStore):
         """
         if not isinstance(data, bytes):
             raise TypeError(f"data must be of type bytes. Found {type(data)}")
-        # We store the creation time for the key as a separate file.
-        with Engine('tcp', mode=pymargo.client) as engine:
-            rpc_id = engine.register("set")
-            buff = np.array([str(time.time()).encode()], dtype=str)  # equivalent to malloc
-            blk = engine.create_bulk(buff, bulk.read_write)
-            print(buff[0])
-            s = blk.to_base64()
-            call_rpc_on(engine, rpc_id, self.addr, self.provider, s, key + "_timestamp", len(buff))
-            buff = np.array([data], dtype=bytes)  # equivalent to malloc
-            blk = engine.create_bulk(buff, bulk.read_write)
-            s = blk.to_base64()
-            call_rpc_on(engine, rpc_id, self.addr, self.provider, s, key, len(data))
-        self.store[key + "_timestamp"] = time.time()
-        self.store[key] = data
-
-
-def call_rpc_on(engine, rpc_id, addr_str, provider_id, array_str, key, size):
-    addr = engine.lookup(addr_str)
-    handle = engine.create_handle(addr, rpc_id)
-    data = {"key": key, "size": size, "buffer": array_str}  # , "buffer": array_str }
-    serialized = json.dumps(data)
-    return handle.forward(provider_id, serialized)
+        # the creation time is sent along and kept in the object metadata
+        self._put(key, data)
@@ -1,59 +1,554 @@
 #!/usr/bin/env python
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import suppress
+
 import numpy as np
-import pymargo
-from pymargo.core import Engine
-import pymargo.bulk as bulk
-import json
+
+import instrument
+import protocol
+from completion import background, completed, gather
+from session import Session, protocol_of
+
+try:
+    import rdma_transfer
+except ImportError:
+    # the native client is optional, built with setup.py
+    rdma_transfer = None
+
+# (address, provider id) the native client is connected to, it holds a
+# single connection per process
+_native_server = None
+_native_lock = threading.Lock()
+
+
+def _connect_native(addr, provider_id):
+    # whether the native client serves addr, connecting it on first use
+    global _native_server
+    if rdma_transfer is None:
+        return False
+    with _native_lock:
+        if _native_server is None:
+            if rdma_transfer.connect(addr, provider_id) != 0:
+                return False
+            _native_server = (addr, provider_id)
+        return _native_server == (addr, provider_id)
 
 
 class RDMA:
 
-    def __init__(self, addr, provider_id, max_size = 50*1024**2):
-        self.engine = Engine('tcp', mode=pymargo.client) 
-        #self.addr = self.engine.lookup(addr)
+    # capacity offered by a get when nothing is known about the value size
+    get_capacity = 64 * 1024
+    # number of keys whose last seen size is remembered to size get buffers
+    max_size_hints = 4096
+    # values larger than this move in chunks of this size, it must match the
+    # chunk size of the server
+    chunk_size = protocol.CHUNK_SIZE
+    # number of chunk requests of one value in flight at once
+    chunk_window = 8
+
+    def __init__(self, addr, provider_id, max_size = 50*1024**2, pool_limit = 256*1024**2, session = None,
+                 native = False):
+        # with native=True, single-key calls on values up to chunk_size go
+        # through the rdma_transfer extension when it is built and not yet
+        # connected to another server: a plain RPC whose wait releases the
+        # GIL, without a pooled region or a handle of the session
+        if session is None:
+            session = Session.get(protocol_of(addr), pool_limit=pool_limit)
+        self.session = session
+        self.engine = session.engine
+        self.pool = session.pool
         self.addr = addr
         self.provider_id = provider_id
         #self.max_size = max_size
-        #self.rpcs = { "get": self.engine.register("get"), "set": self.engine.register("set") }
+        self._size_hints = OrderedDict()
+        self._hints_lock = threading.Lock()
+        self.native = native and _connect_native(addr, provider_id)
 
-    def set(self, key, value):
-        #with Engine('tcp', mode=pymargo.client) as engine:
-        buff = np.chararray(shape=len(value), buffer=value)  # equivalent to malloc
-        blk = self.engine.create_bulk(buff, bulk.read_write)
-        s = blk.to_base64()
-        self.call_rpc_on(self.engine.register("set"), s, key, buff.size*buff.itemsize)
-        return None
+    def set(self, key, value, timestamp=None, flags=0):
+        # timestamp and flags travel in the request and are kept by the
+        # server as metadata of the value, the response holds its new version.
+        # value is a bytes-like object or a list of them sent back to back,
+        # registered in place as the segments of one bulk handle.
+        if timestamp is None:
+            timestamp = time.time()
+        size = _nbytes(value)
+        op = instrument.current()
+        op.count(size)
+        if size > self.chunk_size:
+            return self._set_chunks(key, value, timestamp, flags)
+        if self._native_key(key) and not isinstance(value, (list, tuple)):
+            version = self._call_native(rdma_transfer.set, key, value, timestamp, flags)
+            op.mark("forward")
+            self._hint(key, size)
+            return protocol.Metadata(timestamp, size, version, flags)
+        if size <= self.pool.copy_limit:
+            # small values: a memcpy into a registered region is cheaper than registering
+            with self.pool.lease(size) as lease:
+                op.mark("lease")
+                _copy_into(lease.array, value)
+                op.mark("copy")
+                resp = self.call_rpc_on("set", key, size, lease.descriptor, flags, timestamp)
+        else:
+            blk = self.pool.register(value)
+            op.mark("register")
+            resp = self.call_rpc_on("set", key, size, protocol.bulk_descriptor(blk), flags, timestamp)
+        self._hint(key, size)
+        return resp.metadata
 
-    def get(self, key, size=None):
+    def get(self, key, size=None, metadata=False, copy=True):
+        # Single round trip: offer a whole pooled region sized from the hint,
+        # the server pushes the value if it fits and reports its true size.
+        # Only a value larger than the region needs a second transfer.
+        # With copy=False a large value is received into a region of its own
+        # and returned as that uint8 array instead of a bytes copy.
         if size is None:
-            size = self.get_size(key)
+            size = self._size_hints.get(key, self.get_capacity)
+        op = instrument.current()
 
-        buff = np.chararray(size)  # equivalent to malloc
+        if size <= self.chunk_size and not metadata and self._native_key(key):
+            # a value larger than size takes a second round trip
+            value = self._call_native(rdma_transfer.get, key, size)
+            op.mark("forward")
+            if value is not None:
+                self._hint(key, len(value))
+                op.count(len(value))
+            return value
 
-        #with Engine('tcp', mode=pymargo.client) as engine:
-        blk = self.engine.create_bulk(buff, bulk.read_write)
-        s = blk.to_base64()
-        self.call_rpc_on(self.engine.register("get"), s, key, size)
-        return buff.view('S' + str(buff.size))[0]
+        while True:
+            if size > self.chunk_size:
+                resp, result = self._get_chunks(key, size, metadata, copy)
+            else:
+                pooled = copy or size <= self.pool.copy_limit
+                with self.pool.lease(size, pooled=pooled) as lease:
+                    op.mark("lease")
+                    resp = self.call_rpc_on("get", key, lease.capacity, lease.descriptor)
+                    if resp.status != protocol.OVERFLOW:
+                        result = self._take(key, resp, lease, metadata, copy)
+                        op.mark("copy")
+            if resp.status != protocol.OVERFLOW:
+                if resp.status == protocol.OK:
+                    op.count(resp.value)
+                return result
+            # the value is larger than the region, retry with its true size
+            size = resp.value
 
     def get_size(self, key):
-        buff = np.empty(1, dtype=np.uint64)
-        blk = self.engine.create_bulk(buff, bulk.read_write)
-        s = blk.to_base64()
-        self.call_rpc_on(self.engine.register("get_size"), s, key, buff.itemsize)
-        return int(buff)
-        
-
-    def exists(self, key, size=None):
-        #with Engine('tcp', mode=pymargo.client) as engine:
-        buff = np.array([False], dtype=bool)  # equivalent to malloc
-        blk = engine.create_bulk(buff, bulk.read_write)
-        s = blk.to_base64()
-        self.call_rpc_on(self.engine.register("exists"), s, key, buff.itemsize)
-        return buff[0]
-
-    def call_rpc_on(self, rpc, array_str, key, size):
-         handle = self.engine.create_handle(self.engine.lookup(self.addr), rpc)
-         data = {"key": key, "size": size, "buffer": array_str}  # , "buffer": array_str }
-         serialized = json.dumps(data)
-         return handle.forward(self.provider_id, serialized)
+        if self._native_key(key):
+            return self._call_native(rdma_transfer.get_size, key)
+        resp = self.call_rpc_on("get_size", key)
+        if resp.status == protocol.NOT_FOUND:
+            return None
+        return resp.value
+
+    def stat(self, key):
+        # metadata only, answered without any bulk transfer
+        resp = self.call_rpc_on("stat", key)
+        if resp.status == protocol.NOT_FOUND:
+            return None
+        return resp.metadata
+
+    def exists(self, key):
+        if self._native_key(key):
+            return self._call_native(rdma_transfer.exists, key)
+        return bool(self.call_rpc_on("exists", key).value)
+
+    def snapshot(self):
+        # have the server save its values, returns how many
+        return self.call_rpc_on("snapshot", "").value
+
+    def stats(self):
+        # metrics snapshot of the server, its counters since it started
+        msg = protocol.encode_request("")
+        with self.session.handle(self.addr, "stats") as handle:
+            out = handle.forward(self.provider_id, msg)
+        return protocol.decode_stats(out)
+
+    def evict(self, key):
+        if self._native_key(key):
+            deleted = self._call_native(rdma_transfer.delete, key)
+        else:
+            deleted = self.call_rpc_on("delete", key).status == protocol.OK
+        with self._hints_lock:
+            self._size_hints.pop(key, None)
+        return deleted
+
+    def set_many(self, items, timestamp=None, flags=0):
+        # values are packed back to back in one region and moved with a single
+        # RPC and bulk pull per batch of at most pool.max_class bytes
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(items, Mapping):
+            items = items.items()
+        items = [(key, value) for key, value in items]
+        # values too large for a batch region go on their own, in chunks
+        for key, value in items:
+            if len(value) > self.chunk_size:
+                self.set(key, value, timestamp, flags)
+        items = [(key, value) for key, value in items if len(value) <= self.chunk_size]
+        op = instrument.current()
+        for batch in self._batches(items, [len(v) for _, v in items]):
+            sizes = [len(v) for _, v in batch]
+            with self.pool.lease(sum(sizes)) as lease:
+                op.mark("lease")
+                offset = 0
+                for (_, value), size in zip(batch, sizes):
+                    lease.region.array[offset:offset + size] = np.frombuffer(value, dtype=np.uint8)
+                    offset += size
+                op.mark("copy")
+                op.count(offset)
+                resp = self.call_batch_rpc_on(
+                    "set_many", [k for k, _ in batch], sizes, offset, lease.descriptor, flags, timestamp,
+                )
+            if protocol.ERROR in resp.statuses:
+                failed = resp.statuses.count(protocol.ERROR)
+                raise protocol.RDMAError(f"set_many of {failed} keys failed on {self.addr}")
+            for (key, _), size in zip(batch, sizes):
+                self._hint(key, size)
+
+    def get_many(self, keys, metadata=False):
+        keys = list(keys)
+        results = [(None, None) if metadata else None] * len(keys)
+        hints = [self._size_hints.get(k, self.get_capacity) for k in keys]
+        overflow = []
+        op = instrument.current()
+        for start, end in self._ranges(hints):
+            batch = keys[start:end]
+            capacity = min(sum(hints[start:end]), self.pool.max_class)
+            with self.pool.lease(capacity) as lease:
+                op.mark("lease")
+                resp = self.call_batch_rpc_on("get_many", batch, None, lease.capacity, lease.descriptor)
+                overflow += self._take_many(keys, start, resp, lease, results, metadata)
+                op.mark("copy")
+                op.count(_received(resp))
+        # values that did not fit in the shared region come one by one
+        for i, size in overflow:
+            results[i] = self.get(keys[i], size, metadata)
+        return results
+
+    def exists_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        resp = self.call_batch_rpc_on("exists_many", keys)
+        return [bool(v) for v in resp.values]
+
+    def evict_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        resp = self.call_batch_rpc_on("delete_many", keys)
+        with self._hints_lock:
+            for key in keys:
+                self._size_hints.pop(key, None)
+        return [status == protocol.OK for status in resp.statuses]
+
+    # Asynchronous versions, started with iforward and completed by the
+    # session's completion thread. They return RDMAFutures, which can be
+    # waited on from any thread or awaited from an asyncio event loop.
+    # Submitting blocks while session.max_in_flight operations are pending.
+
+    def set_async(self, key, value, timestamp=None, flags=0):
+        if timestamp is None:
+            timestamp = time.time()
+        size = _nbytes(value)
+        if size > self.chunk_size:
+            return background(self.set, key, value, timestamp, flags)
+        op = instrument.current()
+        op.count(size)
+        if size <= self.pool.copy_limit:
+            lease = self.pool.lease(size)
+            op.mark("lease")
+            _copy_into(lease.array, value)
+            op.mark("copy")
+            descriptor, cleanup = lease.descriptor, lease.release
+        else:
+            blk = self.pool.register(value)
+            op.mark("register")
+            descriptor, cleanup = protocol.bulk_descriptor(blk), None
+
+        def finish(resp):
+            self._hint(key, size)
+            return resp.metadata
+
+        msg = protocol.encode_request(key, size, descriptor, flags, timestamp)
+        op.mark("encode")
+        # a value registered in place and its bulk handle must stay alive
+        # until the server has pulled it
+        keep = None if cleanup else (value, blk)
+        return self._submit("set", msg, protocol.decode_response, finish, cleanup, key=key, keep=keep, op=op)
+
+    def get_async(self, key, size=None, metadata=False):
+        if size is None:
+            size = self._size_hints.get(key, self.get_capacity)
+        if size > self.chunk_size:
+            return background(self.get, key, size, metadata)
+        op = instrument.current()
+        lease = self.pool.lease(size)
+        op.mark("lease")
+
+        def finish(resp):
+            if resp.status == protocol.OVERFLOW:
+                # rare, asked again with the size the server reported
+                with instrument.using(op):
+                    return self.get_async(key, resp.value, metadata)
+            result = self._take(key, resp, lease, metadata)
+            op.mark("copy")
+            if resp.status == protocol.OK:
+                op.count(resp.value)
+            return result
+
+        msg = protocol.encode_request(key, lease.capacity, lease.descriptor)
+        op.mark("encode")
+        return self._submit("get", msg, protocol.decode_response, finish, lease.release, key=key, op=op)
+
+    def get_many_async(self, keys, metadata=False):
+        keys = list(keys)
+        if not keys:
+            return completed([])
+        results = [(None, None) if metadata else None] * len(keys)
+        hints = [self._size_hints.get(k, self.get_capacity) for k in keys]
+        futures = []
+        op = instrument.current()
+        for start, end in self._ranges(hints):
+            lease = self.pool.lease(min(sum(hints[start:end]), self.pool.max_class))
+            op.mark("lease")
+
+            def finish(resp, start=start, lease=lease):
+                overflow = self._take_many(keys, start, resp, lease, results, metadata)
+                op.mark("copy")
+                op.count(_received(resp))
+                with instrument.using(op):
+                    retries = [self.get_async(keys[i], size, metadata) for i, size in overflow]
+
+                def combine(values):
+                    for (i, _), value in zip(overflow, values):
+                        results[i] = value
+
+                return gather(retries, combine)
+
+            msg = protocol.encode_batch_request(keys[start:end], None, lease.capacity, lease.descriptor)
+            op.mark("encode")
+            futures.append(self._submit(
+                "get_many", msg, protocol.decode_batch_response, finish, lease.release,
+                keys=end - start, op=op,
+            ))
+        return gather(futures, lambda _: results)
+
+    def evict_async(self, key):
+        def finish(resp):
+            with self._hints_lock:
+                self._size_hints.pop(key, None)
+            return resp.status == protocol.OK
+
+        msg = protocol.encode_request(key, 0, b"")
+        return self._submit("delete", msg, protocol.decode_response, finish, key=key)
+
+    def _submit(self, rpc, msg, decode, finish, cleanup=None, key=None, keys=0, keep=None, op=instrument.NULL):
+        handle = None
+
+        def start():
+            nonlocal handle
+            handle = self.session.acquire(self.addr, rpc)
+            op.mark("acquire")
+            request = handle.iforward(self.provider_id, msg)
+            op.mark("submit")
+            return request
+
+        def complete(out):
+            nonlocal keep
+            keep = None
+            op.mark("forward")
+            # like session.handle(), only a handle that succeeded is reused
+            self.session.release(self.addr, rpc, handle)
+            resp = decode(out)
+            op.mark("decode")
+            if resp.status == protocol.ERROR:
+                what = f"key '{key}'" if key is not None else f"{keys} keys"
+                raise protocol.RDMAError(f"{rpc} of {what} failed on {self.addr}")
+            return finish(resp)
+
+        return self.session.completions.submit(start, complete, cleanup)
+
+    def _set_chunks(self, key, value, timestamp, flags):
+        # the value is registered once, every chunk request points into it
+        blk = self.pool.register(value)
+        instrument.current().mark("register")
+        size = _nbytes(value)
+        msgs = self._chunk_requests(key, size, protocol.bulk_descriptor(blk), flags, timestamp)
+        resps = self._pipeline("set_chunk", key, msgs)
+        self._hint(key, size)
+        # the chunk that completed the value is answered with its metadata
+        return next((r.metadata for r in resps if r.metadata is not None), None)
+
+    def _get_chunks(self, key, size, metadata=False, copy=True):
+        # returns (response, result) like a get of the whole value, or an
+        # OVERFLOW response with the new size if the value was replaced
+        # between two chunks
+        op = instrument.current()
+        with self.pool.lease(size) as lease:
+            op.mark("lease")
+            msgs = self._chunk_requests(key, size, lease.descriptor)
+            resps = self._pipeline("get_chunk", key, msgs)
+            if any(r.status == protocol.NOT_FOUND for r in resps):
+                return protocol.Response(protocol.NOT_FOUND), (None, None) if metadata else None
+            meta = resps[0].metadata
+            if meta.size != size or any(r.metadata.version != meta.version for r in resps):
+                return protocol.Response(protocol.OVERFLOW, resps[-1].metadata.size), None
+            resp = protocol.Response(protocol.OK, size, metadata=meta)
+            result = self._take(key, resp, lease, metadata, copy)
+            op.mark("copy")
+            return resp, result
+
+    def _chunk_requests(self, key, size, descriptor, flags=0, timestamp=0.0):
+        for offset in range(0, size, self.chunk_size):
+            length = min(self.chunk_size, size - offset)
+            yield protocol.encode_chunk_request(key, offset, size, length, descriptor, flags, timestamp)
+
+    def _pipeline(self, rpc, key, msgs):
+        # forward msgs with up to chunk_window of them in flight and return
+        # the responses in order. Waits on the calling thread, so it can run
+        # on the completion thread as well.
+        pending = deque()
+        resps = []
+        op = instrument.current()
+        try:
+            for msg in msgs:
+                op.mark("encode")
+                if len(pending) == self.chunk_window:
+                    resps.append(self._wait(rpc, key, *pending.popleft()))
+                    op.mark("forward")
+                handle = self.session.acquire(self.addr, rpc)
+                op.mark("acquire")
+                pending.append((handle, handle.iforward(self.provider_id, msg)))
+                op.mark("submit")
+            while pending:
+                resps.append(self._wait(rpc, key, *pending.popleft()))
+                op.mark("forward")
+        finally:
+            # after a failure the buffer must still outlive the transfers in flight
+            for _, request in pending:
+                with suppress(Exception):
+                    request.wait()
+        return resps
+
+    def _wait(self, rpc, key, handle, request):
+        resp = protocol.decode_response(request.wait())
+        self.session.release(self.addr, rpc, handle)
+        if resp.status == protocol.ERROR:
+            raise protocol.RDMAError(f"{rpc} of key '{key}' failed on {self.addr}")
+        return resp
+
+    def _take(self, key, resp, lease, metadata=False, copy=True):
+        # result of a get answered with OK or NOT_FOUND, with its metadata
+        # as a (value, metadata) pair if asked for
+        if resp.status == protocol.NOT_FOUND:
+            return (None, None) if metadata else None
+        self._hint(key, resp.value)
+        if copy or lease.region.pooled:
+            value = lease.region.array[:resp.value].tobytes()
+        else:
+            # the region never goes back to the pool, the value keeps it
+            value = lease.region.array[:resp.value]
+        return (value, resp.metadata) if metadata else value
+
+    def _take_many(self, keys, start, resp, lease, results, metadata=False):
+        # unpack the values of a get_many batch starting at keys[start] into
+        # results, returns the (index, size) of the values that overflowed
+        overflow = []
+        offset = 0
+        for i, (status, size) in enumerate(zip(resp.statuses, resp.values), start):
+            if status == protocol.OK:
+                value = lease.region.array[offset:offset + size].tobytes()
+                results[i] = (value, resp.metadata[i - start]) if metadata else value
+                offset += size
+            if status in (protocol.OK, protocol.OVERFLOW):
+                self._hint(keys[i], size)
+            if status == protocol.OVERFLOW:
+                overflow.append((i, size))
+        return overflow
+
+    def _batches(self, items, sizes):
+        for start, end in self._ranges(sizes):
+            yield items[start:end]
+
+    def _ranges(self, sizes):
+        # split consecutive items into ranges of at most pool.max_class bytes,
+        # an item larger than that gets a range of its own
+        start, total = 0, 0
+        for i, size in enumerate(sizes):
+            if i > start and total + size > self.pool.max_class:
+                yield start, i
+                start, total = i, 0
+            total += size
+        if start < len(sizes):
+            yield start, len(sizes)
+
+    def _hint(self, key, size):
+        with self._hints_lock:
+            self._size_hints[key] = size
+            self._size_hints.move_to_end(key)
+            if len(self._size_hints) > self.max_size_hints:
+                self._size_hints.popitem(last=False)
+
+    def _native_key(self, key):
+        # the native client takes keys as C strings
+        return self.native and "\0" not in key
+
+    def _call_native(self, func, key, *args):
+        try:
+            return func(key, *args)
+        except rdma_transfer.error as e:
+            raise protocol.RDMAError(f"{e} on {self.addr}") from e
+
+    def call_rpc_on(self, rpc, key, size=0, descriptor=b"", flags=0, timestamp=0.0):
+        op = instrument.current()
+        msg = protocol.encode_request(key, size, descriptor, flags, timestamp)
+        op.mark("encode")
+        with self.session.handle(self.addr, rpc) as handle:
+            op.mark("acquire")
+            out = handle.forward(self.provider_id, msg)
+            op.mark("forward")
+        resp = protocol.decode_response(out)
+        op.mark("decode")
+        if resp.status == protocol.ERROR:
+            raise protocol.RDMAError(f"{rpc} of key '{key}' failed on {self.addr}")
+        return resp
+
+    def call_batch_rpc_on(self, rpc, keys, sizes=None, size=0, descriptor=b"", flags=0, timestamp=0.0):
+        op = instrument.current()
+        msg = protocol.encode_batch_request(keys, sizes, size, descriptor, flags, timestamp)
+        op.mark("encode")
+        with self.session.handle(self.addr, rpc) as handle:
+            op.mark("acquire")
+            out = handle.forward(self.provider_id, msg)
+            op.mark("forward")
+        resp = protocol.decode_batch_response(out)
+        op.mark("decode")
+        if resp.status == protocol.ERROR:
+            raise protocol.RDMAError(f"{rpc} of {len(keys)} keys failed on {self.addr}")
+        return resp
+
+
+def _nbytes(value):
+    if isinstance(value, (list, tuple)):
+        return sum(memoryview(segment).nbytes for segment in value)
+    return memoryview(value).nbytes
+
+
+def _received(resp):
+    # bytes of the values pushed by the server in a batch response
+    return sum(size for status, size in zip(resp.statuses, resp.values) if status == protocol.OK)
+
+
+def _copy_into(array, value):
+    # copy a value, or its segments back to back, into a uint8 array
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    offset = 0
+    for segment in value:
+        segment = np.frombuffer(segment, dtype=np.uint8)
+        array[offset:offset + segment.size] = segment
+        offset += segment.size
@@ -1,151 +1,437 @@
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
-#include <assert.h>
 #include <stdio.h>
+#include <string.h>
+#include <time.h>
 #include <margo.h>
 #include "types.h"
+#include "protocol.h"
+
+/* Native client of the RDMA servers.
+ *
+ * Values move between the server and the memory of Python objects through
+ * the buffer protocol: set registers the buffer of its value, get the
+ * buffer of the bytes object it returns and get_into a buffer of the
+ * caller, nothing is copied on the client. Values may hold any byte, keys
+ * are strings without NUL, which the server keeps as C strings: "s" parses
+ * them and raises ValueError for an embedded NUL. The GIL is released while a call waits on the server, so several
+ * Python threads drive calls at once over the progress thread of margo.
+ *
+ * The connection is module state that only changes with the GIL held, and
+ * the RPC ids are registered once by connect. A call copies the state it
+ * needs before releasing the GIL and is counted in calls meanwhile, so
+ * that disconnect never finalizes margo under it.
+ */
+
+enum {
+    RPC_SET, RPC_GET, RPC_GET_SIZE, RPC_EXISTS, RPC_DELETE, RPC_COUNT
+};
 
-hg_addr_t server_addr;
-margo_instance_id mid;
+static const char *rpc_names[RPC_COUNT] = {
+    [RPC_SET] = "set", [RPC_GET] = "get", [RPC_GET_SIZE] = "get_size",
+    [RPC_EXISTS] = "exists", [RPC_DELETE] = "delete",
+};
 
-static PyObject *
-rdma_set(PyObject *self, PyObject *args)
+/* capacity offered by a get when the size of the value is not known */
+#define GET_CAPACITY (64 * 1024)
+
+static margo_instance_id mid = MARGO_INSTANCE_NULL;
+static hg_addr_t server_addr = HG_ADDR_NULL;
+static uint16_t provider_id = 42;
+static double timeout = 5000;
+static hg_id_t rpc_ids[RPC_COUNT];
+/* calls running without the GIL */
+static long calls = 0;
+
+static PyObject *RdmaError;
+
+/* registered in place of an empty buffer, which margo cannot register */
+static char empty[1];
+
+/* connection state a call runs with once the GIL is released */
+typedef struct {
+    margo_instance_id mid;
+    hg_addr_t addr;
+    uint16_t provider_id;
+    double timeout;
+    hg_id_t id;
+} conn_t;
+
+/* outcome of a call */
+typedef struct {
+    const char *failed;    /* step that failed, NULL if the server answered */
+    hg_return_t ret;
+    rdma_resp_t resp;
+    rdma_meta_t meta;
+} result_t;
+
+/* start a call of rpc, with the GIL held */
+static int call_begin(int rpc, conn_t *conn)
+{
+    if (mid == MARGO_INSTANCE_NULL) {
+        PyErr_SetString(RdmaError, "not connected");
+        return -1;
+    }
+    conn->mid = mid;
+    conn->addr = server_addr;
+    conn->provider_id = provider_id;
+    conn->timeout = timeout;
+    conn->id = rpc_ids[rpc];
+    calls++;
+    return 0;
+}
+
+/* end a call started by call_begin, with the GIL held */
+static void call_end(void)
 {
-    char *key, *value;
+    calls--;
+}
 
-    if (!PyArg_ParseTuple(args, "ss*", &key, &value))
-        return NULL;
+/* send a request for key, with bulk as its region (HG_BULK_NULL for none),
+ * and decode the response, runs without the GIL */
+static void forward(const conn_t *conn, const char *key, Py_ssize_t key_len, uint64_t size,
+        hg_bulk_t bulk, uint8_t flags, double timestamp, result_t *res)
+{
+    rdma_msg_t in, out;
+    hg_handle_t h;
 
-    rdma_in_t item;
+    res->failed = NULL;
+    res->ret = HG_SUCCESS;
+    if (rdma_req_encode(key, key_len, size, bulk, flags, timestamp, &in) != 0) {
+        res->failed = "rdma_req_encode";
+        return;
+    }
 
-    hg_string_t d[1] = { value };
-    hg_bulk_t local_bulk;
-    hg_size_t sizes[1] = { strlen(d[0]) };
-    void *ptrs = { (void*)d };
+    res->ret = margo_create(conn->mid, conn->addr, conn->id, &h);
+    if (res->ret != HG_SUCCESS) {
+        res->failed = "margo_create";
+        free(in.data);
+        return;
+    }
+    res->ret = margo_provider_forward_timed(conn->provider_id, h, &in, conn->timeout);
+    free(in.data);
+    if (res->ret != HG_SUCCESS) {
+        res->failed = "margo_provider_forward_timed";
+        margo_destroy(h);
+        return;
+    }
 
-    hg_id_t set_rpc_id = MARGO_REGISTER(mid, "set", rdma_in_t, rdma_out_t, NULL);
-    margo_bulk_create(mid, 1, ptrs, sizes, HG_BULK_READ_ONLY, &local_bulk);
+    res->ret = margo_get_output(h, &out);
+    if (res->ret != HG_SUCCESS) {
+        res->failed = "margo_get_output";
+        margo_destroy(h);
+        return;
+    }
+    if (rdma_resp_decode(&out, &res->resp, &res->meta) != 0)
+        res->failed = "rdma_resp_decode";
+    margo_free_output(h, &out);
+    margo_destroy(h);
+}
 
-    item.key = key;
-    item.size = sizes[0];
-    item.bulk = local_bulk;
+/* forward with the len bytes at data registered in place for the server
+ * to pull (HG_BULK_READ_ONLY) or push to (HG_BULK_WRITE_ONLY), runs
+ * without the GIL */
+static void transfer(const conn_t *conn, const char *key, Py_ssize_t key_len, void *data,
+        hg_size_t len, uint8_t mode, uint8_t flags, double timestamp, result_t *res)
+{
+    hg_bulk_t bulk;
+    hg_size_t region = len ? len : sizeof(empty);
+
+    if (len == 0)
+        data = empty;
+    res->ret = margo_bulk_create(conn->mid, 1, &data, &region, mode, &bulk);
+    if (res->ret != HG_SUCCESS) {
+        res->failed = "margo_bulk_create";
+        return;
+    }
+    forward(conn, key, key_len, len, bulk, flags, timestamp, res);
+    margo_bulk_free(bulk);
+}
 
-    double timeout = 5000;
-    hg_handle_t h;
-    margo_create(mid, server_addr, set_rpc_id, &h);
-    margo_forward_timed(h, &item, timeout);
+/* raise for a call that failed, with the GIL held */
+static int check(const result_t *res, int rpc, const char *key)
+{
+    if (res->failed) {
+        PyErr_Format(RdmaError, "%s of key '%s' failed: %s returned %d",
+                rpc_names[rpc], key, res->failed, (int)res->ret);
+        return -1;
+    }
+    if (res->resp.status == RDMA_ERROR) {
+        PyErr_Format(RdmaError, "%s of key '%s' failed on the server", rpc_names[rpc], key);
+        return -1;
+    }
+    return 0;
+}
 
-    rdma_out_t resp;
-    margo_get_output(h, &resp);
-    //margo_info(mid, "Got response: %d\n", resp.ret);
+/* call rpc, which moves no data, for the key of args */
+static int call_key(PyObject *args, int rpc, result_t *res)
+{
+    const char *key;
+    Py_ssize_t key_len;
+    conn_t conn;
+
+    if (!PyArg_ParseTuple(args, "s", &key))
+        return -1;
+    key_len = strlen(key);
+    if (call_begin(rpc, &conn) != 0)
+        return -1;
+    Py_BEGIN_ALLOW_THREADS
+    forward(&conn, key, key_len, 0, HG_BULK_NULL, 0, 0.0, res);
+    Py_END_ALLOW_THREADS
+    call_end();
+    return check(res, rpc, key);
+}
 
-    margo_free_output(h, &resp);
-    margo_destroy(h);
+static PyObject *
+rdma_set(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *kwlist[] = { "key", "value", "timestamp", "flags", NULL };
+    const char *key;
+    Py_ssize_t key_len;
+    Py_buffer value;
+    PyObject *stamp = Py_None;
+    unsigned char flags = 0;
+    double timestamp;
+    struct timespec now;
+    conn_t conn;
+    result_t res;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "sy*|Ob", kwlist,
+                &key, &value, &stamp, &flags))
+        return NULL;
+    key_len = strlen(key);
+
+    if (stamp == Py_None) {
+        clock_gettime(CLOCK_REALTIME, &now);
+        timestamp = now.tv_sec + now.tv_nsec / 1e9;
+    } else {
+        timestamp = PyFloat_AsDouble(stamp);
+        if (timestamp == -1.0 && PyErr_Occurred()) {
+            PyBuffer_Release(&value);
+            return NULL;
+        }
+    }
 
-    margo_bulk_free(local_bulk);
+    if (call_begin(RPC_SET, &conn) != 0) {
+        PyBuffer_Release(&value);
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    transfer(&conn, key, key_len, value.buf, value.len, HG_BULK_READ_ONLY, flags, timestamp, &res);
+    Py_END_ALLOW_THREADS
+    call_end();
+    PyBuffer_Release(&value);
 
-    PyObject *val = PyBytes_FromStringAndSize(d[0], sizeof(d[0]));
-    return val;
+    if (check(&res, RPC_SET, key) != 0)
+        return NULL;
+    return PyLong_FromUnsignedLongLong(res.meta.version);
 }
 
 static PyObject *
 rdma_get(PyObject *self, PyObject *args)
 {
-    char *key;
-    size_t size;
-    //PyObject *data = PyDict_New();
+    const char *key;
+    Py_ssize_t key_len;
+    Py_ssize_t size = GET_CAPACITY;
+    PyObject *value;
+    conn_t conn;
+    result_t res;
+
+    if (!PyArg_ParseTuple(args, "s|n", &key, &size))
+        return NULL;
+    key_len = strlen(key);
+    if (size < 0) {
+        PyErr_SetString(PyExc_ValueError, "size must not be negative");
+        return NULL;
+    }
 
-    if (!PyArg_ParseTuple(args, "sn", &key, &size))
+    while (1) {
+        // the server pushes the value straight into the bytes returned
+        value = PyBytes_FromStringAndSize(NULL, size);
+        if (!value)
+            return NULL;
+        if (call_begin(RPC_GET, &conn) != 0) {
+            Py_DECREF(value);
+            return NULL;
+        }
+        Py_BEGIN_ALLOW_THREADS
+        transfer(&conn, key, key_len, size ? PyBytes_AS_STRING(value) : NULL, size,
+                HG_BULK_WRITE_ONLY, 0, 0.0, &res);
+        Py_END_ALLOW_THREADS
+        call_end();
+
+        if (check(&res, RPC_GET, key) != 0) {
+            Py_DECREF(value);
+            return NULL;
+        }
+        if (res.resp.status == RDMA_NOT_FOUND) {
+            Py_DECREF(value);
+            Py_RETURN_NONE;
+        }
+        if (res.resp.status != RDMA_OVERFLOW)
+            break;
+        // the value is larger than the buffer, retry with its size
+        Py_DECREF(value);
+        size = (Py_ssize_t)res.resp.value;
+    }
+
+    if (res.resp.value > (uint64_t)size) {
+        Py_DECREF(value);
+        PyErr_Format(RdmaError, "get of key '%s' pushed more than the buffer", key);
+        return NULL;
+    }
+    if (res.resp.value < (uint64_t)size && _PyBytes_Resize(&value, (Py_ssize_t)res.resp.value) != 0)
         return NULL;
+    return value;
+}
 
-    rdma_in_t item;
+static PyObject *
+rdma_get_into(PyObject *self, PyObject *args)
+{
+    const char *key;
+    Py_ssize_t key_len;
+    Py_buffer buffer;
+    conn_t conn;
+    result_t res;
 
-    hg_string_t d[1] = { calloc(1, size) };
-    hg_bulk_t local_bulk;
-    hg_size_t sizes[1] = { size };
-    void *ptrs = { (void*)d };
-    
-    hg_id_t get_rpc_id = MARGO_REGISTER(mid, "get", rdma_in_t, rdma_out_t, NULL);
-    margo_bulk_create(mid, 1, ptrs, sizes, HG_BULK_WRITE_ONLY, &local_bulk);
+    if (!PyArg_ParseTuple(args, "sw*", &key, &buffer))
+        return NULL;
+    key_len = strlen(key);
 
-    item.key = key;
-    item.size = size;
-    item.bulk = local_bulk;
+    if (call_begin(RPC_GET, &conn) != 0) {
+        PyBuffer_Release(&buffer);
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    transfer(&conn, key, key_len, buffer.buf, buffer.len, HG_BULK_WRITE_ONLY, 0, 0.0, &res);
+    Py_END_ALLOW_THREADS
+    call_end();
+    PyBuffer_Release(&buffer);
 
-    double timeout = 5000;
-    hg_handle_t h;
-    margo_create(mid, server_addr, get_rpc_id, &h);
-    margo_forward_timed(h, &item, timeout);
+    if (check(&res, RPC_GET, key) != 0)
+        return NULL;
+    if (res.resp.status == RDMA_NOT_FOUND)
+        Py_RETURN_NONE;
+    if (res.resp.status == RDMA_OVERFLOW) {
+        PyErr_Format(PyExc_BufferError, "value of key '%s' has %llu bytes, more than the buffer holds",
+                key, (unsigned long long)res.resp.value);
+        return NULL;
+    }
+    return PyLong_FromUnsignedLongLong(res.resp.value);
+}
 
-    rdma_out_t resp;
-    margo_get_output(h, &resp);
-    //margo_info(mid, "Got response: %d %s %d\n", resp.ret, d[0], sizeof(d));
+static PyObject *
+rdma_get_size(PyObject *self, PyObject *args)
+{
+    result_t res;
 
-    margo_free_output(h, &resp);
-    margo_destroy(h);
+    if (call_key(args, RPC_GET_SIZE, &res) != 0)
+        return NULL;
+    if (res.resp.status == RDMA_NOT_FOUND)
+        Py_RETURN_NONE;
+    return PyLong_FromUnsignedLongLong(res.resp.value);
+}
 
-    margo_bulk_free(local_bulk);
+static PyObject *
+rdma_exists(PyObject *self, PyObject *args)
+{
+    result_t res;
 
-    if (d[0] == NULL)
-    {
-        d[0] = "";
-    }
+    if (call_key(args, RPC_EXISTS, &res) != 0)
+        return NULL;
+    return PyBool_FromLong(res.resp.value != 0);
+}
+
+static PyObject *
+rdma_delete(PyObject *self, PyObject *args)
+{
+    result_t res;
 
-    PyObject *val = PyBytes_FromString(d[0]);
-    //PyDict_SetItemString(data, key, val);
-    return val;
+    if (call_key(args, RPC_DELETE, &res) != 0)
+        return NULL;
+    return PyBool_FromLong(res.resp.status == RDMA_OK);
 }
 
 static PyObject*
 rdma_connect(PyObject *self, PyObject *args)
 {
+    const char *addr, *sep;
+    char protocol[64] = "tcp";
+    hg_return_t ret;
+    int i;
 
-    if (mid != NULL)
-    {
-        //hg_return_t ret;
-
-        //ret = 
+    if (mid != MARGO_INSTANCE_NULL)
         return PyLong_FromLong(0);
-        //margo_addr_free(mid, server_addr);
-        //margo_finalize(mid);
-    }
 
-    char *addr;
-    if (!PyArg_ParseTuple(args, "s", &addr))
+    if (!PyArg_ParseTuple(args, "s|Hd", &addr, &provider_id, &timeout))
         return NULL;
 
+    // the protocol of the address, e.g. ofi+tcp in ofi+tcp://host:port
+    sep = strstr(addr, "://");
+    if (sep && (size_t)(sep - addr) < sizeof(protocol))
+        snprintf(protocol, sizeof(protocol), "%.*s", (int)(sep - addr), addr);
 
-    hg_return_t ret;
-    // verify that all options are correct
-    mid = margo_init("tcp", MARGO_CLIENT_MODE, 1, 0);
+    // a progress thread serves the calls of every Python thread
+    mid = margo_init(protocol, MARGO_CLIENT_MODE, 1, 0);
+    if (mid == MARGO_INSTANCE_NULL) {
+        PyErr_Format(RdmaError, "could not initialize margo for %s", protocol);
+        return NULL;
+    }
     // let user provide log level
     margo_set_log_level(mid, MARGO_LOG_INFO);
-    ret = margo_addr_lookup(mid, addr, &server_addr);
 
-    return PyLong_FromLong(ret);
+    for (i = 0; i < RPC_COUNT; i++)
+        rpc_ids[i] = MARGO_REGISTER(mid, rpc_names[i], rdma_msg_t, rdma_msg_t, NULL);
 
+    ret = margo_addr_lookup(mid, addr, &server_addr);
+    if (ret != HG_SUCCESS) {
+        margo_finalize(mid);
+        mid = MARGO_INSTANCE_NULL;
+        server_addr = HG_ADDR_NULL;
+    }
+    return PyLong_FromLong(ret);
 }
 
-
 static PyObject*
 rdma_close(PyObject *self, PyObject *args)
 {
-
     hg_return_t ret;
 
+    if (mid == MARGO_INSTANCE_NULL)
+        return PyLong_FromLong(0);
+    if (calls > 0) {
+        PyErr_Format(RdmaError, "%ld calls are still running", calls);
+        return NULL;
+    }
+
     ret = margo_addr_free(mid, server_addr);
     margo_finalize(mid);
+    mid = MARGO_INSTANCE_NULL;
+    server_addr = HG_ADDR_NULL;
     return PyLong_FromLong(ret);
-
 }
 
 static PyMethodDef rdmaMethods[] = {
-    {"set",  rdma_set, METH_VARARGS,
-     "Transfer data to server"},
-    {"get",  rdma_get, METH_VARARGS,
-     "Receive data from server"},
+    {"set", (PyCFunction)(void(*)(void))rdma_set, METH_VARARGS | METH_KEYWORDS,
+     "set(key, value, timestamp=None, flags=0)\n\n"
+     "Transfer the bytes-like value to the server, returns its version"},
+    {"get", rdma_get, METH_VARARGS,
+     "get(key, size=65536)\n\n"
+     "Receive the value of key as bytes, None if it is not found. size is\n"
+     "the expected size, a larger value takes a second round trip"},
+    {"get_into", rdma_get_into, METH_VARARGS,
+     "get_into(key, buffer)\n\n"
+     "Receive the value of key into the writable buffer, returns its size\n"
+     "or None if it is not found. Raises BufferError if it does not fit"},
+    {"get_size", rdma_get_size, METH_VARARGS,
+     "get_size(key)\n\nSize of the value of key, None if it is not found"},
+    {"exists", rdma_exists, METH_VARARGS,
+     "exists(key)\n\nWhether the server holds key"},
+    {"delete", rdma_delete, METH_VARARGS,
+     "delete(key)\n\nDelete key from the server, returns whether it was there"},
     {"connect", rdma_connect, METH_VARARGS,
-     "Connect to server"},
+     "connect(addr, provider_id=42, timeout=5000.0)\n\n"
+     "Connect to server, timeout in ms applies to every call"},
     {"disconnect", rdma_close, METH_VARARGS,
      "Terminate connection to server"},
     {NULL, NULL, 0, NULL}        /* Sentinel */
@@ -154,7 +440,7 @@ static PyMethodDef rdmaMethods[] = {
 static struct PyModuleDef rdmamodule = {
     PyModuleDef_HEAD_INIT,
     "rdma_transfer",   /* name of module */
-    NULL, /* module documentation, may be NULL */
+    "Native client of the RDMA servers, see rdma_transfer.c", /* module documentation, may be NULL */
     -1,       /* size of per-interpreter state of the module,
                  or -1 if the module keeps state in global variables. */
     rdmaMethods
@@ -165,9 +451,22 @@ static struct PyModuleDef rdmamodule = {
 PyMODINIT_FUNC
 PyInit_rdma_transfer(void)
 {
-    return PyModule_Create(&rdmamodule);
-}
+    PyObject *m;
 
+    m = PyModule_Create(&rdmamodule);
+    if (m == NULL)
+        return NULL;
+
+    RdmaError = PyErr_NewException("rdma_transfer.error", PyExc_RuntimeError, NULL);
+    Py_XINCREF(RdmaError);
+    if (PyModule_AddObject(m, "error", RdmaError) < 0) {
+        Py_XDECREF(RdmaError);
+        Py_CLEAR(RdmaError);
+        Py_DECREF(m);
+        return NULL;
+    }
+    return m;
+}
 
 int
 main(int argc, char *argv[])
@@ -0,0 +1,161 @@
+"""Long-lived margo client session shared by the RDMA stores."""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any
+from typing import Generator
+
+import pymargo
+from pymargo.core import Engine
+
+from buffer_pool import BufferPool
+from completion import CompletionQueue
+
+logger = logging.getLogger(__name__)
+
+
+def protocol_of(addr: str) -> str:
+    """Return the Mercury protocol of an address (e.g. ``ofi+tcp;ofi_rxm``)."""
+    return addr.split("://", 1)[0]
+
+
+class Session:
+    """Margo client state shared by every RDMA client of a process.
+
+    A session owns one client :class:`Engine` per protocol together with the
+    :class:`BufferPool <buffer_pool.BufferPool>` registered on it. Server
+    addresses are looked up once, RPC ids are registered once, and
+    ``hg_handle`` objects are kept in a pool per (address, rpc) pair so
+    that none of these costs show up in per-operation latency. Asynchronous
+    operations share the session's :class:`CompletionQueue
+    <completion.CompletionQueue>`, which bounds how many are in flight.
+
+    Use :func:`Session.get()` rather than the constructor so that
+    :class:`MargoStore <margo.MargoStore>`, :class:`RDMAStore <rdma.RDMAStore>`
+    and the stores re-created by :class:`RDMAFactory <rdma.RDMAFactory>`
+    all share the same session.
+    """
+
+    _sessions: dict[tuple[int, str], Session] = {}
+    _sessions_lock = threading.Lock()
+
+    def __init__(
+        self,
+        protocol: str = "tcp",
+        *,
+        pool_limit: int = 256 * 1024**2,
+        max_handles: int = 64,
+        max_in_flight: int = 64,
+    ) -> None:
+        """Init Session.
+
+        Args:
+            protocol (str): Mercury protocol used by the client engine.
+            pool_limit (int): cap in bytes on the registered memory kept by
+                the buffer pool (default: 256 MB).
+            max_handles (int): number of idle handles kept per
+                (address, rpc) pair (default: 64).
+            max_in_flight (int): number of asynchronous operations that can
+                be in flight at once (default: 64).
+        """
+        self.protocol = protocol
+        self.max_handles = max_handles
+        self.max_in_flight = max_in_flight
+        # the progress thread completes asynchronous operations while the
+        # caller is busy computing
+        self.engine = Engine(protocol, mode=pymargo.client, use_progress_thread=True)
+        self.pool = BufferPool(self.engine, limit=pool_limit)
+
+        self._addrs: dict[str, Any] = {}
+        self._rpc_ids: dict[str, Any] = {}
+        self._handles: dict[tuple[str, str], list[Any]] = {}
+        self._completions: CompletionQueue | None = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, protocol: str = "tcp", *, pool_limit: int | None = None) -> Session:
+        """Return the session of this process for `protocol`.
+
+        Sessions are keyed by pid as well so that a forked child builds its
+        own engine instead of reusing the parent's.
+
+        Args:
+            protocol (str): Mercury protocol used by the client engine.
+            pool_limit (int): optional buffer pool cap. When several clients
+                ask for different caps the largest one is used.
+        """
+        key = (os.getpid(), protocol)
+        with cls._sessions_lock:
+            session = cls._sessions.get(key)
+            if session is None:
+                kwargs = {} if pool_limit is None else {"pool_limit": pool_limit}
+                session = cls(protocol, **kwargs)
+                cls._sessions[key] = session
+                logger.debug(f"Started margo client session for {protocol}")
+            elif pool_limit is not None and pool_limit > session.pool.limit:
+                session.pool.limit = pool_limit
+        return session
+
+    @property
+    def completions(self) -> CompletionQueue:
+        """Completion queue of the asynchronous operations, started lazily."""
+        if self._completions is None:
+            with self._lock:
+                if self._completions is None:
+                    self._completions = CompletionQueue(self.max_in_flight)
+        return self._completions
+
+    def lookup(self, addr: str) -> Any:
+        """Resolve `addr` once and return the cached address."""
+        address = self._addrs.get(addr)
+        if address is None:
+            with self._lock:
+                address = self._addrs.get(addr)
+                if address is None:
+                    address = self.engine.lookup(addr)
+                    self._addrs[addr] = address
+        return address
+
+    def rpc_id(self, name: str) -> Any:
+        """Register RPC `name` once and return the cached id."""
+        rpc_id = self._rpc_ids.get(name)
+        if rpc_id is None:
+            with self._lock:
+                rpc_id = self._rpc_ids.get(name)
+                if rpc_id is None:
+                    rpc_id = self.engine.register(name)
+                    self._rpc_ids[name] = rpc_id
+        return rpc_id
+
+    def acquire(self, addr: str, rpc: str) -> Any:
+        """Take an idle handle for (`addr`, `rpc`) or create a new one."""
+        with self._lock:
+            idle = self._handles.get((addr, rpc))
+            if idle:
+                return idle.pop()
+        return self.engine.create_handle(self.lookup(addr), self.rpc_id(rpc))
+
+    def release(self, addr: str, rpc: str, handle: Any) -> None:
+        """Return a handle whose operation has completed to the pool."""
+        with self._lock:
+            idle = self._handles.setdefault((addr, rpc), [])
+            if len(idle) < self.max_handles:
+                idle.append(handle)
+
+    @contextmanager
+    def handle(self, addr: str, rpc: str) -> Generator[Any, None, None]:
+        """Context manager lending a pooled handle for one forward."""
+        handle = self.acquire(addr, rpc)
+        yield handle
+        # only reached if the forward succeeded, a failed handle is dropped
+        self.release(addr, rpc, handle)
+
+    def forget(self, addr: str) -> None:
+        """Drop the cached address and handles of a server that went away."""
+        with self._lock:
+            self._addrs.pop(addr, None)
+            for key in [k for k in self._handles if k[0] == addr]:
+                del self._handles[key]
@@ -8,5 +8,5 @@ module1 = Extension('rdma_transfer',
 
 setup (name = 'rdma_transfer',
        version = '1.0',
-       description = 'This is a demo package',
+       description = 'Native client of the RDMA servers',
        ext_modules = [module1])
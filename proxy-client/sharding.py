@@ -0,0 +1,672 @@
+"""Keys sharded across the RDMA peers of a peer directory.
+
+Every :class:`RDMAClient` started on a node writes ``peer_<pid>.json``,
+holding its address and provider id, to a shared peer directory (by default
+``~/.proxystore/peers``). :class:`ShardedRDMA` places keys on those peers
+with a consistent-hash ring, so that adding or removing a peer only moves
+the keys of the ring segments it takes or gives back, and routes every
+operation to the peer owning its key. The capacity and bandwidth of the
+store then grow with the number of peers.
+
+With a replication factor R, a key is written to the R distinct peers that
+follow it on the ring and read from one of them: a replica on the local
+node if there is one, otherwise the one with the fewest operations in
+flight from this process. Keys read often enough can be copied to more
+peers further along the ring while they are hot.
+"""
+from __future__ import annotations
+
+import bisect
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from contextlib import suppress
+from typing import Any
+from typing import Generator
+from typing import Iterable
+from typing import NamedTuple
+
+import instrument
+from completion import RDMAFuture
+from completion import background
+from completion import completed
+from completion import gather
+from protocol import RDMAError
+from protocol import Stats
+from rdma_interface import RDMA
+
+logger = logging.getLogger(__name__)
+
+PEER_DIR = os.path.join(os.path.expanduser("~"), ".proxystore", "peers")
+
+
+class Peer(NamedTuple):
+    """Address and provider id of an RDMA peer."""
+
+    addr: str
+    provider_id: int
+
+
+def _hash(name: str) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little")
+
+
+def _host(addr: str) -> str:
+    # host of a <protocol>://<host>:<port> address
+    return addr.split("://", 1)[-1].rsplit(":", 1)[0]
+
+
+def _local_hosts() -> set[str]:
+    hosts = {"127.0.0.1", "localhost", socket.gethostname()}
+    with suppress(OSError):
+        hosts.update(socket.gethostbyname_ex(socket.gethostname())[2])
+    return hosts
+
+
+class HashRing:
+    """Consistent-hash ring of peers.
+
+    Each peer is placed on the ring at `vnodes` points and owns the keys
+    hashing between the previous point and each of its own, which spreads
+    the keys evenly and splits the keys of a leaving peer among all others.
+    """
+
+    def __init__(self, vnodes: int = 128) -> None:
+        """Init HashRing.
+
+        Args:
+            vnodes (int): number of points of each peer on the ring
+                (default: 128).
+        """
+        self.vnodes = vnodes
+        self._points: list[int] = []
+        self._peers: list[Peer] = []
+        self._members: set[Peer] = set()
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __contains__(self, peer: Peer) -> bool:
+        return peer in self._members
+
+    @property
+    def peers(self) -> list[Peer]:
+        """Peers on the ring."""
+        return sorted(self._members)
+
+    def add(self, peer: Peer) -> None:
+        """Place `peer` on the ring."""
+        if peer in self._members:
+            return
+        self._members.add(peer)
+        points = [(_hash(f"{peer.addr}/{peer.provider_id}/{i}"), peer) for i in range(self.vnodes)]
+        # points are ordered by peer as well on (unlikely) collisions, so
+        # that every process builds the same ring
+        ring = sorted(list(zip(self._points, self._peers)) + points)
+        self._points = [point for point, _ in ring]
+        self._peers = [p for _, p in ring]
+
+    def remove(self, peer: Peer) -> None:
+        """Take `peer` off the ring."""
+        if peer not in self._members:
+            return
+        self._members.discard(peer)
+        ring = [(point, p) for point, p in zip(self._points, self._peers) if p != peer]
+        self._points = [point for point, _ in ring]
+        self._peers = [p for _, p in ring]
+
+    def lookup(self, key: str) -> Peer:
+        """Return the peer owning `key`.
+
+        Raises:
+            LookupError:
+                if the ring is empty.
+        """
+        return self.lookup_n(key, 1)[0]
+
+    def lookup_n(self, key: str, n: int) -> list[Peer]:
+        """Return the first `n` distinct peers following `key` on the ring.
+
+        Fewer are returned when the ring has less than `n` peers, the first
+        one is the owner of `key`.
+
+        Raises:
+            LookupError:
+                if the ring is empty.
+        """
+        if not self._points:
+            raise LookupError("no peers on the ring")
+        n = min(n, len(self._members))
+        i = bisect.bisect(self._points, _hash(key))
+        found: list[Peer] = []
+        while len(found) < n:
+            peer = self._peers[i % len(self._peers)]
+            if peer not in found:
+                found.append(peer)
+            i += 1
+        return found
+
+
+class ShardedRDMA:
+    """RDMA client spreading keys over the peers of a peer directory.
+
+    It offers the operations of :class:`RDMA <rdma_interface.RDMA>`, each
+    one going to the replicas of its key, and batches split per peer. The
+    clients of all peers share the margo session of the process.
+
+    Writes go to all `replicas` peers of a key in parallel, with the same
+    timestamp, reads to the local or least loaded replica and on to the
+    others if it does not have the key (or fails). With `hot_threshold`
+    set, a key read that many times within `hot_window` seconds by this
+    process is copied to `hot_replicas` more peers, which its reads then
+    share. Every write or eviction of a key then also evicts it from those
+    extra peers, whichever process made them hot, so that they never serve
+    an old value for long.
+
+    Membership is refreshed from the peer directory at most every
+    `refresh_interval` seconds, when an operation comes in. Only the peer
+    files that appeared, changed or disappeared since the last scan are
+    read and moved on or off the ring.
+    """
+
+    # number of keys whose recent reads are counted
+    max_tracked_keys = 4096
+
+    def __init__(
+        self,
+        peer_dir: str | None = None,
+        *,
+        replicas: int = 1,
+        hot_threshold: int | None = None,
+        hot_replicas: int = 2,
+        hot_window: float = 1.0,
+        vnodes: int = 128,
+        refresh_interval: float = 5.0,
+        pool_limit: int = 256 * 1024**2,
+    ) -> None:
+        """Init ShardedRDMA.
+
+        Args:
+            peer_dir (str): directory of the ``peer_<pid>.json`` files
+                (default: ``~/.proxystore/peers``).
+            replicas (int): number of peers each key is written to
+                (default: 1).
+            hot_threshold (int): reads of a key within `hot_window` that
+                make it hot, or None to never replicate hot keys
+                (default: None).
+            hot_replicas (int): peers a hot key is copied to on top of its
+                replicas (default: 2).
+            hot_window (float): seconds over which reads are counted
+                (default: 1).
+            vnodes (int): points of each peer on the hash ring
+                (default: 128).
+            refresh_interval (float): seconds between two scans of the peer
+                directory (default: 5).
+            pool_limit (int): cap in bytes on the registered memory kept by
+                the client buffer pool of the shared session (default: 256 MB).
+        """
+        if replicas < 1:
+            raise ValueError(f"replicas must be at least 1, got {replicas}")
+        self.peer_dir = PEER_DIR if peer_dir is None else peer_dir
+        self.replicas = replicas
+        self.hot_threshold = hot_threshold
+        self.hot_replicas = hot_replicas
+        self.hot_window = hot_window
+        self.refresh_interval = refresh_interval
+        self.pool_limit = pool_limit
+        self.ring = HashRing(vnodes)
+        self._files: dict[str, tuple[float, Peer]] = {}
+        self._clients: dict[Peer, RDMA] = {}
+        self._refreshed = 0.0
+        self._lock = threading.Lock()
+        self._local = _local_hosts()
+        # operations in flight and smoothed read latency, per peer
+        self._load: Counter[Peer] = Counter()
+        self._latency: dict[Peer, float] = {}
+        # key -> [start of its read window, reads in it]
+        self._reads: OrderedDict[str, list[Any]] = OrderedDict()
+        # hot key -> the extra peers it was copied to
+        self._hot: dict[str, list[Peer]] = {}
+        self.refresh()
+
+    @property
+    def peers(self) -> list[Peer]:
+        """Peers keys are currently placed on."""
+        return self.ring.peers
+
+    def refresh(self) -> tuple[list[Peer], list[Peer]]:
+        """Bring the ring up to date with the peer directory.
+
+        Returns:
+            tuple of the peers added to and removed from the ring.
+        """
+        with self._lock:
+            self._refreshed = time.monotonic()
+            seen = {}
+            with os.scandir(self.peer_dir) as entries:
+                for entry in entries:
+                    if entry.name.startswith("peer_") and entry.name.endswith(".json"):
+                        seen[entry.name] = entry
+
+            added, removed = [], []
+            for name in list(self._files):
+                if name not in seen:
+                    removed.append(self._files.pop(name)[1])
+            for name, entry in seen.items():
+                mtime = entry.stat().st_mtime
+                known = self._files.get(name)
+                if known is not None and known[0] == mtime:
+                    continue
+                try:
+                    with open(entry.path) as f:
+                        data = json.load(f)
+                    peer = Peer(data["addr"], int(data["provider_id"]))
+                except (OSError, ValueError, KeyError):
+                    # being written or gone, looked at again next time
+                    continue
+                if known is not None and known[1] != peer:
+                    removed.append(known[1])
+                self._files[name] = (mtime, peer)
+                added.append(peer)
+
+            current = {peer for _, peer in self._files.values()}
+            removed = [peer for peer in removed if peer not in current]
+            added = [peer for peer in added if peer not in self.ring]
+            for peer in removed:
+                self.ring.remove(peer)
+                self._clients.pop(peer, None)
+            for peer in added:
+                self.ring.add(peer)
+            if added or removed:
+                # the extra copies of hot keys were placed on the old ring
+                self._hot.clear()
+
+        if added or removed:
+            logger.debug(
+                f"Peers of {self.peer_dir}: {len(self.ring)} "
+                f"({len(added)} joined, {len(removed)} left)",
+            )
+        return added, removed
+
+    def stats(self) -> dict[Peer, Stats | None]:
+        """Return the metrics snapshot of every peer of the peer directory.
+
+        Returns:
+            dict mapping each peer to its :class:`protocol.Stats`, or to None
+            if it did not answer.
+        """
+        self.refresh()
+        snapshots: dict[Peer, Stats | None] = {}
+        for peer in self.peers:
+            try:
+                snapshots[peer] = self._client(peer).stats()
+            except Exception as error:
+                logger.warning(f"stats of {peer.addr} failed: {error}")
+                snapshots[peer] = None
+        return snapshots
+
+    def snapshot(self) -> dict[Peer, int]:
+        """Have every peer of the peer directory save its values.
+
+        Returns:
+            dict mapping each peer to the number of values it saved.
+
+        Raises:
+            RDMAError:
+                if a peer could not save its values.
+        """
+        self.refresh()
+        return {peer: self._client(peer).snapshot() for peer in self.peers}
+
+    def replicas_of(self, key: str) -> list[Peer]:
+        """Return the peers `key` is written to, its owner first.
+
+        Raises:
+            RDMAError:
+                if there is no peer in the peer directory.
+        """
+        return self._lookup(key, self.replicas)
+
+    def owner(self, key: str) -> RDMA:
+        """Return the client of the peer owning `key`."""
+        return self._client(self.replicas_of(key)[0])
+
+    def set(self, key: str, value: Any, timestamp: float | None = None, flags: int = 0) -> Any:
+        if timestamp is None:
+            timestamp = time.time()
+        peers = self.replicas_of(key)
+        if len(peers) == 1 and self.hot_threshold is None:
+            with self._track(peers[0]):
+                return self._client(peers[0]).set(key, value, timestamp, flags)
+        return self.set_async(key, value, timestamp, flags).result()
+
+    def get(self, key: str, size: int | None = None, metadata: bool = False, copy: bool = True) -> Any:
+        return self._read(key, "get", lambda r: (r[0] if metadata else r) is not None, size, metadata, copy)
+
+    def get_size(self, key: str) -> int | None:
+        return self._read(key, "get_size", lambda r: r is not None)
+
+    def stat(self, key: str) -> Any:
+        return self._read(key, "stat", lambda r: r is not None)
+
+    def exists(self, key: str) -> bool:
+        return self._read(key, "exists", bool)
+
+    def evict(self, key: str) -> bool:
+        return self.evict_async(key).result()
+
+    def set_many(
+        self,
+        items: Mapping[str, Any] | Iterable[tuple[str, Any]],
+        timestamp: float | None = None,
+        flags: int = 0,
+    ) -> None:
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(items, Mapping):
+            items = items.items()
+        items = list(items)
+        keys = [key for key, _ in items]
+        groups = self._group_writes(keys)
+        # one batch per peer, the peers written to in parallel
+        if len(groups) == 1:
+            client, indices = groups[0]
+            client.set_many([items[i] for i in indices], timestamp, flags)
+        else:
+            futures = [
+                background(client.set_many, [items[i] for i in indices], timestamp, flags)
+                for client, indices in groups
+            ]
+            for future in futures:
+                future.result()
+            # the phases of the parallel batches overlap, their wait counts
+            instrument.current().mark("forward")
+        self._invalidate_many(keys)
+
+    def get_many(self, keys: Iterable[str], metadata: bool = False) -> list[Any]:
+        keys = list(keys)
+        results = self._scatter("get_many", keys, self._group_reads(keys), metadata=metadata)
+        return self._complete_reads(keys, results, metadata)
+
+    def exists_many(self, keys: Iterable[str]) -> list[bool]:
+        keys = list(keys)
+        results = self._scatter("exists_many", keys, self._group_reads(keys))
+        if self.replicas > 1 or self.hot_threshold is not None:
+            # another replica may hold what the chosen one misses
+            results = [found or self.exists(key) for key, found in zip(keys, results)]
+        return results
+
+    def evict_many(self, keys: Iterable[str]) -> list[bool]:
+        keys = list(keys)
+        found = [False] * len(keys)
+        for client, indices in self._group_writes(keys, extras=True):
+            for i, evicted in zip(indices, client.evict_many([keys[i] for i in indices])):
+                found[i] = found[i] or evicted
+        with self._lock:
+            for key in keys:
+                self._hot.pop(key, None)
+        return found
+
+    def set_async(self, key: str, value: Any, timestamp: float | None = None, flags: int = 0) -> RDMAFuture:
+        if timestamp is None:
+            timestamp = time.time()
+        futures = [
+            self._tracked(peer, self._client(peer).set_async(key, value, timestamp, flags))
+            for peer in self.replicas_of(key)
+        ]
+        futures += self._invalidate(key)
+        return gather(futures, lambda results: results[0])
+
+    def get_async(self, key: str, size: int | None = None, metadata: bool = False) -> RDMAFuture:
+        future = self._read_async(key, self._ordered(self._read_peers(key)), size, metadata)
+        self._count_read(key)
+        return future
+
+    def get_many_async(self, keys: Iterable[str], metadata: bool = False) -> RDMAFuture:
+        keys = list(keys)
+        if not keys:
+            return completed([])
+        groups = self._group_reads(keys)
+        futures = [client.get_many_async([keys[i] for i in indices], metadata) for client, indices in groups]
+
+        def combine(values: list[list[Any]]) -> list[Any]:
+            results: list[Any] = [None] * len(keys)
+            for (_, indices), group in zip(groups, values):
+                for i, value in zip(indices, group):
+                    results[i] = value
+            return self._complete_reads_async(keys, results, metadata)
+
+        return gather(futures, combine)
+
+    def evict_async(self, key: str) -> RDMAFuture:
+        futures = [self._client(peer).evict_async(key) for peer in self.replicas_of(key)]
+        futures += self._invalidate(key)
+        return gather(futures, any)
+
+    def _lookup(self, key: str, n: int) -> list[Peer]:
+        if time.monotonic() - self._refreshed > self.refresh_interval:
+            self.refresh()
+        with self._lock:
+            try:
+                return self.ring.lookup_n(key, n)
+            except LookupError:
+                raise RDMAError(f"no RDMA peers in {self.peer_dir}") from None
+
+    def _client(self, peer: Peer) -> RDMA:
+        with self._lock:
+            client = self._clients.get(peer)
+            if client is None:
+                client = RDMA(peer.addr, peer.provider_id, pool_limit=self.pool_limit)
+                self._clients[peer] = client
+        return client
+
+    def _extras(self, key: str) -> list[Peer]:
+        # peers that may hold an extra copy of a hot key
+        if self.hot_threshold is None:
+            return []
+        return self._lookup(key, self.replicas + self.hot_replicas)[self.replicas:]
+
+    def _read_peers(self, key: str) -> list[Peer]:
+        return self.replicas_of(key) + self._hot.get(key, [])
+
+    def _ordered(self, peers: list[Peer]) -> list[Peer]:
+        # local replicas first, then by operations in flight and latency
+        return sorted(
+            peers,
+            key=lambda p: (_host(p.addr) not in self._local, self._load[p], self._latency.get(p, 0.0)),
+        )
+
+    @contextmanager
+    def _track(self, peer: Peer) -> Generator[None, None, None]:
+        with self._lock:
+            self._load[peer] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._load[peer] -= 1
+                self._latency[peer] = 0.8 * self._latency.get(peer, elapsed) + 0.2 * elapsed
+
+    def _tracked(self, peer: Peer, future: RDMAFuture) -> RDMAFuture:
+        with self._lock:
+            self._load[peer] += 1
+
+        def done(_: Any) -> None:
+            with self._lock:
+                self._load[peer] -= 1
+
+        future.add_done_callback(done)
+        return future
+
+    def _read(self, key: str, method: str, found: Any, *args: Any) -> Any:
+        # try the replicas in order until one has the key
+        peers = self._ordered(self._read_peers(key))
+        result = None
+        for n, peer in enumerate(peers):
+            try:
+                with self._track(peer):
+                    result = getattr(self._client(peer), method)(key, *args)
+            except Exception:
+                if n == len(peers) - 1:
+                    raise
+                logger.warning(f"{method} of key '{key}' failed on {peer.addr}, trying another replica")
+                continue
+            if found(result):
+                if method == "get":
+                    self._count_read(key)
+                break
+            self._lost(key, peer)
+        return result
+
+    def _read_async(self, key: str, peers: list[Peer], size: int | None, metadata: bool) -> RDMAFuture:
+        # like _read() for get, each replica is asked once the previous one
+        # missed, from the completion thread without waiting on it
+        peer = peers[0]
+        future = self._tracked(peer, self._client(peer).get_async(key, size, metadata))
+
+        def combine(values: list[Any]) -> Any:
+            value = values[0]
+            if (value[0] if metadata else value) is None and len(peers) > 1:
+                self._lost(key, peer)
+                return self._read_async(key, peers[1:], size, metadata)
+            return value
+
+        return gather([future], combine)
+
+    def _lost(self, key: str, peer: Peer) -> None:
+        # an extra copy that was evicted, reads go back to the replicas
+        with self._lock:
+            if peer in self._hot.get(key, ()):
+                self._hot.pop(key, None)
+
+    def _count_read(self, key: str) -> None:
+        if self.hot_threshold is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            window = self._reads.get(key)
+            if window is None or now - window[0] > self.hot_window:
+                window = self._reads[key] = [now, 0]
+            self._reads.move_to_end(key)
+            if len(self._reads) > self.max_tracked_keys:
+                self._reads.popitem(last=False)
+            window[1] += 1
+            hot = window[1] >= self.hot_threshold and key not in self._hot
+            if hot:
+                # copied once, reads keep going to the replicas meanwhile
+                self._hot[key] = []
+        if hot:
+            background(self._replicate, key)
+
+    def _replicate(self, key: str) -> None:
+        try:
+            extras = self._extras(key)
+            peer = self._ordered(self.replicas_of(key))[0]
+            value, metadata = self._client(peer).get(key, metadata=True)
+            if value is None or not extras:
+                with self._lock:
+                    self._hot.pop(key, None)
+                return
+            futures = [
+                self._client(p).set_async(key, value, metadata.timestamp, metadata.flags)
+                for p in extras
+            ]
+            for future in futures:
+                future.result()
+        except Exception:
+            logger.exception(f"Could not replicate hot key '{key}'")
+            with self._lock:
+                self._hot.pop(key, None)
+            return
+        with self._lock:
+            if key in self._hot:
+                self._hot[key] = extras
+        logger.debug(f"Replicated hot key '{key}' to {len(extras)} more peers")
+
+    def _invalidate(self, key: str) -> list[RDMAFuture]:
+        # evict the extra copies a write or an eviction makes stale
+        with self._lock:
+            self._hot.pop(key, None)
+        return [self._client(peer).evict_async(key) for peer in self._extras(key)]
+
+    def _invalidate_many(self, keys: list[str]) -> None:
+        if self.hot_threshold is None:
+            return
+        with self._lock:
+            for key in keys:
+                self._hot.pop(key, None)
+        groups: dict[Peer, list[str]] = {}
+        for key in keys:
+            for peer in self._extras(key):
+                groups.setdefault(peer, []).append(key)
+        for peer, group in groups.items():
+            self._client(peer).evict_many(group)
+
+    def _group_reads(self, keys: list[str]) -> list[tuple[RDMA, list[int]]]:
+        # indices of keys per chosen replica, in key order
+        groups: dict[Peer, list[int]] = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self._ordered(self._read_peers(key))[0], []).append(i)
+        return [(self._client(peer), indices) for peer, indices in groups.items()]
+
+    def _group_writes(self, keys: list[str], extras: bool = False) -> list[tuple[RDMA, list[int]]]:
+        # indices of keys per peer holding them, a key goes to every replica
+        groups: dict[Peer, list[int]] = {}
+        for i, key in enumerate(keys):
+            peers = self.replicas_of(key) + (self._extras(key) if extras else [])
+            for peer in peers:
+                groups.setdefault(peer, []).append(i)
+        return [(self._client(peer), indices) for peer, indices in groups.items()]
+
+    def _complete_reads(self, keys: list[str], results: list[Any], metadata: bool) -> list[Any]:
+        # keys the chosen replicas did not have are looked up on the others
+        for i, key in enumerate(keys):
+            value = results[i]
+            if (value[0] if metadata else value) is not None:
+                self._count_read(key)
+            elif self.replicas > 1 or key in self._hot:
+                results[i] = self.get(key, metadata=metadata)
+        return results
+
+    def _complete_reads_async(self, keys: list[str], results: list[Any], metadata: bool) -> RDMAFuture:
+        # like _complete_reads(), the other replicas are asked asynchronously
+        retries = {}
+        for i, key in enumerate(keys):
+            value = results[i]
+            if (value[0] if metadata else value) is not None:
+                self._count_read(key)
+            elif self.replicas > 1 or key in self._hot:
+                retries[i] = self.get_async(key, metadata=metadata)
+
+        def combine(values: list[Any]) -> list[Any]:
+            for i, value in zip(retries, values):
+                results[i] = value
+            return results
+
+        return gather(list(retries.values()), combine)
+
+    def _scatter(
+        self,
+        method: str,
+        keys: list[str],
+        groups: list[tuple[RDMA, list[int]]],
+        **kwargs: Any,
+    ) -> list[Any]:
+        # run a batch method once per peer and put the results back in order
+        results: list[Any] = [None] * len(keys)
+        for client, indices in groups:
+            values = getattr(client, method)([keys[i] for i in indices], **kwargs)
+            for i, value in zip(indices, values):
+                results[i] = value
+        return results
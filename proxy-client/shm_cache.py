@@ -0,0 +1,290 @@
+"""Node-local cache of objects shared by the processes of a node.
+
+The cache is a directory of files in shared memory (``/dev/shm`` by
+default), one per key::
+
+    metadata | key length | key | pad | value
+
+where metadata is :data:`protocol.METADATA`, the key length is ``<I`` and
+the value starts on an `ALIGNMENT` byte boundary. Entries are written to a
+temporary file renamed into place, so that readers never see a partial
+value, and read by mapping the file copy-on-write: the value comes back as
+a writable :class:`memoryview` of the shared pages, which a process only
+copies the pages of if it writes to them. A file evicted or replaced while
+mapped stays valid for as long as the views into it are alive.
+
+The cache holds at most `size` bytes. The bytes taken are counted in a
+lock file that the processes update as they add and drop entries, and an
+entry is written while holding that lock, so that concurrent writers
+cannot overshoot the budget. A full cache evicts the entries least
+recently read first (reads touch the modification time of their file),
+down to `EVICT_TO` of its size, so that the directory is only scanned
+once every few writes. On a miss,
+:func:`SharedCache.fetch()` lets a single process of the node fetch the
+object while the others wait for it to land in the cache.
+"""
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from contextlib import suppress
+from typing import Any
+from typing import Callable
+from typing import Generator
+
+from protocol import METADATA
+from protocol import Metadata
+
+logger = logging.getLogger(__name__)
+
+SHM_ROOT = "/dev/shm"
+
+ALIGNMENT = 64
+
+KEY_LENGTH = struct.Struct("<I")
+
+# number of locks the keys of a fetch are spread over
+LOCK_STRIPES = 64
+
+# fraction of the size a full cache is brought down to
+EVICT_TO = 0.9
+
+# bytes taken by the entries, the content of the usage lock file
+USAGE = struct.Struct("<q")
+
+
+class SharedCache:
+    """Byte-budgeted cache of (value, metadata) pairs in shared memory.
+
+    Every process of the node that opens the cache with the same `name` and
+    `root` shares its entries.
+    """
+
+    def __init__(
+        self,
+        name: str = "proxystore",
+        size: int = 1024**3,
+        root: str = SHM_ROOT,
+    ) -> None:
+        """Init SharedCache.
+
+        Args:
+            name (str): name of the cache, its directory under `root`
+                (default: ``proxystore``).
+            size (int): bytes the entries of the cache may take
+                (default: 1 GB).
+            root (str): directory holding the cache, normally a tmpfs so that
+                the entries stay in memory (default: ``/dev/shm``).
+        """
+        self.name = name
+        self.size = size
+        self.path = os.path.join(root, name)
+        os.makedirs(self.path, exist_ok=True)
+        self._tmp = 0
+        self._tmp_lock = threading.Lock()
+
+    @property
+    def used(self) -> int:
+        """Bytes taken by the entries of the cache."""
+        with self._locked("usage") as fd:
+            return self._used(fd)
+
+    def get(self, key: str) -> tuple[memoryview, Metadata] | None:
+        """Return the value and metadata of `key`, or None if not cached.
+
+        The value is a copy-on-write view of the shared pages.
+        """
+        path = self._file(key)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            length = os.fstat(fd).st_size
+            if length < METADATA.size + KEY_LENGTH.size:
+                return None
+            view = memoryview(mmap.mmap(fd, length, access=mmap.ACCESS_COPY))
+        finally:
+            os.close(fd)
+
+        metadata = Metadata(*METADATA.unpack_from(view))
+        (key_length,) = KEY_LENGTH.unpack_from(view, METADATA.size)
+        start = METADATA.size + KEY_LENGTH.size
+        # files are named after a hash of the key
+        if bytes(view[start:start + key_length]) != key.encode():
+            return None
+        offset = _aligned(start + key_length)
+        if offset + metadata.size > length:
+            return None
+        with suppress(OSError):
+            os.utime(path)
+        return view[offset:offset + metadata.size], metadata
+
+    def put(self, key: str, value: Any, metadata: Metadata) -> bool:
+        """Cache `value`, a bytes-like object, with its `metadata`.
+
+        Returns:
+            False if the entry is larger than the whole cache.
+        """
+        data = memoryview(value).cast("B")
+        name = key.encode()
+        head = METADATA.pack(metadata.timestamp, data.nbytes, metadata.version, metadata.flags)
+        head += KEY_LENGTH.pack(len(name)) + name
+        head += bytes(_aligned(len(head)) - len(head))
+        if len(head) + data.nbytes > self.size:
+            return False
+
+        length = len(head) + data.nbytes
+        path = self._file(key)
+        with self._tmp_lock:
+            self._tmp += 1
+            tmp = os.path.join(self.path, f".{os.getpid()}.{self._tmp}.tmp")
+        with self._locked("usage") as fd:
+            replaced = _size(path)
+            used = self._used(fd) - replaced
+            if used + length > self.size:
+                used = self._make_room(int(self.size * EVICT_TO) - length, keep=path)
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(head)
+                    f.write(data)
+                os.replace(tmp, path)
+            except OSError:
+                # out of shared memory, the object is still served remotely
+                logger.warning(f"Could not cache key '{key}' in {self.path}")
+                with suppress(OSError):
+                    os.unlink(tmp)
+                os.pwrite(fd, USAGE.pack(used + replaced), 0)
+                return False
+            os.pwrite(fd, USAGE.pack(used + length), 0)
+        return True
+
+    def fetch(
+        self,
+        key: str,
+        load: Callable[[], tuple[Any, Metadata | None]],
+        newer_than: float | None = None,
+    ) -> tuple[Any, Metadata | None]:
+        """Return the cached value of `key`, loading it on a miss.
+
+        Only one process of the node calls `load` for a key at a time, the
+        others wait and read what it cached.
+
+        Args:
+            key (str): key of the object.
+            load (callable): returns the (value, metadata) of the object,
+                (None, None) if it does not exist.
+            newer_than (float): optional timestamp the cached entry must not
+                be older than.
+
+        Returns:
+            (value, metadata) of the object, (None, None) if `load` found
+            nothing.
+        """
+        hit = self._fresh(key, newer_than)
+        if hit is not None:
+            return hit
+        with self._locked(f"fetch-{_digest(key)[0] % LOCK_STRIPES}"):
+            hit = self._fresh(key, newer_than)
+            if hit is not None:
+                return hit
+            value, metadata = load()
+            if value is not None:
+                self.put(key, value, metadata)
+        return value, metadata
+
+    def evict(self, key: str) -> None:
+        """Drop `key` from the cache."""
+        path = self._file(key)
+        with self._locked("usage") as fd:
+            size = _size(path)
+            if size:
+                with suppress(FileNotFoundError):
+                    os.unlink(path)
+                os.pwrite(fd, USAGE.pack(max(self._used(fd) - size, 0)), 0)
+
+    def clear(self) -> None:
+        """Drop every entry of the cache."""
+        with self._locked("usage") as fd:
+            for path, _, _ in self._entries():
+                with suppress(FileNotFoundError):
+                    os.unlink(path)
+            os.pwrite(fd, USAGE.pack(0), 0)
+
+    def _fresh(self, key: str, newer_than: float | None) -> tuple[memoryview, Metadata] | None:
+        hit = self.get(key)
+        if hit is not None and newer_than is not None and hit[1].timestamp < newer_than:
+            return None
+        return hit
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, _digest(key).hex())
+
+    def _entries(self) -> list[tuple[str, int, float]]:
+        # (path, size, last read) of the entries, skipping temporary and
+        # lock files
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                with suppress(FileNotFoundError):
+                    st = entry.stat()
+                    entries.append((entry.path, st.st_size, st.st_mtime))
+        return entries
+
+    def _used(self, fd: int) -> int:
+        # bytes taken, read from the usage lock file `fd`, counted from the
+        # entries if the file is new
+        data = os.pread(fd, USAGE.size, 0)
+        if len(data) == USAGE.size:
+            return USAGE.unpack(data)[0]
+        return sum(s for _, s, _ in self._entries())
+
+    def _make_room(self, target: int, keep: str) -> int:
+        # evict the least recently read entries, but the one at `keep`,
+        # until they take at most `target` bytes, holding the usage lock.
+        # Returns the bytes they take, counted afresh to make up for the
+        # processes that died before updating the usage
+        entries = [e for e in self._entries() if e[0] != keep]
+        used = sum(s for _, s, _ in entries)
+        entries.sort(key=lambda e: e[2])
+        for path, s, _ in entries:
+            if used <= target:
+                break
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+            used -= s
+        return used
+
+    @contextmanager
+    def _locked(self, name: str) -> Generator[int, None, None]:
+        # lock shared by the processes of the node, and the threads of this
+        # one since each takes it through its own open file
+        fd = os.open(os.path.join(self.path, f".lock-{name}"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)
+
+
+def _digest(key: str) -> bytes:
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+def _size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _aligned(offset: int) -> int:
+    return offset + (-offset % ALIGNMENT)
@@ -0,0 +1,643 @@
+"""Operations shared by the RDMA-backed stores."""
+from __future__ import annotations
+
+import logging
+import time
+from collections.abc import Mapping
+from typing import Any
+from typing import Iterable
+from typing import Sequence
+
+import proxystore as ps
+
+import compression
+import instrument
+import oob
+from completion import RDMAFuture
+from completion import completed
+from completion import gather
+
+logger = logging.getLogger(__name__)
+
+
+class RDMAStoreMixin:
+    """Batched store operations on top of an :class:`RDMA <rdma_interface.RDMA>` client.
+
+    Shared by :class:`MargoStore <margo.MargoStore>` and
+    :class:`RDMAStore <rdma.RDMAStore>`, which provide the ``_rdma`` client
+    together with the ``_cache`` and ``name`` of the proxystore base class.
+    Each batch method moves all of its keys with one RPC and one bulk
+    transfer (per 64 MB of values).
+
+    Objects exposing large buffers, such as NumPy arrays, are serialized with
+    pickle protocol 5 and their buffers sent out-of-band (see :mod:`oob`):
+    they are registered in place on set and received into an array of
+    their own on get, without being copied.
+
+    With a node-local :class:`SharedCache <shm_cache.SharedCache>` as
+    ``_shm``, objects missing from the per-process cache are looked up in
+    shared memory before being fetched, and every fetched object is put
+    there for the other processes of the node. Objects read from it are
+    views of the shared pages, their out-of-band buffers are not copied.
+
+    With a :class:`Compressor <compression.Compressor>` as ``_compressor``,
+    objects are compressed before they are sent when it pays off for them,
+    and decompressed when fetched, according to the codec in their flags.
+
+    The ``*_async`` methods return an :class:`RDMAFuture
+    <completion.RDMAFuture>` immediately. It can be waited on with
+    :func:`result()` from any thread or awaited from an asyncio coroutine.
+    Submitting an operation blocks while the client session already has
+    its maximum number of operations in flight.
+
+    A store created with ``stats=True`` times the phases of its operations
+    in ``_phases`` (see :mod:`instrument`): the time of each phase is added
+    to the stats of the key as the ``<function>.<phase>`` event, and
+    :func:`phase_stats()` and :func:`write_phase_trace()` export them for
+    all keys.
+    """
+
+    _shm = None
+    _compressor = None
+    _phases = instrument.DISABLED
+
+    def phase_stats(self) -> dict[str, Any]:
+        """Return the time spent in each phase of the store operations.
+
+        Returns:
+            dict mapping each operation to its number of calls, bytes moved
+            and the calls, total, average, minimum and maximum milliseconds
+            of each of its phases (see :func:`Phases.snapshot()
+            <instrument.Phases.snapshot>`).
+
+        Raises:
+            ValueError:
+                if the store was initialized with :code:`stats=False`.
+        """
+        return self._phases_or_raise().snapshot()
+
+    def write_phase_trace(self, path: str) -> None:
+        """Write the phases of the recent operations as a Chrome trace.
+
+        Args:
+            path (str): file to write, opened by ``chrome://tracing`` or
+                Perfetto.
+
+        Raises:
+            ValueError:
+                if the store was initialized with :code:`stats=False` or
+                without :code:`phase_trace=True`.
+        """
+        phases = self._phases_or_raise()
+        if not phases.trace:
+            raise ValueError(
+                "Operations are not being traced because this store was "
+                "initialized with phase_trace=False.",
+            )
+        phases.write_trace(path)
+
+    def evict(self, key: str) -> None:
+        """Evict the object associated with key from the server and cache.
+
+        Args:
+            key (str): key corresponding to object in store to evict.
+        """
+        with self._phases.operation("evict", key):
+            self._rdma.evict(key)
+            self._cache.evict(key)
+            self._shm_evict([key])
+        logger.debug(
+            f"EVICT key='{key}' FROM {self.__class__.__name__}"
+            f"(name='{self.name}')",
+        )
+
+    def evict_many(self, keys: Iterable[str]) -> None:
+        """Evict the objects associated with keys.
+
+        Args:
+            keys (iterable): keys corresponding to objects to evict.
+        """
+        keys = list(keys)
+        with self._phases.operation("evict_many"):
+            self._rdma.evict_many(keys)
+            for key in keys:
+                self._cache.evict(key)
+            self._shm_evict(keys)
+        logger.debug(
+            f"EVICT {len(keys)} keys FROM {self.__class__.__name__}"
+            f"(name='{self.name}')",
+        )
+
+    def exists_many(self, keys: Iterable[str]) -> list[bool]:
+        """Check if keys exist.
+
+        Args:
+            keys (iterable): keys to check.
+
+        Returns:
+            list of `bool` in the order of `keys`.
+        """
+        return self._rdma.exists_many(keys)
+
+    def get(
+        self,
+        key: str,
+        *,
+        deserialize: bool = True,
+        strict: bool = False,
+        default: Any | None = None,
+    ) -> Any | None:
+        """Return object associated with key.
+
+        The value and its timestamp come back from the server in a single
+        RPC, instead of :func:`get_bytes()` followed by
+        :func:`get_timestamp()`.
+
+        Args:
+            key (str): key corresponding to object.
+            deserialize (bool): deserialize object if True. If objects
+                are custom serialized, set this as False (default: True).
+            strict (bool): guarantee returned object is the most recent
+                version (default: False).
+            default: optionally provide value to be returned if an object
+                associated with the key does not exist (default: None).
+
+        Returns:
+            object associated with key or `default` if key does not exist.
+        """
+        with self._phases.operation("get", key) as op:
+            return self._get(op, key, deserialize, strict, default)
+
+    def _get(self, op: Any, key: str, deserialize: bool, strict: bool, default: Any) -> Any:
+        # get() within its timed operation
+        if self.is_cached(key, strict=strict):
+            value = self._cache.get(key)["value"]
+            op.mark("cache")
+            logger.debug(
+                f"GET key='{key}' FROM {self.__class__.__name__}"
+                f"(name='{self.name}'): was_cached=True",
+            )
+            return value
+        op.mark("cache")
+
+        if self._shm is not None:
+            value, metadata = self._get_shared(key, strict)
+            op.mark("shared_cache")
+        else:
+            start = time.perf_counter()
+            value, metadata = self._rdma.get(key, metadata=True, copy=False)
+            if value is not None and self._compressor is not None:
+                self._compressor.observe(len(value), time.perf_counter() - start)
+        if value is not None:
+            results = self._fill([key], [0], [(value, metadata)], [default], deserialize)
+            logger.debug(
+                f"GET key='{key}' FROM {self.__class__.__name__}"
+                f"(name='{self.name}'): was_cached=False",
+            )
+            return results[0]
+
+        logger.debug(
+            f"GET key='{key}' FROM {self.__class__.__name__}"
+            f"(name='{self.name}'): key did not exist, returned default",
+        )
+        return default
+
+    def get_timestamp(self, key: str) -> float:
+        """Get timestamp of most recent object version in the store.
+
+        Answered from the metadata kept by the server, without moving the
+        object.
+
+        Args:
+            key (str): key corresponding to object.
+
+        Returns:
+            timestamp (float) of when key was added to the server (seconds
+            since epoch).
+
+        Raises:
+            KeyError:
+                if `key` does not exist in store.
+        """
+        metadata = self._rdma.stat(key)
+        if metadata is None:
+            raise KeyError(f"Key='{key}' does not exist on the remote server")
+        return metadata.timestamp
+
+    def get_many(
+        self,
+        keys: Iterable[str],
+        *,
+        deserialize: bool = True,
+        default: Any | None = None,
+    ) -> list[Any | None]:
+        """Return the objects associated with keys.
+
+        Objects that are cached locally are not fetched. The others are
+        fetched, with their metadata, in a single batch.
+
+        Args:
+            keys (iterable): keys corresponding to objects.
+            deserialize (bool): deserialize objects if True (default: True).
+            default: value returned for keys that do not exist
+                (default: None).
+
+        Returns:
+            list of objects in the order of `keys`.
+        """
+        keys = list(keys)
+        with self._phases.operation("get_many") as op:
+            results, missing = self._lookup_cache(keys, default)
+            op.mark("cache")
+            if missing:
+                values = self._get_many_shared([keys[i] for i in missing])
+                self._fill(keys, missing, values, results, deserialize)
+
+        logger.debug(
+            f"GET {len(keys)} keys FROM {self.__class__.__name__}"
+            f"(name='{self.name}'): {len(keys) - len(missing)} were cached",
+        )
+        return results
+
+    def get_async(
+        self,
+        key: str,
+        *,
+        deserialize: bool = True,
+        default: Any | None = None,
+    ) -> RDMAFuture:
+        """Asynchronously get the object associated with key.
+
+        Args:
+            key (str): key corresponding to object.
+            deserialize (bool): deserialize object if True (default: True).
+            default: value returned if the key does not exist
+                (default: None).
+
+        Returns:
+            :class:`RDMAFuture` of the object.
+        """
+        future = self.get_many_async([key], deserialize=deserialize, default=default)
+        return gather([future], lambda values: values[0][0])
+
+    def get_many_async(
+        self,
+        keys: Iterable[str],
+        *,
+        deserialize: bool = True,
+        default: Any | None = None,
+    ) -> RDMAFuture:
+        """Asynchronously get the objects associated with keys.
+
+        Args:
+            keys (iterable): keys corresponding to objects.
+            deserialize (bool): deserialize objects if True (default: True).
+            default: value returned for keys that do not exist
+                (default: None).
+
+        Returns:
+            :class:`RDMAFuture` of the list of objects in the order of `keys`.
+        """
+        keys = list(keys)
+        op = self._phases.start("get_many_async", keys[0] if len(keys) == 1 else None)
+        results, missing = self._lookup_cache(keys, default)
+        op.mark("cache")
+        if self._shm is not None:
+            hits = {i: self._shm.get(keys[i]) for i in missing}
+            hits = {i: hit for i, hit in hits.items() if hit is not None}
+            with instrument.using(op):
+                self._fill(keys, list(hits), list(hits.values()), results, deserialize)
+            missing = [i for i in missing if i not in hits]
+        if not missing:
+            op.stop()
+            return completed(results)
+        with instrument.using(op):
+            future = self._rdma.get_many_async([keys[i] for i in missing], metadata=True)
+
+        def fill(values: list[list[tuple[Any, Any]]]) -> list[Any]:
+            if self._shm is not None:
+                for i, (value, metadata) in zip(missing, values[0]):
+                    if value is not None:
+                        self._shm.put(keys[i], value, metadata)
+                op.mark("shared_cache")
+            with instrument.using(op):
+                return self._fill(keys, missing, values[0], results, deserialize)
+
+        return self._stop_when_done(gather([future], fill), op)
+
+    def set(
+        self,
+        obj: Any,
+        *,
+        key: str | None = None,
+        serialize: bool = True,
+    ) -> str:
+        """Set key-object pair in store.
+
+        Objects with out-of-band buffers are sent without being copied,
+        others are serialized to bytes as in the base store.
+
+        Args:
+            obj (object): object to be placed in the store.
+            key (str, optional): key to use with the object. If the key is not
+                provided, one will be created.
+            serialize (bool): serialize object if True. If object is already
+                custom serialized, set this as False (default: True).
+
+        Returns:
+            key (str).
+        """
+        with self._phases.operation("set", key) as op:
+            value = oob.dumps(obj) if serialize else obj
+            if not serialize or isinstance(value, bytes):
+                key = super().set(value, key=key, serialize=False)
+                self._shm_evict([key])
+                op.identify(key)
+                return key
+            if key is None:
+                key = self.create_key(obj)
+            op.identify(key)
+
+            self._put(key, value, oob.OUT_OF_BAND)
+            self._shm_evict([key])
+        logger.debug(
+            f"SET key='{key}' IN {self.__class__.__name__}"
+            f"(name='{self.name}'): out-of-band",
+        )
+        return key
+
+    def set_async(
+        self,
+        obj: Any,
+        *,
+        key: str | None = None,
+        serialize: bool = True,
+    ) -> RDMAFuture:
+        """Asynchronously set key-object pair in the store.
+
+        Args:
+            obj (object): object to be placed in the store.
+            key (str, optional): key to use with the object. If the key is not
+                provided, one will be created.
+            serialize (bool): serialize object if True (default: True).
+
+        Returns:
+            :class:`RDMAFuture` of the key, done once the object is stored.
+
+        Raises:
+            TypeError:
+                if `serialize=False` and `obj` is not an instance of `bytes`.
+        """
+        op = self._phases.start("set_async", key)
+        value = oob.dumps(obj) if serialize else obj
+        if serialize and not isinstance(value, bytes):
+            if key is None:
+                key = self.create_key(obj)
+            op.identify(key)
+            op.mark("serialize")
+            self._shm_evict([key])
+            with instrument.using(op):
+                value, flags = self._encode(value, oob.OUT_OF_BAND)
+                future = self._rdma.set_async(key, value, flags=flags)
+            logger.debug(
+                f"SET key='{key}' IN {self.__class__.__name__}"
+                f"(name='{self.name}'): submitted asynchronously, out-of-band",
+            )
+            return self._stop_when_done(gather([future], lambda _: key), op)
+
+        if not isinstance(value, bytes):
+            raise TypeError(f"data must be of type bytes. Found {type(value)}")
+        if key is None:
+            key = self.create_key(value)
+        op.identify(key)
+        op.mark("serialize")
+
+        self._shm_evict([key])
+        with instrument.using(op):
+            value, flags = self._encode(value)
+            future = self._rdma.set_async(key, value, flags=flags)
+        logger.debug(
+            f"SET key='{key}' IN {self.__class__.__name__}"
+            f"(name='{self.name}'): submitted asynchronously",
+        )
+        return self._stop_when_done(gather([future], lambda _: key), op)
+
+    def set_many(
+        self,
+        items: Mapping[str, Any] | Iterable[tuple[str, Any]],
+        *,
+        serialize: bool = True,
+    ) -> list[str]:
+        """Set key-object pairs in the store.
+
+        Args:
+            items: mapping or iterable of (key, object) pairs.
+            serialize (bool): serialize objects if True (default: True).
+
+        Returns:
+            list of keys.
+
+        Raises:
+            TypeError:
+                if `serialize=False` and an object is not an instance of
+                `bytes`.
+        """
+        if isinstance(items, Mapping):
+            items = items.items()
+
+        with self._phases.operation("set_many") as op:
+            batch = []
+            keys = []
+            for key, obj in items:
+                if serialize:
+                    obj = ps.serialize.serialize(obj)
+                if not isinstance(obj, bytes):
+                    raise TypeError(f"data must be of type bytes. Found {type(obj)}")
+                batch.append((key, obj))
+                keys.append(key)
+            op.mark("serialize")
+
+            # compressed and raw values go in separate batches, as the flags
+            # of a batch are shared by all its values
+            batches: dict[int, list[tuple[str, Any]]] = {}
+            for key, obj in batch:
+                obj, flags = self._encode(obj)
+                batches.setdefault(flags, []).append((key, obj))
+            for flags, group in batches.items():
+                self._rdma.set_many(group, flags=flags)
+            self._shm_evict(keys)
+        logger.debug(
+            f"SET {len(keys)} keys IN {self.__class__.__name__}"
+            f"(name='{self.name}')",
+        )
+        return keys
+
+    def set_batch(
+        self,
+        objs: Sequence[Any],
+        *,
+        keys: Sequence[str | None] | None = None,
+        serialize: bool = True,
+    ) -> list[str]:
+        """Set objects in store with a single :func:`set_many()` call.
+
+        Args:
+            objs (Sequence[object]): objects to be placed in the store.
+            keys (Sequence[str], optional): keys to use with the objects.
+                If the keys are not provided, keys will be created.
+            serialize (bool): serialize objects if True (default: True).
+
+        Returns:
+            List of keys (str).
+
+        Raises:
+            ValueError:
+                if :code:`keys is not None` and :code:`len(objs) != len(keys)`.
+        """
+        if keys is not None and len(objs) != len(keys):
+            raise ValueError(
+                f"objs has length {len(objs)} but keys has length {len(keys)}",
+            )
+        if keys is None:
+            keys = [None] * len(objs)
+
+        items = []
+        for key, obj in zip(keys, objs):
+            if serialize:
+                obj = ps.serialize.serialize(obj)
+            if key is None:
+                key = self.create_key(obj)
+            items.append((key, obj))
+        return self.set_many(items, serialize=False)
+
+    def _get_shared(self, key: str, strict: bool) -> tuple[Any, Any]:
+        # (value, metadata) from the node cache, one process of the node
+        # fetches it on a miss
+        newer_than = None
+        if strict:
+            metadata = self._rdma.stat(key)
+            if metadata is None:
+                return None, None
+            newer_than = metadata.timestamp
+        return self._shm.fetch(
+            key,
+            lambda: self._rdma.get(key, metadata=True, copy=False),
+            newer_than,
+        )
+
+    def _get_many_shared(self, keys: list[str]) -> list[tuple[Any, Any]]:
+        # (value, metadata) pairs of keys, the ones missing from the node
+        # cache fetched in one batch and put there
+        if self._shm is None:
+            return self._rdma.get_many(keys, metadata=True)
+        values = [self._shm.get(key) for key in keys]
+        fetch = [i for i, hit in enumerate(values) if hit is None]
+        if fetch:
+            fetched = self._rdma.get_many([keys[i] for i in fetch], metadata=True)
+            for i, (value, metadata) in zip(fetch, fetched):
+                if value is not None:
+                    self._shm.put(keys[i], value, metadata)
+                values[i] = (value, metadata)
+        return values
+
+    def _encode(self, value: Any, flags: int = 0) -> tuple[Any, int]:
+        # the value to send and its flags, compressed if it pays off
+        if self._compressor is None:
+            return value, flags
+        codec = self._compressor.choose(value)
+        if codec is None:
+            instrument.current().mark("compress")
+            return value, flags
+        value = compression.compress(value, codec)
+        instrument.current().mark("compress")
+        return value, flags | codec.id << compression.CODEC_SHIFT
+
+    def _decode(self, value: Any, metadata: Any) -> Any:
+        # the raw value of a fetched one
+        codec = compression.codec_of(metadata.flags)
+        if codec is None:
+            return value
+        value = compression.decompress(value, codec)
+        instrument.current().mark("decompress")
+        return value
+
+    def _put(self, key: str, value: Any, flags: int = 0) -> None:
+        # set a value, compressed if it pays off, measuring the link
+        with self._phases.operation("set", key) as op:
+            # the object was serialized since the operation started
+            op.mark("serialize")
+            value, flags = self._encode(value, flags)
+            start = time.perf_counter()
+            self._rdma.set(key, value, flags=flags)
+            if self._compressor is not None:
+                nbytes = len(value) if isinstance(value, bytes) else sum(memoryview(s).nbytes for s in value)
+                self._compressor.observe(nbytes, time.perf_counter() - start)
+
+    def _get_raw(self, key: str) -> bytes | None:
+        # serialized object of key, or None
+        with self._phases.operation("get_bytes", key):
+            value, metadata = self._rdma.get(key, metadata=True)
+            if value is None:
+                return None
+            return bytes(self._decode(value, metadata))
+
+    def _phases_or_raise(self) -> instrument.Phases:
+        if not isinstance(self._phases, instrument.Phases):
+            raise ValueError(
+                "Phases are not being tracked because this store was "
+                "initialized with stats=False.",
+            )
+        return self._phases
+
+    def _stop_when_done(self, future: RDMAFuture, op: Any) -> RDMAFuture:
+        # an asynchronous operation ends when its future completes
+        future.add_done_callback(lambda _: op.stop())
+        return future
+
+    def _shm_evict(self, keys: list[str]) -> None:
+        # a write or eviction makes the node cache entries stale
+        if self._shm is not None:
+            for key in keys:
+                self._shm.evict(key)
+
+    def _lookup_cache(
+        self,
+        keys: list[str],
+        default: Any,
+    ) -> tuple[list[Any], list[int]]:
+        # results with the cached objects filled in and the indices of the
+        # keys that have to be fetched
+        results = [default] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            if self.is_cached(key):
+                results[i] = self._cache.get(key)["value"]
+            else:
+                missing.append(i)
+        return results, missing
+
+    def _fill(
+        self,
+        keys: list[str],
+        missing: list[int],
+        values: list[tuple[Any, Any]],
+        results: list[Any],
+        deserialize: bool,
+    ) -> list[Any]:
+        # store the fetched (value, metadata) pairs in results and the cache,
+        # a value is bytes or the uint8 array it was received into, and is
+        # decompressed first if its flags name a codec
+        for i, (value, metadata) in zip(missing, values):
+            if value is None:
+                continue
+            value = self._decode(value, metadata)
+            if deserialize and metadata.flags & oob.OUT_OF_BAND:
+                value = oob.loads(value)
+            elif deserialize:
+                value = ps.serialize.deserialize(bytes(value))
+            else:
+                value = bytes(value)
+            self._cache.set(keys[i], {"timestamp": metadata.timestamp, "value": value})
+            results[i] = value
+        instrument.current().mark("deserialize")
+        return results
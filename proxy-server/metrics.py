@@ -0,0 +1,156 @@
+"""Counters and latency histograms of the RPCs served by a peer.
+
+Every RPC type served by :class:`RDMAProvider` has the counters of a
+:class:`protocol.RPCStats`: calls, calls answered with ``ERROR``, bytes
+pulled from and pushed to the clients, and the latency of the handler in a
+log2 histogram. The bulk transfers of the handlers are also counted on
+their own, as the ``pull`` and ``push`` RPCs, so that the time spent moving
+data shows apart from the time spent in the handlers.
+
+A handler is timed by :func:`Metrics.timed()`, which hands it a
+:class:`TrackedHandle` that records the status it answers with. Handlers
+charge their transfers to it with :func:`Metrics.transferred()`. The
+``stats`` RPC answers with :func:`Metrics.snapshot()`.
+"""
+from __future__ import annotations
+
+import threading
+from time import monotonic
+from time import perf_counter_ns
+from typing import Any
+from typing import Callable
+
+import protocol
+
+
+class Call:
+    """RPC being served."""
+
+    __slots__ = ("rpc", "start", "status", "bytes_in", "bytes_out")
+
+    def __init__(self, rpc: str) -> None:
+        self.rpc = rpc
+        self.start = perf_counter_ns()
+        self.status = protocol.OK
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+class TrackedHandle:
+    """Handle of an RPC being served, keeping the status it answers with."""
+
+    __slots__ = ("handle", "call")
+
+    def __init__(self, handle: Any, call: Call) -> None:
+        self.handle = handle
+        self.call = call
+
+    def get_addr(self) -> Any:
+        return self.handle.get_addr()
+
+    def respond(self, msg: bytes) -> None:
+        # every response starts with its status
+        self.call.status = protocol.RESPONSE.unpack_from(msg)[0]
+        self.handle.respond(msg)
+
+
+class _Counters:
+    __slots__ = ("calls", "errors", "bytes_in", "bytes_out", "latency", "max_latency", "histogram")
+
+    def __init__(self) -> None:
+        self.calls = self.errors = self.bytes_in = self.bytes_out = 0
+        self.latency = self.max_latency = 0
+        self.histogram = [0] * protocol.LATENCY_BUCKETS
+
+
+class Metrics:
+    """Counters of the RPCs served by a provider since it started."""
+
+    def __init__(self) -> None:
+        self.started = monotonic()
+        # handlers running
+        self.active = 0
+        self._rpcs: dict[str, _Counters] = {}
+        self._lock = threading.Lock()
+
+    def timed(self, rpc: str, handler: Callable[[Any, bytes], None]) -> Callable[[Any, bytes], None]:
+        """Return `handler` counted as RPC `rpc`.
+
+        A handler that raises is counted as an error.
+        """
+        def serve(handle: Any, msg: bytes) -> None:
+            call = Call(rpc)
+            with self._lock:
+                self.active += 1
+            try:
+                handler(TrackedHandle(handle, call), msg)
+            except Exception:
+                call.status = protocol.ERROR
+                raise
+            finally:
+                self.add(
+                    rpc, perf_counter_ns() - call.start, call.status == protocol.ERROR,
+                    call.bytes_in, call.bytes_out, finished=True,
+                )
+
+        return serve
+
+    def transferred(self, handle: TrackedHandle, pull: bool, nbytes: int, ns: int) -> None:
+        """Account for a bulk transfer of `nbytes` made for `handle`."""
+        if pull:
+            handle.call.bytes_in += nbytes
+            self.add("pull", ns, bytes_in=nbytes)
+        else:
+            handle.call.bytes_out += nbytes
+            self.add("push", ns, bytes_out=nbytes)
+
+    def add(
+        self,
+        rpc: str,
+        ns: int,
+        error: bool = False,
+        bytes_in: int = 0,
+        bytes_out: int = 0,
+        finished: bool = False,
+    ) -> None:
+        """Count a call of `rpc` that took `ns` nanoseconds.
+
+        `finished` marks the end of a handler counted in :attr:`active`.
+        """
+        with self._lock:
+            c = self._rpcs.get(rpc)
+            if c is None:
+                c = self._rpcs[rpc] = _Counters()
+            c.calls += 1
+            c.errors += error
+            c.bytes_in += bytes_in
+            c.bytes_out += bytes_out
+            c.latency += ns
+            c.max_latency = max(c.max_latency, ns)
+            c.histogram[protocol.latency_bucket(ns)] += 1
+            if finished:
+                self.active -= 1
+
+    def snapshot(
+        self,
+        memory_used: int = 0,
+        memory_limit: int = 0,
+        items: int = 0,
+        evictions: int = 0,
+    ) -> protocol.Stats:
+        """Return the counters with the memory figures of the store."""
+        with self._lock:
+            rpcs = {
+                rpc: protocol.RPCStats(
+                    rpc, c.calls, c.errors, c.bytes_in, c.bytes_out, c.latency,
+                    c.max_latency, tuple(c.histogram),
+                )
+                for rpc, c in self._rpcs.items()
+            }
+            active = self.active
+        # values are never written behind and the handler queue of pymargo
+        # is not visible, dirty and queued stay 0
+        return protocol.Stats(
+            monotonic() - self.started, memory_used, memory_limit, items, evictions,
+            0, active, 0, rpcs,
+        )
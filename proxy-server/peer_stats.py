@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""Live view of the RDMA peers of a peer directory, for capacity planning.
+
+Every interval, the ``stats`` RPC of each peer listed in the peer directory
+is polled and the difference with its previous snapshot printed: requests
+and bytes per second, latency percentiles and memory per peer, then per
+RPC type over all the peers. The first view covers the whole life of the
+peers. Latency percentiles are the upper bound of their log2 histogram
+bucket, so they are off by up to a factor 2 on the high side.
+
+    python peer_stats.py --peer-dir ~/.proxystore/peers --interval 5
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "proxy-client"))
+import protocol
+from sharding import PEER_DIR, ShardedRDMA
+
+# counters of the bulk transfers rather than of an RPC
+TRANSFERS = ("pull", "push")
+
+
+def since(new, old):
+    """Return (seconds, rpcs) of the counters of new since old.
+
+    The whole of new when there is no old snapshot or the peer restarted.
+    """
+    if old is None or new.uptime < old.uptime:
+        return new.uptime, new.rpcs
+    rpcs = {}
+    for name, r in new.rpcs.items():
+        o = old.rpcs.get(name, protocol.RPCStats(name))
+        rpcs[name] = protocol.RPCStats(
+            name,
+            *(a - b for a, b in zip(r[1:6], o[1:6])),
+            r.max_latency,
+            tuple(a - b for a, b in zip(r.histogram, o.histogram)),
+        )
+    return new.uptime - old.uptime, rpcs
+
+
+def merge(name, rpcs):
+    """Return the sum of the counters of rpcs."""
+    total = protocol.RPCStats(name)
+    for r in rpcs:
+        total = protocol.RPCStats(
+            name,
+            *(a + b for a, b in zip(total[1:6], r[1:6])),
+            max(total.max_latency, r.max_latency),
+            tuple(a + b for a, b in zip(total.histogram, r.histogram)),
+        )
+    return total
+
+
+def percentile(histogram, q):
+    """Return the latency in ns under which a fraction q of calls fell."""
+    count = sum(histogram)
+    if count == 0:
+        return None
+    rank = max(q * count, 1)
+    seen = 0
+    for bucket, n in enumerate(histogram):
+        seen += n
+        if seen >= rank:
+            return 2 ** (bucket + 1)
+    return 2 ** len(histogram)
+
+
+def rates(r, seconds):
+    seconds = max(seconds, 1e-9)
+    # no call took longer than the largest latency
+    p50, p99 = (
+        min(p, r.max_latency) if p is not None else None
+        for p in (percentile(r.histogram, 0.5), percentile(r.histogram, 0.99))
+    )
+    return {
+        "ops": r.calls / seconds,
+        "errors": r.errors / seconds,
+        "in_mb": r.bytes_in / seconds / 1e6,
+        "out_mb": r.bytes_out / seconds / 1e6,
+        "p50_ms": p50 / 1e6 if p50 is not None else None,
+        "p99_ms": p99 / 1e6 if p99 is not None else None,
+        "max_ms": r.max_latency / 1e6,
+    }
+
+
+def ms(value):
+    return f"{value:9.3f}" if value is not None else f"{'-':>9}"
+
+
+def size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TB"
+
+
+def duration(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+
+def view(snapshots, previous):
+    """Return the view of one poll, as a JSON serializable dict."""
+    peers = []
+    by_rpc = {}
+    longest = 0.0
+    for peer, stats in sorted(snapshots.items()):
+        if stats is None:
+            peers.append({"addr": peer.addr, "provider_id": peer.provider_id, "up": False})
+            continue
+        seconds, rpcs = since(stats, previous.get(peer))
+        longest = max(longest, seconds)
+        for name, r in rpcs.items():
+            by_rpc.setdefault(name, []).append(r)
+        served = merge("all", [r for name, r in rpcs.items() if name not in TRANSFERS])
+        moved = merge("all", [r for name, r in rpcs.items() if name in TRANSFERS])
+        peers.append({
+            "addr": peer.addr,
+            "provider_id": peer.provider_id,
+            "up": True,
+            "uptime": stats.uptime,
+            "seconds": seconds,
+            **rates(served, seconds),
+            "in_mb": moved.bytes_in / max(seconds, 1e-9) / 1e6,
+            "out_mb": moved.bytes_out / max(seconds, 1e-9) / 1e6,
+            "memory_used": stats.memory_used,
+            "memory_limit": stats.memory_limit,
+            "items": stats.items,
+            "evictions": stats.evictions,
+            "dirty": stats.dirty,
+            "active": stats.active,
+            "queued": stats.queued,
+        })
+    # the peers are polled together, their counters add up over the longest
+    # of their intervals
+    rpcs = {}
+    for name, counters in sorted(by_rpc.items()):
+        total = merge(name, counters)
+        if total.calls:
+            rpcs[name] = rates(total, longest)
+    return {"time": datetime.now().isoformat(timespec="seconds"), "peers": peers, "rpcs": rpcs}
+
+
+def show(v):
+    up = [p for p in v["peers"] if p["up"]]
+    click.echo(f"\n{v['time']}  {len(up)}/{len(v['peers'])} peers up")
+    click.echo(
+        f"{'peer':<28} {'uptime':>8} {'ops/s':>10} {'in MB/s':>9} {'out MB/s':>9} {'p50 ms':>9} "
+        f"{'p99 ms':>9} {'memory':>19} {'items':>9} {'active':>6} {'queued':>6} {'dirty':>6}"
+    )
+    totals = {"ops": 0.0, "in_mb": 0.0, "out_mb": 0.0, "memory_used": 0, "memory_limit": 0, "items": 0}
+    for p in v["peers"]:
+        if not p["up"]:
+            click.echo(f"{p['addr']:<28} {'down':>8}")
+            continue
+        for field in totals:
+            totals[field] += p[field]
+        memory = f"{size(p['memory_used'])}/{size(p['memory_limit'])}"
+        click.echo(
+            f"{p['addr']:<28} {duration(p['uptime']):>8} {p['ops']:10.1f} {p['in_mb']:9.1f} "
+            f"{p['out_mb']:9.1f} {ms(p['p50_ms'])} {ms(p['p99_ms'])} {memory:>19} {p['items']:9d} "
+            f"{p['active']:6d} {p['queued']:6d} {p['dirty']:6d}"
+        )
+    memory = f"{size(totals['memory_used'])}/{size(totals['memory_limit'])}"
+    click.echo(
+        f"{'total':<28} {'':>8} {totals['ops']:10.1f} {totals['in_mb']:9.1f} {totals['out_mb']:9.1f} "
+        f"{'':>9} {'':>9} {memory:>19} {totals['items']:9d}"
+    )
+
+    click.echo(
+        f"\n{'rpc':<28} {'':>8} {'ops/s':>10} {'in MB/s':>9} {'out MB/s':>9} {'p50 ms':>9} "
+        f"{'p99 ms':>9} {'max ms':>9} {'errors/s':>9}"
+    )
+    for name, r in v["rpcs"].items():
+        click.echo(
+            f"{name:<28} {'':>8} {r['ops']:10.1f} {r['in_mb']:9.1f} {r['out_mb']:9.1f} {ms(r['p50_ms'])} "
+            f"{ms(r['p99_ms'])} {ms(r['max_ms'])} {r['errors']:9.2f}"
+        )
+
+
+@click.command()
+@click.option("--peer-dir", type=str, default=PEER_DIR, help="directory of the peer_<pid>.json files")
+@click.option("--interval", type=float, default=5.0, help="seconds between polls")
+@click.option("--count", type=int, default=0, help="number of polls, 0 to poll until interrupted")
+@click.option("--json", "as_json", is_flag=True, help="print one JSON document per poll instead of tables")
+def cli(peer_dir, interval, count, as_json):
+    client = ShardedRDMA(peer_dir)
+    previous = {}
+    polls = 0
+    try:
+        while True:
+            snapshots = client.stats()
+            v = view(snapshots, previous)
+            if as_json:
+                click.echo(json.dumps(v))
+            else:
+                show(v)
+            previous = {peer: stats for peer, stats in snapshots.items() if stats is not None}
+            polls += 1
+            if count and polls >= count:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,391 @@
+#ifndef PROTOCOL_H
+#define PROTOCOL_H
+
+/* Binary wire protocol shared with the Python clients and provider
+ * (proxy-client/protocol.py). All integers are little-endian.
+ *
+ * request:  version u8 | flags u8 | key length u16 | bulk length u32 | size u64
+ *           | timestamp f64
+ *           key bytes | serialized bulk handle
+ * response: status i32 | flags u32 | value u64
+ *           [metadata, if flags has RDMA_HAS_METADATA]
+ * metadata: timestamp f64 | size u64 | version u64 | flags u32 | reserved u32
+ *
+ * A get whose size (the capacity of the client buffer) is too small for the
+ * value transfers nothing and answers RDMA_OVERFLOW with the value size.
+ * The flags and timestamp of a set are kept with the value as its metadata,
+ * returned by get, set and stat.
+ *
+ * batch request:  version u8 | flags u8 | reserved u16 | count u32
+ *                 | bulk length u32 | size u64 | timestamp f64
+ *                 key lengths u16[count] | sizes u64[count] | keys
+ *                 | serialized bulk handle
+ * batch response: status i32 | flags u32 | count u64
+ *                 | status u8[count] | value u64[count]
+ *                 [metadata[count], if flags has RDMA_HAS_METADATA]
+ *
+ * Values of a batch sit back to back, in key order, in the single bulk
+ * region of the request. get_many skips the keys it does not push.
+ *
+ * chunk request: request | offset u64 | total u64
+ *
+ * Objects larger than RDMA_CHUNK_SIZE move with set_chunk/get_chunk, size
+ * is the chunk length and offset, a multiple of RDMA_CHUNK_SIZE, its place
+ * in the object of total bytes. The bulk handle covers the whole object and
+ * the chunk sits at offset in it.
+ *
+ * stats response: response, value is count
+ *                 | uptime f64 | memory used u64 | memory limit u64
+ *                 | items u64 | evictions u64 | dirty u64 | active u32
+ *                 | queued u32
+ *                 rpc[count]
+ * rpc:            name char[16] | calls u64 | errors u64 | bytes in u64
+ *                 | bytes out u64 | latency u64 | max latency u64
+ *                 | buckets u64[RDMA_LATENCY_BUCKETS]
+ *
+ * The snapshot RPC takes a request whose key is ignored and answers with
+ * the number of values saved, so that they survive a restart of the server.
+ * The C server counts the keys of the Redis dataset.
+ *
+ * The stats RPC takes a request whose key is ignored. Every rpc record
+ * holds the counters of an RPC type since the server started, or of its
+ * bulk transfers as "pull" and "push". Latencies are in nanoseconds, bucket
+ * i of the histogram counts the calls that took [2^i, 2^(i+1)) ns and the
+ * last one everything longer.
+ */
+
+#include <stdint.h>
+#include <string.h>
+#include <margo.h>
+#include "types.h"
+
+#define RDMA_PROTOCOL_VERSION 2
+
+/* objects larger than this are split into chunks of this size */
+#define RDMA_CHUNK_SIZE (64ULL * 1024 * 1024)
+
+/* log2 buckets of the latency histograms, up to 2^39 ns */
+#define RDMA_LATENCY_BUCKETS 40
+#define RDMA_RPC_NAME_SIZE 16
+
+/* response flags */
+#define RDMA_HAS_METADATA 0x1
+
+enum {
+    RDMA_OK = 0,
+    RDMA_NOT_FOUND = 1,
+    RDMA_ERROR = 2,
+    RDMA_OVERFLOW = 3
+};
+
+typedef struct __attribute__((packed)) {
+    uint8_t version;
+    uint8_t flags;
+    uint16_t key_len;
+    uint32_t bulk_len;
+    uint64_t size;
+    double timestamp;
+} rdma_req_hdr_t;
+
+typedef struct __attribute__((packed)) {
+    int32_t status;
+    uint32_t flags;
+    uint64_t value;
+} rdma_resp_t;
+
+typedef struct __attribute__((packed)) {
+    double timestamp;
+    uint64_t size;
+    uint64_t version;
+    uint32_t flags;
+    uint32_t reserved;
+} rdma_meta_t;
+
+/* response followed by the metadata of the object */
+typedef struct __attribute__((packed)) {
+    rdma_resp_t resp;
+    rdma_meta_t meta;
+} rdma_resp_meta_t;
+
+typedef struct __attribute__((packed)) {
+    uint8_t version;
+    uint8_t flags;
+    uint16_t reserved;
+    uint32_t count;
+    uint32_t bulk_len;
+    uint64_t size;
+    double timestamp;
+} rdma_batch_hdr_t;
+
+typedef struct __attribute__((packed)) {
+    double uptime;
+    uint64_t memory_used;
+    uint64_t memory_limit;
+    uint64_t items;
+    uint64_t evictions;
+    uint64_t dirty;
+    uint32_t active;
+    uint32_t queued;
+} rdma_stats_t;
+
+typedef struct __attribute__((packed)) {
+    char name[RDMA_RPC_NAME_SIZE];
+    uint64_t calls;
+    uint64_t errors;
+    uint64_t bytes_in;
+    uint64_t bytes_out;
+    uint64_t latency;
+    uint64_t max_latency;
+    uint64_t buckets[RDMA_LATENCY_BUCKETS];
+} rdma_rpc_stats_t;
+
+/* histogram bucket of a latency of ns nanoseconds */
+static inline int rdma_latency_bucket(uint64_t ns)
+{
+    int bucket = 63 - __builtin_clzll(ns | 1);
+    return bucket < RDMA_LATENCY_BUCKETS ? bucket : RDMA_LATENCY_BUCKETS - 1;
+}
+
+/* decoded request, bulk is HG_BULK_NULL when the request carries none */
+typedef struct {
+    uint8_t flags;
+    uint64_t size;
+    double timestamp;
+    char *key;
+    hg_bulk_t bulk;
+} rdma_req_t;
+
+static inline int rdma_req_decode(margo_instance_id mid, const rdma_msg_t *msg, rdma_req_t *req)
+{
+    rdma_req_hdr_t hdr;
+    const char *p = msg->data;
+
+    if (msg->size < sizeof(hdr))
+        return -1;
+    memcpy(&hdr, p, sizeof(hdr));
+    if (hdr.version != RDMA_PROTOCOL_VERSION
+            || sizeof(hdr) + hdr.key_len + hdr.bulk_len > msg->size)
+        return -1;
+    p += sizeof(hdr);
+
+    req->flags = hdr.flags;
+    req->size = hdr.size;
+    req->timestamp = hdr.timestamp;
+    req->key = strndup(p, hdr.key_len);
+    req->bulk = HG_BULK_NULL;
+    if (!req->key)
+        return -1;
+    p += hdr.key_len;
+
+    if (hdr.bulk_len
+            && margo_bulk_deserialize(mid, &req->bulk, p, hdr.bulk_len) != HG_SUCCESS) {
+        free(req->key);
+        return -1;
+    }
+    return 0;
+}
+
+/* read the trailer of a chunk request decoded with rdma_req_decode */
+static inline int rdma_chunk_decode(const rdma_msg_t *msg, uint64_t *offset, uint64_t *total)
+{
+    if (msg->size < sizeof(rdma_req_hdr_t) + 2 * sizeof(uint64_t))
+        return -1;
+    memcpy(offset, msg->data + msg->size - 2 * sizeof(uint64_t), sizeof(*offset));
+    memcpy(total, msg->data + msg->size - sizeof(uint64_t), sizeof(*total));
+    return 0;
+}
+
+static inline void rdma_req_free(rdma_req_t *req)
+{
+    free(req->key);
+    if (req->bulk != HG_BULK_NULL)
+        margo_bulk_free(req->bulk);
+}
+
+/* decoded batch request, keys and sizes have count entries */
+typedef struct {
+    uint8_t flags;
+    uint32_t count;
+    uint64_t size;
+    double timestamp;
+    char **keys;
+    uint64_t *sizes;
+    hg_bulk_t bulk;
+} rdma_batch_req_t;
+
+static inline void rdma_batch_req_free(rdma_batch_req_t *req)
+{
+    if (req->keys) {
+        for (uint32_t i = 0; i < req->count; i++)
+            free(req->keys[i]);
+        free(req->keys);
+    }
+    free(req->sizes);
+    if (req->bulk != HG_BULK_NULL)
+        margo_bulk_free(req->bulk);
+}
+
+static inline int rdma_batch_req_decode(margo_instance_id mid, const rdma_msg_t *msg,
+        rdma_batch_req_t *req)
+{
+    rdma_batch_hdr_t hdr;
+    const char *p = msg->data;
+    const char *end = msg->data + msg->size;
+    const char *lens;
+
+    memset(req, 0, sizeof(*req));
+    req->bulk = HG_BULK_NULL;
+
+    if (msg->size < sizeof(hdr))
+        return -1;
+    memcpy(&hdr, p, sizeof(hdr));
+    if (hdr.version != RDMA_PROTOCOL_VERSION
+            || (uint64_t)hdr.count * 10 > msg->size - sizeof(hdr))
+        return -1;
+    p += sizeof(hdr);
+
+    req->flags = hdr.flags;
+    req->count = hdr.count;
+    req->size = hdr.size;
+    req->timestamp = hdr.timestamp;
+    req->keys = calloc(hdr.count ? hdr.count : 1, sizeof(char*));
+    req->sizes = malloc((hdr.count ? hdr.count : 1) * sizeof(uint64_t));
+    if (!req->keys || !req->sizes) {
+        rdma_batch_req_free(req);
+        return -1;
+    }
+
+    lens = p;
+    p += 2 * (size_t)hdr.count;
+    memcpy(req->sizes, p, 8 * (size_t)hdr.count);
+    p += 8 * (size_t)hdr.count;
+
+    for (uint32_t i = 0; i < hdr.count; i++) {
+        uint16_t len;
+        memcpy(&len, lens + 2 * i, sizeof(len));
+        if (p + len > end || !(req->keys[i] = strndup(p, len))) {
+            rdma_batch_req_free(req);
+            return -1;
+        }
+        p += len;
+    }
+
+    if (p + hdr.bulk_len > end) {
+        rdma_batch_req_free(req);
+        return -1;
+    }
+    if (hdr.bulk_len
+            && margo_bulk_deserialize(mid, &req->bulk, p, hdr.bulk_len) != HG_SUCCESS) {
+        req->bulk = HG_BULK_NULL;
+        rdma_batch_req_free(req);
+        return -1;
+    }
+    return 0;
+}
+
+/* allocate a batch response for count keys, with room for their metadata
+ * if with_meta is set, msg->data must be released with free() once
+ * responded */
+static inline int rdma_batch_resp_alloc(int32_t status, uint32_t count, int with_meta,
+        rdma_msg_t *msg)
+{
+    rdma_resp_t hdr = { status, with_meta ? RDMA_HAS_METADATA : 0, count };
+
+    msg->size = sizeof(hdr) + (9 + (with_meta ? sizeof(rdma_meta_t) : 0)) * (size_t)count;
+    msg->data = calloc(1, msg->size);
+    if (!msg->data)
+        return -1;
+    memcpy(msg->data, &hdr, sizeof(hdr));
+    return 0;
+}
+
+static inline void rdma_batch_resp_set(rdma_msg_t *msg, uint32_t i, uint8_t status, uint64_t value)
+{
+    rdma_resp_t hdr;
+    memcpy(&hdr, msg->data, sizeof(hdr));
+    msg->data[sizeof(hdr) + i] = status;
+    memcpy(msg->data + sizeof(hdr) + hdr.value + 8 * (size_t)i, &value, sizeof(value));
+}
+
+static inline void rdma_batch_resp_set_meta(rdma_msg_t *msg, uint32_t i, const rdma_meta_t *meta)
+{
+    rdma_resp_t hdr;
+    memcpy(&hdr, msg->data, sizeof(hdr));
+    memcpy(msg->data + sizeof(hdr) + 9 * hdr.value + sizeof(*meta) * (size_t)i,
+            meta, sizeof(*meta));
+}
+
+/* encode a request for the key_len bytes of key into msg, msg->data must
+ * be released with free() */
+static inline int rdma_req_encode(const char *key, size_t key_len, uint64_t size, hg_bulk_t bulk,
+        uint8_t flags, double timestamp, rdma_msg_t *msg)
+{
+    rdma_req_hdr_t hdr;
+    hg_size_t bulk_len = 0;
+    char *p;
+
+    msg->data = NULL;
+    if (key_len > UINT16_MAX)
+        return -1;
+    if (bulk != HG_BULK_NULL)
+        bulk_len = margo_bulk_get_serialize_size(bulk, HG_FALSE);
+
+    hdr.version = RDMA_PROTOCOL_VERSION;
+    hdr.flags = flags;
+    hdr.key_len = (uint16_t)key_len;
+    hdr.bulk_len = (uint32_t)bulk_len;
+    hdr.size = size;
+    hdr.timestamp = timestamp;
+
+    msg->size = sizeof(hdr) + hdr.key_len + bulk_len;
+    msg->data = malloc(msg->size);
+    if (!msg->data)
+        return -1;
+
+    p = msg->data;
+    memcpy(p, &hdr, sizeof(hdr));
+    p += sizeof(hdr);
+    memcpy(p, key, hdr.key_len);
+    p += hdr.key_len;
+    if (bulk_len && margo_bulk_serialize(bulk, p, bulk_len, HG_FALSE) != HG_SUCCESS) {
+        free(msg->data);
+        msg->data = NULL;
+        return -1;
+    }
+    return 0;
+}
+
+/* point msg at resp, resp must outlive the margo_respond/forward call */
+static inline void rdma_resp_wrap(rdma_resp_t *resp, rdma_msg_t *msg)
+{
+    msg->size = sizeof(*resp);
+    msg->data = (char*)resp;
+}
+
+/* same as rdma_resp_wrap, followed by the metadata of the object */
+static inline void rdma_resp_meta_wrap(rdma_resp_meta_t *resp, rdma_msg_t *msg)
+{
+    resp->resp.flags |= RDMA_HAS_METADATA;
+    msg->size = sizeof(*resp);
+    msg->data = (char*)resp;
+}
+
+/* decode a response, and its metadata into meta if not NULL (zeroed when
+ * the response carries none) */
+static inline int rdma_resp_decode(const rdma_msg_t *msg, rdma_resp_t *resp, rdma_meta_t *meta)
+{
+    if (msg->size < sizeof(*resp))
+        return -1;
+    memcpy(resp, msg->data, sizeof(*resp));
+    if (meta) {
+        memset(meta, 0, sizeof(*meta));
+        if (resp->flags & RDMA_HAS_METADATA) {
+            if (msg->size < sizeof(*resp) + sizeof(*meta))
+                return -1;
+            memcpy(meta, msg->data + sizeof(*resp), sizeof(*meta));
+        }
+    }
+    return 0;
+}
+
+#endif
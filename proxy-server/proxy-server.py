@@ -1,25 +1,43 @@
 #!/uiisr/bin/env python
 
 import os
+import sys
 import json
+import logging
 import daemon
 import signal
+import threading
 import numpy as np
 
+from contextlib import suppress
 from functools import partial
-from time import sleep
+from time import monotonic, perf_counter_ns, sleep
 
 import pymargo.client
 import pymargo.bulk as bulk
 from pymargo.core import Engine, Provider
-from pymargo.bulk import Bulk
+
+# the wire protocol and client live next to the proxystore stores
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "proxy-client"))
+import protocol
+from metrics import Metrics
+from sharding import ShardedRDMA
+from spill import SpillStore
+from storage import SlabStore
+
+logger = logging.getLogger(__name__)
 
 
 class RDMAClient():
 
     peer_dir = os.path.join(os.path.expanduser('~'), ".proxystore", "peers")
 
-    def __init__(self, host, port, max_size = 50*1024**2, peer_dir=None):
+    def __init__(self, host, port, max_size = 50*1024**2, peer_dir=None, memory_limit = 1024**3, policy = "lru",
+                 progress_thread = True, rpc_threads = 4, replicas = 1, spill_dir = None, spill_limit = 64*1024**3,
+                 snapshot = None):
+
+        # number of peers each key is written to
+        self.replicas = replicas
 
         if peer_dir is not None:
             self.peer_dir = peer_dir
@@ -38,8 +56,12 @@ class RDMAClient():
         # Start peer service. Using a daemon as wait_for_finalize hangs
         with daemon.DaemonContext():
             addr = f"tcp://{host}:{port}" # tcp for now, maybe UCX later?
-            engine = Engine(addr)
+            # a progress thread plus rpc_threads handler threads, so that one
+            # long transfer does not hold up the requests of other clients
+            engine = Engine(addr, use_progress_thread=progress_thread, rpc_thread_count=rpc_threads)
             provider_id = os.getpid()
+            self.addr = addr
+            self.provider_id = provider_id
 
             peer_file = os.path.join(self.peer_dir, f"peer_{provider_id}.json")
 
@@ -54,11 +76,16 @@ class RDMAClient():
             )
 
             engine.on_finalize(WhenFinalize)
+            # leaving the peer directory takes this peer off the hash rings
+            engine.on_finalize(partial(_leave, peer_file))
             engine.enable_remote_shutdown()
 
             signal.signal(signal.SIGINT, partial(handler, engine))
 
-            RDMAProvider(engine, provider_id)
+            provider = RDMAProvider(engine, provider_id, memory_limit=memory_limit, policy=policy,
+                                    spill_dir=spill_dir, spill_limit=spill_limit, snapshot=snapshot)
+            # the values are served from the snapshot after a restart
+            engine.on_finalize(provider.save)
 
             engine.wait_for_finalize()
 
@@ -79,7 +106,7 @@ class RDMAClient():
         new_peers = []
 
         for fn in os.listdir(self.peer_dir):
-            with open(self.join(self.peer_dir, fn), "r+") as f:
+            with open(os.path.join(self.peer_dir, fn), "r+") as f:
                 peer_data = json.load(f)
 
             if peer_data["addr"] not in self.peers:
@@ -92,139 +119,456 @@ class RDMAClient():
 
 
 
+    @property
+    def _rdma(self):
+        # keys are spread over all the peers of the peer directory, each one
+        # going to its replicas on the hash ring. The clients share the
+        # process-wide client session.
+        if not hasattr(self, "_client"):
+            self._client = ShardedRDMA(self.peer_dir, replicas=self.replicas)
+        return self._client
+
     def set(self, key, value):
-        buff = np.chararray(shape=len(value), buffer=value)  # equivalent to malloc
-        blk = self.engine.create_bulk(buff, bulk.read_write)
-        s = blk.to_base64()
-        self.call_rpc_on(self.rpcs["set"], s, key, buff.size*buff.itemsize)
-        return None
+        return self._rdma.set(key, value)
 
     def get(self, key, size=None):
-        if size is None:
-            size = self.get_size(key)
+        return self._rdma.get(key, size)
 
-        buff = np.chararray(size)  # equivalent to malloc
+    def get_size(self, key):
+        return self._rdma.get_size(key)
 
-        #with Engine('tcp', mode=pymargo.client) as engine:
-        blk = self.engine.create_bulk(buff, bulk.read_write)
-        s = blk.to_base64()
-        self.call_rpc_on(self.rpcs["get"], s, key, size)
-        return buff.view('S' + str(buff.size))[0]
+    def stat(self, key):
+        return self._rdma.stat(key)
+
+    def exists(self, key):
+        return self._rdma.exists(key)
+
+    def evict(self, key):
+        return self._rdma.evict(key)
+
+class Upload():
+    # value being uploaded in chunks: its reserved item, the offsets of the
+    # chunks received, the chunks being pulled and when it is given up. The
+    # status is set once it is complete (OK) or failed (ERROR).
+
+    __slots__ = ("item", "received", "nbytes", "pulling", "deadline", "status")
+
+    def __init__(self, item, deadline):
+        self.item = item
+        self.received = set()
+        self.nbytes = 0
+        self.pulling = 0
+        self.deadline = deadline
+        self.status = None
 
-    def get_size(self, key):
-        buff = np.empty(1, dtype=np.uint64)
-        blk = self.engine.create_bulk(buff, bulk.read_write)
-        s = blk.to_base64()
-        self.call_rpc_on(self.engine.register("get_size"), s, key, buff.itemsize)
-        return int(buff)
-
-    def exists(self, key, size=None):
-        buff = np.array([False], dtype=bool)  # equivalent to malloc
-        blk = self.engine.create_bulk(buff, bulk.read_write)
-        s = blk.to_base64()
-        self.call_rpc_on(self.engine.register("exists"), s, key, buff.itemsize)
-        return buff[0]
-
-    def call_rpc_on(self, rpc, array_str, key, size):
-         handle = self.engine.create_handle(self.engine.lookup(self.addr), rpc)
-         data = {"key": key, "size": size, "buffer": array_str}  # , "buffer": array_str }
-         serialized = json.dumps(data)
-         print("hello 2")
-         return handle.forward(self.provider_id, serialized)
 
 class RDMAProvider(Provider):
-    def __init__(self, engine, provider_id):
+
+    # seconds an upload may wait for its next chunk before its room is given
+    # back, and that the outcome of an upload is kept for late chunks
+    upload_timeout = 600
+
+    rpcs = ("get", "get_size", "stat", "set", "exists", "delete", "get_many", "set_many",
+            "exists_many", "delete_many", "set_chunk", "get_chunk", "snapshot")
+
+    def __init__(self, engine, provider_id, memory_limit=1024**3, policy="lru", spill_dir=None,
+                 spill_limit=64*1024**3, snapshot=None):
         super().__init__(engine, provider_id)
-        self.register("get", "get")
-        self.register("get_size", "get_size")
-        self.register("set", "set")
-        self.register("exists", "exists")
-        self.data = {}
+        # every handler is counted for the stats RPC, which is not
+        self.metrics = Metrics()
+        for rpc in self.rpcs:
+            setattr(self, rpc, self.metrics.timed(rpc, getattr(self, rpc)))
+            self.register(rpc, rpc)
+        self.register("stats", "stats")
+        # values live in registered slabs, gets and sets transfer straight
+        # to and from them. Cold values go to memory-mapped segments under
+        # spill_dir, a local disk, rather than being dropped
+        spill = None
+        if spill_dir is not None:
+            spill = SpillStore(engine, os.path.join(spill_dir, f"spill_{provider_id}"), limit=spill_limit)
+        elif snapshot is not None:
+            # only serves the snapshot
+            spill = SpillStore(engine, None)
+        self.data = SlabStore(engine, limit=memory_limit, policy=policy, spill=spill)
+        # values of an earlier run are served from its snapshot file
+        # right away, read from it as they are asked for
+        self.snapshot_path = snapshot
+        if snapshot is not None and os.path.exists(snapshot):
+            self.data.restore(snapshot)
+        # values being uploaded in chunks, by (key, total, timestamp), and
+        # the status and expiry time of the uploads that are over, so that
+        # their late or resent chunks reserve nothing
+        self._uploads = {}
+        self._closed = {}
+        self._uploads_lock = threading.Lock()
+
+    @staticmethod
+    def metadata(item):
+        return protocol.Metadata(item.timestamp, item.size, item.version, item.flags)
+
+    def _transfer(self, handle, op, remote, remote_offset, local, local_offset, size):
+        # bulk transfer for the RPC of handle, counted as a pull or a push
+        start = perf_counter_ns()
+        self.get_engine().transfer(op, handle.get_addr(), remote, remote_offset, local, local_offset, size)
+        self.metrics.transferred(handle, op == bulk.pull, size, perf_counter_ns() - start)
+
+    @staticmethod
+    def _decode(handle, decode, msg):
+        # decode the request of an RPC, a malformed one is answered with
+        # ERROR and gives None
+        try:
+            return decode(msg)
+        except Exception:
+            logger.exception(f"Could not decode a request of {len(msg)} bytes")
+            if decode is protocol.decode_batch_request:
+                handle.respond(protocol.encode_batch_response([], [], protocol.ERROR))
+            else:
+                handle.respond(protocol.encode_response(protocol.ERROR))
+            return None
+
+    def stats(self, handle, msg):
+        if self._decode(handle, protocol.decode_request, msg) is None:
+            return
+        handle.respond(protocol.encode_stats(self.metrics.snapshot(
+            self.data.used, self.data.limit, len(self.data), self.data.evictions
+        )))
+
+    def save(self):
+        # write the snapshot, if the provider has one, returns the number of
+        # values written
+        if self.snapshot_path is None:
+            return None
+        try:
+            return self.data.snapshot(self.snapshot_path)
+        except Exception:
+            logger.exception(f"Could not write the snapshot {self.snapshot_path}")
+            return None
+
+    def snapshot(self, handle, msg):
+        if self._decode(handle, protocol.decode_request, msg) is None:
+            return
+        count = self.save()
+        if count is None:
+            handle.respond(protocol.encode_response(protocol.ERROR))
+        else:
+            handle.respond(protocol.encode_response(protocol.OK, count))
 
-    def set(self, handle, bulk_str):
-        data = json.loads(bulk_str)
-        print("Received set RPC")
+    def set(self, handle, msg):
+        req = self._decode(handle, protocol.decode_request, msg)
+        if req is None:
+            return
 
         engine = self.get_engine()
-        #print("data size", data["size"])
-        localArray = np.chararray(data["size"])
+        item = None
         try:
-            localBulk = engine.create_bulk(localArray, bulk.write_only)
-            remoteBulk = Bulk.from_base64(engine, data["buffer"])
-            #print("Remote bulk deserialized")
-            size = localArray.itemsize * localArray.size
-            engine.transfer(
-                bulk.pull, handle.get_addr(), remoteBulk, 0, localBulk, 0, size
+            item = self.data.reserve(req.size, req.timestamp, req.flags)
+            remoteBulk = protocol.bulk_from_descriptor(engine, req.descriptor)
+            self._transfer(
+                handle, bulk.pull, remoteBulk, 0, item.bulk, item.offset, req.size
             )
-        except Exception as error:
-            print("An exception was caught:")
-            print(error)
-        #print("Transfer done")
-        self.data[data["key"]] = localArray
-        handle.respond("OK")
-
-    def get(self, handle, bulk_str):
-        #print("Received get RPC")
-        data = json.loads(bulk_str)
+        except Exception:
+            logger.exception(f"set of key '{req.key}' failed")
+            if item is not None:
+                self.data.abort(item)
+            handle.respond(protocol.encode_response(protocol.ERROR))
+            return
+        self.data.commit(req.key, item)
+        handle.respond(protocol.encode_response(protocol.OK, req.size, metadata=self.metadata(item)))
+
+    def get(self, handle, msg):
+        req = self._decode(handle, protocol.decode_request, msg)
+        if req is None:
+            return
+
+        # pinned, so that a concurrent set or eviction does not reuse the
+        # chunk while it is pushed
+        item = self.data.pin(req.key)
+        if item is None:
+            handle.respond(protocol.encode_response(protocol.NOT_FOUND))
+            return
+
+        if item.size > req.size:
+            # client buffer too small, report the size so it can retry
+            self.data.unpin(item)
+            handle.respond(protocol.encode_response(protocol.OVERFLOW, item.size))
+            return
 
         engine = self.get_engine()
-        localArray = np.chararray(shape=len(self.data[data["key"]]), buffer=self.data[data["key"]])
         try:
-            localBulk = engine.create_bulk(localArray, bulk.read_only)
-            remoteBulk = Bulk.from_base64(engine, data["buffer"])
-            #print("Remote bulk deserialized", data["key"], localArray.itemsize * localArray.size)
-            size = localArray.itemsize * localArray.size
-            engine.transfer(
-                bulk.push, handle.get_addr(), remoteBulk, 0, localBulk, 0, size
+            remoteBulk = protocol.bulk_from_descriptor(engine, req.descriptor)
+            self._transfer(
+                handle, bulk.push, remoteBulk, 0, item.bulk, item.offset, item.size
             )
-        except Exception as error:
-            print("An exception was caught:")
-            print(error)
-        #print("Transfer done")
-        handle.respond("OK")
-
-
-    def get_size(self, handle, bulk_str):
-        data = json.loads(bulk_str)
+        except Exception:
+            logger.exception(f"get of key '{req.key}' failed")
+            handle.respond(protocol.encode_response(protocol.ERROR))
+            return
+        finally:
+            self.data.unpin(item)
+        handle.respond(protocol.encode_response(protocol.OK, item.size, metadata=self.metadata(item)))
+
+    def set_chunk(self, handle, msg):
+        req = self._decode(handle, protocol.decode_chunk_request, msg)
+        if req is None:
+            return
 
         engine = self.get_engine()
-        localArray = np.array([self.data[data["key"]].size], dtype=np.uint64)
+        upload = (req.key, req.total, req.timestamp)
+        now = monotonic()
+        # each chunk must map to exactly one chunk of the reserved item, as
+        # in the C server
+        valid = (
+            req.offset % protocol.CHUNK_SIZE == 0 and req.size <= protocol.CHUNK_SIZE
+            and req.offset + req.size <= req.total
+        )
+        with self._uploads_lock:
+            self._expire_uploads(now)
+            state = self._uploads.get(upload)
+            closed = self._closed.get(upload)
+            if not valid:
+                if state is not None:
+                    self._close_upload(upload, state, protocol.ERROR, now)
+                elif closed is None:
+                    self._closed[upload] = (protocol.ERROR, now + self.upload_timeout)
+                closed = (protocol.ERROR, None)
+            elif state is None and closed is None:
+                try:
+                    # the first chunk to arrive reserves room for the whole value
+                    state = self._uploads[upload] = Upload(
+                        self.data.reserve(req.total, req.timestamp, req.flags), now + self.upload_timeout
+                    )
+                except Exception:
+                    logger.exception(f"Could not reserve {req.total} bytes for key '{req.key}'")
+                    closed = self._closed[upload] = (protocol.ERROR, now + self.upload_timeout)
+            if closed is None:
+                state.pulling += 1
+                state.deadline = now + self.upload_timeout
+        if closed is not None:
+            # a chunk of an upload that failed, or that the others completed
+            handle.respond(protocol.encode_response(closed[0], req.size if closed[0] == protocol.OK else 0))
+            return
+
+        item = state.item
         try:
-            localBulk = engine.create_bulk(localArray, bulk.read_only)
-            remoteBulk = Bulk.from_base64(engine, data["buffer"])
-            #print("Remote bulk deserialized", data["key"], localArray.itemsize * localArray.size)
-            size = localArray.itemsize * localArray.size
-            engine.transfer(
-                bulk.push, handle.get_addr(), remoteBulk, 0, localBulk, 0, size
+            remoteBulk = protocol.bulk_from_descriptor(engine, req.descriptor)
+            self._transfer(
+                handle, bulk.pull, remoteBulk, req.offset,
+                item.bulk, item.offset + req.offset, req.size,
             )
-        except Exception as error:
-            print("An exception was caught:")
-            print(error)
-        #print("Transfer done")
-        handle.respond("OK")
+        except Exception:
+            logger.exception(f"set_chunk of key '{req.key}' at {req.offset} failed")
+            with self._uploads_lock:
+                state.pulling -= 1
+                self._close_upload(upload, state, protocol.ERROR, monotonic())
+            handle.respond(protocol.encode_response(protocol.ERROR))
+            return
+
+        done = False
+        now = monotonic()
+        with self._uploads_lock:
+            state.pulling -= 1
+            # a resent chunk is only counted once
+            if state.status is None and req.offset not in state.received:
+                state.received.add(req.offset)
+                state.nbytes += req.size
+                done = state.nbytes >= req.total
+                if done:
+                    self._close_upload(upload, state, protocol.OK, now)
+            else:
+                self._close_upload(upload, state, state.status, now)
+            status = state.status
+        if status == protocol.ERROR:
+            handle.respond(protocol.encode_response(protocol.ERROR))
+            return
+        if not done:
+            handle.respond(protocol.encode_response(protocol.OK, req.size))
+            return
+        # the last chunk makes the value visible
+        self.data.commit(req.key, item)
+        handle.respond(protocol.encode_response(protocol.OK, req.size, metadata=self.metadata(item)))
+
+    def _close_upload(self, upload, state, status, now):
+        # end an upload, with _uploads_lock held. The item of a failed one is
+        # given back once no chunk is pulled into it any more
+        if status is not None and state.status is None:
+            state.status = status
+            self._uploads.pop(upload, None)
+            self._closed[upload] = (status, now + self.upload_timeout)
+        if state.status == protocol.ERROR and state.pulling == 0 and state.item is not None:
+            self.data.abort(state.item)
+            state.item = None
+
+    def _expire_uploads(self, now):
+        # uploads whose client stopped sending chunks give their room back,
+        # with _uploads_lock held
+        for upload, state in list(self._uploads.items()):
+            if state.deadline < now and state.pulling == 0:
+                self._close_upload(upload, state, protocol.ERROR, now)
+        for upload, (_, expires) in list(self._closed.items()):
+            if expires < now:
+                del self._closed[upload]
+
+    def get_chunk(self, handle, msg):
+        req = self._decode(handle, protocol.decode_chunk_request, msg)
+        if req is None:
+            return
+
+        item = self.data.pin(req.key)
+        if item is None:
+            handle.respond(protocol.encode_response(protocol.NOT_FOUND))
+            return
+
+        # a value that shrank since the first chunk has less, or nothing,
+        # at this offset, its metadata tells the client to start over
+        size = max(min(req.size, item.size - req.offset), 0)
+        engine = self.get_engine()
+        try:
+            if size:
+                remoteBulk = protocol.bulk_from_descriptor(engine, req.descriptor)
+                self._transfer(
+                    handle, bulk.push, remoteBulk, req.offset,
+                    item.bulk, item.offset + req.offset, size,
+                )
+        except Exception:
+            logger.exception(f"get_chunk of key '{req.key}' at {req.offset} failed")
+            handle.respond(protocol.encode_response(protocol.ERROR))
+            return
+        finally:
+            self.data.unpin(item)
+        handle.respond(protocol.encode_response(protocol.OK, size, metadata=self.metadata(item)))
+
+    def get_size(self, handle, msg):
+        req = self._decode(handle, protocol.decode_request, msg)
+        if req is None:
+            return
+
+        item = self.data.peek(req.key)
+        if item is None:
+            handle.respond(protocol.encode_response(protocol.NOT_FOUND))
+        else:
+            handle.respond(protocol.encode_response(protocol.OK, item.size))
 
-    def exists(self, handle, bulk_str):
-        #print("Received exists RPC")
-        data = json.loads(bulk_str)
+    def stat(self, handle, msg):
+        req = self._decode(handle, protocol.decode_request, msg)
+        if req is None:
+            return
 
+        item = self.data.peek(req.key)
+        if item is None:
+            handle.respond(protocol.encode_response(protocol.NOT_FOUND))
+        else:
+            handle.respond(protocol.encode_response(protocol.OK, item.size, metadata=self.metadata(item)))
+
+    def exists(self, handle, msg):
+        req = self._decode(handle, protocol.decode_request, msg)
+        if req is None:
+            return
+        handle.respond(protocol.encode_response(protocol.OK, int(req.key in self.data)))
+
+    def delete(self, handle, msg):
+        req = self._decode(handle, protocol.decode_request, msg)
+        if req is None:
+            return
+        if self.data.delete(req.key):
+            handle.respond(protocol.encode_response(protocol.OK, 1))
+        else:
+            handle.respond(protocol.encode_response(protocol.NOT_FOUND))
+
+    def set_many(self, handle, msg):
+        req = self._decode(handle, protocol.decode_batch_request, msg)
+        if req is None:
+            return
+
+        # each value is pulled from its offset in the client region straight
+        # into its own slab chunk
         engine = self.get_engine()
-        localArray = np.array([data["key"] in self.data], dtype=bool)
+        items = []
         try:
-            localBulk = engine.create_bulk(localArray, bulk.read_only)
-            remoteBulk = Bulk.from_base64(engine, data["buffer"])
-            #print("Remote bulk deserialized", data["key"], localArray.itemsize)
-            size = localArray.itemsize
-            engine.transfer(
-                bulk.push, handle.get_addr(), remoteBulk, 0, localBulk, 0, size
-            )
-        except Exception as error:
-            print("An exception was caught:")
-            print(error)
-        #print("Transfer done")
-        handle.respond("OK")
+            remoteBulk = protocol.bulk_from_descriptor(engine, req.descriptor)
+            offset = 0
+            for size in req.sizes:
+                item = self.data.reserve(size, req.timestamp, req.flags)
+                items.append(item)
+                self._transfer(
+                    handle, bulk.pull, remoteBulk, offset, item.bulk, item.offset, size
+                )
+                offset += size
+        except Exception:
+            logger.exception(f"set_many of {len(req.keys)} keys failed")
+            for item in items:
+                self.data.abort(item)
+            handle.respond(protocol.encode_batch_response([], [], protocol.ERROR))
+            return
+
+        for key, item in zip(req.keys, items):
+            self.data.commit(key, item)
+        handle.respond(protocol.encode_batch_response(
+            [protocol.OK] * len(req.keys), req.sizes, metadata=[self.metadata(i) for i in items]
+        ))
+
+    def get_many(self, handle, msg):
+        req = self._decode(handle, protocol.decode_batch_request, msg)
+        if req is None:
+            return
+
+        # every value that fits is pushed from its slab to the next offset of
+        # the client region
+        engine = self.get_engine()
+        statuses, sizes, metadata = [], [], []
+        free = req.size
+        try:
+            remoteBulk = protocol.bulk_from_descriptor(engine, req.descriptor) if req.keys else None
+            for key in req.keys:
+                item = self.data.pin(key)
+                if item is None:
+                    statuses.append(protocol.NOT_FOUND)
+                    sizes.append(0)
+                    metadata.append(protocol.Metadata(0.0, 0))
+                    continue
+                try:
+                    metadata.append(self.metadata(item))
+                    if item.size > free:
+                        statuses.append(protocol.OVERFLOW)
+                        sizes.append(item.size)
+                    else:
+                        self._transfer(
+                            handle, bulk.push, remoteBulk, req.size - free,
+                            item.bulk, item.offset, item.size
+                        )
+                        statuses.append(protocol.OK)
+                        sizes.append(item.size)
+                        free -= item.size
+                finally:
+                    self.data.unpin(item)
+        except Exception:
+            logger.exception(f"get_many of {len(req.keys)} keys failed")
+            handle.respond(protocol.encode_batch_response([], [], protocol.ERROR))
+            return
+        handle.respond(protocol.encode_batch_response(statuses, sizes, metadata=metadata))
+
+    def exists_many(self, handle, msg):
+        req = self._decode(handle, protocol.decode_batch_request, msg)
+        if req is None:
+            return
+        found = [int(key in self.data) for key in req.keys]
+        handle.respond(protocol.encode_batch_response([protocol.OK] * len(found), found))
+
+    def delete_many(self, handle, msg):
+        req = self._decode(handle, protocol.decode_batch_request, msg)
+        if req is None:
+            return
+        statuses = [
+            protocol.OK if self.data.delete(key) else protocol.NOT_FOUND
+            for key in req.keys
+        ]
+        handle.respond(protocol.encode_batch_response(statuses, [0] * len(statuses)))
 
 def handler(engine, *args):
     engine.finalize()
 
 def WhenFinalize():
-    print("Finalize was called")
\ No newline at end of file
+    print("Finalize was called")
+
+def _leave(peer_file):
+    with suppress(FileNotFoundError):
+        os.remove(peer_file)
\ No newline at end of file
@@ -2,63 +2,366 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <signal.h>
+#include <string.h>
+#include <errno.h>
+#include <time.h>
+#include <unistd.h>
 #include <margo.h>
 #include <mercury.h>
 #include <mercury_macros.h>
 #include <hiredis.h>
 #include "types.h"
+#include "protocol.h"
+#include "tier.h"
 
 
 // to handle process termination
 // Doesn't actually work properly
 // need to find a better alternative to cleaning up on the server side
 margo_instance_id cur_mid;
-redisContext *c;
+
+// Redis connections shared by the handler threads. A context is not thread
+// safe, so each handler takes one from the pool for its redis commands and
+// gives it back before answering.
+static struct {
+    redisContext **free;
+    int count;
+    ABT_mutex mutex;
+    ABT_cond cond;
+} redis_pool;
+
+static int redis_pool_init(const char* host, int port, int size)
+{
+    redis_pool.free = calloc(size, sizeof(redisContext*));
+    if (!redis_pool.free)
+        return -1;
+    ABT_mutex_create(&redis_pool.mutex);
+    ABT_cond_create(&redis_pool.cond);
+
+    for (int i = 0; i < size; i++) {
+        redisContext *ctx = redisConnect(host, port);
+        if (ctx == NULL || ctx->err) {
+            if (ctx) {
+                printf("Error: %s port id: %d\n", ctx->errstr, port);
+                redisFree(ctx);
+            } else {
+                printf("Can't allocate redis context\n");
+            }
+            return -1;
+        }
+        redis_pool.free[redis_pool.count++] = ctx;
+    }
+    return 0;
+}
+
+// wait for a free connection, only blocks the calling handler
+static redisContext* redis_acquire(void)
+{
+    redisContext *ctx;
+
+    ABT_mutex_lock(redis_pool.mutex);
+    while (redis_pool.count == 0)
+        ABT_cond_wait(redis_pool.cond, redis_pool.mutex);
+    ctx = redis_pool.free[--redis_pool.count];
+    ABT_mutex_unlock(redis_pool.mutex);
+    return ctx;
+}
+
+static void redis_release(redisContext* ctx)
+{
+    // a connection that failed is re-established before it is reused
+    if (ctx->err && redisReconnect(ctx) != REDIS_OK)
+        printf("Error: lost redis connection: %s\n", ctx->errstr);
+
+    ABT_mutex_lock(redis_pool.mutex);
+    redis_pool.free[redis_pool.count++] = ctx;
+    ABT_cond_signal(redis_pool.cond);
+    ABT_mutex_unlock(redis_pool.mutex);
+}
+
+// Values are kept in a memory tier in front of redis, from which gets are
+// served when it holds them. Sets are acknowledged once stored in redis in
+// the sync durability mode, the tier then only caches them. In write-behind
+// mode they are acknowledged as soon as their value is in the tier, and a
+// flusher writes them to redis in the background on its own execution
+// stream and connection. Whatever writes redis directly drains the key
+// from the tier first, and fails while a write of the key still waits for
+// redis.
+static tier_t tier;
+static int tier_enabled;
+static int write_behind;
+static struct {
+    redisContext *c;
+    ABT_xstream xstream;
+    ABT_thread thread;
+} flush;
+
+static int drain(const char* key)
+{
+    return tier_enabled ? tier_drain(&tier, key) : 0;
+}
+
+static int drain_all(char** keys, uint32_t count)
+{
+    for (uint32_t i = 0; i < count; i++)
+        if (drain(keys[i]) != 0)
+            return -1;
+    return 0;
+}
+
+static tier_entry_t* pin(const char* key)
+{
+    return tier_enabled ? tier_pin(&tier, key) : NULL;
+}
+
+static void flusher(void* arg);
+
+// margo finalize callback, the queue is flushed before the server exits
+static void stop_flusher(void* arg)
+{
+    tier_stop(&tier);
+    ABT_thread_join(flush.thread);
+    ABT_thread_free(&flush.thread);
+    ABT_xstream_join(flush.xstream);
+    ABT_xstream_free(&flush.xstream);
+    redisFree(flush.c);
+}
+
+static int start_flusher(margo_instance_id mid, const char* host, int port)
+{
+    ABT_pool pool;
+
+    flush.c = redisConnect(host, port);
+    if (flush.c == NULL || flush.c->err) {
+        printf("Error: can't connect the flusher to redis\n");
+        return -1;
+    }
+    if (ABT_xstream_create(ABT_SCHED_NULL, &flush.xstream) != ABT_SUCCESS
+            || ABT_xstream_get_main_pools(flush.xstream, 1, &pool) != ABT_SUCCESS
+            || ABT_thread_create(pool, flusher, flush.c, ABT_THREAD_ATTR_NULL, &flush.thread) != ABT_SUCCESS) {
+        printf("Error: can't start the flusher\n");
+        return -1;
+    }
+    margo_push_finalize_callback(mid, stop_flusher, NULL);
+    return 0;
+}
 
 void intHandler(int intrpt)
 {
-    redisFree(c);
+    for (int i = 0; i < redis_pool.count; i++)
+        redisFree(redis_pool.free[i]);
     margo_finalize(cur_mid);
 }
 
+// Counters of every RPC type and of the bulk transfers, for the stats RPC.
+// Handlers run wrapped by timed, which keeps a call_t of the RPC served in
+// ULT-local storage: the bulk transfers charge their bytes to it and finish
+// records the status it answers with.
+enum {
+    RPC_SET, RPC_GET, RPC_GET_SIZE, RPC_STAT, RPC_EXISTS, RPC_DELETE,
+    RPC_SET_MANY, RPC_GET_MANY, RPC_EXISTS_MANY, RPC_DELETE_MANY,
+    RPC_SET_CHUNK, RPC_GET_CHUNK, RPC_SNAPSHOT, RPC_PULL, RPC_PUSH, RPC_COUNT
+};
+
+typedef struct {
+    const char* name;
+    uint64_t calls;
+    uint64_t errors;
+    uint64_t bytes_in;
+    uint64_t bytes_out;
+    uint64_t latency;
+    uint64_t max_latency;
+    uint64_t buckets[RDMA_LATENCY_BUCKETS];
+} rpc_counters_t;
+
+static rpc_counters_t counters[RPC_COUNT] = {
+    [RPC_SET] = { "set" }, [RPC_GET] = { "get" }, [RPC_GET_SIZE] = { "get_size" },
+    [RPC_STAT] = { "stat" }, [RPC_EXISTS] = { "exists" }, [RPC_DELETE] = { "delete" },
+    [RPC_SET_MANY] = { "set_many" }, [RPC_GET_MANY] = { "get_many" },
+    [RPC_EXISTS_MANY] = { "exists_many" }, [RPC_DELETE_MANY] = { "delete_many" },
+    [RPC_SET_CHUNK] = { "set_chunk" }, [RPC_GET_CHUNK] = { "get_chunk" },
+    [RPC_SNAPSHOT] = { "snapshot" },
+    [RPC_PULL] = { "pull" }, [RPC_PUSH] = { "push" },
+};
+
+typedef struct {
+    int32_t status;
+    uint64_t bytes_in;
+    uint64_t bytes_out;
+} call_t;
+
+static ABT_key call_key;
+static uint32_t active;
+static uint64_t started;
+
+static uint64_t now_ns(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+static void count(int rpc, uint64_t ns, int error, uint64_t bytes_in, uint64_t bytes_out)
+{
+    rpc_counters_t* c = &counters[rpc];
+    uint64_t max = __atomic_load_n(&c->max_latency, __ATOMIC_RELAXED);
+
+    __atomic_fetch_add(&c->calls, 1, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&c->errors, error ? 1 : 0, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&c->bytes_in, bytes_in, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&c->bytes_out, bytes_out, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&c->latency, ns, __ATOMIC_RELAXED);
+    __atomic_fetch_add(&c->buckets[rdma_latency_bucket(ns)], 1, __ATOMIC_RELAXED);
+    while (ns > max && !__atomic_compare_exchange_n(&c->max_latency, &max, ns, 1,
+                __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+        ;
+}
+
+static call_t* current_call(void)
+{
+    call_t* call = NULL;
+
+    ABT_key_get(call_key, (void**)&call);
+    return call;
+}
+
+// serve h with handler as an RPC of type rpc
+static void timed(hg_handle_t h, int rpc, void (*handler)(hg_handle_t))
+{
+    call_t call = { RDMA_OK, 0, 0 };
+    uint64_t start = now_ns();
+
+    __atomic_fetch_add(&active, 1, __ATOMIC_RELAXED);
+    ABT_key_set(call_key, &call);
+    handler(h);
+    ABT_key_set(call_key, NULL);
+    __atomic_fetch_sub(&active, 1, __ATOMIC_RELAXED);
+    count(rpc, now_ns() - start, call.status == RDMA_ERROR, call.bytes_in, call.bytes_out);
+}
+
+// margo_bulk_transfer, counted as a pull or a push and charged to the RPC
+// being served
+static hg_return_t transfer(margo_instance_id mid, hg_bulk_op_t op, hg_addr_t addr,
+        hg_bulk_t remote, size_t remote_offset, hg_bulk_t local, size_t local_offset, size_t size)
+{
+    call_t* call = current_call();
+    int pull = op == HG_BULK_PULL;
+    uint64_t start = now_ns();
+    hg_return_t ret;
+
+    ret = margo_bulk_transfer(mid, op, addr, remote, remote_offset, local, local_offset, size);
+    if (ret != HG_SUCCESS)
+        size = 0;
+    count(pull ? RPC_PULL : RPC_PUSH, now_ns() - start, ret != HG_SUCCESS,
+            pull ? size : 0, pull ? 0 : size);
+    if (call) {
+        if (pull)
+            call->bytes_in += size;
+        else
+            call->bytes_out += size;
+    }
+    return ret;
+}
+
 static void set(hg_handle_t h);
 static void get(hg_handle_t h);
+static void get_size(hg_handle_t h);
+static void stat_key(hg_handle_t h);
+static void exists(hg_handle_t h);
+static void delete(hg_handle_t h);
+static void set_many(hg_handle_t h);
+static void get_many(hg_handle_t h);
+static void exists_many(hg_handle_t h);
+static void delete_many(hg_handle_t h);
+static void set_chunk(hg_handle_t h);
+static void get_chunk(hg_handle_t h);
+static void snapshot(hg_handle_t h);
+static void server_stats(hg_handle_t h);
 
-DECLARE_MARGO_RPC_HANDLER(set)
-DECLARE_MARGO_RPC_HANDLER(get)
+// the handler registered for an RPC, timed as RPC type rpc
+#define TIMED(handler, rpc) \
+    static void handler##_timed(hg_handle_t h) { timed(h, rpc, handler); }
+
+TIMED(set, RPC_SET)
+TIMED(get, RPC_GET)
+TIMED(get_size, RPC_GET_SIZE)
+TIMED(stat_key, RPC_STAT)
+TIMED(exists, RPC_EXISTS)
+TIMED(delete, RPC_DELETE)
+TIMED(set_many, RPC_SET_MANY)
+TIMED(get_many, RPC_GET_MANY)
+TIMED(exists_many, RPC_EXISTS_MANY)
+TIMED(delete_many, RPC_DELETE_MANY)
+TIMED(set_chunk, RPC_SET_CHUNK)
+TIMED(get_chunk, RPC_GET_CHUNK)
+TIMED(snapshot, RPC_SNAPSHOT)
+
+DECLARE_MARGO_RPC_HANDLER(set_timed)
+DECLARE_MARGO_RPC_HANDLER(get_timed)
+DECLARE_MARGO_RPC_HANDLER(get_size_timed)
+DECLARE_MARGO_RPC_HANDLER(stat_key_timed)
+DECLARE_MARGO_RPC_HANDLER(exists_timed)
+DECLARE_MARGO_RPC_HANDLER(delete_timed)
+DECLARE_MARGO_RPC_HANDLER(set_many_timed)
+DECLARE_MARGO_RPC_HANDLER(get_many_timed)
+DECLARE_MARGO_RPC_HANDLER(exists_many_timed)
+DECLARE_MARGO_RPC_HANDLER(delete_many_timed)
+DECLARE_MARGO_RPC_HANDLER(set_chunk_timed)
+DECLARE_MARGO_RPC_HANDLER(get_chunk_timed)
+DECLARE_MARGO_RPC_HANDLER(snapshot_timed)
+DECLARE_MARGO_RPC_HANDLER(server_stats)
 
 int main(int argc, char** argv)
 {
     char* rport = argv[1];
     char* mochi_host = argv[2];
     char* mochi_port = argv[3];
+    // provider id the clients address, RDMAStore uses 42 by default
+    uint16_t provider_id = argc > 4 ? atoi(argv[4]) : 42;
+    // execution streams running the RPC handlers, so that a long transfer
+    // does not hold up the requests of other clients, and whether network
+    // progress gets an execution stream of its own
+    int rpc_threads = argc > 5 ? atoi(argv[5]) : 4;
+    int progress_thread = argc > 6 ? atoi(argv[6]) : 1;
+    // durability mode, "sync" or "write-behind", the memory of the tier in
+    // MB, 0 for none, and how many sets may wait for the flusher
+    write_behind = argc > 7 && strcmp(argv[7], "write-behind") == 0;
+    size_t tier_mb = argc > 8 ? strtoull(argv[8], NULL, 10) : 1024;
+    size_t queue_depth = argc > 9 ? strtoull(argv[9], NULL, 10) : 64;
 
     char mochi_addr[1024] = "tcp://";
 
     strcat(mochi_addr, mochi_host);
     strcat(mochi_addr, ":");
     strcat(mochi_addr, mochi_port);
-   
+
     signal(SIGINT, intHandler);
     int redis_port = atoi(rport);
 
-    // create redis context
-    c = redisConnect("127.0.0.1", redis_port);
-    if (c == NULL || c->err) {
-        if (c) {
-            printf("Error: %s port id: %d\n", c->errstr, redis_port);
-            // handle error
-            exit(0);
-        } else {
-            printf("Can't allocate redis context\n");
-        }
-    }
-
     // initialize margo instance
-    margo_instance_id mid = margo_init(mochi_addr, MARGO_SERVER_MODE, 0, 0);
+    margo_instance_id mid = margo_init(mochi_addr, MARGO_SERVER_MODE, progress_thread, rpc_threads);
     assert(mid);
+
+    // one connection per handler thread, and one more for the handlers
+    // that run on the progress loop when there are none
+    if (redis_pool_init("127.0.0.1", redis_port, rpc_threads + 1) != 0) {
+        margo_finalize(mid);
+        exit(0);
+    }
     margo_set_log_level(mid, MARGO_LOG_INFO);
 
+    started = now_ns();
+    ABT_key_create(NULL, &call_key);
+
+    if (tier_mb && tier_init(&tier, tier_mb << 20, queue_depth) == 0)
+        tier_enabled = 1;
+    if (write_behind && (!tier_enabled || start_flusher(mid, "127.0.0.1", redis_port) != 0)) {
+        printf("Error: write-behind needs the memory tier and its flusher\n");
+        margo_finalize(mid);
+        exit(0);
+    }
+
     hg_addr_t my_address;
     margo_addr_self(mid, &my_address);
     char addr_str[128];
@@ -66,10 +369,24 @@ int main(int argc, char** argv)
     margo_addr_to_string(mid, addr_str, &addr_str_size, my_address);
     margo_addr_free(mid,my_address);
 
-    margo_info(mid, "Server running at address %s\n", addr_str);
+    margo_info(mid, "Server running at address %s with provider_id %d, %d handler threads, "
+            "%s sets, %zu MB memory tier\n", addr_str, provider_id, rpc_threads,
+            write_behind ? "write-behind" : "sync", tier_enabled ? tier_mb : 0);
 
-    MARGO_REGISTER(mid, "set", rdma_in_t, rdma_out_t, set);
-    MARGO_REGISTER(mid, "get", rdma_in_t, rdma_out_t, get);
+    MARGO_REGISTER_PROVIDER(mid, "set", rdma_msg_t, rdma_msg_t, set_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "get", rdma_msg_t, rdma_msg_t, get_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "get_size", rdma_msg_t, rdma_msg_t, get_size_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "stat", rdma_msg_t, rdma_msg_t, stat_key_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "exists", rdma_msg_t, rdma_msg_t, exists_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "delete", rdma_msg_t, rdma_msg_t, delete_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "set_many", rdma_msg_t, rdma_msg_t, set_many_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "get_many", rdma_msg_t, rdma_msg_t, get_many_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "exists_many", rdma_msg_t, rdma_msg_t, exists_many_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "delete_many", rdma_msg_t, rdma_msg_t, delete_many_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "set_chunk", rdma_msg_t, rdma_msg_t, set_chunk_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "get_chunk", rdma_msg_t, rdma_msg_t, get_chunk_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "snapshot", rdma_msg_t, rdma_msg_t, snapshot_timed, provider_id, ABT_POOL_NULL);
+    MARGO_REGISTER_PROVIDER(mid, "stats", rdma_msg_t, rdma_msg_t, server_stats, provider_id, ABT_POOL_NULL);
 
     cur_mid = mid;
     margo_wait_for_finalize(mid);
@@ -77,17 +394,267 @@ int main(int argc, char** argv)
     return 0;
 }
 
+// values are stored in redis behind a fixed rdma_meta_t header, the
+// version of each key is counted in a separate version:<key> integer
+#define META_SIZE sizeof(rdma_meta_t)
+
+// read the metadata header of a redis reply, -1 if it holds no value
+static int read_meta(const redisReply* reply, rdma_meta_t* meta)
+{
+    if (!reply || reply->type != REDIS_REPLY_STRING || reply->len < META_SIZE)
+        return -1;
+    memcpy(meta, reply->str, META_SIZE);
+    return 0;
+}
+
+// Values larger than RDMA_CHUNK_SIZE exceed what a redis string can hold
+// (512 MB) or should be moved in one transfer. They keep only their header
+// under key:<key>, flagged META_CHUNKED, and their data in chunk strings
+// named after the key, the timestamp of the upload and the chunk index. An
+// upload thus never overwrites the chunks of the value being read, and the
+// indices of the chunks received so far are kept in the set
+// received:<key>:<timestamp>. Until the upload completes, its chunks and
+// that set expire UPLOAD_TTL seconds after the last chunk received, so a
+// failed or abandoned upload leaves nothing behind.
+#define META_CHUNKED 1
+#define CHUNK_KEY "chunk:%s:%.6f:%llu"
+#define RECEIVED_KEY "received:%s:%.6f"
+#define UPLOAD_TTL 600
+
+static uint64_t chunk_count(const rdma_meta_t* meta)
+{
+    if (!(meta->reserved & META_CHUNKED))
+        return 0;
+    return (meta->size + RDMA_CHUNK_SIZE - 1) / RDMA_CHUNK_SIZE;
+}
+
+// delete the chunks of the value whose header GETRANGE answered, except
+// those also used by the value described by keep, if any
+static void drop_chunks(redisContext* c, const char* key, const redisReply* header, const rdma_meta_t* keep)
+{
+    rdma_meta_t meta;
+    uint64_t first = 0, n;
+    redisReply *reply;
+
+    if (read_meta(header, &meta) != 0)
+        return;
+    n = chunk_count(&meta);
+    if (keep && (keep->reserved & META_CHUNKED) && keep->timestamp == meta.timestamp)
+        first = chunk_count(keep);
+
+    for (uint64_t i = first; i < n; i++)
+        redisAppendCommand(c, "DEL " CHUNK_KEY, key, meta.timestamp, (unsigned long long)i);
+    for (uint64_t i = first; i < n; i++) {
+        reply = NULL;
+        redisGetReply(c, (void**)&reply);
+        freeReplyObject(reply);
+    }
+}
+
+// push the chunks of a value to the client bulk, one at a time
+static int push_chunks(redisContext* c, margo_instance_id mid, hg_addr_t client_addr, hg_bulk_t bulk,
+        const char* key, const rdma_meta_t* meta)
+{
+    hg_return_t ret;
+    hg_bulk_t local_bulk;
+    redisReply *reply;
+    int err = 0;
+
+    for (uint64_t i = 0; i < chunk_count(meta) && !err; i++) {
+        hg_size_t len;
+        void* data;
+
+        reply = redisCommand(c, "GET " CHUNK_KEY, key, meta->timestamp, (unsigned long long)i);
+        len = i * RDMA_CHUNK_SIZE + RDMA_CHUNK_SIZE > meta->size
+            ? meta->size - i * RDMA_CHUNK_SIZE : RDMA_CHUNK_SIZE;
+        if (!reply || reply->type != REDIS_REPLY_STRING || reply->len != len) {
+            err = -1;
+        } else {
+            data = reply->str;
+            ret = margo_bulk_create(mid, 1, &data, &len, HG_BULK_READ_ONLY, &local_bulk);
+            assert(ret == HG_SUCCESS);
+
+            ret = transfer(mid, HG_BULK_PUSH, client_addr,
+                    bulk, i * RDMA_CHUNK_SIZE, local_bulk, 0, len);
+            assert(ret == HG_SUCCESS);
+
+            ret = margo_bulk_free(local_bulk);
+            assert(ret == HG_SUCCESS);
+        }
+        freeReplyObject(reply);
+    }
+    return err;
+}
+
+// SET commands are built in RESP form around the room for their value, which
+// is pulled straight into place from the client. The commands are then
+// written to the redis socket as they are, instead of being copied once more
+// into the output buffer of hiredis by redisCommand.
+#define SET_HEADER "*3\r\n$3\r\nSET\r\n$%zu\r\n%s%s\r\n$%zu\r\n"
+#define SET_TRAILER "\r\n"
+#define SET_TRAILER_SIZE 2
+
+// write the header of SET <prefix><key> <value_len bytes> at out, or only
+// measure it when out is NULL, and return its length. The value follows
+// the header and is itself followed by SET_TRAILER.
+static size_t set_header(char* out, const char* prefix, const char* key, size_t value_len)
+{
+    size_t name_len = strlen(prefix) + strlen(key);
+    int n = snprintf(NULL, 0, SET_HEADER, name_len, prefix, key, value_len);
+
+    // the terminating NUL lands on the value, written afterwards
+    if (out)
+        snprintf(out, n + 1, SET_HEADER, name_len, prefix, key, value_len);
+    return n;
+}
+
+// write commands built in place to the redis socket, their replies are read
+// with redisGetReply. Nothing may be pending in the hiredis output buffer.
+static int redis_write(redisContext* c, const char* buf, size_t len)
+{
+    while (len) {
+        ssize_t n = write(c->fd, buf, len);
+        if (n < 0 && errno == EINTR)
+            continue;
+        if (n <= 0) {
+            // fails the following redisGetReply calls
+            c->err = REDIS_ERR_IO;
+            snprintf(c->errstr, sizeof(c->errstr), "%s", strerror(errno));
+            return -1;
+        }
+        buf += n;
+        len -= n;
+    }
+    return 0;
+}
+
+// first and longest wait of the flusher between two rounds of failed writes
+#define FLUSH_BACKOFF_MIN 10000
+#define FLUSH_BACKOFF_MAX 1000000
+
+// write the dirty entries of the tier to redis in the order they were put,
+// with the version they were given so that redis INCR continues from it.
+// An entry that could not be written is retried, first, with a growing
+// backoff, it is only given up when the server stops.
+static void flusher(void* arg)
+{
+    redisContext *c = arg;
+    redisReply *reply, *old;
+    tier_entry_t *e;
+    useconds_t backoff = 0;
+
+    while ((e = tier_next_dirty(&tier)) != NULL) {
+        int ok = 0;
+
+        for (int attempt = 0; attempt < 3 && !ok; attempt++) {
+            if (c->err && redisReconnect(c) != REDIS_OK)
+                continue;
+            old = NULL;
+            reply = NULL;
+            redisAppendCommand(c, "GETRANGE key:%s 0 %d", e->key, (int)META_SIZE - 1);
+            redisGetReply(c, (void**)&old);
+            if (redis_write(c, e->cmd, e->cmd_size) == 0) {
+                redisAppendCommand(c, "SET version:%s %llu", e->key, (unsigned long long)e->meta.version);
+                redisGetReply(c, (void**)&reply);
+                ok = reply && reply->type != REDIS_REPLY_ERROR;
+                freeReplyObject(reply);
+                reply = NULL;
+                redisGetReply(c, (void**)&reply);
+            }
+            if (ok)
+                drop_chunks(c, e->key, old, NULL);
+            freeReplyObject(reply);
+            freeReplyObject(old);
+        }
+        if (ok) {
+            if (backoff)
+                printf("Redis takes the writes again\n");
+            backoff = 0;
+            tier_flushed(&tier, e);
+            continue;
+        }
+        if (!backoff)
+            printf("Error: could not write %s to redis, retrying: %s\n", e->key, c->errstr);
+        if (tier_failed(&tier, e) != 0) {
+            printf("Error: %s was never written to redis\n", e->key);
+            continue;
+        }
+        backoff = backoff ? backoff * 2 : FLUSH_BACKOFF_MIN;
+        if (backoff > FLUSH_BACKOFF_MAX)
+            backoff = FLUSH_BACKOFF_MAX;
+        usleep(backoff);
+    }
+}
+
+// send the response and release everything owned by the handler
+static void finish(hg_handle_t h, rdma_msg_t* in, rdma_req_t* req, int decoded, rdma_resp_meta_t* resp)
+{
+    hg_return_t ret;
+    rdma_msg_t out;
+    call_t* call;
+
+    if (resp->resp.flags & RDMA_HAS_METADATA)
+        rdma_resp_meta_wrap(resp, &out);
+    else
+        rdma_resp_wrap(&resp->resp, &out);
+    ret = margo_respond(h, &out);
+    assert(ret == HG_SUCCESS);
+    if ((call = current_call()))
+        call->status = resp->resp.status;
+
+    if (decoded == 0)
+        rdma_req_free(req);
+
+    ret = margo_free_input(h, in);
+    assert(ret == HG_SUCCESS);
+
+    ret = margo_destroy(h);
+    assert(ret == HG_SUCCESS);
+}
+
+// batch version of finish, out is the response built by the handler or
+// empty if the request could not be served
+static void finish_batch(hg_handle_t h, rdma_msg_t* in, rdma_batch_req_t* req, int decoded, rdma_msg_t* out)
+{
+    hg_return_t ret;
+    rdma_resp_t err = { RDMA_ERROR, 0, 0 };
+    rdma_msg_t err_out;
+    call_t* call;
+
+    if (out->data == NULL)
+        rdma_resp_wrap(&err, &err_out);
+
+    ret = margo_respond(h, out->data ? out : &err_out);
+    assert(ret == HG_SUCCESS);
+    if ((call = current_call()) && out->data == NULL)
+        call->status = RDMA_ERROR;
+
+    free(out->data);
+    if (decoded == 0)
+        rdma_batch_req_free(req);
+
+    ret = margo_free_input(h, in);
+    assert(ret == HG_SUCCESS);
+
+    ret = margo_destroy(h);
+    assert(ret == HG_SUCCESS);
+}
+
 static void set(hg_handle_t h)
 {
 
     hg_return_t ret;
 
-    rdma_in_t in;
-    rdma_out_t out;
-    hg_bulk_t local_bulk;
-    hg_string_t* val;
+    rdma_msg_t in;
+    rdma_req_t req;
+    rdma_resp_meta_t resp = { { RDMA_ERROR, 0, 0 }, { 0, 0, 0, 0, 0 } };
+    hg_bulk_t local_bulk = HG_BULK_NULL;
+    char* cmd = NULL;
+    size_t cmd_size = 0;
+    int decoded;
 
-    redisReply *reply;
+    redisReply *reply, *old;
+    redisContext *c;
 
     margo_instance_id mid = margo_hg_handle_get_instance(h);
 
@@ -97,57 +664,315 @@ static void set(hg_handle_t h)
     ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    val = (hg_string_t*)malloc(in.size);
-    if(val)
+    decoded = rdma_req_decode(mid, &in, &req);
+    if (decoded == 0) {
+        cmd_size = set_header(NULL, "key:", req.key, META_SIZE + req.size)
+            + META_SIZE + req.size + SET_TRAILER_SIZE;
+        cmd = malloc(cmd_size);
+    }
+    if(cmd)
     {
-        hg_size_t buf_size = in.size;
+        hg_size_t buf_size = req.size;
+        char* val = cmd + set_header(cmd, "key:", req.key, META_SIZE + req.size);
+        void* data = val + META_SIZE;
 
-        ret = margo_bulk_create(mid, 1, (void**)&val, &buf_size,
-                 HG_BULK_WRITE_ONLY, &local_bulk);
-        assert(ret == HG_SUCCESS);
+        memcpy(val + META_SIZE + req.size, SET_TRAILER, SET_TRAILER_SIZE);
 
-        ret = margo_bulk_transfer(mid, HG_BULK_PULL, client_addr,
-                in.bulk, 0, local_bulk, 0, buf_size);
-        assert(ret == HG_SUCCESS);
+        // the value is pulled behind the room left for its header, and the
+        // registration is kept by the tier to push it to the readers
+        if (buf_size) {
+            ret = margo_bulk_create(mid, 1, &data, &buf_size,
+                     HG_BULK_READWRITE, &local_bulk);
+            assert(ret == HG_SUCCESS);
+
+            ret = transfer(mid, HG_BULK_PULL, client_addr,
+                    req.bulk, 0, local_bulk, 0, buf_size);
+            assert(ret == HG_SUCCESS);
+        }
+
+        //margo_info(mid, "obtained key %s and value %s\n", req.key, val);
 
-        out.ret = 0;
+        resp.meta.timestamp = req.timestamp;
+        resp.meta.size = req.size;
+        resp.meta.flags = req.flags;
+        if (write_behind && tier_put(&tier, req.key, &resp.meta, cmd, cmd_size, val, local_bulk, 1) == 0) {
+            // the flusher owns the command now
+            cmd = NULL;
+            local_bulk = HG_BULK_NULL;
+            resp.resp.status = RDMA_OK;
+            resp.resp.flags = RDMA_HAS_METADATA;
+            resp.resp.value = req.size;
+        } else if (drain(req.key) == 0) {
+            // the old header tells which chunks to drop if it was chunked
+            c = redis_acquire();
+            redisAppendCommand(c, "GETRANGE key:%s 0 %d", req.key, (int)META_SIZE - 1);
+            redisAppendCommand(c, "INCR version:%s", req.key);
+            old = NULL;
+            redisGetReply(c, (void**)&old);
+            reply = NULL;
+            redisGetReply(c, (void**)&reply);
+            resp.meta.version = reply && reply->type == REDIS_REPLY_INTEGER ? reply->integer : 0;
+            freeReplyObject(reply);
+            memcpy(val, &resp.meta, META_SIZE);
 
-        //margo_info(mid, "obtained key %s and value %s\n", in.key, val);
+            // store key-value pair in redis
+            reply = NULL;
+            if (redis_write(c, cmd, cmd_size) == 0)
+                redisGetReply(c, (void**)&reply);
+            if (reply && reply->type != REDIS_REPLY_ERROR) {
+                resp.resp.status = RDMA_OK;
+                resp.resp.flags = RDMA_HAS_METADATA;
+                resp.resp.value = req.size;
+                drop_chunks(c, req.key, old, NULL);
+            }
+            redis_release(c);
 
-        // store key-value pair in redis
-        reply = redisCommand(c, "SET key:%s %b", in.key, val, (size_t)in.size);
-        margo_debug(mid, "SET (binary API): %s\n", reply->str);
+            // and keep it in the tier for the gets that follow
+            if (resp.resp.status == RDMA_OK && tier_enabled
+                    && tier_put(&tier, req.key, &resp.meta, cmd, cmd_size, val, local_bulk, 0) == 0) {
+                cmd = NULL;
+                local_bulk = HG_BULK_NULL;
+            }
+            freeReplyObject(reply);
+            freeReplyObject(old);
+        }
+
+        if (local_bulk != HG_BULK_NULL) {
+            ret = margo_bulk_free(local_bulk);
+            assert(ret == HG_SUCCESS);
+        }
+        free(cmd);
     }
-   
 
-    ret = margo_respond(h, &out);
-    assert(ret == HG_SUCCESS);
+    finish(h, &in, &req, decoded, &resp);
+}
 
-    ret = margo_bulk_free(local_bulk);
+static void get(hg_handle_t h)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in;
+    rdma_req_t req;
+    rdma_resp_meta_t resp = { { RDMA_ERROR, 0, 0 }, { 0, 0, 0, 0, 0 } };
+    hg_bulk_t local_bulk;
+    hg_string_t val;
+    hg_size_t buf_size;
+    int decoded;
+
+    redisReply *reply;
+    redisContext *c;
+    tier_entry_t *e;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    const struct hg_info* info = margo_get_info(h);
+    hg_addr_t client_addr = info->addr;
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    ret = margo_free_input(h, &in);
+    decoded = rdma_req_decode(mid, &in, &req);
+    if (decoded != 0) {
+        finish(h, &in, &req, decoded, &resp);
+        return;
+    }
+
+    // values in the tier are pushed from the memory they were pulled into
+    if ((e = pin(req.key)) != NULL) {
+        resp.meta = e->meta;
+        resp.resp.flags = RDMA_HAS_METADATA;
+        resp.resp.value = e->meta.size;
+        if (e->meta.size > req.size) {
+            resp.resp.status = RDMA_OVERFLOW;
+        } else {
+            if (e->meta.size) {
+                ret = transfer(mid, HG_BULK_PUSH, client_addr,
+                        req.bulk, 0, e->bulk, 0, e->meta.size);
+                assert(ret == HG_SUCCESS);
+            }
+            resp.resp.status = RDMA_OK;
+        }
+        tier_unpin(&tier, e);
+        finish(h, &in, &req, decoded, &resp);
+        return;
+    }
+
+    // get data from redis, the connection is held while the value is pushed
+    // from the reply
+    c = redis_acquire();
+    reply = redisCommand(c, "GET key:%s", req.key);
+
+    margo_debug(mid, "GET %s\n", req.key);
+
+    if (reply && reply->type == REDIS_REPLY_NIL) {
+        resp.resp.status = RDMA_NOT_FOUND;
+    } else if (read_meta(reply, &resp.meta) == 0) {
+        resp.resp.flags = RDMA_HAS_METADATA;
+        val = reply->str + META_SIZE;
+        buf_size = resp.meta.size;
+
+        if (buf_size > req.size) {
+            // client buffer too small, report the size so it can retry
+            resp.resp.status = RDMA_OVERFLOW;
+            resp.resp.value = buf_size;
+        } else if (resp.meta.reserved & META_CHUNKED) {
+            if (push_chunks(c, mid, client_addr, req.bulk, req.key, &resp.meta) == 0) {
+                resp.resp.status = RDMA_OK;
+                resp.resp.value = buf_size;
+            }
+        } else {
+            if (buf_size) {
+                ret = margo_bulk_create(mid, 1, (void*)&val, &buf_size,
+                        HG_BULK_READ_ONLY, &local_bulk);
+                assert(ret == HG_SUCCESS);
+
+                ret = transfer(mid, HG_BULK_PUSH, client_addr,
+                        req.bulk, 0, local_bulk, 0, buf_size);
+                assert(ret == HG_SUCCESS);
+
+                ret = margo_bulk_free(local_bulk);
+                assert(ret == HG_SUCCESS);
+            }
+
+            resp.resp.status = RDMA_OK;
+            resp.resp.value = buf_size;
+        }
+    }
+
+    freeReplyObject(reply);
+    redis_release(c);
+
+    finish(h, &in, &req, decoded, &resp);
+}
+
+// answer from the metadata header alone, with the header itself if
+// with_meta is set
+static void stat_one(hg_handle_t h, int with_meta)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in;
+    rdma_req_t req;
+    rdma_resp_meta_t resp = { { RDMA_ERROR, 0, 0 }, { 0, 0, 0, 0, 0 } };
+    int decoded;
+
+    redisReply *reply;
+    tier_entry_t *e;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    ret = margo_destroy(h);
+    decoded = rdma_req_decode(mid, &in, &req);
+    if (decoded == 0 && (e = pin(req.key)) != NULL) {
+        resp.meta = e->meta;
+        tier_unpin(&tier, e);
+        resp.resp.status = RDMA_OK;
+        resp.resp.value = resp.meta.size;
+        if (with_meta)
+            resp.resp.flags = RDMA_HAS_METADATA;
+    } else if (decoded == 0) {
+        // GETRANGE reads the header without copying the value, it answers
+        // an empty string for missing keys
+        redisContext *c = redis_acquire();
+        reply = redisCommand(c, "GETRANGE key:%s 0 %d", req.key, (int)META_SIZE - 1);
+        redis_release(c);
+        if (read_meta(reply, &resp.meta) == 0) {
+            resp.resp.status = RDMA_OK;
+            resp.resp.value = resp.meta.size;
+            if (with_meta)
+                resp.resp.flags = RDMA_HAS_METADATA;
+        } else if (reply && reply->type == REDIS_REPLY_STRING) {
+            resp.resp.status = RDMA_NOT_FOUND;
+        }
+        freeReplyObject(reply);
+    }
+
+    finish(h, &in, &req, decoded, &resp);
+}
+
+static void get_size(hg_handle_t h)
+{
+    stat_one(h, 0);
+}
+
+static void stat_key(hg_handle_t h)
+{
+    stat_one(h, 1);
+}
+
+// run one redis command on the key of a request and answer with its
+// integer reply, using missing_status when the reply is 0. The key is
+// passed twice so that the command can name it twice. With drop set, the
+// command removes the value, whose chunks are deleted first, otherwise it
+// only reads and a value in the tier answers 1.
+static void integer_one(hg_handle_t h, const char* command, int32_t missing_status, int drop)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in;
+    rdma_req_t req;
+    rdma_resp_meta_t resp = { { RDMA_ERROR, 0, 0 }, { 0, 0, 0, 0, 0 } };
+    int decoded;
+
+    redisReply *reply;
+    tier_entry_t *e;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    free(val);
-    freeReplyObject(reply);
+    decoded = rdma_req_decode(mid, &in, &req);
+    if (decoded == 0 && !drop && (e = pin(req.key)) != NULL) {
+        tier_unpin(&tier, e);
+        resp.resp.status = RDMA_OK;
+        resp.resp.value = 1;
+    } else if (decoded == 0 && (!drop || drain(req.key) == 0)) {
+        redisContext *c = redis_acquire();
+        if (drop) {
+            reply = redisCommand(c, "GETRANGE key:%s 0 %d", req.key, (int)META_SIZE - 1);
+            drop_chunks(c, req.key, reply, NULL);
+            freeReplyObject(reply);
+        }
+        reply = redisCommand(c, command, req.key, req.key);
+        redis_release(c);
+        if (reply && reply->type == REDIS_REPLY_INTEGER) {
+            resp.resp.status = reply->integer ? RDMA_OK : missing_status;
+            resp.resp.value = reply->integer;
+        }
+        freeReplyObject(reply);
+    }
+
+    finish(h, &in, &req, decoded, &resp);
 }
 
-static void get(hg_handle_t h)
+static void exists(hg_handle_t h)
+{
+    integer_one(h, "EXISTS key:%s", RDMA_OK, 0);
+}
+
+static void delete(hg_handle_t h)
+{
+    integer_one(h, "DEL key:%s version:%s", RDMA_NOT_FOUND, 1);
+}
+
+static void set_many(hg_handle_t h)
 {
     hg_return_t ret;
 
-    rdma_in_t in;
-    rdma_out_t out;
+    rdma_msg_t in;
+    rdma_msg_t out = { 0, NULL };
+    rdma_batch_req_t req;
     hg_bulk_t local_bulk;
-    hg_string_t val;
-    hg_size_t buf_size;
-    
-    FILE *fptr;
-    size_t read_size;
+    char* cmds = NULL;
+    char** values = NULL;
+    void **segments = NULL;
+    hg_size_t *segment_sizes = NULL;
+    redisReply **old = NULL;
+    size_t cmds_size = 0;
+    int decoded;
 
     redisReply *reply;
 
@@ -159,40 +984,660 @@ static void get(hg_handle_t h)
     ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
+    decoded = rdma_batch_req_decode(mid, &in, &req);
+    if (decoded == 0) {
+        for (uint32_t i = 0; i < req.count; i++)
+            cmds_size += set_header(NULL, "key:", req.keys[i], META_SIZE + req.sizes[i])
+                + META_SIZE + req.sizes[i] + SET_TRAILER_SIZE;
+        cmds = malloc(cmds_size ? cmds_size : 1);
+        values = malloc((req.count ? req.count : 1) * sizeof(char*));
+        segments = malloc((req.count ? req.count : 1) * sizeof(void*));
+        segment_sizes = malloc((req.count ? req.count : 1) * sizeof(hg_size_t));
+        old = calloc(req.count ? req.count : 1, sizeof(redisReply*));
+    }
 
-    // get data from redis
-    reply = redisCommand(c, "GET key:%s", in.key);
+    if (cmds && values && segments && segment_sizes && old && drain_all(req.keys, req.count) == 0
+            && rdma_batch_resp_alloc(RDMA_OK, req.count, 1, &out) == 0) {
+        uint32_t nseg = 0;
+        hg_size_t total = 0;
+        char* p = cmds;
 
-    margo_debug(mid, "GET %s\n", in.key);
+        // the SET commands of the batch are laid out back to back and every
+        // value comes in with a single pull, each one behind the room left
+        // for its header
+        for (uint32_t i = 0; i < req.count; i++) {
+            values[i] = p + set_header(p, "key:", req.keys[i], META_SIZE + req.sizes[i]);
+            p = values[i] + META_SIZE + req.sizes[i];
+            memcpy(p, SET_TRAILER, SET_TRAILER_SIZE);
+            p += SET_TRAILER_SIZE;
+            if (req.sizes[i]) {
+                segments[nseg] = values[i] + META_SIZE;
+                segment_sizes[nseg++] = req.sizes[i];
+                total += req.sizes[i];
+            }
+        }
+        if (nseg) {
+            ret = margo_bulk_create(mid, nseg, segments, segment_sizes,
+                     HG_BULK_WRITE_ONLY, &local_bulk);
+            assert(ret == HG_SUCCESS);
 
-    val = reply->str;
-    buf_size = strlen(reply->str);
+            ret = transfer(mid, HG_BULK_PULL, client_addr,
+                    req.bulk, 0, local_bulk, 0, total);
+            assert(ret == HG_SUCCESS);
 
-    ret = margo_bulk_create(mid, 1, (void*)&val, &buf_size,
-	    HG_BULK_READ_ONLY, &local_bulk);
+            ret = margo_bulk_free(local_bulk);
+            assert(ret == HG_SUCCESS);
+        }
+
+        // pipeline the version increments and old headers, then write all
+        // the SETs at once, so that the batch costs two redis round trips
+        redisContext *c = redis_acquire();
+        for (uint32_t i = 0; i < req.count; i++) {
+            redisAppendCommand(c, "GETRANGE key:%s 0 %d", req.keys[i], (int)META_SIZE - 1);
+            redisAppendCommand(c, "INCR version:%s", req.keys[i]);
+        }
+
+        for (uint32_t i = 0; i < req.count; i++) {
+            rdma_meta_t meta = { req.timestamp, req.sizes[i], 0, req.flags, 0 };
+
+            redisGetReply(c, (void**)&old[i]);
+            reply = NULL;
+            redisGetReply(c, (void**)&reply);
+            if (reply && reply->type == REDIS_REPLY_INTEGER)
+                meta.version = reply->integer;
+            freeReplyObject(reply);
+
+            memcpy(values[i], &meta, META_SIZE);
+            rdma_batch_resp_set_meta(&out, i, &meta);
+        }
+        // on a failed write the replies below fail as well
+        redis_write(c, cmds, cmds_size);
+        for (uint32_t i = 0; i < req.count; i++) {
+            reply = NULL;
+            redisGetReply(c, (void**)&reply);
+            rdma_batch_resp_set(&out, i,
+                    reply && reply->type != REDIS_REPLY_ERROR ? RDMA_OK : RDMA_ERROR,
+                    req.sizes[i]);
+            freeReplyObject(reply);
+        }
+        // chunks of the values that were replaced
+        for (uint32_t i = 0; i < req.count; i++)
+            drop_chunks(c, req.keys[i], old[i], NULL);
+        redis_release(c);
+    }
+
+    for (uint32_t i = 0; old && i < req.count; i++)
+        if (old[i])
+            freeReplyObject(old[i]);
+    free(old);
+    free(cmds);
+    free(values);
+    free(segments);
+    free(segment_sizes);
+    finish_batch(h, &in, &req, decoded, &out);
+}
+
+static void get_many(hg_handle_t h)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in;
+    rdma_msg_t out = { 0, NULL };
+    rdma_batch_req_t req;
+    hg_bulk_t local_bulk;
+    redisReply **replies = NULL;
+    tier_entry_t **entries = NULL;
+    void **segments = NULL;
+    hg_size_t *segment_sizes = NULL;
+    int decoded;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    const struct hg_info* info = margo_get_info(h);
+    hg_addr_t client_addr = info->addr;
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    ret = margo_bulk_transfer(mid, HG_BULK_PUSH, client_addr,
-	    in.bulk, 0, local_bulk, 0, buf_size);
+    decoded = rdma_batch_req_decode(mid, &in, &req);
+    if (decoded == 0) {
+        replies = calloc(req.count ? req.count : 1, sizeof(redisReply*));
+        entries = calloc(req.count ? req.count : 1, sizeof(tier_entry_t*));
+        segments = malloc((req.count ? req.count : 1) * sizeof(void*));
+        segment_sizes = malloc((req.count ? req.count : 1) * sizeof(hg_size_t));
+    }
+
+    if (replies && entries && segments && segment_sizes
+            && rdma_batch_resp_alloc(RDMA_OK, req.count, 1, &out) == 0) {
+        uint32_t nseg = 0;
+        hg_size_t free_space = req.size;
+        hg_size_t total = 0;
+
+        // only the values missing from the tier are read from redis
+        redisContext *c = redis_acquire();
+        for (uint32_t i = 0; i < req.count; i++)
+            if ((entries[i] = pin(req.keys[i])) == NULL)
+                redisAppendCommand(c, "GET key:%s", req.keys[i]);
+
+        // the reply buffers and tier entries that fit, past their headers,
+        // become the segments of a single local bulk handle pushed in one
+        // transfer
+        for (uint32_t i = 0; i < req.count; i++) {
+            rdma_meta_t meta;
+            hg_size_t len;
+
+            if (entries[i]) {
+                meta = entries[i]->meta;
+            } else {
+                redisGetReply(c, (void**)&replies[i]);
+                if (read_meta(replies[i], &meta) != 0) {
+                    int missing = replies[i] && replies[i]->type == REDIS_REPLY_NIL;
+                    rdma_batch_resp_set(&out, i, missing ? RDMA_NOT_FOUND : RDMA_ERROR, 0);
+                    continue;
+                }
+            }
+
+            rdma_batch_resp_set_meta(&out, i, &meta);
+            len = meta.size;
+            // chunked values are fetched on their own with get_chunk
+            if (len > free_space || (meta.reserved & META_CHUNKED)) {
+                rdma_batch_resp_set(&out, i, RDMA_OVERFLOW, len);
+                continue;
+            }
+            if (len) {
+                segments[nseg] = (entries[i] ? entries[i]->value : replies[i]->str) + META_SIZE;
+                segment_sizes[nseg++] = len;
+                free_space -= len;
+                total += len;
+            }
+            rdma_batch_resp_set(&out, i, RDMA_OK, len);
+        }
+        // the replies outlive the connection
+        redis_release(c);
+
+        if (nseg) {
+            ret = margo_bulk_create(mid, nseg, segments, segment_sizes,
+                    HG_BULK_READ_ONLY, &local_bulk);
+            assert(ret == HG_SUCCESS);
+
+            ret = transfer(mid, HG_BULK_PUSH, client_addr,
+                    req.bulk, 0, local_bulk, 0, total);
+            assert(ret == HG_SUCCESS);
+
+            ret = margo_bulk_free(local_bulk);
+            assert(ret == HG_SUCCESS);
+        }
+
+        for (uint32_t i = 0; i < req.count; i++) {
+            if (replies[i])
+                freeReplyObject(replies[i]);
+            if (entries[i])
+                tier_unpin(&tier, entries[i]);
+        }
+    }
+
+    free(replies);
+    free(entries);
+    free(segments);
+    free(segment_sizes);
+    finish_batch(h, &in, &req, decoded, &out);
+}
+
+// run one redis command per key of a batch in a single pipeline and answer
+// with the integer reply of each, the key is passed twice and drop has the
+// same meaning as in integer_one
+static void integer_many(hg_handle_t h, const char* command, int drop)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in;
+    rdma_msg_t out = { 0, NULL };
+    rdma_batch_req_t req;
+    int decoded;
+
+    redisReply *reply;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    out.ret = 0;
+    decoded = rdma_batch_req_decode(mid, &in, &req);
+    if (decoded == 0 && (!drop || drain_all(req.keys, req.count) == 0)
+            && rdma_batch_resp_alloc(RDMA_OK, req.count, 0, &out) == 0) {
+        redisContext *c = redis_acquire();
+        if (drop) {
+            redisReply **headers = calloc(req.count ? req.count : 1, sizeof(redisReply*));
+            for (uint32_t i = 0; headers && i < req.count; i++)
+                redisAppendCommand(c, "GETRANGE key:%s 0 %d", req.keys[i], (int)META_SIZE - 1);
+            for (uint32_t i = 0; headers && i < req.count; i++)
+                redisGetReply(c, (void**)&headers[i]);
+            for (uint32_t i = 0; headers && i < req.count; i++) {
+                drop_chunks(c, req.keys[i], headers[i], NULL);
+                freeReplyObject(headers[i]);
+            }
+            free(headers);
+        }
+        for (uint32_t i = 0; i < req.count; i++)
+            redisAppendCommand(c, command, req.keys[i], req.keys[i]);
 
-    ret = margo_respond(h, &out);
+        for (uint32_t i = 0; i < req.count; i++) {
+            tier_entry_t *e;
+
+            reply = NULL;
+            redisGetReply(c, (void**)&reply);
+            if (!drop && (e = pin(req.keys[i])) != NULL) {
+                // not in redis yet with write-behind
+                tier_unpin(&tier, e);
+                rdma_batch_resp_set(&out, i, RDMA_OK, 1);
+            } else if (reply && reply->type == REDIS_REPLY_INTEGER) {
+                rdma_batch_resp_set(&out, i, reply->integer ? RDMA_OK : RDMA_NOT_FOUND, reply->integer);
+            } else {
+                rdma_batch_resp_set(&out, i, RDMA_ERROR, 0);
+            }
+            freeReplyObject(reply);
+        }
+        redis_release(c);
+    }
+
+    finish_batch(h, &in, &req, decoded, &out);
+}
+
+static void exists_many(hg_handle_t h)
+{
+    integer_many(h, "EXISTS key:%s", 0);
+}
+
+static void delete_many(hg_handle_t h)
+{
+    integer_many(h, "DEL key:%s version:%s", 1);
+}
+
+static void set_chunk(hg_handle_t h)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in;
+    rdma_req_t req;
+    rdma_resp_meta_t resp = { { RDMA_ERROR, 0, 0 }, { 0, 0, 0, 0, 0 } };
+    hg_bulk_t local_bulk;
+    uint64_t offset = 0, total = 0;
+    char* name = NULL;
+    char* cmd = NULL;
+    size_t cmd_size = 0;
+    int decoded;
+
+    redisReply *reply, *old;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    const struct hg_info* info = margo_get_info(h);
+    hg_addr_t client_addr = info->addr;
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    ret = margo_bulk_free(local_bulk);
+    decoded = rdma_req_decode(mid, &in, &req);
+    // each chunk must map to exactly one chunk string
+    if (decoded == 0 && rdma_chunk_decode(&in, &offset, &total) == 0
+            && offset % RDMA_CHUNK_SIZE == 0 && req.size <= RDMA_CHUNK_SIZE
+            && offset + req.size <= total) {
+        // the chunk key of CHUNK_KEY, without its "chunk:" prefix
+        name = malloc(strlen(req.key) + 64);
+        if (name) {
+            sprintf(name, "%s:%.6f:%llu", req.key, req.timestamp,
+                    (unsigned long long)(offset / RDMA_CHUNK_SIZE));
+            cmd_size = set_header(NULL, "chunk:", name, req.size) + req.size + SET_TRAILER_SIZE;
+            cmd = malloc(cmd_size);
+        }
+    }
+
+    if (cmd) {
+        hg_size_t buf_size = req.size;
+        char* val = cmd + set_header(cmd, "chunk:", name, req.size);
+
+        memcpy(val + req.size, SET_TRAILER, SET_TRAILER_SIZE);
+        if (buf_size) {
+            ret = margo_bulk_create(mid, 1, (void**)&val, &buf_size,
+                     HG_BULK_WRITE_ONLY, &local_bulk);
+            assert(ret == HG_SUCCESS);
+
+            ret = transfer(mid, HG_BULK_PULL, client_addr,
+                    req.bulk, offset, local_bulk, 0, buf_size);
+            assert(ret == HG_SUCCESS);
+
+            ret = margo_bulk_free(local_bulk);
+            assert(ret == HG_SUCCESS);
+        }
+
+        uint64_t index = offset / RDMA_CHUNK_SIZE;
+        uint64_t count = total ? (total + RDMA_CHUNK_SIZE - 1) / RDMA_CHUNK_SIZE : 1;
+        redisContext *c = redis_acquire();
+
+        // a chunk resent after its upload completed must not touch the
+        // chunks of the value, which no longer expire
+        old = redisCommand(c, "GETRANGE key:%s 0 %d", req.key, (int)META_SIZE - 1);
+        if (read_meta(old, &resp.meta) == 0 && (resp.meta.reserved & META_CHUNKED)
+                && resp.meta.timestamp == req.timestamp && resp.meta.size == total) {
+            resp.resp.status = RDMA_OK;
+            resp.resp.value = buf_size;
+            resp.resp.flags = RDMA_HAS_METADATA;
+            freeReplyObject(old);
+            redis_release(c);
+            free(name);
+            free(cmd);
+            finish(h, &in, &req, decoded, &resp);
+            return;
+        }
+        freeReplyObject(old);
+        memset(&resp.meta, 0, sizeof(resp.meta));
+
+        redis_write(c, cmd, cmd_size);
+        redisAppendCommand(c, "EXPIRE " CHUNK_KEY " %d", req.key, req.timestamp,
+                (unsigned long long)index, UPLOAD_TTL);
+        redisAppendCommand(c, "SADD " RECEIVED_KEY " %llu", req.key, req.timestamp, (unsigned long long)index);
+        redisAppendCommand(c, "EXPIRE " RECEIVED_KEY " %d", req.key, req.timestamp, UPLOAD_TTL);
+        redisAppendCommand(c, "SCARD " RECEIVED_KEY, req.key, req.timestamp);
+        resp.resp.status = RDMA_OK;
+        for (int i = 0; i < 4; i++) {
+            reply = NULL;
+            redisGetReply(c, (void**)&reply);
+            if (!reply || reply->type == REDIS_REPLY_ERROR)
+                resp.resp.status = RDMA_ERROR;
+            freeReplyObject(reply);
+        }
+        if (resp.resp.status == RDMA_OK)
+            resp.resp.value = buf_size;
+        reply = NULL;
+        redisGetReply(c, (void**)&reply);
+
+        // a resent chunk is only counted once. The chunk completing the
+        // upload claims it by deleting the received set, the others only
+        // answer for their own chunk. A failed chunk leaves the upload to
+        // expire
+        if (resp.resp.status == RDMA_OK && reply && reply->type == REDIS_REPLY_INTEGER
+                && (uint64_t)reply->integer == count && drain(req.key) != 0) {
+            // a write of key still waits for redis, the upload fails
+            resp.resp.status = RDMA_ERROR;
+            resp.resp.value = 0;
+        } else if (resp.resp.status == RDMA_OK && reply && reply->type == REDIS_REPLY_INTEGER
+                && (uint64_t)reply->integer == count) {
+            freeReplyObject(reply);
+            reply = redisCommand(c, "DEL " RECEIVED_KEY, req.key, req.timestamp);
+        } else {
+            freeReplyObject(reply);
+            reply = NULL;
+        }
+
+        if (reply && reply->type == REDIS_REPLY_INTEGER && reply->integer == 1) {
+            // the last chunk makes the value visible under its header, the
+            // key was drained above. An empty value keeps no chunk
+            uint64_t n = (total + RDMA_CHUNK_SIZE - 1) / RDMA_CHUNK_SIZE;
+            freeReplyObject(reply);
+            for (uint64_t i = 0; i < n; i++)
+                redisAppendCommand(c, "PERSIST " CHUNK_KEY, req.key, req.timestamp, (unsigned long long)i);
+            for (uint64_t i = 0; i < n; i++) {
+                reply = NULL;
+                redisGetReply(c, (void**)&reply);
+                freeReplyObject(reply);
+            }
+            redisAppendCommand(c, "GETRANGE key:%s 0 %d", req.key, (int)META_SIZE - 1);
+            redisAppendCommand(c, "INCR version:%s", req.key);
+            old = NULL;
+            redisGetReply(c, (void**)&old);
+            reply = NULL;
+            redisGetReply(c, (void**)&reply);
+            resp.meta.timestamp = req.timestamp;
+            resp.meta.size = total;
+            resp.meta.version = reply && reply->type == REDIS_REPLY_INTEGER ? reply->integer : 0;
+            resp.meta.flags = req.flags;
+            resp.meta.reserved = META_CHUNKED;
+            freeReplyObject(reply);
+
+            reply = redisCommand(c, "SET key:%s %b", req.key, &resp.meta, META_SIZE);
+            if (reply && reply->type != REDIS_REPLY_ERROR) {
+                resp.resp.flags = RDMA_HAS_METADATA;
+                drop_chunks(c, req.key, old, &resp.meta);
+            } else {
+                resp.resp.status = RDMA_ERROR;
+            }
+            freeReplyObject(old);
+        }
+        redis_release(c);
+        freeReplyObject(reply);
+    }
+    free(name);
+    free(cmd);
+
+    finish(h, &in, &req, decoded, &resp);
+}
+
+static void get_chunk(hg_handle_t h)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in;
+    rdma_req_t req;
+    rdma_resp_meta_t resp = { { RDMA_ERROR, 0, 0 }, { 0, 0, 0, 0, 0 } };
+    hg_bulk_t local_bulk;
+    uint64_t offset = 0, total = 0;
+    int decoded;
+
+    redisReply *header, *reply = NULL;
+    redisContext *c;
+    tier_entry_t *e;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    const struct hg_info* info = margo_get_info(h);
+    hg_addr_t client_addr = info->addr;
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    ret = margo_free_input(h, &in);
+    decoded = rdma_req_decode(mid, &in, &req);
+    if (decoded != 0 || rdma_chunk_decode(&in, &offset, &total) != 0) {
+        finish(h, &in, &req, decoded, &resp);
+        return;
+    }
+
+    if ((e = pin(req.key)) != NULL) {
+        hg_size_t len = offset < e->meta.size ? e->meta.size - offset : 0;
+        if (len > req.size)
+            len = req.size;
+        if (len) {
+            ret = transfer(mid, HG_BULK_PUSH, client_addr,
+                    req.bulk, offset, e->bulk, offset, len);
+            assert(ret == HG_SUCCESS);
+        }
+        resp.meta = e->meta;
+        tier_unpin(&tier, e);
+        resp.resp.status = RDMA_OK;
+        resp.resp.flags = RDMA_HAS_METADATA;
+        resp.resp.value = len;
+        finish(h, &in, &req, decoded, &resp);
+        return;
+    }
+
+    c = redis_acquire();
+    header = redisCommand(c, "GETRANGE key:%s 0 %d", req.key, (int)META_SIZE - 1);
+    if (read_meta(header, &resp.meta) == 0) {
+        // a value that shrank since the first chunk has less, or nothing,
+        // at this offset, its metadata tells the client to start over
+        hg_size_t len = offset < resp.meta.size ? resp.meta.size - offset : 0;
+        if (len > req.size)
+            len = req.size;
+
+        if (len && (resp.meta.reserved & META_CHUNKED)) {
+            unsigned long long start = offset % RDMA_CHUNK_SIZE;
+            if (start + len > RDMA_CHUNK_SIZE)
+                len = RDMA_CHUNK_SIZE - start;
+            reply = redisCommand(c, "GETRANGE " CHUNK_KEY " %llu %llu", req.key, resp.meta.timestamp,
+                    (unsigned long long)(offset / RDMA_CHUNK_SIZE), start, start + len - 1);
+        } else if (len) {
+            reply = redisCommand(c, "GETRANGE key:%s %llu %llu", req.key,
+                    (unsigned long long)(META_SIZE + offset),
+                    (unsigned long long)(META_SIZE + offset + len - 1));
+        }
+
+        if (len == 0 || (reply && reply->type == REDIS_REPLY_STRING && reply->len == len)) {
+            if (len) {
+                void* data = reply->str;
+                ret = margo_bulk_create(mid, 1, &data, &len,
+                        HG_BULK_READ_ONLY, &local_bulk);
+                assert(ret == HG_SUCCESS);
+
+                ret = transfer(mid, HG_BULK_PUSH, client_addr,
+                        req.bulk, offset, local_bulk, 0, len);
+                assert(ret == HG_SUCCESS);
+
+                ret = margo_bulk_free(local_bulk);
+                assert(ret == HG_SUCCESS);
+            }
+            resp.resp.status = RDMA_OK;
+            resp.resp.flags = RDMA_HAS_METADATA;
+            resp.resp.value = len;
+        }
+        freeReplyObject(reply);
+    } else if (header && header->type == REDIS_REPLY_STRING) {
+        resp.resp.status = RDMA_NOT_FOUND;
+    }
+    redis_release(c);
+    freeReplyObject(header);
+
+    finish(h, &in, &req, decoded, &resp);
+}
+
+// Values outlive a restart of the server in redis, which serves them again
+// right away. A snapshot writes the values still queued in the tier to
+// redis and has redis save its dataset in the background, for them to
+// outlive a restart of redis too.
+static void snapshot(hg_handle_t h)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in;
+    rdma_req_t req;
+    rdma_resp_meta_t resp = { { RDMA_ERROR, 0, 0 }, { 0, 0, 0, 0, 0 } };
+    int decoded;
+
+    redisReply *save, *size;
+    redisContext *c;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    ret = margo_destroy(h);
+    decoded = rdma_req_decode(mid, &in, &req);
+    // writes still waiting for redis fail the snapshot
+    if (decoded == 0 && (!write_behind || tier_sync(&tier) == 0)) {
+        // a save already running is followed by this one
+        c = redis_acquire();
+        redisAppendCommand(c, "BGSAVE SCHEDULE");
+        redisAppendCommand(c, "DBSIZE");
+        save = size = NULL;
+        redisGetReply(c, (void**)&save);
+        redisGetReply(c, (void**)&size);
+        if (save && save->type == REDIS_REPLY_STATUS && size && size->type == REDIS_REPLY_INTEGER) {
+            resp.resp.status = RDMA_OK;
+            resp.resp.value = size->integer;
+        } else {
+            printf("Error: snapshot failed: %s\n", save && save->type == REDIS_REPLY_ERROR ? save->str : c->errstr);
+        }
+        freeReplyObject(save);
+        freeReplyObject(size);
+        redis_release(c);
+    }
+
+    finish(h, &in, &req, decoded, &resp);
+}
+
+// metrics snapshot of the server, see protocol.h
+static void server_stats(hg_handle_t h)
+{
+    hg_return_t ret;
+
+    rdma_msg_t in, out;
+    rdma_req_t req;
+    rdma_resp_t resp = { RDMA_OK, 0, RPC_COUNT };
+    rdma_stats_t stats = { 0 };
+    rdma_rpc_stats_t rpc;
+    ABT_pool pool;
+    size_t queued = 0;
+    char* p;
+
+    margo_instance_id mid = margo_hg_handle_get_instance(h);
+
+    ret = margo_get_input(h, &in);
     assert(ret == HG_SUCCESS);
 
-    freeReplyObject(reply);
+    out.size = sizeof(resp) + sizeof(stats) + RPC_COUNT * sizeof(rpc);
+    out.data = malloc(out.size);
+    if (rdma_req_decode(mid, &in, &req) != 0 || out.data == NULL) {
+        resp.status = RDMA_ERROR;
+        resp.value = 0;
+        free(out.data);
+        rdma_resp_wrap(&resp, &out);
+        ret = margo_respond(h, &out);
+        assert(ret == HG_SUCCESS);
+        margo_free_input(h, &in);
+        margo_destroy(h);
+        return;
+    }
+    rdma_req_free(&req);
+
+    stats.uptime = (now_ns() - started) / 1e9;
+    if (tier_enabled)
+        tier_usage(&tier, &stats);
+    stats.active = __atomic_load_n(&active, __ATOMIC_RELAXED);
+    // handlers waiting for an execution stream
+    if (margo_get_handler_pool(mid, &pool) == 0)
+        ABT_pool_get_size(pool, &queued);
+    stats.queued = (uint32_t)queued;
+
+    p = out.data;
+    memcpy(p, &resp, sizeof(resp));
+    p += sizeof(resp);
+    memcpy(p, &stats, sizeof(stats));
+    p += sizeof(stats);
+    for (int i = 0; i < RPC_COUNT; i++) {
+        rpc_counters_t* c = &counters[i];
+        memset(&rpc, 0, sizeof(rpc));
+        strncpy(rpc.name, c->name, sizeof(rpc.name));
+        rpc.calls = __atomic_load_n(&c->calls, __ATOMIC_RELAXED);
+        rpc.errors = __atomic_load_n(&c->errors, __ATOMIC_RELAXED);
+        rpc.bytes_in = __atomic_load_n(&c->bytes_in, __ATOMIC_RELAXED);
+        rpc.bytes_out = __atomic_load_n(&c->bytes_out, __ATOMIC_RELAXED);
+        rpc.latency = __atomic_load_n(&c->latency, __ATOMIC_RELAXED);
+        rpc.max_latency = __atomic_load_n(&c->max_latency, __ATOMIC_RELAXED);
+        for (int b = 0; b < RDMA_LATENCY_BUCKETS; b++)
+            rpc.buckets[b] = __atomic_load_n(&c->buckets[b], __ATOMIC_RELAXED);
+        memcpy(p, &rpc, sizeof(rpc));
+        p += sizeof(rpc);
+    }
+
+    ret = margo_respond(h, &out);
+    assert(ret == HG_SUCCESS);
+    free(out.data);
 
+    ret = margo_free_input(h, &in);
+    assert(ret == HG_SUCCESS);
+    ret = margo_destroy(h);
+    assert(ret == HG_SUCCESS);
 }
 
-DEFINE_MARGO_RPC_HANDLER(set)
-DEFINE_MARGO_RPC_HANDLER(get)
+DEFINE_MARGO_RPC_HANDLER(set_timed)
+DEFINE_MARGO_RPC_HANDLER(get_timed)
+DEFINE_MARGO_RPC_HANDLER(get_size_timed)
+DEFINE_MARGO_RPC_HANDLER(stat_key_timed)
+DEFINE_MARGO_RPC_HANDLER(exists_timed)
+DEFINE_MARGO_RPC_HANDLER(delete_timed)
+DEFINE_MARGO_RPC_HANDLER(set_many_timed)
+DEFINE_MARGO_RPC_HANDLER(get_many_timed)
+DEFINE_MARGO_RPC_HANDLER(exists_many_timed)
+DEFINE_MARGO_RPC_HANDLER(delete_many_timed)
+DEFINE_MARGO_RPC_HANDLER(set_chunk_timed)
+DEFINE_MARGO_RPC_HANDLER(get_chunk_timed)
+DEFINE_MARGO_RPC_HANDLER(snapshot_timed)
+DEFINE_MARGO_RPC_HANDLER(server_stats)
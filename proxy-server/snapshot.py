@@ -0,0 +1,152 @@
+"""Snapshots of the values held by the RDMA provider.
+
+A snapshot is a single file holding every value of the store and a key
+index at its end::
+
+    header | value 0 | value 1 ... | index
+
+where the header is :data:`HEADER` (magic, format, number of keys, offset
+of the index, creation time) padded to a page, values start on an
+`ALIGNMENT` byte boundary and the index holds one :data:`ENTRY` (key
+length, reserved, flags, timestamp, version, size, offset of the value)
+followed by the key for each value.
+
+:func:`write()` lays the file out from the sizes of the values, then copies
+them in parallel with ``pwrite``, which releases the GIL, and renames the
+file into place once it is complete. :func:`load()` maps a snapshot and
+reads its index only, the values are paged in from the file as they are
+read.
+"""
+from __future__ import annotations
+
+import logging
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import NamedTuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PSSNAP\0\0"
+FORMAT = 1
+
+HEADER = struct.Struct("<8sIIQQd")
+ENTRY = struct.Struct("<HHIdQQQ")
+
+ALIGNMENT = 64
+PAGE = 4096
+
+# bytes copied by one task of the writers
+PIECE = 64 * 1024**2
+
+
+class Entry(NamedTuple):
+    """Value of a snapshot."""
+
+    key: str
+    offset: int
+    size: int
+    timestamp: float
+    version: int
+    flags: int
+
+
+def write(path: str, items: list[tuple[str, Any]], workers: int = 8) -> int:
+    """Write the values of `items` to a snapshot at `path`.
+
+    Args:
+        path (str): file of the snapshot, replaced once the new one is
+            complete.
+        items (list): (key, item) pairs, items having the ``array``,
+            ``size``, ``timestamp``, ``version`` and ``flags`` of a value.
+            Their values must not change while they are written.
+        workers (int): threads copying the values (default: 8).
+
+    Returns:
+        size of the snapshot in bytes.
+    """
+    start = time.perf_counter()
+    offsets = []
+    index = bytearray()
+    offset = PAGE
+    for key, item in items:
+        name = key.encode()
+        index += ENTRY.pack(len(name), 0, item.flags, item.timestamp, item.version, item.size, offset)
+        index += name
+        offsets.append(offset)
+        offset = _aligned(offset + item.size)
+    size = offset + len(index)
+
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.ftruncate(fd, size)
+        # values larger than a piece are split, so that the writers share
+        # the work of a few large values too
+        pieces = [
+            (item, at, position)
+            for (_, item), at in zip(items, offsets)
+            for position in range(0, max(item.size, 1), PIECE)
+        ]
+
+        def copy(piece: tuple[Any, int, int]) -> None:
+            item, at, position = piece
+            view = memoryview(item.array)[position : position + PIECE]
+            while view.nbytes:
+                written = os.pwrite(fd, view, at + position)
+                view = view[written:]
+                position += written
+
+        with ThreadPoolExecutor(max(workers, 1)) as pool:
+            list(pool.map(copy, pieces))
+        os.pwrite(fd, index, offset)
+        os.pwrite(fd, HEADER.pack(MAGIC, FORMAT, 0, len(items), offset, time.time()), 0)
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp)
+        raise
+    os.close(fd)
+    os.replace(tmp, path)
+    logger.info(
+        f"Wrote {len(items)} values ({size} bytes) to {path} in {time.perf_counter() - start:.2f}s",
+    )
+    return size
+
+
+def load(path: str) -> tuple[mmap.mmap, np.ndarray, list[Entry]]:
+    """Map the snapshot at `path` and read its index.
+
+    Returns:
+        the read-only mapping of the file, a ``uint8`` array over it and
+        the entries of its values.
+
+    Raises:
+        ValueError:
+            if the file is not a snapshot of a known format.
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is not a snapshot")
+    magic, version, _, count, offset, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT:
+        raise ValueError(f"{path} is not a snapshot of format {FORMAT}")
+
+    entries = []
+    for _ in range(count):
+        key_length, _, flags, timestamp, version, size, at = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        key = data[offset : offset + key_length].decode()
+        offset += key_length
+        entries.append(Entry(key, at, size, timestamp, version, flags))
+    return data, np.frombuffer(data, dtype=np.uint8), entries
+
+
+def _aligned(offset: int) -> int:
+    return offset + (-offset % ALIGNMENT)
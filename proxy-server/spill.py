@@ -0,0 +1,354 @@
+"""Memory-mapped spill tier of the RDMA provider.
+
+Values evicted from the memory of a :class:`SlabStore <storage.SlabStore>`
+are appended to segment files on local disk, preferably NVMe, instead of
+being dropped. Every segment is a fixed size file mapped in memory and
+filled with records, each starting on an `ALIGNMENT` byte boundary::
+
+    key length u16 | reserved u16 | flags u32 | timestamp f64 | version u64
+    | size u64
+    key | pad | value
+
+with the value aligned as well. An index in memory maps every key to the
+segment and offset of its record. Records are never rewritten: a key
+spilled again, deleted or promoted back to memory leaves a dead record
+behind, and a segment whose records are all dead is removed once no
+transfer reads from it. Segments are written one after the other, and
+when the tier would grow over its limit the oldest one is dropped with the
+values still in it.
+
+A segment is registered with the engine the first time a value is read
+from it, gets then push straight from the mapped pages: the kernel reads
+them from disk as the transport reads them, without a copy into a buffer.
+
+A :mod:`snapshot` is served the same way once adopted with
+:func:`SpillStore.adopt()`, as a read-only segment that the store does not
+own: its file is kept, and it is not counted against the limit.
+"""
+from __future__ import annotations
+
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+from contextlib import suppress
+from typing import Any
+from typing import Container
+from typing import Iterator
+
+import numpy as np
+import pymargo.bulk as bulk
+
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct("<HHIdQQ")
+
+ALIGNMENT = 64
+
+
+class Segment:
+    """Segment file mapped in memory, filled from its start.
+
+    A segment over the existing `mapping` of a file, a snapshot, is full
+    and does not own the file.
+    """
+
+    __slots__ = ("path", "size", "map", "array", "engine", "_bulk", "end", "keys", "pins", "owned")
+
+    def __init__(self, engine: Any, path: str, size: int, mapping: mmap.mmap | None = None) -> None:
+        self.owned = mapping is None
+        if mapping is None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, size)
+                mapping = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        self.path = path
+        self.size = size
+        self.map = mapping
+        self.array = np.frombuffer(self.map, dtype=np.uint8)
+        self.engine = engine
+        self._bulk = None
+        # bytes written, keys whose record is live, transfers reading
+        self.end = 0 if self.owned else size
+        self.keys: set[str] = set()
+        self.pins = 0
+
+    @property
+    def bulk(self) -> Any:
+        """Bulk handle of the whole segment, registered on first use."""
+        if self._bulk is None:
+            self._bulk = self.engine.create_bulk(self.array, bulk.read_only)
+        return self._bulk
+
+    def close(self) -> None:
+        """Unmap the segment and remove its file if owned."""
+        self._bulk = None
+        self.array = None
+        with suppress(BufferError):
+            self.map.close()
+        if self.owned:
+            with suppress(FileNotFoundError):
+                os.unlink(self.path)
+
+
+class SpillEntry:
+    """Location and metadata of a spilled value.
+
+    Has the attributes of an :class:`Item <storage.Item>` the provider reads
+    a value with.
+    """
+
+    __slots__ = ("segment", "offset", "size", "timestamp", "version", "flags", "hits", "pins")
+
+    def __init__(
+        self,
+        segment: Segment,
+        offset: int,
+        size: int,
+        timestamp: float,
+        version: int,
+        flags: int,
+    ) -> None:
+        self.segment = segment
+        self.offset = offset
+        self.size = size
+        self.timestamp = timestamp
+        self.version = version
+        self.flags = flags
+        self.hits = 0
+        self.pins = 0
+
+    @property
+    def bulk(self) -> Any:
+        """Bulk handle of the segment holding the value, at :attr:`offset`."""
+        return self.segment.bulk
+
+    @property
+    def array(self) -> np.ndarray:
+        """``uint8`` view of the value in the mapped segment."""
+        return self.segment.array[self.offset : self.offset + self.size]
+
+
+class SpillStore:
+    """Log-structured store of the values spilled by a :class:`SlabStore`.
+
+    The store owns the files of its directory, a directory left by an
+    earlier run is emptied. Without a directory nothing is spilled, the
+    store only serves the snapshots it adopted.
+    """
+
+    def __init__(
+        self,
+        engine: Any,
+        path: str | None,
+        *,
+        limit: int = 64 * 1024**3,
+        segment_size: int = 1024**3,
+    ) -> None:
+        """Init SpillStore.
+
+        Args:
+            engine (Engine): margo engine the segments are registered with.
+            path (str): directory of the segment files, None to spill
+                nothing.
+            limit (int): cap in bytes on the segment files (default: 64 GB).
+            segment_size (int): size of a segment file, the largest record
+                it can hold (default: 1 GB).
+
+        Raises:
+            ValueError:
+                if `segment_size > limit`.
+        """
+        if segment_size > limit:
+            raise ValueError("segment_size must not be larger than limit")
+        self.engine = engine
+        self.path = path
+        self.limit = limit
+        self.segment_size = segment_size
+
+        self.allocated = 0
+        self.used = 0
+        self.evictions = 0
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                if name.endswith(".spill"):
+                    os.unlink(os.path.join(path, name))
+
+        self._index: dict[str, SpillEntry] = {}
+        # oldest first, the last one is written to
+        self._segments: deque[Segment] = deque()
+        self._adopted: list[Segment] = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over a snapshot of the spilled keys."""
+        with self._lock:
+            return iter(list(self._index))
+
+    def peek(self, key: str) -> SpillEntry | None:
+        """Return the entry of `key` without counting an access."""
+        return self._index.get(key)
+
+    def pin(self, key: str) -> SpillEntry | None:
+        """Return the entry of `key`, counting an access, and pin it.
+
+        The segment of a pinned entry is kept, and registered, until the
+        entry is given back with :func:`unpin()`.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            # registered once, before the first transfer reads from it
+            entry.segment.bulk
+            entry.hits += 1
+            entry.pins += 1
+            entry.segment.pins += 1
+            return entry
+
+    def pin_all(self) -> list[tuple[str, SpillEntry]]:
+        """Pin every entry, without counting an access, for a snapshot."""
+        with self._lock:
+            entries = list(self._index.items())
+            for _, entry in entries:
+                entry.pins += 1
+                entry.segment.pins += 1
+            return entries
+
+    def adopt(self, path: str, exclude: Container[str] = ()) -> int:
+        """Serve the values of the snapshot at `path` from its file.
+
+        Keys already in the tier or in `exclude` keep their value.
+
+        Returns:
+            number of values adopted.
+
+        Raises:
+            ValueError:
+                if the file is not a snapshot.
+        """
+        data, _, entries = snapshot.load(path)
+        segment = Segment(self.engine, path, len(data), data)
+        with self._lock:
+            for e in entries:
+                if e.key in self._index or e.key in exclude:
+                    continue
+                self._index[e.key] = SpillEntry(segment, e.offset, e.size, e.timestamp, e.version, e.flags)
+                segment.keys.add(e.key)
+                self.used += e.size
+            self._adopted.append(segment)
+            self._collect(segment)
+        logger.info(f"Serving {len(segment.keys)} values from snapshot {path}")
+        return len(segment.keys)
+
+    def unpin(self, entry: SpillEntry) -> None:
+        """Release an entry returned by :func:`pin()`."""
+        with self._lock:
+            entry.pins -= 1
+            entry.segment.pins -= 1
+            self._collect(entry.segment)
+
+    def put(self, key: str, value: np.ndarray, timestamp: float, version: int, flags: int) -> bool:
+        """Append `value`, a ``uint8`` array, as the value of `key`.
+
+        Returns:
+            False if the value was not spilled, because it is larger than a
+            segment or the oldest segment is being read.
+        """
+        name = key.encode()
+        start = _aligned(RECORD.size + len(name))
+        length = start + _aligned(value.size)
+        if self.path is None or length > self.segment_size:
+            return False
+        with self._lock:
+            self._remove(key)
+            segment = self._room(length)
+            if segment is None:
+                return False
+            offset = segment.end
+            RECORD.pack_into(segment.map, offset, len(name), 0, flags, timestamp, version, value.size)
+            segment.map[offset + RECORD.size : offset + RECORD.size + len(name)] = name
+            segment.array[offset + start : offset + start + value.size] = value
+            segment.end += length
+            segment.keys.add(key)
+            self._index[key] = SpillEntry(segment, offset + start, value.size, timestamp, version, flags)
+            self.used += value.size
+        return True
+
+    def remove(self, key: str) -> SpillEntry | None:
+        """Drop `key` from the tier, returns its entry if it was spilled.
+
+        A pinned entry stays readable until it is unpinned.
+        """
+        with self._lock:
+            return self._remove(key)
+
+    def _remove(self, key: str) -> SpillEntry | None:
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            entry.segment.keys.discard(key)
+            self.used -= entry.size
+            self._collect(entry.segment)
+        return entry
+
+    def _collect(self, segment: Segment) -> None:
+        # remove a segment left with dead records only
+        if segment.keys or segment.pins or (self._segments and segment is self._segments[-1]):
+            return
+        if segment in self._segments:
+            self._segments.remove(segment)
+            self.allocated -= segment.size
+            segment.close()
+        elif segment in self._adopted:
+            self._adopted.remove(segment)
+            segment.close()
+
+    def _room(self, length: int) -> Segment | None:
+        # the segment to append length bytes to, starting a new one if needed
+        if self._segments and self._segments[-1].end + length <= self.segment_size:
+            return self._segments[-1]
+        while self.allocated + self.segment_size > self.limit:
+            oldest = self._segments[0]
+            if oldest.pins:
+                return None
+            self._drop(oldest)
+        full = self._segments[-1] if self._segments else None
+        self._next += 1
+        segment = Segment(self.engine, os.path.join(self.path, f"segment_{self._next:06d}.spill"), self.segment_size)
+        self._segments.append(segment)
+        self.allocated += segment.size
+        if full is not None:
+            self._collect(full)
+        logger.debug(f"Started spill segment {segment.path}")
+        return segment
+
+    def _drop(self, segment: Segment) -> None:
+        # evict the values of the oldest segment
+        for key in segment.keys:
+            entry = self._index.pop(key)
+            self.used -= entry.size
+            self.evictions += 1
+        logger.debug(f"Dropped spill segment {segment.path} with {len(segment.keys)} values")
+        segment.keys.clear()
+        self._segments.remove(segment)
+        self.allocated -= segment.size
+        segment.close()
+
+
+def _aligned(offset: int) -> int:
+    return offset + (-offset % ALIGNMENT)
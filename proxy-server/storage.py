@@ -0,0 +1,537 @@
+"""Slab-allocated, memory-capped storage engine of the RDMA provider."""
+from __future__ import annotations
+
+import logging
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import Any
+from typing import Iterator
+
+import numpy as np
+import pymargo.bulk as bulk
+
+import snapshot
+from spill import SpillEntry
+from spill import SpillStore
+
+logger = logging.getLogger(__name__)
+
+LRU = "lru"
+LFU = "lfu"
+
+
+class Slab:
+    """Registered arena cut into chunks of a single size class.
+
+    Values larger than the largest size class get a slab of their own
+    holding exactly one chunk.
+    """
+
+    __slots__ = ("array", "bulk", "chunk", "free", "used")
+
+    def __init__(self, engine: Any, size: int, chunk: int) -> None:
+        self.array = np.empty(size, dtype=np.uint8)
+        self.bulk = engine.create_bulk(self.array, bulk.read_write)
+        self.chunk = chunk
+        self.free = list(range(size - chunk, -1, -chunk))
+        self.used = 0
+
+    @property
+    def size(self) -> int:
+        return self.array.size
+
+
+class Item:
+    """Location, metadata and access statistics of a stored value."""
+
+    __slots__ = (
+        "slab", "offset", "size", "timestamp", "version", "flags", "hits", "tick",
+        "pins", "dead",
+    )
+
+    def __init__(
+        self,
+        slab: Slab,
+        offset: int,
+        size: int,
+        timestamp: float = 0.0,
+        flags: int = 0,
+    ) -> None:
+        self.slab = slab
+        self.offset = offset
+        self.size = size
+        self.timestamp = timestamp
+        self.version = 0
+        self.flags = flags
+        self.hits = 0
+        self.tick = 0
+        # transfers reading the value, its chunk is freed once the last one
+        # is done if it was deleted meanwhile
+        self.pins = 0
+        self.dead = False
+
+    @property
+    def bulk(self) -> Any:
+        """Bulk handle of the slab holding the value, at :attr:`offset`."""
+        return self.slab.bulk
+
+    @property
+    def array(self) -> np.ndarray:
+        """``uint8`` view of the value inside its slab."""
+        return self.slab.array[self.offset : self.offset + self.size]
+
+
+class SlabStore:
+    """Key-value storage in pre-registered slab arenas.
+
+    Values are stored in chunks of power-of-two size classes between
+    `min_class` and `max_class`, carved out of `slab_size` byte arenas that
+    are registered with the engine once. A get or set is then a single bulk
+    transfer to or from the slab at the offset of the value, without any
+    per-request allocation or registration. Values larger than `max_class`
+    get a dedicated arena.
+
+    The memory of all arenas is kept under `limit` bytes. When a value does
+    not fit, the store first reuses the chunk of a victim of the same size
+    class, then evicts victims of any class until an arena can be dropped.
+    Victims are chosen by `policy`: least recently used (``"lru"``), or
+    least frequently used among the `samples` least recently used items of
+    a class (``"lfu"``, approximated as Redis does).
+
+    New values are written with :func:`reserve()` and made visible with
+    :func:`commit()` once their transfer completed, so that a failed set
+    leaves the previous value in place.
+
+    The store is safe to use from several handler threads. A value read by
+    a transfer is held with :func:`pin()` until :func:`unpin()`: it may be
+    replaced or deleted meanwhile, but its chunk is not reused before the
+    transfer is done, and it is never chosen for eviction.
+
+    With a `spill` tier, evicted values are appended to its memory-mapped
+    segments instead of being dropped. They are written out without holding
+    the lock of the store, which only unlinks them, and stay readable from
+    their slab until they are. :func:`pin()` then returns the
+    :class:`SpillEntry <spill.SpillEntry>` of a spilled key, which is read
+    from the mapped pages, and copies a value read `promote_hits` times
+    while spilled back into a slab, if the tier has a directory that the
+    values evicted to make room can be spilled to.
+
+    :func:`snapshot()` writes every value to a :mod:`snapshot` file, which
+    :func:`restore()` serves from in a new store, through the spill tier,
+    without reading it first.
+    """
+
+    def __init__(
+        self,
+        engine: Any,
+        *,
+        limit: int = 1024**3,
+        policy: str = LRU,
+        slab_size: int = 4 * 1024**2,
+        min_class: int = 64,
+        max_class: int = 1024**2,
+        samples: int = 16,
+        spill: SpillStore | None = None,
+        promote_hits: int = 2,
+    ) -> None:
+        """Init SlabStore.
+
+        Args:
+            engine (Engine): margo engine used to register the arenas.
+            limit (int): cap in bytes on the arena memory (default: 1 GB).
+            policy (str): eviction policy, ``"lru"`` or ``"lfu"``
+                (default: ``"lru"``).
+            slab_size (int): size of the arenas in bytes (default: 4 MB).
+            min_class (int): smallest chunk size in bytes (default: 64).
+            max_class (int): largest chunk size in bytes, larger values get
+                a dedicated arena (default: 1 MB).
+            samples (int): number of items compared to pick an LFU victim
+                (default: 16).
+            spill (SpillStore): tier evicted values are spilled to, or None
+                to drop them (default: None).
+            promote_hits (int): reads of a spilled value that bring it back
+                to memory (default: 2).
+
+        Raises:
+            ValueError:
+                if `policy` is unknown or `max_class > slab_size`.
+        """
+        if policy not in (LRU, LFU):
+            raise ValueError(f"Unknown eviction policy '{policy}'")
+        if max_class > slab_size:
+            raise ValueError("max_class must not be larger than slab_size")
+
+        self.engine = engine
+        self.limit = limit
+        self.policy = policy
+        self.slab_size = slab_size
+        self.min_class = min_class
+        self.max_class = max_class
+        self.samples = samples
+        self.spill = spill
+        self.promote_hits = promote_hits
+
+        self.allocated = 0
+        self.used = 0
+        self.evictions = 0
+        self.spilled = 0
+        self.promoted = 0
+
+        self._items: dict[str, Item] = {}
+        # items of each size class in access order, oldest first
+        self._order: dict[int, OrderedDict[str, Item]] = {}
+        # slabs of each size class with at least one free chunk
+        self._partial: dict[int, list[Slab]] = {}
+        self._tick = 0
+        self._lock = threading.RLock()
+        # taken before _lock, by one eviction spilling at a time
+        self._spill_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items) + (len(self.spill) if self.spill is not None else 0)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items or (self.spill is not None and key in self.spill)
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over a snapshot of the stored keys, spilled ones last."""
+        with self._lock:
+            keys = list(self._items)
+            if self.spill is not None:
+                keys += self.spill.keys()
+            return iter(keys)
+
+    def size_class(self, size: int) -> int:
+        """Return the chunk size used for a value of `size` bytes."""
+        if size > self.max_class:
+            return size
+        return max(self.min_class, 1 << max(size - 1, 0).bit_length())
+
+    def peek(self, key: str) -> Item | SpillEntry | None:
+        """Return the item of `key` without counting an access."""
+        item = self._items.get(key)
+        if item is None and self.spill is not None:
+            return self.spill.peek(key)
+        return item
+
+    def get(self, key: str) -> Item | None:
+        """Return the item of `key` and count an access to it."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._touch(key, item)
+            return item
+
+    def pin(self, key: str) -> Item | SpillEntry | None:
+        """Return the item of `key`, counting an access, and pin it.
+
+        The item must be given back with :func:`unpin()` once its value has
+        been read.
+        """
+        with self._lock:
+            item = self.get(key)
+            if item is not None:
+                item.pins += 1
+                return item
+            if self.spill is None:
+                return None
+            entry = self.spill.pin(key)
+        # a promotion evicts values, only to a tier that can take them
+        if entry is not None and entry.hits >= self.promote_hits and self.spill.path is not None:
+            item = self._promote(key, entry)
+            if item is not None:
+                self.spill.unpin(entry)
+                return item
+        return entry
+
+    def unpin(self, item: Item | SpillEntry) -> None:
+        """Release an item returned by :func:`pin()`."""
+        if isinstance(item, SpillEntry):
+            self.spill.unpin(item)
+            return
+        with self._lock:
+            item.pins -= 1
+            if item.pins == 0 and item.dead:
+                self._free(item)
+
+    def reserve(self, size: int, timestamp: float = 0.0, flags: int = 0) -> Item:
+        """Allocate room for a value of `size` bytes.
+
+        The item is not visible until it is passed to :func:`commit()`, it
+        must be given back with :func:`abort()` if the value cannot be
+        written. `timestamp` and `flags` are kept as metadata of the value.
+
+        Raises:
+            MemoryError:
+                if the value cannot fit under the memory limit.
+        """
+        cls = self.size_class(size)
+        while True:
+            victims: list[tuple[str, Item]] = []
+            with self._lock:
+                slab = self._chunk_slab(cls, victims)
+                if slab is not None:
+                    offset = slab.free.pop()
+                    slab.used += 1
+                    if not slab.free and cls <= self.max_class:
+                        self._partial[cls].pop()
+                    return Item(slab, offset, size, timestamp, flags)
+            # the chunks of the victims are free once they are spilled
+            self._spill(victims)
+
+    def commit(self, key: str, item: Item) -> None:
+        """Make a reserved item the value of `key`, with the next version."""
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is None and self.spill is not None:
+                old = self.spill.remove(key)
+            item.version = 1
+            if old is not None:
+                item.version = old.version + 1
+                if not isinstance(old, SpillEntry):
+                    self._remove(key, old)
+            self._insert(key, item)
+
+    def abort(self, item: Item) -> None:
+        """Give back a reserved item that was not committed."""
+        with self._lock:
+            self._free(item)
+
+    def delete(self, key: str) -> bool:
+        """Delete the value of `key`, returns False if it did not exist."""
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return self.spill is not None and self.spill.remove(key) is not None
+            self._remove(key, item)
+            return True
+
+    def snapshot(self, path: str, workers: int = 8) -> int:
+        """Write every value to a snapshot at `path`.
+
+        The values are pinned while they are copied, the snapshot holds
+        them as they were when it started while sets and deletes go on, but
+        none of them is evicted meanwhile.
+
+        Args:
+            path (str): file of the snapshot.
+            workers (int): threads copying the values (default: 8).
+
+        Returns:
+            number of values written.
+        """
+        with self._lock:
+            items = list(self._items.items())
+            for _, item in items:
+                item.pins += 1
+            spilled = self.spill.pin_all() if self.spill is not None else []
+        try:
+            snapshot.write(path, items + spilled, workers)
+        finally:
+            for _, item in items:
+                self.unpin(item)
+            for _, entry in spilled:
+                self.spill.unpin(entry)
+        return len(items) + len(spilled)
+
+    def restore(self, path: str) -> int:
+        """Serve the values of the snapshot at `path`.
+
+        The values are read from the file, and promoted to memory when hot
+        as spilled values are, if the spill tier has a directory. Keys already stored keep their value.
+
+        Returns:
+            number of values restored.
+
+        Raises:
+            ValueError:
+                if the store has no spill tier or the file is not a
+                snapshot.
+        """
+        if self.spill is None:
+            raise ValueError("Restoring a snapshot needs a spill tier")
+        with self._lock:
+            return self.spill.adopt(path, exclude=self._items)
+
+    def _promote(self, key: str, entry: SpillEntry) -> Item | None:
+        # copy a spilled value back into a slab and return it pinned, None
+        # if it does not fit or was replaced meanwhile. The copy runs
+        # outside the lock, reading the pinned entry.
+        try:
+            item = self.reserve(entry.size, entry.timestamp, entry.flags)
+        except MemoryError:
+            return None
+        item.array[:] = entry.array
+        with self._lock:
+            if self.spill.peek(key) is not entry:
+                self._free(item)
+                return None
+            self.spill.remove(key)
+            item.version = entry.version
+            self._insert(key, item)
+            item.pins += 1
+            self.promoted += 1
+        logger.debug(f"Promoted key '{key}' ({item.size} bytes)")
+        return item
+
+    def _insert(self, key: str, item: Item) -> None:
+        self._items[key] = item
+        self._order.setdefault(self._order_class(item), OrderedDict())[key] = item
+        self.used += item.size
+        self._touch(key, item)
+
+    def _touch(self, key: str, item: Item) -> None:
+        self._tick += 1
+        item.tick = self._tick
+        item.hits += 1
+        if not item.dead:
+            self._order[self._order_class(item)].move_to_end(key)
+
+    def _remove(self, key: str, item: Item) -> None:
+        # unlink a committed item, the caller already popped it from _items
+        if item.dead:
+            # a victim being spilled, already unlinked
+            return
+        del self._order[self._order_class(item)][key]
+        self.used -= item.size
+        if item.pins:
+            # still being read, freed by the last unpin()
+            item.dead = True
+        else:
+            self._free(item)
+
+    def _order_class(self, item: Item) -> int:
+        # values in dedicated arenas share one access order, keyed 0
+        return item.slab.chunk if item.slab.chunk <= self.max_class else 0
+
+    def _free(self, item: Item) -> None:
+        slab = item.slab
+        slab.used -= 1
+        if slab.chunk > self.max_class:
+            # dedicated arenas are not reused
+            self.allocated -= slab.size
+            return
+        partial = self._partial.setdefault(slab.chunk, [])
+        if slab.used == 0 and any(other is not slab for other in partial):
+            # an empty arena goes back right away, unless it is the only one
+            # with free chunks in its class
+            if slab in partial:
+                partial.remove(slab)
+            self.allocated -= slab.size
+            return
+        if not slab.free:
+            partial.append(slab)
+        slab.free.append(item.offset)
+
+    def _chunk_slab(self, cls: int, victims: list[tuple[str, Item]]) -> Slab | None:
+        # return a slab of class cls with a free chunk, evicting if needed.
+        # None if victims to spill were added to victims instead, their
+        # chunks are not free before
+        if cls > self.max_class:
+            self._make_room(cls, None, victims)
+            return None if victims else self._new_slab(cls, cls)
+
+        partial = self._partial.setdefault(cls, [])
+        if partial:
+            return partial[-1]
+
+        if self.allocated + self.slab_size > self.limit:
+            # cheapest: take over the chunk of a victim of the same class
+            key = self._victim([cls])
+            if key is not None:
+                self._evict(key, victims)
+                return None if victims else partial[-1]
+
+        self._make_room(self.slab_size, cls, victims)
+        if victims:
+            return None
+        if partial:
+            return partial[-1]
+        slab = self._new_slab(self.slab_size, cls)
+        partial.append(slab)
+        return slab
+
+    def _make_room(self, size: int, cls: int | None, victims: list[tuple[str, Item]]) -> None:
+        # evict until size more bytes of arenas fit under the limit, a chunk
+        # of class cls is freed on the way, or a victim is to be spilled
+        if size > self.limit:
+            raise MemoryError(f"{size} byte value does not fit in a {self.limit} byte store")
+        if self.allocated + size > self.limit:
+            # the arenas emptied by the victims spilled since the last call
+            self._release_empty()
+        while self.allocated + size > self.limit:
+            key = self._victim(list(self._order))
+            if key is None:
+                raise MemoryError(f"No room for a {size} byte value")
+            self._evict(key, victims)
+            if victims or (cls is not None and self._partial.get(cls)):
+                return
+            self._release_empty()
+
+    def _new_slab(self, size: int, cls: int) -> Slab:
+        slab = Slab(self.engine, size, cls)
+        self.allocated += size
+        logger.debug(f"Allocated {size} byte slab for {cls} byte chunks")
+        return slab
+
+    def _release_empty(self) -> None:
+        # drop the arenas whose chunks are all free
+        for partial in self._partial.values():
+            for slab in [s for s in partial if s.used == 0]:
+                partial.remove(slab)
+                self.allocated -= slab.size
+
+    def _victim(self, classes: list[int]) -> str | None:
+        best, best_rank = None, None
+        for cls in classes:
+            order = self._order.get(cls)
+            if not order:
+                continue
+            # pinned items are skipped, evicting them would not free memory
+            unpinned = ((k, i) for k, i in order.items() if not i.pins)
+            if self.policy == LRU:
+                candidates = islice(unpinned, 1)
+            else:
+                candidates = islice(unpinned, self.samples)
+            for key, item in candidates:
+                rank = (item.tick,) if self.policy == LRU else (item.hits, item.tick)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = key, rank
+        return best
+
+    def _evict(self, key: str, victims: list[tuple[str, Item]]) -> None:
+        # drop the value of key, or unlink it and add it to victims to be
+        # spilled once the lock is released. It stays readable meanwhile,
+        # pinned for its chunk not to be reused
+        item = self._items[key]
+        self.evictions += 1
+        if self.spill is None or self.spill.path is None:
+            del self._items[key]
+            self._remove(key, item)
+            logger.debug(f"Evicted key '{key}' ({item.size} bytes)")
+            return
+        item.pins += 1
+        self._remove(key, item)
+        victims.append((key, item))
+
+    def _spill(self, victims: list[tuple[str, Item]]) -> None:
+        # write the victims of _evict() to the spill tier, without the lock
+        # of the store, then drop them from memory
+        for key, item in victims:
+            with self._spill_lock:
+                spilled = self.spill.put(key, item.array, item.timestamp, item.version, item.flags)
+                with self._lock:
+                    if self._items.get(key) is item:
+                        del self._items[key]
+                    elif spilled:
+                        # replaced or deleted while it was written
+                        self.spill.remove(key)
+                        spilled = False
+                    if spilled:
+                        self.spilled += 1
+                    self.unpin(item)
+            if spilled:
+                logger.debug(f"Spilled key '{key}' ({item.size} bytes)")
+            else:
+                logger.debug(f"Evicted key '{key}' ({item.size} bytes)")
@@ -0,0 +1,353 @@
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include "tier.h"
+
+#define TIER_BUCKETS 1024
+
+// FNV-1a
+static size_t hash(const char* key)
+{
+    uint64_t h = 14695981039346656037ULL;
+
+    for (; *key; key++) {
+        h ^= (unsigned char)*key;
+        h *= 1099511628211ULL;
+    }
+    return (size_t)h;
+}
+
+int tier_init(tier_t* tier, size_t limit, size_t max_dirty)
+{
+    memset(tier, 0, sizeof(*tier));
+    tier->buckets = calloc(TIER_BUCKETS, sizeof(tier_entry_t*));
+    if (!tier->buckets)
+        return -1;
+    tier->nbuckets = TIER_BUCKETS;
+    tier->limit = limit;
+    tier->max_dirty = max_dirty ? max_dirty : 1;
+    // versions handed out by dirty puts start above those counted by redis
+    // INCR and above those of an earlier run, unless it put more than 2^20
+    // values a second
+    tier->next_version = (uint64_t)time(NULL) << 20;
+    ABT_mutex_create(&tier->mutex);
+    ABT_cond_create(&tier->changed);
+    return 0;
+}
+
+static tier_entry_t* find(tier_t* tier, const char* key)
+{
+    tier_entry_t* e = tier->buckets[hash(key) & (tier->nbuckets - 1)];
+
+    while (e && strcmp(e->key, key) != 0)
+        e = e->next;
+    return e;
+}
+
+static void grow(tier_t* tier)
+{
+    size_t n = tier->nbuckets * 2;
+    tier_entry_t** buckets = calloc(n, sizeof(tier_entry_t*));
+
+    // a full table only gets slower
+    if (!buckets)
+        return;
+    for (size_t i = 0; i < tier->nbuckets; i++) {
+        tier_entry_t* e = tier->buckets[i];
+        while (e) {
+            tier_entry_t* next = e->next;
+            size_t b = hash(e->key) & (n - 1);
+            e->next = buckets[b];
+            buckets[b] = e;
+            e = next;
+        }
+    }
+    free(tier->buckets);
+    tier->buckets = buckets;
+    tier->nbuckets = n;
+}
+
+static void lru_remove(tier_t* tier, tier_entry_t* e)
+{
+    if (e->lru_prev)
+        e->lru_prev->lru_next = e->lru_next;
+    else
+        tier->lru_head = e->lru_next;
+    if (e->lru_next)
+        e->lru_next->lru_prev = e->lru_prev;
+    else
+        tier->lru_tail = e->lru_prev;
+    e->lru_prev = e->lru_next = NULL;
+}
+
+static void lru_push(tier_t* tier, tier_entry_t* e)
+{
+    e->lru_prev = NULL;
+    e->lru_next = tier->lru_head;
+    if (tier->lru_head)
+        tier->lru_head->lru_prev = e;
+    else
+        tier->lru_tail = e;
+    tier->lru_head = e;
+}
+
+static void release(tier_t* tier, tier_entry_t* e)
+{
+    if (--e->refs > 0)
+        return;
+    tier->used -= e->cmd_size;
+    if (e->bulk != HG_BULK_NULL)
+        margo_bulk_free(e->bulk);
+    free(e->cmd);
+    free(e->key);
+    free(e);
+}
+
+// take e out of the table, it stays alive while referenced elsewhere
+static void unlink_entry(tier_t* tier, tier_entry_t* e)
+{
+    tier_entry_t** p = &tier->buckets[hash(e->key) & (tier->nbuckets - 1)];
+
+    while (*p != e)
+        p = &(*p)->next;
+    *p = e->next;
+    lru_remove(tier, e);
+    e->linked = 0;
+    tier->count--;
+    release(tier, e);
+}
+
+// evict clean entries nobody uses until size more bytes fit
+static int make_room(tier_t* tier, size_t size)
+{
+    tier_entry_t* e = tier->lru_tail;
+
+    while (tier->used + size > tier->limit && e) {
+        tier_entry_t* prev = e->lru_prev;
+        if (e->state == TIER_CLEAN && e->refs == 1) {
+            unlink_entry(tier, e);
+            tier->evictions++;
+        }
+        e = prev;
+    }
+    return tier->used + size > tier->limit ? -1 : 0;
+}
+
+int tier_put(tier_t* tier, const char* key, rdma_meta_t* meta, char* cmd, size_t cmd_size,
+        char* value, hg_bulk_t bulk, int dirty)
+{
+    tier_entry_t *e, *old;
+    char* name;
+
+    if (cmd_size > tier->limit)
+        return -1;
+    e = calloc(1, sizeof(*e));
+    name = strdup(key);
+    if (!e || !name) {
+        free(e);
+        free(name);
+        return -1;
+    }
+
+    ABT_mutex_lock(tier->mutex);
+    old = find(tier, key);
+    if (dirty) {
+        // the old entry goes anyway, its room counts for the new one
+        if (old && old->state == TIER_CLEAN) {
+            unlink_entry(tier, old);
+            old = NULL;
+        }
+        while (!tier->failing && (tier->dirty >= tier->max_dirty || make_room(tier, cmd_size) != 0))
+            ABT_cond_wait(tier->changed, tier->mutex);
+        if (tier->failing) {
+            // redis does not take the writes, the set is not acknowledged
+            ABT_mutex_unlock(tier->mutex);
+            free(e);
+            free(name);
+            return -1;
+        }
+        old = find(tier, key);
+        meta->version = old ? old->meta.version + 1 : tier->next_version++;
+        memcpy(value, meta, sizeof(*meta));
+    } else if ((old && old->meta.version >= meta->version) || make_room(tier, cmd_size) != 0) {
+        // a newer value was put meanwhile, or there is no room to spare
+        ABT_mutex_unlock(tier->mutex);
+        free(e);
+        free(name);
+        return -1;
+    }
+    // a replaced entry still queued is skipped by the flusher
+    if (old)
+        unlink_entry(tier, old);
+
+    e->key = name;
+    e->meta = *meta;
+    e->cmd = cmd;
+    e->cmd_size = cmd_size;
+    e->value = value;
+    e->bulk = bulk;
+    e->state = dirty ? TIER_DIRTY : TIER_CLEAN;
+    e->refs = dirty ? 2 : 1;
+    e->linked = 1;
+
+    if (tier->count >= tier->nbuckets)
+        grow(tier);
+    size_t b = hash(key) & (tier->nbuckets - 1);
+    e->next = tier->buckets[b];
+    tier->buckets[b] = e;
+    tier->count++;
+    tier->used += cmd_size;
+    lru_push(tier, e);
+
+    if (dirty) {
+        if (tier->queue_tail)
+            tier->queue_tail->queue_next = e;
+        else
+            tier->queue_head = e;
+        tier->queue_tail = e;
+        tier->dirty++;
+        ABT_cond_broadcast(tier->changed);
+    }
+    ABT_mutex_unlock(tier->mutex);
+    return 0;
+}
+
+tier_entry_t* tier_pin(tier_t* tier, const char* key)
+{
+    tier_entry_t* e;
+
+    ABT_mutex_lock(tier->mutex);
+    e = find(tier, key);
+    if (e) {
+        e->refs++;
+        lru_remove(tier, e);
+        lru_push(tier, e);
+    }
+    ABT_mutex_unlock(tier->mutex);
+    return e;
+}
+
+void tier_unpin(tier_t* tier, tier_entry_t* entry)
+{
+    ABT_mutex_lock(tier->mutex);
+    release(tier, entry);
+    // an unpinned entry may be evicted by a waiting put
+    ABT_cond_broadcast(tier->changed);
+    ABT_mutex_unlock(tier->mutex);
+}
+
+int tier_drain(tier_t* tier, const char* key)
+{
+    tier_entry_t* e;
+
+    ABT_mutex_lock(tier->mutex);
+    // the queue is flushed in order, so the entry in the table is the last
+    // write of key to reach redis
+    while ((e = find(tier, key)) && e->state != TIER_CLEAN && !tier->failing)
+        ABT_cond_wait(tier->changed, tier->mutex);
+    if (e && e->state != TIER_CLEAN) {
+        ABT_mutex_unlock(tier->mutex);
+        return -1;
+    }
+    if (e) {
+        unlink_entry(tier, e);
+        ABT_cond_broadcast(tier->changed);
+    }
+    ABT_mutex_unlock(tier->mutex);
+    return 0;
+}
+
+tier_entry_t* tier_next_dirty(tier_t* tier)
+{
+    tier_entry_t* e;
+
+    ABT_mutex_lock(tier->mutex);
+    for (;;) {
+        while (!tier->queue_head && !tier->stopping)
+            ABT_cond_wait(tier->changed, tier->mutex);
+        e = tier->queue_head;
+        if (!e)
+            break;
+        tier->queue_head = e->queue_next;
+        if (!tier->queue_head)
+            tier->queue_tail = NULL;
+        e->queue_next = NULL;
+        if (e->linked) {
+            e->state = TIER_FLUSHING;
+            break;
+        }
+        // replaced before it was written, the newer entry is queued
+        tier->dirty--;
+        release(tier, e);
+        ABT_cond_broadcast(tier->changed);
+    }
+    ABT_mutex_unlock(tier->mutex);
+    return e;
+}
+
+void tier_flushed(tier_t* tier, tier_entry_t* entry)
+{
+    ABT_mutex_lock(tier->mutex);
+    entry->state = TIER_CLEAN;
+    tier->dirty--;
+    tier->failing = 0;
+    release(tier, entry);
+    ABT_cond_broadcast(tier->changed);
+    ABT_mutex_unlock(tier->mutex);
+}
+
+int tier_failed(tier_t* tier, tier_entry_t* entry)
+{
+    int ret = 0;
+
+    ABT_mutex_lock(tier->mutex);
+    if (tier->stopping) {
+        tier->dirty--;
+        release(tier, entry);
+        ret = -1;
+    } else {
+        // the oldest write goes first again, the ones queued behind it
+        // must not overtake it
+        entry->state = TIER_DIRTY;
+        entry->queue_next = tier->queue_head;
+        tier->queue_head = entry;
+        if (!tier->queue_tail)
+            tier->queue_tail = entry;
+        tier->failing = 1;
+    }
+    // waiting puts and drains give up
+    ABT_cond_broadcast(tier->changed);
+    ABT_mutex_unlock(tier->mutex);
+    return ret;
+}
+
+int tier_sync(tier_t* tier)
+{
+    int ret;
+
+    ABT_mutex_lock(tier->mutex);
+    while (tier->dirty > 0 && !tier->failing)
+        ABT_cond_wait(tier->changed, tier->mutex);
+    ret = tier->dirty > 0 ? -1 : 0;
+    ABT_mutex_unlock(tier->mutex);
+    return ret;
+}
+
+void tier_usage(tier_t* tier, rdma_stats_t* stats)
+{
+    ABT_mutex_lock(tier->mutex);
+    stats->memory_used = tier->used;
+    stats->memory_limit = tier->limit;
+    stats->items = tier->count;
+    stats->evictions = tier->evictions;
+    stats->dirty = tier->dirty;
+    ABT_mutex_unlock(tier->mutex);
+}
+
+void tier_stop(tier_t* tier)
+{
+    ABT_mutex_lock(tier->mutex);
+    tier->stopping = 1;
+    ABT_cond_broadcast(tier->changed);
+    ABT_mutex_unlock(tier->mutex);
+}
@@ -0,0 +1,115 @@
+#ifndef TIER_H
+#define TIER_H
+
+/* In-memory tier of margo_server, in front of redis.
+ *
+ * Every entry owns the SET command built by the set handler around its
+ * value (see set_header in server.c) and keeps the bulk handle the value
+ * was pulled with, so that gets push straight from it without registering
+ * the memory again.
+ *
+ * Entries are either clean, their value is in redis, or dirty, queued for
+ * the flusher that writes them to redis in the order they were put. Only
+ * clean entries are evicted, least recently used first, to keep the tier
+ * under its memory limit, and the number of dirty entries is bounded so
+ * that the puts of a writer faster than redis wait for the flusher.
+ *
+ * An entry the flusher could not write stays dirty and goes back to the
+ * head of the queue. Until a write succeeds again the tier is failing:
+ * dirty puts are refused and drains give up, so that nothing is
+ * acknowledged that only the tier holds, and nothing is written to redis
+ * ahead of the writes still waiting for it.
+ *
+ * An entry lives as long as it is referenced by the table, the flusher or
+ * a reader that pinned it, a replaced entry is freed once the last of them
+ * lets it go.
+ */
+
+#include <stddef.h>
+#include <stdint.h>
+#include <margo.h>
+#include "protocol.h"
+
+#define TIER_CLEAN 0
+#define TIER_DIRTY 1
+#define TIER_FLUSHING 2
+
+typedef struct tier_entry {
+    char* key;
+    rdma_meta_t meta;
+    char* cmd;              // SET command holding the value
+    size_t cmd_size;
+    char* value;            // metadata header in cmd, the value follows it
+    hg_bulk_t bulk;         // registration of the value, HG_BULK_NULL if empty
+    int state;
+    int refs;
+    int linked;             // still the entry of key in the table
+    struct tier_entry* next;            // hash chain
+    struct tier_entry* lru_prev;
+    struct tier_entry* lru_next;
+    struct tier_entry* queue_next;      // dirty queue
+} tier_entry_t;
+
+typedef struct {
+    tier_entry_t** buckets;
+    size_t nbuckets;
+    size_t count;
+    tier_entry_t* lru_head;     // most recently used
+    tier_entry_t* lru_tail;
+    tier_entry_t* queue_head;
+    tier_entry_t* queue_tail;
+    size_t used;
+    size_t limit;
+    size_t dirty;
+    size_t max_dirty;
+    uint64_t evictions;
+    uint64_t next_version;
+    int stopping;
+    int failing;                // the last write of the flusher failed
+    ABT_mutex mutex;
+    ABT_cond changed;
+} tier_t;
+
+// limit is the memory the entries may take, max_dirty the depth of the
+// queue of entries waiting for the flusher
+int tier_init(tier_t* tier, size_t limit, size_t max_dirty);
+
+// put the value of key, taking ownership of cmd and bulk on success. A
+// dirty put gets the next version of key, written in meta and in the header
+// at value, and waits for room in the tier and in the queue, unless the
+// tier is failing. A clean put never waits and does not replace a newer
+// version. Returns -1, leaving cmd and bulk to the caller, if the entry was
+// not put.
+int tier_put(tier_t* tier, const char* key, rdma_meta_t* meta, char* cmd, size_t cmd_size,
+        char* value, hg_bulk_t bulk, int dirty);
+
+// the entry of key, pinned until tier_unpin, or NULL
+tier_entry_t* tier_pin(tier_t* tier, const char* key);
+void tier_unpin(tier_t* tier, tier_entry_t* entry);
+
+// wait until the pending writes of key have reached redis and drop it from
+// the tier, before redis is written by other means. Returns -1 if a write
+// of key is still pending while the tier is failing.
+int tier_drain(tier_t* tier, const char* key);
+
+// next dirty entry in queue order for the flusher, NULL once the tier stops
+// and the queue is empty. The flusher hands it back with tier_flushed once
+// written, or with tier_failed.
+tier_entry_t* tier_next_dirty(tier_t* tier);
+void tier_flushed(tier_t* tier, tier_entry_t* entry);
+
+// requeue an entry that could not be written first and mark the tier
+// failing. Returns -1 if the tier is stopping, the entry is then given up.
+int tier_failed(tier_t* tier, tier_entry_t* entry);
+
+// wait until every dirty entry put so far has reached redis, returns -1 if
+// the tier is failing
+int tier_sync(tier_t* tier);
+
+// fill the memory, items, evictions and dirty counts of stats
+void tier_usage(tier_t* tier, rdma_stats_t* stats);
+
+// let the flusher finish the queue and return NULL
+void tier_stop(tier_t* tier);
+
+#endif
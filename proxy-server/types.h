@@ -1,15 +1,51 @@
 #ifndef PARAM_H
 #define PARAM_H
 
+#include <stdlib.h>
 #include <mercury.h>
 #include <mercury_macros.h>
-#include <mercury_proc_string.h>
+#include <mercury_proc.h>
 
-MERCURY_GEN_PROC(rdma_in_t,
-        ((hg_string_t)(key))\
-        ((int32_t)(size))\
-        ((hg_bulk_t)(bulk)))
+/* Raw message carried by every RPC, in either direction.
+ *
+ * It is encoded as a size followed by the bytes, which is how pymargo
+ * encodes the input and output of Python RPCs, so C and Python peers can
+ * talk to each other. The contents follow the layout in protocol.h. */
+typedef struct {
+    hg_size_t size;
+    char *data;
+} rdma_msg_t;
 
-MERCURY_GEN_PROC(rdma_out_t, ((int32_t)(ret)))
+static inline hg_return_t hg_proc_rdma_msg_t(hg_proc_t proc, void *arg)
+{
+    rdma_msg_t *msg = (rdma_msg_t*)arg;
+    hg_return_t ret;
+
+    ret = hg_proc_hg_size_t(proc, &msg->size);
+    if (ret != HG_SUCCESS)
+        return ret;
+
+    switch (hg_proc_get_op(proc)) {
+        case HG_DECODE:
+            msg->data = NULL;
+            if (msg->size) {
+                msg->data = (char*)malloc(msg->size);
+                if (!msg->data)
+                    return HG_NOMEM;
+            }
+            /* fall through */
+        case HG_ENCODE:
+            if (msg->size)
+                ret = hg_proc_raw(proc, msg->data, msg->size);
+            break;
+        case HG_FREE:
+            free(msg->data);
+            msg->data = NULL;
+            break;
+        default:
+            break;
+    }
+    return ret;
+}
 
 #endif
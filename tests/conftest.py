@@ -0,0 +1,22 @@
+"""Shared setup of the tests of the pure-Python modules.
+
+The modules are imported by bare name, as the server and the benchmarks do,
+from the directories they live in. Tests of the modules built on pymargo
+are skipped where it is not installed.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for directory in ("benchmark", "proxy-server", "proxy-client"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+
+@pytest.fixture(scope="session")
+def engine():
+    core = pytest.importorskip("pymargo.core")
+    with core.Engine("na+sm") as engine:
+        yield engine
@@ -0,0 +1,129 @@
+import random
+from array import array
+from collections import Counter
+
+import pytest
+
+import benchmark
+from benchmark import READ
+from benchmark import WRITE
+from benchmark import LoadBenchmark
+
+MS = 10**6
+
+
+def _spec(**kwargs):
+    spec = dict(keys=1000, size=1000, size_dist="fixed", min_size=10, max_exp=12, popularity="uniform", zipf_s=1.0)
+    spec.update(kwargs)
+    return spec
+
+
+@pytest.mark.parametrize("dist", ["fixed", "uniform", "lognormal"])
+def test_object_sizes_are_clamped(dist):
+    spec = _spec(size=3000, size_dist=dist, min_size=500)
+    sizes = benchmark.object_sizes(spec, random.Random(0))
+    assert len(sizes) == 1000
+    assert min(sizes) >= 500 and max(sizes) <= 2**11
+    if dist != "fixed":
+        # the draws above the maximum are clamped, and below the minimum
+        assert max(sizes) == 2**11
+    if dist == "lognormal":
+        assert min(sizes) == 500
+
+
+def test_object_sizes_fixed():
+    assert benchmark.object_sizes(_spec(keys=3, size=5), random.Random(0)) == [10, 10, 10]
+    assert benchmark.object_sizes(_spec(keys=2), random.Random(0)) == [1000, 1000]
+
+
+def test_uniform_keys():
+    pick = benchmark.key_picker(_spec(keys=10), random.Random(0))
+    counts = Counter(pick() for _ in range(10000))
+    assert set(counts) == set(range(10))
+
+
+def test_zipf_keys():
+    pick = benchmark.key_picker(_spec(keys=100, popularity="zipf"), random.Random(0))
+    counts = Counter(pick() for _ in range(100000))
+    assert max(counts) <= 99 and min(counts) >= 0
+    # key i is drawn about (N + 1) / (i + 1) times as often as key N
+    assert counts[0] > 20 * counts[99]
+    assert counts[0] > counts[1] > counts[9] > counts[99]
+    assert counts[0] / counts[1] == pytest.approx(2, rel=0.1)
+
+
+def test_zipf_keys_are_bounded():
+    # a draw of the total weight itself must still be a valid key
+    rng = random.Random(0)
+    rng.random = lambda: 1.0
+    assert benchmark.key_picker(_spec(keys=5, popularity="zipf"), rng)() == 4
+
+
+def test_percentile():
+    ordered = list(range(100))
+    assert benchmark.percentile(ordered, 0.5) == 50
+    assert benchmark.percentile(ordered, 0.99) == 99
+    assert benchmark.percentile(ordered, 1.0) == 99
+    assert benchmark.percentile(ordered, 0.0) == 0
+    assert benchmark.percentile([7], 0.999) == 7
+
+
+def _load(tmp_path):
+    load = object.__new__(LoadBenchmark)
+    load.spec = {"interval": 1.0}
+    load.name = "store"
+    load.logfile = str(tmp_path / "load.log")
+    return load
+
+
+def _worker(*ops):
+    # (op, end seconds, latency milliseconds, bytes) of every operation
+    return (
+        bytearray(op for op, _, _, _ in ops),
+        array("q", (int(end * 10**9) for _, end, _, _ in ops)),
+        array("q", (latency * MS for _, _, latency, _ in ops)),
+        array("q", (size for _, _, _, size in ops)),
+        0,
+        None,
+    )
+
+
+def test_report_buckets_intervals(tmp_path):
+    load = _load(tmp_path)
+    samples = [
+        _worker((READ, 0.25, 1, 100), (WRITE, 0.5, 4, 200), (READ, 1.5, 3, 300)),
+        _worker((READ, 0.75, 2, 100)),
+    ]
+    load.report(samples)
+    rows = {(interval, op): row for interval, op, *row in load.rows}
+    assert [(interval, op) for interval, op, *_ in load.rows] == [
+        (0, "read"), (0, "write"), (0, "all"), (1, "read"), (1, "all"),
+        ("total", "read"), ("total", "write"), ("total", "all"),
+    ]
+
+    ops, rate, gbps, p50, p95, p99, p999 = rows[0, "read"]
+    assert (ops, rate, gbps) == (2, 2.0, 200e-9)
+    assert (p50, p999) == (2.0, 2.0)
+    ops, rate, gbps, p50, _, _, p999 = rows[0, "all"]
+    assert (ops, rate, gbps, p50, p999) == (3, 3.0, 400e-9, 2.0, 4.0)
+
+    # the run ended half way through the last interval
+    ops, rate, gbps, *_ = rows[1, "read"]
+    assert (ops, rate, gbps) == (1, 2.0, pytest.approx(600e-9))
+
+    ops, rate, gbps, p50, *_ = rows["total", "all"]
+    assert (ops, rate, p50) == (4, pytest.approx(4 / 1.5), 3.0)
+    assert gbps == pytest.approx(700e-9 / 1.5)
+
+    with open(load.logfile) as f:
+        assert len(f.read().splitlines()) == len(load.rows)
+
+
+def test_report_of_an_idle_worker(tmp_path):
+    load = _load(tmp_path)
+    load.report([_worker((WRITE, 0.5, 1, 10)), _worker()])
+    assert [(interval, op, ops) for interval, op, ops, *_ in load.rows] == [
+        (0, "write", 1), (0, "all", 1), ("total", "write", 1), ("total", "all", 1),
+    ]
+    # a run shorter than the interval is rated over its own duration
+    assert load.rows[0][3] == 2.0
@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("pymargo")
+
+from buffer_pool import BufferPool  # noqa: E402
+
+
+@pytest.fixture
+def pool(engine):
+    return BufferPool(engine, min_class=1024, max_class=64 * 1024, limit=128 * 1024)
+
+
+def test_size_class(pool):
+    assert pool.size_class(0) == 1024
+    assert pool.size_class(1024) == 1024
+    assert pool.size_class(1025) == 2048
+    assert pool.size_class(64 * 1024) == 64 * 1024
+    assert pool.size_class(64 * 1024 + 1) is None
+
+
+def test_lease_is_reused(pool):
+    with pool.lease(1500) as lease:
+        assert lease.capacity == 2048
+        assert lease.array.size == 1500
+        region = lease.region
+    with pool.lease(2000) as lease:
+        assert lease.region is region
+    assert (pool.hits, pool.misses) == (1, 1)
+    assert pool.hit_rate == 0.5
+    assert pool.size == 2048
+
+
+def test_release_twice(pool):
+    lease = pool.lease(100)
+    lease.release()
+    lease.release()
+    assert len(pool._free[1024]) == 1
+
+
+def test_large_lease_is_not_pooled(pool):
+    with pool.lease(100 * 1024) as lease:
+        assert lease.capacity == 100 * 1024
+        assert not lease.region.pooled
+    assert pool.size == 0
+    assert not pool._free
+
+
+def test_unpooled_lease(pool):
+    with pool.lease(100, pooled=False) as lease:
+        assert lease.capacity == 100
+    assert pool.size == 0
+
+
+def test_limit_drops_free_regions(pool):
+    first = pool.lease(64 * 1024)
+    second = pool.lease(64 * 1024)
+    assert pool.size == 128 * 1024
+    # over the limit while both are leased
+    third = pool.lease(64 * 1024)
+    assert not third.region.pooled
+    for lease in (first, second, third):
+        lease.release()
+    assert len(pool._free[64 * 1024]) == 2
+
+    # free regions of other classes make room for a new one
+    with pool.lease(32 * 1024):
+        assert pool.size <= pool.limit
+    assert len(pool._free[64 * 1024]) == 1
+
+
+def test_clear(pool):
+    pool.lease(100).release()
+    pool.clear()
+    assert pool.size == 0
+    assert not pool._free
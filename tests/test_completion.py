@@ -0,0 +1,182 @@
+import threading
+
+import pytest
+
+import completion
+from completion import CompletionQueue
+from completion import RDMAFuture
+
+TIMEOUT = 5
+
+
+class Request:
+    """Request of a non-blocking margo operation, done once released."""
+
+    def __init__(self, output=None, error=None):
+        self.output = output
+        self.error = error
+        self.released = threading.Event()
+
+    def release(self):
+        self.released.set()
+        return self
+
+    def wait(self):
+        assert self.released.wait(TIMEOUT)
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+
+def _pending():
+    future = RDMAFuture()
+    future.set_running_or_notify_cancel()
+    return future
+
+
+def test_completed():
+    future = completion.completed(1)
+    assert future.done() and future.result() == 1
+
+
+def test_gather():
+    futures = [_pending() for _ in range(3)]
+    gathered = completion.gather(futures, sum)
+    futures[2].set_result(3)
+    futures[0].set_result(1)
+    assert not gathered.done()
+    futures[1].set_result(2)
+    assert gathered.result(TIMEOUT) == 6
+    assert completion.gather([]).result() == []
+
+
+def test_gather_fails_with_the_first_error():
+    futures = [_pending() for _ in range(2)]
+    gathered = completion.gather(futures)
+    futures[1].set_exception(KeyError("a"))
+    with pytest.raises(KeyError):
+        gathered.result(TIMEOUT)
+    futures[0].set_exception(ValueError())
+    with pytest.raises(KeyError):
+        gathered.result(TIMEOUT)
+
+
+def test_gather_combine_returning_a_future():
+    follow_up = _pending()
+    gathered = completion.gather([completion.completed(1)], lambda results: follow_up)
+    assert not gathered.done()
+    follow_up.set_result("done")
+    assert gathered.result(TIMEOUT) == "done"
+
+    failed = completion.gather([completion.completed(1)], lambda results: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        failed.result(TIMEOUT)
+
+
+def test_settle():
+    future, source = _pending(), _pending()
+    completion._settle(future, source)
+    assert not future.done()
+    source.set_result(1)
+    assert future.result(TIMEOUT) == 1
+
+    future, source = _pending(), _pending()
+    completion._settle(future, source)
+    source.set_exception(KeyError("a"))
+    with pytest.raises(KeyError):
+        future.result(TIMEOUT)
+
+
+def test_background():
+    assert completion.background(lambda a, b: a + b, 1, 2).result(TIMEOUT) == 3
+    with pytest.raises(ZeroDivisionError):
+        completion.background(lambda: 1 / 0).result(TIMEOUT)
+
+
+def test_background_reentrant_calls_run_inline():
+    def outer():
+        future = completion.background(threading.current_thread)
+        # it did not wait for a free thread, it already ran on this one
+        assert future.done()
+        return threading.current_thread(), future.result()
+
+    # more nested calls than threads cannot deadlock
+    futures = [completion.background(outer) for _ in range(2 * completion.BACKGROUND_WORKERS)]
+    for future in futures:
+        thread, inner = future.result(TIMEOUT)
+        assert inner is thread and thread is not threading.current_thread()
+
+
+def test_completion_queue():
+    completions = CompletionQueue()
+    request = Request(b"output")
+    future = completions.submit(lambda: request, lambda output: output.upper())
+    assert not future.done()
+    request.release()
+    assert future.result(TIMEOUT) == b"OUTPUT"
+
+    failed = completions.submit(lambda: Request(error=KeyError("a")).release(), lambda output: output)
+    with pytest.raises(KeyError):
+        failed.result(TIMEOUT)
+
+
+def test_completion_queue_window():
+    completions = CompletionQueue(window=2)
+    requests = [Request(i) for i in range(3)]
+    futures = [completions.submit(lambda r=r: r, lambda output: output) for r in requests[:2]]
+
+    # the third operation waits for one of the first two to complete
+    started = threading.Event()
+
+    def submit():
+        futures.append(completions.submit(lambda: started.set() or requests[2], lambda output: output))
+
+    thread = threading.Thread(target=submit)
+    thread.start()
+    assert not started.wait(0.1)
+    requests[0].release()
+    assert started.wait(TIMEOUT)
+    thread.join(TIMEOUT)
+    requests[1].release()
+    requests[2].release()
+    assert [f.result(TIMEOUT) for f in futures] == [0, 1, 2]
+
+
+def test_completion_queue_start_fails():
+    completions = CompletionQueue(window=1)
+    cleaned = []
+
+    def start():
+        raise ConnectionError()
+
+    for _ in range(2):
+        future = completions.submit(start, lambda output: output, lambda: cleaned.append(1))
+        with pytest.raises(ConnectionError):
+            future.result(0)
+    assert cleaned == [1, 1]
+    # the slots were freed
+    assert completions.submit(lambda: Request(1).release(), lambda output: output).result(TIMEOUT) == 1
+
+
+def test_completion_queue_cleanup():
+    completions = CompletionQueue()
+    cleaned = threading.Event()
+    future = completions.submit(lambda: Request().release(), lambda output: 1 / 0, cleaned.set)
+    with pytest.raises(ZeroDivisionError):
+        future.result(TIMEOUT)
+    assert cleaned.is_set()
+
+
+def test_completion_queue_follow_up_from_the_completion_thread():
+    # a retry submitted by `finish` when every slot is taken
+    completions = CompletionQueue(window=1)
+
+    def finish(output):
+        if output == "retry":
+            return completions.submit(lambda: Request("done").release(), lambda output: output)
+        return output
+
+    future = completions.submit(lambda: Request("retry").release(), finish)
+    assert future.result(TIMEOUT) == "done"
+    # and every slot is free again
+    assert completions._slots.acquire(blocking=False)
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+import compression
+from compression import CODECS
+from compression import Compressor
+
+
+@pytest.fixture(params=sorted(CODECS))
+def codec(request):
+    return CODECS[request.param]
+
+
+def test_round_trip(codec):
+    value = b"abc" * 100000
+    frame = compression.compress(value, codec)
+    assert len(frame) < len(value)
+    out = compression.decompress(frame, codec)
+    assert isinstance(out, bytearray) and out == value
+
+
+def test_round_trip_of_several_blocks(codec, monkeypatch):
+    monkeypatch.setattr(compression, "BLOCK_SIZE", 4096)
+    value = os.urandom(1000) * 50
+    frame = compression.compress(value, codec)
+    length, count = compression.FRAME.unpack_from(frame)
+    assert (length, count) == (len(value), 13)
+    assert compression.decompress(frame, codec) == value
+
+
+def test_round_trip_of_segments(codec):
+    segments = [b"a" * 1000, memoryview(b"b" * 10), bytearray(b"c" * 5000)]
+    frame = compression.compress(segments, codec)
+    assert compression.decompress(frame, codec) == b"".join(bytes(s) for s in segments)
+
+
+def test_empty_value(codec):
+    assert compression.decompress(compression.compress(b"", codec), codec) == b""
+
+
+def test_codec_of_flags():
+    assert compression.codec_of(0) is None
+    assert compression.codec_of(1) is None
+    assert compression.codec_of(1 << compression.CODEC_SHIFT | 1) is CODECS[1]
+    with pytest.raises(ValueError):
+        compression.codec_of(7 << compression.CODEC_SHIFT)
+
+
+def test_choose():
+    compressor = Compressor(["zlib"], min_size=1024, bandwidth=1e6)
+    assert compressor.choose(b"a" * 100) is None
+    assert compressor.choose(os.urandom(100000)) is None
+    assert compressor.choose(b"abcd" * 100000) is CODECS[1]
+
+    # compressing does not pay off over a fast enough link
+    compressor.bandwidth = 1e15
+    assert compressor.choose(b"abcd" * 100000) is None
+
+
+def test_observe():
+    compressor = Compressor(min_size=1024, bandwidth=1e9)
+    compressor.observe(100, 1.0)
+    compressor.observe(10**6, 0.0)
+    assert compressor.bandwidth == 1e9
+    compressor.observe(10**6, 1.0)
+    assert compressor.bandwidth == pytest.approx(0.8e9 + 0.2e6)
+
+
+def test_unknown_codecs():
+    with pytest.raises(ValueError):
+        Compressor(["brotli"])
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+import harness
+from harness import Histogram
+
+
+def test_histogram_precision():
+    h = Histogram()
+    for value in (1, 255, 256, 1000, 123456789):
+        h.record(value)
+    for q, value in ((0.2, 1), (0.4, 255), (0.6, 256), (0.8, 1000), (1.0, 123456789)):
+        assert value * (1 - 2**-7) <= h.percentile(q) <= value
+
+
+def test_histogram_percentiles():
+    h = Histogram()
+    for value in range(1, 1001):
+        h.record(value)
+    assert h.count == 1000
+    assert h.percentile(0.5) == pytest.approx(500, rel=0.01)
+    assert h.percentile(0.99) == pytest.approx(990, rel=0.01)
+    assert h.percentile(0.0) == 1
+    assert Histogram().percentile(0.5) == 0
+
+
+def test_histogram_merge_and_serialize():
+    a, b = Histogram(), Histogram()
+    for value in range(100):
+        a.record(value)
+        b.record(value * 1000)
+    a.merge(b)
+    assert a.count == 200
+
+    restored = Histogram.from_dict(json.loads(json.dumps(a.to_dict())))
+    assert restored.count == 200
+    assert restored.percentile(0.9) == a.percentile(0.9)
+
+
+def test_summary():
+    s = harness.summary([3.0, 1.0, 2.0])
+    assert (s["count"], s["min"], s["p50"], s["max"], s["mean"]) == (3, 1.0, 2.0, 3.0, 2.0)
+    assert harness.summary([1.0])["stdev"] == 0.0
+
+
+def test_t_quantile():
+    # exact values of Student's t distribution
+    assert harness.t_quantile(0.975, 5) == pytest.approx(2.571, rel=0.01)
+    assert harness.t_quantile(0.975, 30) == pytest.approx(2.042, rel=0.001)
+    assert harness.t_quantile(0.975, 10**6) == pytest.approx(1.960, rel=0.001)
+
+
+def test_compare():
+    assert harness.compare([1.0], [1.0, 2.0]) is None
+
+    change, low, high = harness.compare([1.0, 1.0, 1.0], [2.0, 2.0, 2.0])
+    assert change == low == high == 1.0
+
+    baseline = [1.0, 1.1, 0.9, 1.0, 1.05, 0.95]
+    change, low, high = harness.compare(baseline, [x * 1.5 for x in baseline])
+    assert change == pytest.approx(0.5)
+    assert 0 < low < change < high
+
+    change, low, high = harness.compare(baseline, list(reversed(baseline)))
+    assert change == pytest.approx(0.0)
+    assert low < 0 < high
+
+
+def test_read_samples(tmp_path):
+    log = tmp_path / "run.log"
+    log.write_text(harness.HEADER + "RDMAStore,get,100,0,1,0.5\nRDMAStore,get,100,1,2,0.25\n")
+    assert harness.read_samples(str(log)) == {("RDMAStore", "get", 100): [0.5, 0.25]}
+
+    run = tmp_path / "run.json"
+    run.write_text(json.dumps({"results": [
+        {"store": "RDMAStore", "function": "set", "size": 10, "samples": [0.1, 0.2]},
+        {"store": "RDMAStore", "function": "get", "size": 10, "samples": []},
+    ]}))
+    assert harness.read_samples(str(run)) == {("RDMAStore", "set", 10): [0.1, 0.2]}
@@ -0,0 +1,128 @@
+import json
+import threading
+from collections import defaultdict
+
+import pytest
+from proxystore.store.stats import Event
+from proxystore.store.stats import TimeStats
+
+import instrument
+from instrument import Phases
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # every reading is one millisecond after the previous one
+    now = iter(range(0, 10**12, 10**6))
+    monkeypatch.setattr(instrument, "perf_counter_ns", lambda: next(now))
+
+
+@pytest.fixture
+def phases(clock):
+    return Phases(defaultdict(TimeStats), trace=True)
+
+
+def test_marks_add_up_to_the_latency(phases):
+    op = phases.start("get", "a")
+    op.mark("cache")
+    op.mark("forward")
+    op.mark("cache")
+    op.count(100)
+    op.count(20)
+    op.stop()
+    assert op.times == {"cache": 2 * 10**6, "forward": 10**6, "other": 10**6}
+    assert phases.stats[Event(function="get.cache", key="a")].calls == 1
+    assert phases.stats[Event(function="get.cache", key="a")].avg_time_ms == 2.0
+    assert phases.stats[Event(function="get.other", key="a")].avg_time_ms == 1.0
+
+
+def test_snapshot(phases):
+    for key in ("a", "b"):
+        op = phases.start("get", key)
+        op.mark("forward")
+        op.count(10)
+        op.stop()
+    phases.start("set").stop()
+
+    snapshot = phases.snapshot()
+    assert snapshot["get"]["calls"] == 2 and snapshot["get"]["bytes"] == 20
+    assert snapshot["get"]["phases"]["forward"] == {
+        "calls": 2, "total_ms": 2.0, "avg_ms": 1.0, "min_ms": 1.0, "max_ms": 1.0,
+    }
+    assert set(snapshot["set"]["phases"]) == {"other"}
+
+
+def test_operation_is_current(phases):
+    assert instrument.current() is instrument.NULL
+    with phases.operation("get", "a") as op:
+        assert instrument.current() is op
+        # layers below the store take part in the same operation
+        with phases.operation("get_batch") as inner:
+            assert inner is op
+        instrument.current().mark("forward")
+    assert instrument.current() is instrument.NULL
+    assert set(phases.snapshot()) == {"get"}
+    assert "forward" in op.times
+
+
+def test_operations_of_another_recorder_nest(phases):
+    other = Phases(defaultdict(TimeStats))
+    with phases.operation("set", "a") as outer:
+        with other.operation("get", "b") as inner:
+            assert inner is not outer and instrument.current() is inner
+            instrument.current().mark("forward")
+        assert instrument.current() is outer
+    assert instrument.current() is instrument.NULL
+    assert set(other.snapshot()) == {"get"} and "forward" in inner.times
+    assert set(phases.snapshot()) == {"set"} and "forward" not in outer.times
+
+
+def test_operation_stopped_on_error(phases):
+    with pytest.raises(KeyError):
+        with phases.operation("get", "a"):
+            raise KeyError("a")
+    assert instrument.current() is instrument.NULL
+    assert phases.snapshot()["get"]["calls"] == 1
+
+
+def test_operations_are_per_thread(phases):
+    seen = []
+    with phases.operation("get", "a"):
+        thread = threading.Thread(target=lambda: seen.append(instrument.current()))
+        thread.start()
+        thread.join()
+    assert seen == [instrument.NULL]
+
+
+def test_disabled():
+    with instrument.DISABLED.operation("get", "a") as op:
+        assert op is instrument.NULL
+        assert instrument.current() is instrument.NULL
+
+
+def test_write_trace(phases, tmp_path):
+    op = phases.start("get", "a")
+    op.mark("cache")
+    op.mark("forward")
+    op.count(5)
+    op.stop()
+
+    path = tmp_path / "trace.json"
+    phases.write_trace(str(path))
+    trace = json.loads(path.read_text())
+    assert trace["displayTimeUnit"] == "ms"
+    events = trace["traceEvents"]
+    assert [e["name"] for e in events] == ["get", "cache", "forward", "other"]
+    assert events[0]["args"] == {"key": "a", "bytes": 5}
+    assert events[0]["dur"] == 3000.0
+    assert [e["dur"] for e in events[1:]] == [1000.0, 1000.0, 1000.0]
+    # the phases follow each other within the operation
+    assert events[1]["ts"] == events[0]["ts"]
+    assert events[2]["ts"] == events[1]["ts"] + events[1]["dur"]
+
+
+def test_trace_is_kept_only_when_asked(clock, tmp_path):
+    phases = Phases(defaultdict(TimeStats))
+    phases.start("get").stop()
+    phases.write_trace(str(tmp_path / "trace.json"))
+    assert json.loads((tmp_path / "trace.json").read_text())["traceEvents"] == []
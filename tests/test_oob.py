@@ -0,0 +1,93 @@
+import pickle
+
+import numpy as np
+from proxystore import serialize
+
+import oob
+
+
+def _join(segments):
+    return b"".join(bytes(segment) for segment in segments)
+
+
+def test_small_objects_stay_in_band():
+    for obj in (b"x" * 100000, "text", {"a": 1}):
+        data = oob.dumps(obj)
+        assert isinstance(data, bytes) and serialize.deserialize(data) == obj
+    data = oob.dumps(np.zeros(10), min_size=1024)
+    assert isinstance(data, bytes)
+    assert np.array_equal(serialize.deserialize(data), np.zeros(10))
+
+
+def test_small_buffers_stay_in_band():
+    obj = [np.ones(100, dtype=np.uint8), np.ones(100000, dtype=np.uint8)]
+    segments = oob.dumps(obj)
+    length, count = oob.HEADER.unpack_from(bytes(segments[0]))
+    assert count == 1
+    out = oob.loads(bytearray(_join(segments)))
+    assert [a.size for a in out] == [100, 100000]
+
+
+def test_in_band_objects_are_pickled_once(monkeypatch):
+    calls = []
+    dumps = pickle.dumps
+    monkeypatch.setattr(pickle, "dumps", lambda *args, **kwargs: calls.append(1) or dumps(*args, **kwargs))
+    data = oob.dumps({"a": np.zeros(10)})
+    assert len(calls) == 1
+    assert serialize.deserialize(data)["a"].size == 10
+
+
+def test_round_trip():
+    obj = {"a": np.arange(100000, dtype=np.float64), "b": bytearray(b"y" * 70000), "c": 3}
+    segments = oob.dumps(obj)
+    assert segments is not None
+
+    out = oob.loads(bytearray(_join(segments)))
+    assert np.array_equal(out["a"], obj["a"])
+    assert out["b"] == obj["b"] and out["c"] == 3
+
+
+def test_buffers_are_referenced_not_copied():
+    array = np.arange(100000, dtype=np.int64)
+    segments = oob.dumps(array)
+    assert any(np.shares_memory(np.frombuffer(s, dtype=np.uint8), array) for s in segments[2:])
+
+
+def test_buffers_are_aligned():
+    obj = [np.ones(10001, dtype=np.uint8), np.ones(70001, dtype=np.uint8)]
+    segments = oob.dumps(obj, min_size=0)
+    starts = {}
+    offset = 0
+    for segment in segments:
+        starts[memoryview(segment).nbytes] = offset
+        offset += memoryview(segment).nbytes
+    assert starts[10001] % oob.ALIGNMENT == 0
+    assert starts[70001] % oob.ALIGNMENT == 0
+
+    data = bytearray(_join(segments))
+    out = oob.loads(data)
+    assert [a.size for a in out] == [10001, 70001]
+
+
+def test_views_into_writable_data():
+    data = bytearray(_join(oob.dumps(np.zeros(100000))))
+    out = oob.loads(data)
+    assert np.shares_memory(out, np.frombuffer(data, dtype=np.uint8))
+    out[0] = 1.0
+
+
+def test_read_only_data_is_copied():
+    data = _join(oob.dumps(np.zeros(100000)))
+    out = oob.loads(data)
+    assert out.flags.writeable
+    out[0] = 1.0
+    assert oob.loads(data)[0] == 0.0
+
+
+def test_unpicklable_objects_use_cloudpickle():
+    array = np.arange(100000)
+    obj = (lambda: 1, array)
+    out = oob.loads(bytearray(_join(oob.dumps(obj))))
+    assert out[0]() == 1
+    assert np.array_equal(out[1], array)
+    assert serialize.deserialize(oob.dumps(lambda: 2))() == 2
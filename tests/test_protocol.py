@@ -0,0 +1,134 @@
+import os
+import re
+
+import pytest
+
+import protocol
+from conftest import ROOT
+
+C_SIZES = {"char": 1, "uint8_t": 1, "uint16_t": 2, "int32_t": 4, "uint32_t": 4, "uint64_t": 8, "double": 8}
+
+
+def _header():
+    with open(os.path.join(ROOT, "proxy-server", "protocol.h")) as f:
+        return f.read()
+
+
+def _defines():
+    return dict(re.findall(r"#define (RDMA_\w+) (.+)", _header()))
+
+
+def _struct_sizes():
+    # sizes of the packed structs of protocol.h, from their fields
+    defines = _defines()
+    sizes = {}
+    pattern = r"typedef struct __attribute__\(\(packed\)\) \{(.*?)\} (\w+);"
+    for body, name in re.findall(pattern, _header(), re.S):
+        size = 0
+        for kind, count in re.findall(r"(\w+) \w+(?:\[(\w+)\])?;", body):
+            length = int(defines.get(count, count)) if count else 1
+            size += (C_SIZES[kind] if kind in C_SIZES else sizes[kind]) * length
+        sizes[name] = size
+    return sizes
+
+
+def test_sizes_match_protocol_h():
+    sizes = _struct_sizes()
+    assert protocol.REQUEST.size == sizes["rdma_req_hdr_t"] == 24
+    assert protocol.RESPONSE.size == sizes["rdma_resp_t"] == 16
+    assert protocol.METADATA.size == sizes["rdma_meta_t"] == 32
+    assert protocol.BATCH_REQUEST.size == sizes["rdma_batch_hdr_t"]
+    assert protocol.STATS.size == sizes["rdma_stats_t"]
+    assert protocol.RPC_STATS.size == sizes["rdma_rpc_stats_t"]
+
+
+def test_constants_match_protocol_h():
+    defines = _defines()
+    assert protocol.VERSION == int(defines["RDMA_PROTOCOL_VERSION"])
+    assert protocol.LATENCY_BUCKETS == int(defines["RDMA_LATENCY_BUCKETS"])
+    assert protocol.HAS_METADATA == int(defines["RDMA_HAS_METADATA"], 16)
+    assert protocol.CHUNK_SIZE == 64 * 1024**2
+
+
+def test_protocol_h_copies_are_identical():
+    with open(os.path.join(ROOT, "proxy-client", "protocol.h")) as f:
+        assert f.read() == _header()
+
+
+def test_request_round_trip():
+    msg = protocol.encode_request("kéy", 1234, b"bulk", flags=3, timestamp=1.5)
+    assert protocol.decode_request(msg) == protocol.Request("kéy", 1234, b"bulk", 3, 1.5)
+    assert protocol.decode_request(memoryview(msg)).key == "kéy"
+
+
+def test_chunk_request_round_trip():
+    msg = protocol.encode_chunk_request("key", 2**26, 2**30, 100, b"bulk", 1, 2.0)
+    req = protocol.decode_chunk_request(msg)
+    assert req == protocol.ChunkRequest("key", 100, b"bulk", 2**26, 2**30, 1, 2.0)
+
+
+def test_response_round_trip():
+    assert protocol.decode_response(protocol.encode_response(protocol.OVERFLOW, 7)) == (
+        protocol.Response(protocol.OVERFLOW, 7)
+    )
+    metadata = protocol.Metadata(1.5, 10, 2, 1)
+    resp = protocol.decode_response(protocol.encode_response(protocol.OK, 10, metadata=metadata))
+    assert resp.metadata == metadata
+    assert resp.flags & protocol.HAS_METADATA
+
+
+def test_batch_round_trip():
+    msg = protocol.encode_batch_request(["a", "bb", ""], [1, 2, 3], 6, b"bulk", 1, 3.0)
+    assert protocol.decode_batch_request(msg) == protocol.BatchRequest(
+        ["a", "bb", ""], [1, 2, 3], 6, b"bulk", 1, 3.0,
+    )
+    assert protocol.decode_batch_request(protocol.encode_batch_request(["a"])).sizes == [0]
+
+    metadata = [protocol.Metadata(1.0, 1, 1), protocol.Metadata(0.0, 0)]
+    msg = protocol.encode_batch_response([protocol.OK, protocol.NOT_FOUND], [1, 0], metadata=metadata)
+    resp = protocol.decode_batch_response(msg)
+    assert resp == protocol.BatchResponse(protocol.OK, [protocol.OK, protocol.NOT_FOUND], [1, 0], metadata)
+
+    resp = protocol.decode_batch_response(protocol.encode_batch_response([], [], protocol.ERROR))
+    assert resp.status == protocol.ERROR
+
+
+def test_stats_round_trip():
+    rpc = protocol.RPCStats("get", 3, 1, 10, 20, 300, 200, tuple(range(protocol.LATENCY_BUCKETS)))
+    stats = protocol.Stats(1.5, 100, 1000, 2, 1, 0, 1, 0, {"get": rpc})
+    assert protocol.decode_stats(protocol.encode_stats(stats)) == stats
+
+    with pytest.raises(protocol.RDMAError):
+        protocol.decode_stats(protocol.encode_response(protocol.ERROR))
+
+
+def test_latency_bucket():
+    assert protocol.latency_bucket(0) == 0
+    assert protocol.latency_bucket(1) == 0
+    assert protocol.latency_bucket(1024) == 10
+    assert protocol.latency_bucket(2**60) == protocol.LATENCY_BUCKETS - 1
+
+
+@pytest.mark.parametrize(
+    "decode, msg",
+    [
+        (protocol.decode_request, protocol.encode_request("key", 1, b"bulk")[:-1]),
+        (protocol.decode_request, b"\0" * 4),
+        (protocol.decode_chunk_request, protocol.encode_request("key", 1, b"bulk")),
+        (protocol.decode_response, b"\0" * 15),
+        (protocol.decode_response, protocol.encode_response(metadata=protocol.Metadata(0.0, 0))[:-1]),
+        (protocol.decode_batch_request, protocol.encode_batch_request(["a", "b"])[:-1]),
+        (protocol.decode_batch_request, protocol.BATCH_REQUEST.pack(protocol.VERSION, 0, 0, 1000, 0, 0, 0.0)),
+        (protocol.decode_batch_response, protocol.encode_batch_response([protocol.OK], [1])[:-1]),
+    ],
+)
+def test_truncated(decode, msg):
+    with pytest.raises(protocol.RDMAError):
+        decode(msg)
+
+
+def test_other_version():
+    msg = bytearray(protocol.encode_request("key"))
+    msg[0] = protocol.VERSION + 1
+    with pytest.raises(protocol.RDMAError, match="version"):
+        protocol.decode_request(bytes(msg))
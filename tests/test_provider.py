@@ -0,0 +1,60 @@
+import importlib.util
+import os
+
+import pytest
+
+pytest.importorskip("pymargo")
+pytest.importorskip("daemon")
+
+import protocol  # noqa: E402
+from conftest import ROOT  # noqa: E402
+
+spec = importlib.util.spec_from_file_location("proxy_server", os.path.join(ROOT, "proxy-server", "proxy-server.py"))
+proxy_server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(proxy_server)
+
+
+class Handle:
+    def __init__(self):
+        self.response = None
+
+    def get_addr(self):
+        return None
+
+    def respond(self, msg):
+        self.response = protocol.decode_response(msg)
+
+
+@pytest.fixture
+def provider(engine):
+    return proxy_server.RDMAProvider(engine, 17, memory_limit=64 * 1024**2)
+
+
+def _chunk(provider, offset, total, size):
+    handle = Handle()
+    provider.set_chunk(handle, protocol.encode_chunk_request("key", offset, total, size, b"", timestamp=1.0))
+    return handle.response.status
+
+
+@pytest.mark.parametrize(
+    "offset, total, size",
+    [
+        (1, 2 * protocol.CHUNK_SIZE, 100),
+        (0, 2 * protocol.CHUNK_SIZE, protocol.CHUNK_SIZE + 1),
+        (protocol.CHUNK_SIZE, protocol.CHUNK_SIZE + 10, 11),
+        (2 * protocol.CHUNK_SIZE, protocol.CHUNK_SIZE + 10, 1),
+    ],
+)
+def test_out_of_bounds_chunk_is_rejected(provider, offset, total, size):
+    assert _chunk(provider, offset, total, size) == protocol.ERROR
+    assert not provider._uploads
+    # the upload is closed, its other chunks reserve nothing
+    assert _chunk(provider, 0, total, 100) == protocol.ERROR
+    assert not provider._uploads
+    assert len(provider.data) == 0
+
+
+def test_malformed_request_is_answered(provider):
+    handle = Handle()
+    provider.set_chunk(handle, b"xx")
+    assert handle.response.status == protocol.ERROR
@@ -0,0 +1,123 @@
+import ctypes.util
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+
+@pytest.fixture(scope="module")
+def native(tmp_path_factory):
+    if ctypes.util.find_library("margo") is None:
+        pytest.skip("margo is not installed")
+    build = tmp_path_factory.mktemp("build")
+    subprocess.run(
+        [sys.executable, "setup.py", "build_ext", "--build-lib", str(build), "--build-temp", str(build)],
+        cwd=os.path.join(ROOT, "proxy-client"), check=True,
+    )
+    (path,) = build.glob("rdma_transfer*.so")
+    spec = importlib.util.spec_from_file_location("rdma_transfer", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_build_and_import(native):
+    for name in ("connect", "disconnect", "set", "get", "get_into", "get_size", "exists", "delete"):
+        assert callable(getattr(native, name))
+    assert issubclass(native.error, RuntimeError)
+    with pytest.raises(native.error):
+        native.exists("a")
+
+
+def test_keys_with_nul_are_rejected(native):
+    with pytest.raises(ValueError):
+        native.exists("a\0b")
+    with pytest.raises(ValueError):
+        native.set("a\0b", b"value")
+    with pytest.raises(ValueError):
+        native.get_into("\0", bytearray(1))
+
+
+class Native:
+    """Stand-in for the rdma_transfer extension, serving a dict."""
+
+    error = RuntimeError
+
+    def __init__(self):
+        self.values = {}
+        self.calls = []
+
+    def connect(self, addr, provider_id):
+        return 0
+
+    def set(self, key, value, timestamp, flags):
+        self.calls.append("set")
+        self.values[key] = bytes(value)
+        return 1
+
+    def get(self, key, size):
+        self.calls.append("get")
+        return self.values.get(key)
+
+    def get_size(self, key):
+        self.calls.append("get_size")
+        return len(self.values[key]) if key in self.values else None
+
+    def exists(self, key):
+        self.calls.append("exists")
+        return key in self.values
+
+    def delete(self, key):
+        self.calls.append("delete")
+        if key == "broken":
+            raise self.error("delete of key 'broken' failed on the server")
+        return self.values.pop(key, None) is not None
+
+
+@pytest.fixture
+def rdma_interface(monkeypatch):
+    pytest.importorskip("pymargo")
+    import rdma_interface
+
+    monkeypatch.setattr(rdma_interface, "rdma_transfer", Native())
+    monkeypatch.setattr(rdma_interface, "_native_server", None)
+    return rdma_interface
+
+
+def test_rdma_single_key_calls_go_native(rdma_interface):
+    import protocol
+
+    rdma = rdma_interface.RDMA("tcp://127.0.0.1:1234", 42, native=True)
+    native = rdma_interface.rdma_transfer
+    assert rdma.native
+    assert rdma.set("a", b"value", 1.5, 2) == protocol.Metadata(1.5, 5, 1, 2)
+    assert rdma.get("a") == b"value"
+    assert rdma.get_size("a") == 5 and rdma.exists("a")
+    assert rdma.evict("a") and not rdma.evict("a")
+    assert rdma.get("a") is None
+    assert native.calls == ["set", "get", "get_size", "exists", "delete", "delete", "get"]
+    with pytest.raises(protocol.RDMAError):
+        rdma.evict("broken")
+
+
+def test_rdma_other_calls_use_the_session(rdma_interface, monkeypatch):
+    import protocol
+
+    rdma = rdma_interface.RDMA("tcp://127.0.0.1:1234", 42, native=True)
+    rpcs = []
+
+    def call_rpc_on(rpc, key, *args):
+        rpcs.append((rpc, key))
+        return protocol.Response(protocol.OK, 1)
+
+    monkeypatch.setattr(rdma, "call_rpc_on", call_rpc_on)
+    rdma.exists("a\0b")
+    assert rpcs == [("exists", "a\0b")]
+
+    # only one server is served natively
+    assert not rdma_interface.RDMA("tcp://127.0.0.1:1235", 42, native=True).native
+    assert not rdma_interface.RDMA("tcp://127.0.0.1:1234", 42).native
@@ -0,0 +1,72 @@
+import pytest
+
+pytest.importorskip("pymargo")
+
+from sharding import HashRing  # noqa: E402
+from sharding import Peer  # noqa: E402
+
+PEERS = [Peer(f"tcp://10.0.0.{i}:1234", i) for i in range(1, 5)]
+KEYS = [f"key-{i}" for i in range(2000)]
+
+
+def _ring(peers):
+    ring = HashRing()
+    for peer in peers:
+        ring.add(peer)
+    return ring
+
+
+def test_empty_ring():
+    with pytest.raises(LookupError):
+        HashRing().lookup("key")
+
+
+def test_membership():
+    ring = _ring(PEERS)
+    ring.add(PEERS[0])
+    assert len(ring) == 4
+    assert ring.peers == sorted(PEERS)
+    ring.remove(PEERS[0])
+    ring.remove(PEERS[0])
+    assert PEERS[0] not in ring and len(ring) == 3
+
+
+def test_same_ring_in_every_process():
+    ring, other = _ring(PEERS), _ring(reversed(PEERS))
+    assert [ring.lookup(k) for k in KEYS] == [other.lookup(k) for k in KEYS]
+
+
+def test_keys_are_spread():
+    ring = _ring(PEERS)
+    counts = {peer: 0 for peer in PEERS}
+    for key in KEYS:
+        counts[ring.lookup(key)] += 1
+    assert min(counts.values()) > len(KEYS) / len(PEERS) / 2
+
+
+def test_only_the_keys_of_a_new_peer_move():
+    ring = _ring(PEERS[:3])
+    before = {k: ring.lookup(k) for k in KEYS}
+    ring.add(PEERS[3])
+    moved = [k for k in KEYS if ring.lookup(k) != before[k]]
+    assert moved
+    assert all(ring.lookup(k) == PEERS[3] for k in moved)
+    assert len(moved) < len(KEYS) / 2
+
+
+def test_only_the_keys_of_a_leaving_peer_move():
+    ring = _ring(PEERS)
+    before = {k: ring.lookup(k) for k in KEYS}
+    ring.remove(PEERS[0])
+    for key in KEYS:
+        if before[key] != PEERS[0]:
+            assert ring.lookup(key) == before[key]
+
+
+def test_lookup_n():
+    ring = _ring(PEERS)
+    for key in KEYS[:100]:
+        replicas = ring.lookup_n(key, 3)
+        assert len(set(replicas)) == 3
+        assert replicas[0] == ring.lookup(key)
+    assert len(ring.lookup_n("key", 10)) == 4
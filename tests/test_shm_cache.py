@@ -0,0 +1,142 @@
+import os
+import threading
+
+import pytest
+
+import shm_cache
+from protocol import Metadata
+from shm_cache import SharedCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SharedCache("test", size=64 * 1024, root=str(tmp_path))
+
+
+def test_put_get(cache):
+    assert cache.get("a") is None
+    assert cache.put("a", b"value", Metadata(1.5, 5, 2, 1))
+    value, metadata = cache.get("a")
+    assert bytes(value) == b"value"
+    assert metadata == Metadata(1.5, 5, 2, 1)
+
+
+def test_values_are_copy_on_write(cache):
+    cache.put("a", b"value", Metadata(1.0, 5))
+    value, _ = cache.get("a")
+    value[0] = ord("V")
+    assert bytes(cache.get("a")[0]) == b"value"
+
+
+def test_shared_between_instances(cache, tmp_path):
+    cache.put("a", b"value", Metadata(1.0, 5))
+    other = SharedCache("test", root=str(tmp_path))
+    assert bytes(other.get("a")[0]) == b"value"
+
+
+def test_evict_and_clear(cache):
+    cache.put("a", b"1", Metadata(1.0, 1))
+    cache.put("b", b"2", Metadata(1.0, 1))
+    cache.evict("a")
+    cache.evict("a")
+    assert cache.get("a") is None and cache.get("b") is not None
+    cache.clear()
+    assert cache.used == 0
+
+
+def test_least_recently_read_are_evicted(cache):
+    value = bytes(20 * 1024)
+    cache.put("a", value, Metadata(1.0, len(value)))
+    cache.put("b", value, Metadata(1.0, len(value)))
+    # reads touch the modification time, "b" was read last long ago
+    os.utime(cache._file("b"), (1, 1))
+    cache.put("c", value, Metadata(1.0, len(value)))
+    cache.put("d", value, Metadata(1.0, len(value)))
+    assert cache.get("b") is None
+    assert cache.used <= cache.size
+
+
+def test_usage_is_counted(cache, tmp_path):
+    cache.put("a", b"1" * 100, Metadata(1.0, 100))
+    entry = os.stat(cache._file("a")).st_size
+    cache.put("b", b"1" * 100, Metadata(1.0, 100))
+    assert cache.used == 2 * entry
+    # replacing an entry only counts its new size
+    cache.put("a", b"1" * 100, Metadata(2.0, 100))
+    assert cache.used == 2 * entry
+    cache.evict("a")
+    cache.evict("a")
+    assert cache.used == entry
+    assert SharedCache("test", root=str(tmp_path)).used == entry
+
+
+def test_usage_of_an_existing_directory(cache, tmp_path):
+    cache.put("a", b"1" * 100, Metadata(1.0, 100))
+    os.unlink(os.path.join(cache.path, ".lock-usage"))
+    assert SharedCache("test", root=str(tmp_path)).used == os.stat(cache._file("a")).st_size
+
+
+def test_full_cache_is_evicted_down(cache, monkeypatch):
+    scans = []
+    entries = cache._entries
+    monkeypatch.setattr(cache, "_entries", lambda: scans.append(1) or entries())
+    value = bytes(1000)
+    for i in range(200):
+        cache.put(f"k{i}", value, Metadata(1.0, len(value)))
+        assert cache.used <= cache.size
+    assert cache.used == sum(size for _, size, _ in entries())
+    # every scan makes room for a few puts
+    full = cache.size // os.stat(cache._file("k199")).st_size
+    assert len(scans) <= (200 - full) // 5
+
+
+def test_concurrent_puts_keep_to_the_size(cache):
+    value = bytes(10 * 1024)
+    start = threading.Barrier(8)
+
+    def put(index):
+        start.wait()
+        for i in range(20):
+            cache.put(f"{index}-{i}", value, Metadata(1.0, len(value)))
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    on_disk = sum(size for _, size, _ in cache._entries())
+    assert cache.used == on_disk <= cache.size
+
+
+def test_too_large(cache):
+    assert not cache.put("a", bytes(cache.size), Metadata(1.0, cache.size))
+    assert cache.get("a") is None
+
+
+def test_fetch_loads_once(cache):
+    calls = []
+    start = threading.Barrier(4)
+
+    def load():
+        calls.append(1)
+        return b"value", Metadata(1.0, 5)
+
+    def fetch():
+        start.wait()
+        assert bytes(cache.fetch("a", load)[0]) == b"value"
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+
+
+def test_fetch_stale_and_missing(cache):
+    cache.put("a", b"old", Metadata(1.0, 3))
+    value, metadata = cache.fetch("a", lambda: (b"new", Metadata(2.0, 3)), newer_than=1.5)
+    assert bytes(value) == b"new"
+    assert bytes(cache.get("a")[0]) == b"new"
+    assert cache.fetch("b", lambda: (None, None)) == (None, None)
+    assert cache.get("b") is None
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import snapshot
+
+
+def _item(data, timestamp=1.5, version=1, flags=0):
+    array = np.frombuffer(data, dtype=np.uint8)
+    return SimpleNamespace(array=array, size=array.size, timestamp=timestamp, version=version, flags=flags)
+
+
+def test_write_and_load(tmp_path):
+    path = str(tmp_path / "store.snapshot")
+    items = [("a", _item(b"x" * 100, 1.5, 3, 2)), ("ключ", _item(b"")), ("c", _item(bytes(range(256)) * 10))]
+    size = snapshot.write(path, items, workers=2)
+    assert size == (tmp_path / "store.snapshot").stat().st_size
+
+    data, array, entries = snapshot.load(path)
+    assert [e.key for e in entries] == ["a", "ключ", "c"]
+    assert entries[0] == snapshot.Entry("a", entries[0].offset, 100, 1.5, 3, 2)
+    for (_, item), entry in zip(items, entries):
+        assert entry.offset % snapshot.ALIGNMENT == 0
+        assert bytes(array[entry.offset : entry.offset + entry.size]) == bytes(item.array)
+    assert array.flags.writeable is False
+
+
+def test_values_are_split_between_writers(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "PIECE", 4096)
+    path = str(tmp_path / "store.snapshot")
+    value = np.random.default_rng(0).integers(0, 256, 100000, dtype=np.uint8).tobytes()
+    snapshot.write(path, [("a", _item(value))], workers=4)
+    _, array, (entry,) = snapshot.load(path)
+    assert bytes(array[entry.offset : entry.offset + entry.size]) == value
+
+
+def test_replaced_once_complete(tmp_path):
+    path = str(tmp_path / "store.snapshot")
+    snapshot.write(path, [("a", _item(b"old"))])
+    snapshot.write(path, [("b", _item(b"new"))])
+    _, _, entries = snapshot.load(path)
+    assert [e.key for e in entries] == ["b"]
+    assert not (tmp_path / "store.snapshot.tmp").exists()
+
+
+def test_failed_write_keeps_the_previous_snapshot(tmp_path):
+    path = str(tmp_path / "store.snapshot")
+    snapshot.write(path, [("a", _item(b"old"))])
+    broken = SimpleNamespace(array=None, size=10, timestamp=0.0, version=1, flags=0)
+    with pytest.raises(TypeError):
+        snapshot.write(path, [("b", broken)])
+    _, _, entries = snapshot.load(path)
+    assert [e.key for e in entries] == ["a"]
+    assert not (tmp_path / "store.snapshot.tmp").exists()
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / "other"
+    path.write_bytes(b"x" * 100)
+    with pytest.raises(ValueError):
+        snapshot.load(str(path))
+    path.write_bytes(b"x")
+    with pytest.raises(ValueError):
+        snapshot.load(str(path))
+
+
+def test_slab_store_restore(engine, tmp_path):
+    from spill import SpillStore
+    from storage import SlabStore
+
+    path = str(tmp_path / "store.snapshot")
+    store = SlabStore(engine, limit=1024**2, slab_size=64 * 1024, max_class=64 * 1024)
+    for key, fill in (("a", 1), ("b", 2)):
+        item = store.reserve(1000, 1.5, 2)
+        item.array[:] = fill
+        store.commit(key, item)
+    store.commit("a", store.reserve(10))
+    assert store.snapshot(path) == 2
+
+    restored = SlabStore(engine, spill=SpillStore(engine, str(tmp_path / "spill")))
+    item = restored.reserve(5)
+    restored.commit("b", item)
+    assert restored.restore(path) == 1
+    assert restored.peek("a").version == 2 and restored.peek("a").size == 10
+    assert restored.peek("b") is item
+
+    entry = restored.pin("a")
+    assert entry.size == 10
+    restored.unpin(entry)
+
+    with pytest.raises(ValueError):
+        SlabStore(engine).restore(path)
@@ -0,0 +1,162 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pymargo")
+
+from spill import ALIGNMENT  # noqa: E402
+from spill import SpillStore  # noqa: E402
+from storage import SlabStore  # noqa: E402
+
+SEGMENT = 64 * 1024
+
+
+def _value(size, fill=1):
+    return np.full(size, fill, dtype=np.uint8)
+
+
+def _segments(path):
+    return sorted(name for name in os.listdir(path) if name.endswith(".spill"))
+
+
+@pytest.fixture
+def spill(engine, tmp_path):
+    return SpillStore(engine, str(tmp_path), limit=2 * SEGMENT, segment_size=SEGMENT)
+
+
+def test_put_and_pin(spill):
+    assert spill.put("a", _value(1000, 7), 1.5, 3, 2)
+    entry = spill.pin("a")
+    assert (entry.size, entry.timestamp, entry.version, entry.flags) == (1000, 1.5, 3, 2)
+    assert entry.offset % ALIGNMENT == 0
+    assert (entry.array == 7).all()
+    assert entry.hits == 1 and entry.segment.pins == 1
+    spill.unpin(entry)
+    assert entry.segment.pins == 0
+    assert "a" in spill and len(spill) == 1 and spill.used == 1000
+
+
+def test_spilled_again_replaces(spill):
+    spill.put("a", _value(1000, 1), 0.0, 1, 0)
+    spill.put("a", _value(500, 2), 0.0, 2, 0)
+    assert len(spill) == 1 and spill.used == 500
+    assert spill.peek("a").version == 2
+
+
+def test_remove(spill):
+    spill.put("a", _value(1000), 0.0, 1, 0)
+    assert spill.remove("a") is not None
+    assert spill.remove("a") is None
+    assert spill.used == 0
+
+
+def test_oldest_segment_is_dropped(spill, tmp_path):
+    for i in range(6):
+        assert spill.put(f"k{i}", _value(SEGMENT // 2), 0.0, 1, 0)
+    assert spill.allocated <= spill.limit
+    assert len(_segments(tmp_path)) == 2
+    assert "k0" not in spill and "k5" in spill
+    assert spill.evictions == 4
+
+
+def test_pinned_oldest_segment_is_kept(spill):
+    spill.put("k0", _value(SEGMENT // 2), 0.0, 1, 0)
+    spill.put("k1", _value(SEGMENT // 2), 0.0, 1, 0)
+    entry = spill.pin("k0")
+    assert not spill.put("k2", _value(SEGMENT // 2), 0.0, 1, 0)
+    assert (entry.array == 1).all()
+    spill.unpin(entry)
+    assert spill.put("k2", _value(SEGMENT // 2), 0.0, 1, 0)
+    assert "k0" not in spill
+
+
+def test_dead_segments_are_removed(spill, tmp_path):
+    spill.put("k0", _value(SEGMENT // 2), 0.0, 1, 0)
+    spill.put("k1", _value(SEGMENT // 2), 0.0, 1, 0)
+    assert len(_segments(tmp_path)) == 2
+    spill.remove("k0")
+    assert len(_segments(tmp_path)) == 1
+
+
+def test_values_that_cannot_spill(engine, spill):
+    assert not spill.put("a", _value(SEGMENT), 0.0, 1, 0)
+    assert not SpillStore(engine, None).put("a", _value(10), 0.0, 1, 0)
+
+
+def test_directory_is_emptied(engine, tmp_path):
+    (tmp_path / "segment_000001.spill").write_bytes(b"old")
+    SpillStore(engine, str(tmp_path))
+    assert not _segments(tmp_path)
+
+
+def test_slab_store_spills_and_promotes(engine, spill):
+    store = SlabStore(engine, limit=SEGMENT, slab_size=SEGMENT, max_class=SEGMENT, spill=spill, promote_hits=2)
+    for i in range(5):
+        item = store.reserve(SEGMENT // 4)
+        item.array[:] = i
+        store.commit(f"k{i}", item)
+    assert store.spilled == 1 and "k0" in spill
+    assert len(store) == 5
+
+    entry = store.pin("k0")
+    assert entry.segment is not None and (entry.array == 0).all()
+    store.unpin(entry)
+    item = store.pin("k0")
+    assert store.promoted == 1 and "k0" not in spill
+    assert (item.array == 0).all()
+    store.unpin(item)
+
+
+def _fill(store, count, size=SEGMENT // 4):
+    for i in range(count):
+        item = store.reserve(size)
+        item.array[:] = i
+        store.commit(f"k{i}", item)
+
+
+def test_slab_store_spills_outside_its_lock(engine, spill, monkeypatch):
+    store = SlabStore(engine, limit=SEGMENT, slab_size=SEGMENT, max_class=SEGMENT, spill=spill)
+    _fill(store, 4)
+    put = spill.put
+    seen = []
+
+    def spilling(key, *args):
+        # another thread can take the lock and read the value meanwhile
+        def read():
+            entry = store.pin(key)
+            seen.append((entry.array == 0).all())
+            store.unpin(entry)
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+        return put(key, *args)
+
+    monkeypatch.setattr(spill, "put", spilling)
+    store.commit("new", store.reserve(SEGMENT // 4))
+    assert seen == [True]
+    assert store.spilled == 1 and "k0" in spill and store.peek("k0") is spill.peek("k0")
+    assert store.used == 4 * (SEGMENT // 4)
+
+
+def test_slab_store_victim_replaced_while_spilled(engine, spill, monkeypatch):
+    store = SlabStore(engine, limit=2 * SEGMENT, slab_size=SEGMENT, max_class=SEGMENT, spill=spill)
+    _fill(store, 4)
+    new = store.reserve(10)
+    new.array[:] = 9
+    put = spill.put
+
+    def spilling(key, *args):
+        store.commit(key, new)
+        return put(key, *args)
+
+    monkeypatch.setattr(spill, "put", spilling)
+    store.reserve(SEGMENT // 4)
+    # the stale copy is dropped, the new value stays
+    assert "k0" not in spill and store.spilled == 0 and store.evictions == 1
+    entry = store.pin("k0")
+    assert entry is new and entry.version == 2 and (entry.array == 9).all()
+    store.unpin(entry)
@@ -0,0 +1,116 @@
+import pytest
+
+pytest.importorskip("pymargo")
+
+from storage import SlabStore  # noqa: E402
+
+SLAB = 64 * 1024
+
+
+def _put(store, key, size, fill=1):
+    item = store.reserve(size, 1.5, 2)
+    item.array[:] = fill
+    store.commit(key, item)
+    return item
+
+
+def test_reserve_is_invisible_until_commit(engine):
+    store = SlabStore(engine, limit=4 * SLAB, slab_size=SLAB, max_class=SLAB)
+    item = store.reserve(100, 1.5, 2)
+    assert item.size == 100
+    assert item.slab.chunk == 128
+    assert "a" not in store
+
+    store.commit("a", item)
+    assert "a" in store and len(store) == 1
+    assert store.peek("a") is item
+    assert (item.version, item.timestamp, item.flags) == (1, 1.5, 2)
+    assert store.used == 100
+
+    replaced = _put(store, "a", 200)
+    assert replaced.version == 2
+    assert store.used == 200
+
+
+def test_abort_frees_the_chunk(engine):
+    store = SlabStore(engine, limit=4 * SLAB, slab_size=SLAB, max_class=SLAB)
+    item = store.reserve(100)
+    store.abort(item)
+    assert store.reserve(100).offset == item.offset
+    assert len(store) == 0
+
+
+def test_delete(engine):
+    store = SlabStore(engine, limit=4 * SLAB, slab_size=SLAB, max_class=SLAB)
+    _put(store, "a", 100)
+    assert store.delete("a")
+    assert not store.delete("a")
+    assert store.used == 0
+
+
+def test_lru_eviction(engine):
+    store = SlabStore(engine, limit=SLAB, slab_size=SLAB, max_class=SLAB)
+    for i in range(4):
+        _put(store, f"k{i}", SLAB // 4)
+    store.get("k0")
+    _put(store, "k4", SLAB // 4)
+    assert sorted(store.keys()) == ["k0", "k2", "k3", "k4"]
+    assert store.evictions == 1
+    assert store.allocated <= store.limit
+
+
+def test_lfu_eviction(engine):
+    store = SlabStore(engine, limit=SLAB, slab_size=SLAB, max_class=SLAB, policy="lfu")
+    for i in range(4):
+        _put(store, f"k{i}", SLAB // 4)
+    for key in ("k0", "k0", "k1", "k3"):
+        store.get(key)
+    _put(store, "k4", SLAB // 4)
+    assert "k2" not in store
+
+
+def test_pinned_items_are_not_evicted(engine):
+    store = SlabStore(engine, limit=SLAB, slab_size=SLAB, max_class=SLAB)
+    for i in range(4):
+        _put(store, f"k{i}", SLAB // 4)
+    pinned = store.pin("k0")
+    _put(store, "k4", SLAB // 4)
+    assert "k0" in store and "k1" not in store
+    store.unpin(pinned)
+
+
+def test_pinned_chunk_outlives_delete(engine):
+    store = SlabStore(engine, limit=4 * SLAB, slab_size=SLAB, max_class=SLAB)
+    _put(store, "a", 100, fill=7)
+    pinned = store.pin("a")
+    store.delete("a")
+    assert pinned.dead
+    other = store.reserve(100)
+    assert other.offset != pinned.offset or other.slab is not pinned.slab
+    assert (pinned.array == 7).all()
+    store.abort(other)
+
+    store.unpin(pinned)
+    assert store.reserve(100).offset == pinned.offset
+
+
+def test_dedicated_arenas(engine):
+    store = SlabStore(engine, limit=4 * SLAB, slab_size=SLAB, max_class=SLAB // 2)
+    item = _put(store, "big", SLAB)
+    assert item.slab.size == SLAB
+    assert store.allocated == SLAB
+    store.delete("big")
+    assert store.allocated == 0
+
+
+def test_too_large(engine):
+    store = SlabStore(engine, limit=SLAB, slab_size=SLAB, max_class=SLAB)
+    with pytest.raises(MemoryError):
+        store.reserve(2 * SLAB)
+
+
+def test_bad_arguments(engine):
+    with pytest.raises(ValueError):
+        SlabStore(engine, policy="fifo")
+    with pytest.raises(ValueError):
+        SlabStore(engine, slab_size=SLAB, max_class=2 * SLAB)